@@ -0,0 +1,55 @@
+# Molecular Dynamics with spatial domain decomposition.
+#
+# Run this with several MPI processes, e.g.
+#     mpirun -np 4 mmtkpython domains.py
+#
+# Each process integrates the atoms in one slab of the simulation box
+# and exchanges only the coordinates of the atoms near the slab
+# boundaries with the other processes. For comparison, the same
+# trajectory is then computed with the standard MPI parallelization,
+# in which every process integrates all atoms.
+#
+
+from MMTK import *
+from MMTK.ForceFields import LennardJonesForceField
+from MMTK.Dynamics import VelocityVerletIntegrator
+from MMTK.Trajectory import StandardLogOutput
+from Scientific.Geometry.Objects3D import SCLattice
+from Scientific.MPI import world
+from Scientific import N
+
+# A box of argon atoms. The random velocities are generated on each
+# process, so they are replaced by those of process 0.
+cutoff = 0.8*Units.nm
+universe = OrthorhombicPeriodicUniverse((6., 6., 6.),
+                                        LennardJonesForceField(cutoff))
+for point in SCLattice(0.4, 15):
+    universe.addObject(Atom('Ar', position=point-Vector(3., 3., 3.)))
+universe.initializeVelocitiesToTemperature(100.*Units.K)
+initial = universe.copyConfiguration()
+world.broadcast(universe.velocities().array, 0)
+initial_velocities = universe.velocities().copy()
+
+if world.rank == 0:
+    output_actions = [StandardLogOutput(50)]
+else:
+    output_actions = []
+
+# Domain decomposition, with a skin of 0.2 nm around the cutoff sphere
+integrator = VelocityVerletIntegrator(universe, delta_t=5.*Units.fs,
+                                      mpi_communicator=world,
+                                      domain_decomposition=0.2*Units.nm)
+integrator(steps=200, actions=output_actions)
+x_dd = universe.configuration().array.copy()
+
+# The same trajectory with replicated data
+universe.setConfiguration(initial)
+universe.setVelocities(initial_velocities)
+integrator = VelocityVerletIntegrator(universe, delta_t=5.*Units.fs,
+                                      mpi_communicator=world)
+integrator(steps=200, actions=output_actions)
+x_rd = universe.configuration().array
+
+if world.rank == 0:
+    print "Largest coordinate difference:", \
+          N.maximum.reduce(N.fabs(N.ravel(x_dd-x_rd)))
@@ -9,10 +9,10 @@
 
 from MMTK import *
 from MMTK.Trajectory import Trajectory
-from MMTK.DCD import writeDCDPDB
+from MMTK.DCD import writeTrajectoryDCDPDB
 
 
 trajectory = Trajectory(None, "rotation.nc")
 universe = trajectory.universe
 
-writeDCDPDB(trajectory.configuration, 'rotation.dcd', 'rotation.pdb')
+writeTrajectoryDCDPDB(trajectory, 'rotation.dcd', 'rotation.pdb')
@@ -41,8 +41,31 @@ typedef struct {
   int natoms;
   int thread_id, proc_id, slice_id, nthreads, nprocs, nslices;
   int small_change;
+  int *atom_owner;
 } energy_spec;
 
+/* Spatial domain decomposition: the part of the state that the
+   integrators need. owner[i] is the MPI rank of the process that
+   integrates atom i. */
+
+typedef struct {
+  int *owner;
+  int proc_id, nprocs;
+  int active;
+} domain_info;
+
+enum domain_update_modes { domain_start, domain_step,
+                           domain_sync, domain_finish };
+
+/* Test if an interaction whose reference atom is i is evaluated
+   by this process. */
+#define DOMAIN_OWNS(input, i) \
+  ((input)->atom_owner == NULL || (input)->atom_owner[i] == (input)->proc_id)
+
+/* Pair interactions are evaluated by the owner of the lower index */
+#define DOMAIN_OWNS_PAIR(input, i, j) \
+  DOMAIN_OWNS(input, ((i) < (j)) ? (i) : (j))
+
 struct ffedata;
 struct ffterm;
 struct ffeval;
@@ -116,7 +139,7 @@ typedef struct ffterm {
   int index, virial_index, barrier_index;
   int nterms, nbarriers;
   int n;
-  int threaded, parallelized, thread_safe;
+  int threaded, parallelized, thread_safe, domain_safe;
 } PyFFEnergyTermObject;
 
 /* Evaluator object structure */
@@ -141,6 +164,8 @@ typedef struct ffeval {
 #endif
   int nterms, ntermobjects;
   int nthreads, nprocs, nslices, proc_id;
+  void *process_pool;
+  domain_info *domain;
 } PyFFEvaluatorObject;
 
 /* Non-bonded list object structure */
@@ -300,8 +325,21 @@ typedef struct sparse_fc {
                                                       *iterator))
 #define PyNonbondedListIterate_NUM 15
 
+/* Spatial domain decomposition: exchange or synchronize atom data */
+#define PyFFEvaluator_DomainUpdate_RET int
+#define PyFFEvaluator_DomainUpdate_PROTO \
+        Py_PROTO((PyFFEvaluatorObject *evaluator, int mode, int natoms, \
+                  vector3 *x, vector3 *v, vector3 *g))
+#define PyFFEvaluator_DomainUpdate_NUM 16
+
+/* Spatial domain decomposition: sum values over all processes */
+#define PyFFEvaluator_DomainSum_RET int
+#define PyFFEvaluator_DomainSum_PROTO \
+        Py_PROTO((PyFFEvaluatorObject *evaluator, double *data, int n))
+#define PyFFEvaluator_DomainSum_NUM 17
+
 /* Total number of C API pointers */
-#define PyFF_API_pointers 16
+#define PyFF_API_pointers 18
 
 
 #ifdef _FORCEFIELD_MODULE
@@ -335,6 +373,10 @@ extern PyNonbondedListUpdate_RET PyNonbondedListUpdate \
        PyNonbondedListUpdate_PROTO;
 extern PyNonbondedListIterate_RET PyNonbondedListIterate \
        PyNonbondedListIterate_PROTO;
+extern PyFFEvaluator_DomainUpdate_RET PyFFEvaluator_DomainUpdate \
+       PyFFEvaluator_DomainUpdate_PROTO;
+extern PyFFEvaluator_DomainSum_RET PyFFEvaluator_DomainSum \
+       PyFFEvaluator_DomainSum_PROTO;
 
 #else
 
@@ -394,6 +436,12 @@ static void **PyFF_API;
 #define PyNonbondedListIterate \
   (*(PyNonbondedListIterate_RET (*)PyNonbondedListIterate_PROTO) \
    PyFF_API[PyNonbondedListIterate_NUM])
+#define PyFFEvaluator_DomainUpdate \
+  (*(PyFFEvaluator_DomainUpdate_RET (*)PyFFEvaluator_DomainUpdate_PROTO) \
+   PyFF_API[PyFFEvaluator_DomainUpdate_NUM])
+#define PyFFEvaluator_DomainSum \
+  (*(PyFFEvaluator_DomainSum_RET (*)PyFFEvaluator_DomainSum_PROTO) \
+   PyFF_API[PyFFEvaluator_DomainSum_NUM])
 
 #endif
 
@@ -47,6 +47,9 @@ nblist_update(PyNonbondedListObject *nblist, int natoms,
 int
 nblist_iterate(PyNonbondedListObject *nblist,
 	       struct nblist_iterator *iterator);
+int
+nonbonded_load(PyFFEnergyTermObject *self, int nthreads,
+	       double *pairs, double *seconds);
 
 ff_eterm_function nonbonded_evaluator;
 ff_eterm_function lennard_jones_evaluator;
@@ -50,6 +50,7 @@ typedef struct {
   int cycle;
   int first_step;
   int write;
+  void *writer;
 } PyTrajectoryObject;
 
 extern PyTypeObject PyTrajectory_Type;
@@ -70,7 +71,8 @@ enum PyTrajectory_DataClass { PyTrajectory_Configuration = 1,
 			      PyTrajectory_Thermodynamic = 16,
 			      PyTrajectory_Time = 32,
                               PyTrajectory_Internal = 64,
-			      PyTrajectory_Auxiliary = 128 };
+			      PyTrajectory_Auxiliary = 128,
+			      PyTrajectory_Performance = 256 };
 
 typedef struct {
   char *name;
@@ -103,6 +105,8 @@ typedef struct {
   int type;
   int close;
   int what;
+  void *writer;
+  int nogil;
 } PyTrajectoryOutputSpec;
 
 
@@ -149,8 +153,15 @@ typedef struct {
 	       PyTrajectoryVariable *data, PyThreadState **thread))
 #define PyTrajectory_Output_NUM 5
 
+/* Declare a trajectory function safe to call without the global
+   interpreter lock, except for initialization and cleanup */
+#define PyTrajectory_RegisterFunction_RET int
+#define PyTrajectory_RegisterFunction_PROTO \
+     Py_PROTO((trajectory_fn *function))
+#define PyTrajectory_RegisterFunction_NUM 6
+
 /* Total number of C API pointers */
-#define PyTrajectory_API_pointers 6
+#define PyTrajectory_API_pointers 7
 
 
 #ifdef _TRAJECTORY_MODULE
@@ -170,6 +181,8 @@ static PyTrajectory_OutputFinish_RET PyTrajectory_OutputFinish \
        PyTrajectory_OutputFinish_PROTO;
 static PyTrajectory_Output_RET PyTrajectory_Output \
        PyTrajectory_Output_PROTO;
+static PyTrajectory_RegisterFunction_RET PyTrajectory_RegisterFunction \
+       PyTrajectory_RegisterFunction_PROTO;
 
 #else
 
@@ -199,6 +212,10 @@ static void **PyTrajectory_API;
   (*(PyTrajectory_Output_RET \
      (*)PyTrajectory_Output_PROTO) \
    PyTrajectory_API[PyTrajectory_Output_NUM])
+#define PyTrajectory_RegisterFunction \
+  (*(PyTrajectory_RegisterFunction_RET \
+     (*)PyTrajectory_RegisterFunction_PROTO) \
+   PyTrajectory_API[PyTrajectory_RegisterFunction_NUM])
 
 #endif
 
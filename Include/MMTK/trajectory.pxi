@@ -22,6 +22,7 @@ cdef extern from "MMTK/trajectory.h":
         PyTrajectory_Time
         PyTrajectory_Internal
         PyTrajectory_Auxiliary
+        PyTrajectory_Performance
 
     cdef union data:
         int *ip
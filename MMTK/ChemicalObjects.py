@@ -847,6 +847,10 @@ class Molecule(CompositeChemicalObject, ChemicalObject):
         data. It was developed for proteins and DNA and may not give
         good results for other molecules. It raises an exception
         if presented with a topology it cannot handle.
+
+        The atoms that need hydrogens are first classified by their
+        bonding pattern. The hydrogen positions for all atoms of a
+        pattern are then computed together using array operations.
         """
         self.setBondAttributes()
         try:
@@ -858,6 +862,8 @@ class Molecule(CompositeChemicalObject, ChemicalObject):
                                           ' is undefined')
                     bonded = a.bondedTo()[0]
                     unknown.setdefault(bonded, []).append(a)
+            patterns = []
+            cases = {}
             for a, list in unknown.items():
                 bonded = a.bondedTo()
                 n = len(bonded)
@@ -869,7 +875,12 @@ class Molecule(CompositeChemicalObject, ChemicalObject):
                     raise ValueError("Can't handle this yet: " +
                                       a.symbol + ' with ' + `n` + ' bonds (' +
                                       a.fullName() + ').')
-                method(self, a, known, list)
+                if not cases.has_key(method):
+                    patterns.append(method)
+                    cases[method] = []
+                cases[method].append((a, known, list))
+            for method in patterns:
+                _findHydrogenPositions(self, method, cases[method])
         finally:
             self.clearBondAttributes()
 
@@ -1259,3 +1270,226 @@ class AtomCluster(CompositeChemicalObject, ChemicalObject):
                                              index_map[c[1].index], c[2])
             s = s + ']'
         return s + ')'
+
+#
+# Hydrogen placement for many atoms of the same bonding pattern.
+# The functions below follow step by step the geometrical
+# constructions of the Molecule methods _C4oneH etc., which are
+# based on Scientific.Geometry.Objects3D, but operate on arrays of
+# shape (n, 3). Cases for which the construction is degenerate
+# (zero-length normals, parallel planes, no intersection) are marked
+# as invalid and handled by the original method.
+#
+def _findHydrogenPositions(molecule, method, cases):
+    try:
+        batch, parameters = _h_batch_methods[getattr(method, 'im_func',
+                                                     method)]
+    except KeyError:
+        for atom, known, unknown in cases:
+            method(molecule, atom, known, unknown)
+        return
+    import numpy
+    parameters = [getattr(molecule, p) if isinstance(p, str) else p
+                  for p in parameters]
+    error_state = numpy.seterr(all='ignore')
+    try:
+        positions = batch(cases, *parameters)
+    finally:
+        numpy.seterr(**error_state)
+    valid = numpy.logical_and.reduce(numpy.isfinite(positions), -1)
+    valid = numpy.logical_and.reduce(valid, -1)
+    for i in range(len(cases)):
+        atom, known, unknown = cases[i]
+        if valid[i]:
+            for h, position in zip(unknown, positions[i]):
+                h.setPosition(Vector(position))
+        else:
+            method(molecule, atom, known, unknown)
+
+def _positionArray(atoms):
+    return N.array([atom.position().array for atom in atoms])
+
+def _otherHeavyAtom(atom, known):
+    return filter(lambda a: a.symbol != 'H', known[0].bondedTo())[0]
+
+def _dot(v1, v2):
+    return N.add.reduce(v1*v2, -1)
+
+def _cross(v1, v2):
+    return N.transpose(N.array([v1[:, 1]*v2[:, 2]-v1[:, 2]*v2[:, 1],
+                                v1[:, 2]*v2[:, 0]-v1[:, 0]*v2[:, 2],
+                                v1[:, 0]*v2[:, 1]-v1[:, 1]*v2[:, 0]]))
+
+def _normal(v):
+    length = N.sqrt(N.add.reduce(v*v, -1))
+    # A zero length yields non-finite values, marking the case invalid
+    return v/length[..., N.NewAxis]
+
+def _scale(s, v):
+    return s[:, N.NewAxis]*v
+
+def _rotateDirection(v, axis, angle):
+    s = N.sin(angle)
+    c = N.cos(angle)
+    c1 = 1-c
+    return _cross(axis, v)*s + _scale(_dot(axis, v), axis)*c1 + v*c
+
+def _rotatePoint(p, point, axis, angle):
+    return point + _rotateDirection(p-point, axis, angle)
+
+def _planeFromPoints(p1, p2, p3):
+    normal = _normal(_cross(p2-p1, p3-p2))
+    return normal, _dot(normal, p2)
+
+def _rotatePlane(plane, point, axis, angle):
+    normal, distance = plane
+    axis = _normal(axis)
+    p = _rotatePoint(_scale(distance, normal), point, axis, angle)
+    normal = _normal(_rotateDirection(normal, axis, angle))
+    return normal, _dot(normal, p)
+
+def _sphereConeCircle(center, radius, axis, angle):
+    axis = _normal(axis)
+    return center+axis*(radius*N.cos(angle)), axis, radius*N.sin(angle)
+
+def _circlePlanePoints(circle, plane):
+    center, circle_normal, radius = circle
+    plane_normal, distance = plane
+    normal2 = _normal(circle_normal)
+    parallel = N.logical_or(
+        N.fabs(N.fabs(_dot(circle_normal, plane_normal))-1.) < 1.e-16,
+        N.fabs(N.fabs(_dot(plane_normal, normal2))-1.) < 1.e-16)
+    distance2 = _dot(normal2, center)
+    direction = _normal(_cross(plane_normal, normal2))
+    point_in_1 = _scale(distance, plane_normal)
+    point = point_in_1 - _scale(_dot(point_in_1, normal2)-distance2, normal2)
+    def distanceFromLine(p):
+        d = point-p
+        d = d - _scale(_dot(d, direction), direction)
+        return N.sqrt(_dot(d, d))
+    x = distanceFromLine(center)
+    # arccos yields NaN if there is no intersection
+    along_line = N.sin(N.arccos(x/radius))*radius
+    normal = _cross(circle_normal, direction)
+    flip = distanceFromLine(center+normal) > x
+    normal = N.where(flip[:, N.NewAxis], -normal, normal)
+    middle = center + _scale(x, normal)
+    offset = _scale(along_line, direction)
+    p1 = middle - offset
+    p2 = middle + offset
+    invalid = N.logical_or(parallel, x > radius)
+    p1[invalid] = N.nan
+    p2[invalid] = N.nan
+    return p1, p2
+
+def _sumH(cases, bond):
+    r = _positionArray([case[0] for case in cases])
+    nknown = len(cases[0][1])
+    directions = [_normal(_positionArray([case[1][i] for case in cases])-r)
+                  for i in range(nknown)]
+    n = _normal(reduce(lambda a, b: a+b, directions))
+    return (r-bond*n)[:, N.NewAxis, :]
+
+def _linearH(cases, bond):
+    r = _positionArray([case[0] for case in cases])
+    r1 = _positionArray([case[1][0] for case in cases])
+    return (r+bond*_normal(r-r1))[:, N.NewAxis, :]
+
+def _perpendicularPlaneH(cases, bond, angle):
+    r = _positionArray([case[0] for case in cases])
+    r1 = _positionArray([case[1][0] for case in cases])
+    r2 = _positionArray([case[1][1] for case in cases])
+    axis = -_normal((r1-r)+(r2-r))
+    plane = _rotatePlane(_planeFromPoints(r, r1, r2), r, axis,
+                         90.*Units.deg)
+    circle = _sphereConeCircle(r, bond, axis, 0.5*angle)
+    return N.transpose(N.array(_circlePlanePoints(circle, plane)), (1, 0, 2))
+
+def _planeH(cases, bond, angle, count):
+    r = _positionArray([case[0] for case in cases])
+    r1 = _positionArray([case[1][0] for case in cases])
+    r2 = _positionArray([_otherHeavyAtom(*case[:2]) for case in cases])
+    plane = _planeFromPoints(r, r1, r2)
+    circle = _sphereConeCircle(r, bond, _normal(r-r1), 0.5*angle)
+    points = _circlePlanePoints(circle, plane)[:count]
+    return N.transpose(N.array(points), (1, 0, 2))
+
+def _tetrahedralH(cases, bond):
+    r = _positionArray([case[0] for case in cases])
+    r1 = _positionArray([case[1][0] for case in cases])
+    others = []
+    for atom, known, unknown in cases:
+        heavy = filter(lambda a: a.symbol != 'H', known[0].bondedTo())
+        heavy.remove(atom)
+        others.append(heavy[0])
+    other = _positionArray(others)
+    center, normal, radius = _sphereConeCircle(r, bond, _normal(r1-r),
+                                               N.arccos(-1./3.))
+    plane_normal = _normal(normal)
+    projection = other - _scale(_dot(plane_normal, other)
+                                - _dot(plane_normal, center), plane_normal)
+    ref = _normal(projection-center)
+    axis = _normal(normal)
+    p0 = center + ref*radius
+    p0 = _rotatePoint(p0, center, axis, 60.*Units.deg)
+    p1 = _rotatePoint(p0, center, axis, 120.*Units.deg)
+    p2 = _rotatePoint(p1, center, axis, 120.*Units.deg)
+    return N.transpose(N.array([p0, p1, p2]), (1, 0, 2))
+
+def _dihedralH(cases, bond, angle, dihedral, third_atom):
+    a1 = _positionArray([case[0] for case in cases])
+    a2 = _positionArray([case[1][0] for case in cases])
+    a3 = []
+    for atom, known, unknown in cases:
+        p = third_atom(atom, known)
+        if p is None:
+            a3.append(3*[N.nan])
+        else:
+            a3.append(p.array)
+    a3 = N.array(a3)
+    circle = _sphereConeCircle(a1, bond, a2-a1, angle)
+    plane = _rotatePlane(_planeFromPoints(a3, a2, a1), a1, a2-a1, dihedral)
+    p1, p2 = _circlePlanePoints(circle, plane)
+    # The first point on the correct side is used. If there is none,
+    # the case is marked invalid, and the original method will
+    # leave the position undefined as well.
+    side1 = _dot(_cross(a1-a2, p1-a1), plane[0]) > 0
+    side2 = _dot(_cross(a1-a2, p2-a1), plane[0]) > 0
+    p = N.where(side1[:, N.NewAxis], p1, p2)
+    p[N.logical_not(N.logical_or(side1, side2))] = N.nan
+    p[N.logical_not(N.isfinite(p1[:, 0]))] = N.nan
+    return p[:, N.NewAxis, :]
+
+def _O2Neighbor(atom, known):
+    for a in known[0].bondedTo():
+        r = a.position()
+        if a != atom and r is not None: break
+    return r
+
+def _S2Neighbor(atom, known):
+    return filter(lambda a: a.symbol == 'C',
+                  known[0].bondedTo())[0].position()
+
+_h_batch_methods = {
+    '_C4oneH': (_sumH, ('_ch_bond',)),
+    '_N4oneH': (_sumH, ('_nh_bond',)),
+    '_C3oneH': (_sumH, ('_ch_bond',)),
+    '_N3oneH': (_sumH, ('_nh_bond',)),
+    '_C2oneH': (_linearH, ('_ch_bond',)),
+    '_C4twoH': (_perpendicularPlaneH, ('_ch_bond', '_hch_angle')),
+    '_N4twoH': (_perpendicularPlaneH, ('_nh_bond', '_hnh_angle')),
+    '_C3twoH': (_planeH, ('_ch_bond', '_hch_angle', 2)),
+    '_N3twoH': (_planeH, ('_nh_bond', '_hnh_angle', 2)),
+    '_N2oneH': (_planeH, ('_nh_bond', '_hch_angle', 1)),
+    '_C4threeH': (_tetrahedralH, ('_ch_bond',)),
+    '_N4threeH': (_tetrahedralH, ('_nh_bond',)),
+    '_O2': (_dihedralH, ('_oh_bond', '_coh_angle', 180.*Units.deg,
+                         _O2Neighbor)),
+    '_S2': (_dihedralH, ('_sh_bond', '_csh_angle', 180.*Units.deg,
+                         _S2Neighbor)),
+    }
+# The table is keyed by the function objects rather than by their names,
+# such that methods with the same name defined elsewhere (e.g. in
+# subclasses) are never mistaken for the ones the batch code reproduces.
+_h_batch_methods = dict((getattr(Molecule, name).im_func, value)
+                        for name, value in _h_batch_methods.items())
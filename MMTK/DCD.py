@@ -18,8 +18,9 @@ format and is therefore platform-dependent.
 __docformat__ = 'restructuredtext'
 
 import MMTK_DCD
-from MMTK import PDB, Trajectory, Units
+from MMTK import PDB, ParticleProperties, Trajectory, Units, Utility
 from Scientific import N
+import os, struct, time
 
 
 class DCDReader(Trajectory.TrajectoryGenerator):
@@ -67,6 +68,299 @@ class DCDReader(Trajectory.TrajectoryGenerator):
         MMTK_DCD.readDCD(self.universe, configuration.array,
                          self.getActions(), self.getOption('dcd_file'))
 
+
+
+class DCDTrajectory(object):
+
+    """
+    Random-access reader for DCD trajectories (CHARMM/X-Plor/NAMD)
+
+    A DCDTrajectory object provides the read operations of a
+    :class:`~MMTK.Trajectory.Trajectory` object for data stored
+    in a DCD file, without converting the file first:
+
+     * len(t) is the number of steps
+     * t[i] is the data for step i, in the form of a dictionary
+       with the entries "configuration", "time", "step", and
+       "box_size" if the file contains unit cell data
+     * t[i:j] and t[i:j:n] return a
+       :class:`~MMTK.Trajectory.SubTrajectory` object
+     * t.configuration is a variable that can be indexed by step
+     * t.time and t.step are arrays
+     * t.readParticleTrajectory(atom) reads the trajectory of a
+       single atom
+
+    The file is memory-mapped, so only the data that is actually
+    used is read from disk. The universe must be compatible with the
+    DCD file, as for :class:`~MMTK.DCD.DCDReader`. DCD files with
+    fixed atoms are not supported. Unit cell data is used only for
+    orthorhombic universes.
+    """
+
+    def __init__(self, universe, filename, atom_order=None):
+        """
+        :param universe: the universe for which the information from the
+                         trajectory file is read
+        :param filename: the name of the DCD file
+        :type filename: str
+        :param atom_order: the universe atom index for each atom in the
+                           DCD file, as in :func:`~MMTK.DCD.writeDCD`.
+                           The default (None) is identical numbering.
+                           Atoms that are not listed have undefined
+                           positions.
+        :type atom_order: sequence of int
+        """
+        import numpy
+        self.universe = universe
+        self.filename = os.path.expanduser(filename)
+        header = _readDCDHeader(self.filename)
+        self.natoms = header['natoms']
+        byteorder = header['byteorder']
+        fields = []
+        if header['unit_cell']:
+            fields.extend([('cell_begin', byteorder+'i4'),
+                           ('cell', byteorder+'f8', (6,)),
+                           ('cell_end', byteorder+'i4')])
+        for name in 'xyz':
+            fields.extend([(name+'_begin', byteorder+'i4'),
+                           (name, byteorder+'f4', (self.natoms,)),
+                           (name+'_end', byteorder+'i4')])
+        frame_type = numpy.dtype(fields)
+        size = os.path.getsize(self.filename)
+        nframes = (size-header['size'])/frame_type.itemsize
+        if nframes > 0:
+            self.frames = numpy.memmap(self.filename, frame_type, 'r',
+                                       header['size'], (nframes,))
+        else:
+            self.frames = numpy.zeros((0,), frame_type)
+        if atom_order is None:
+            if self.natoms != universe.numberOfAtoms():
+                raise ValueError("number of atoms in DCD file (%d) doesn't "
+                                 "match universe (%d)"
+                                 % (self.natoms, universe.numberOfAtoms()))
+            self.atom_order = None
+            self.atom_rows = None
+        else:
+            self.atom_order = N.array(atom_order)
+            if len(self.atom_order) != self.natoms:
+                raise ValueError("atom_order doesn't match DCD file")
+            self.atom_rows = {}
+            for i in range(self.natoms):
+                self.atom_rows[int(self.atom_order[i])] = i
+        self.step = header['istart'] + header['nsavc']*N.arange(nframes)
+        self.time = header['nsavc']*header['delta']*Units.akma_time \
+                    * N.arange(nframes)
+        self.unit_cell = header['unit_cell'] \
+                         and universe.is_periodic \
+                         and len(universe.cellParameters()) == 3
+        self.vars = ['configuration', 'time', 'step']
+        if self.unit_cell:
+            self.vars.append('box_size')
+        self.particle_trajectory_reader = self._readParticleTrajectory
+
+    def close(self):
+        """
+        Close the DCD file. No data access is possible after closing.
+        """
+        self.frames = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, item):
+        if not isinstance(item, int):
+            return Trajectory.SubTrajectory(self, N.arange(len(self)))[item]
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError
+        data = {'configuration': self._configuration(item),
+                'time': self.time[item],
+                'step': self.step[item]}
+        if self.unit_cell:
+            data['box_size'] = data['configuration'].cell_parameters
+        return data
+
+    def __getslice__(self, first, last):
+        return self[(slice(first, last),)]
+
+    def __getattr__(self, name):
+        if name == 'configuration':
+            return DCDConfigurationVariable(self)
+        if name == 'box_size' and self.unit_cell:
+            return self._boxSize(slice(None))
+        raise AttributeError("no variable named " + name)
+
+    def variables(self):
+        """
+        :returns: a list of the names of all variables that are stored
+                  in the trajectory
+        :rtype: list of str
+        """
+        return self.vars
+
+    def readParticleTrajectory(self, atom, first=0, last=None, skip=1,
+                               variable = "configuration"):
+        """
+        Read trajectory information for a single atom but for multiple
+        time steps. Only the data for the requested atom is read from
+        the file.
+
+        :param atom: the atom whose trajectory is requested
+        :type atom: :class:`~MMTK.ChemicalObjects.Atom`
+        :param first: the number of the first step to be read
+        :type first: int
+        :param last: the number of the first step not to be read.
+                     A value of None indicates that the
+                     whole trajectory should be read.
+        :type last: int
+        :param skip: the number of steps to skip between two steps read
+        :type skip: int
+        :param variable: "configuration" (made continuous by eliminating
+                         all jumps caused by periodic boundary conditions)
+                         or "box_coordinates"
+        :type variable: str
+        :returns: the trajectory for a single atom
+        :rtype: :class:`~MMTK.Trajectory.ParticleTrajectory`
+        """
+        return Trajectory.ParticleTrajectory(self, atom, first, last, skip,
+                                             variable)
+
+    def readRigidBodyTrajectory(self, object, first=0, last=None, skip=1,
+                                reference = None):
+        return Trajectory.RigidBodyTrajectory(self, object, first, last, skip,
+                                              reference)
+
+    def _boxSize(self, steps):
+        # CHARMM stores the unit cell as (a, gamma, b, beta, alpha, c)
+        return N.array(self.frames['cell'][steps][..., [0, 2, 5]]
+                       .astype(N.Float))*Units.Ang
+
+    def _configuration(self, item):
+        frame = self.frames[item]
+        array = N.transpose(N.array([frame['x'], frame['y'], frame['z']])) \
+                .astype(N.Float)*Units.Ang
+        if self.atom_order is not None:
+            conf = N.zeros((self.universe.numberOfAtoms(), 3), N.Float) \
+                   + Utility.undefined
+            N.put(conf, (3*self.atom_order[:, N.NewAxis]
+                         + N.arange(3)[N.NewAxis, :]).ravel(), array.ravel())
+            array = conf
+        if self.unit_cell:
+            box = self._boxSize(item)
+        else:
+            box = None
+        return ParticleProperties.Configuration(self.universe, array, box)
+
+    def _readParticleTrajectory(self, atom, variable, first, last, skip,
+                                correct, box):
+        if variable != 'configuration':
+            raise ValueError("variable not in trajectory")
+        if isinstance(atom, int):
+            index = atom
+        else:
+            index = atom.index
+            if atom.universe() is not self.universe:
+                raise ValueError("objects not in the same universe")
+        if self.atom_rows is None:
+            row = index
+        else:
+            try:
+                row = self.atom_rows[index]
+            except KeyError:
+                raise ValueError("atom %d not stored in trajectory" % index)
+        steps = slice(first, last, skip)
+        data = N.transpose(N.array([self.frames['x'][steps, row],
+                                    self.frames['y'][steps, row],
+                                    self.frames['z'][steps, row]])) \
+               .astype(N.Float)*Units.Ang
+        if not self.universe.is_periodic or not (correct or box):
+            return data
+        if self.unit_cell:
+            self.recently_read_box_size = self._boxSize(steps)
+        else:
+            self.recently_read_box_size = None
+        data = self.universe._realToBoxPointArray(data,
+                                                  self.recently_read_box_size)
+        if correct:
+            jumps = N.floor(data[1:]-data[:-1]+0.5)
+            data[1:] -= N.add.accumulate(jumps)
+        if not box:
+            data = self.universe._boxToRealPointArray(data,
+                                                  self.recently_read_box_size)
+        return data
+
+    def _boxTransformation(self, pt_in, pt_out, to_box=0):
+        try:
+            box_size = self.recently_read_box_size
+        except AttributeError:
+            return
+        if to_box:
+            pt_out[:] = self.universe._realToBoxPointArray(pt_in, box_size)
+        else:
+            pt_out[:] = self.universe._boxToRealPointArray(pt_in, box_size)
+
+
+class DCDConfigurationVariable(Trajectory.TrajectoryVariable):
+
+    """
+    The variable "configuration" of a :class:`~MMTK.DCD.DCDTrajectory`
+    """
+
+    def __init__(self, trajectory):
+        self.universe = trajectory.universe
+        self.trajectory = trajectory
+        self.name = 'configuration'
+
+    def __getitem__(self, item):
+        if not isinstance(item, int):
+            return Trajectory.SubVariable(self, N.arange(len(self)))[item]
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError
+        return self.trajectory._configuration(item)
+
+
+def _readDCDHeader(filename):
+    import numpy
+    file = open(filename, 'rb')
+    try:
+        first = numpy.fromstring(file.read(4), '<i4')
+        if len(first) != 1:
+            raise IOError("Not a DCD file")
+        if first[0] == 84:
+            byteorder = '<'
+        elif first[0] == 0x54000000:
+            byteorder = '>'
+        else:
+            raise IOError("Not a DCD file")
+        int_type = numpy.dtype(byteorder+'i4')
+        if file.read(4) != 'CORD':
+            raise IOError("Not a DCD file")
+        control = numpy.fromstring(file.read(80), int_type)
+        delta = numpy.fromstring(control[9:10].tostring(), byteorder+'f4')[0]
+        end, title_size = numpy.fromstring(file.read(8), int_type)
+        if end != 84 or (title_size-4) % 80 != 0:
+            raise IOError("Not a DCD file")
+        file.seek(title_size+4, 1)
+        record = numpy.fromstring(file.read(12), int_type)
+        if len(record) != 3 or record[0] != 4 or record[2] != 4:
+            raise IOError("Not a DCD file")
+    finally:
+        file.close()
+    charmm = control[19] != 0
+    if control[8] != 0:
+        raise ValueError("Can't read DCD files with free atoms")
+    if charmm and control[11] != 0:
+        raise ValueError("Can't read DCD files with four dimensions")
+    return {'byteorder': byteorder,
+            'natoms': int(record[1]),
+            'istart': int(control[1]),
+            'nsavc': int(control[2]),
+            'delta': float(delta),
+            'unit_cell': bool(charmm and control[10] != 0),
+            'size': 112+title_size}
         
 def writeDCD(vector_list, dcd_file_name, factor, atom_order=None,
              delta_t=0.1, conf_flag=1):
@@ -76,20 +370,173 @@ def writeDCD(vector_list, dcd_file_name, factor, atom_order=None,
         atom_order = N.arrayrange(natoms)
     else:
         atom_order = N.array(atom_order)
+    writer = _DCDWriter(dcd_file_name, len(atom_order), len(vector_list),
+                        delta_t)
+    chunk_size = _chunkSize(natoms)
+    for first in range(0, len(vector_list), chunk_size):
+        block = []
+        for vector in vector_list[first:first+chunk_size]:
+            if conf_flag:
+                vector = universe.contiguousObjectConfiguration(None, vector)
+            block.append(vector.array)
+        writer.writeFrames(N.array(block), factor, atom_order)
+    writer.close()
+
+def writeTrajectoryDCD(trajectory, dcd_file_name, atom_order=None,
+                       first=0, last=None, skip=1,
+                       variable='configuration', delta_t=None):
+    """
+    Write the configurations or velocities stored in a trajectory
+    to a DCD file. The data is read in blocks of steps, so the memory
+    requirement does not depend on the length of the trajectory.
+
+    :param trajectory: the trajectory to be exported
+    :type trajectory: :class:`~MMTK.Trajectory.Trajectory`
+    :param dcd_file_name: the name of the DCD file
+    :type dcd_file_name: str
+    :param atom_order: the universe atom index for each atom in the DCD
+                       file. The default (None) is the universe's
+                       internal atom numbering.
+    :type atom_order: sequence of int
+    :param first: the number of the first step to be written
+    :type first: int
+    :param last: the number of the first step not to be written.
+                 A value of None indicates that the whole trajectory
+                 should be written.
+    :type last: int
+    :param skip: the number of steps to skip between two steps written
+    :type skip: int
+    :param variable: "configuration" or "velocities"
+    :type variable: str
+    :param delta_t: the time step between two frames. The default (None)
+                    is to take it from the variable "time" in the
+                    trajectory, or 0.1 if that is not available.
+    :type delta_t: float
+    """
+    universe = trajectory.universe
+    natoms = universe.numberOfAtoms()
+    if atom_order is None:
+        atom_order = N.arrayrange(natoms)
+    else:
+        atom_order = N.array(atom_order)
+    if variable == 'configuration':
+        factor = 1./Units.Ang
+        contiguous = universe.is_periodic
+    elif variable == 'velocities':
+        factor = 1./(Units.Ang/Units.akma_time)
+        contiguous = False
+    else:
+        raise ValueError("variable must be 'configuration' or 'velocities'")
+    steps = N.arange(len(trajectory))[first:last:skip]
+    if delta_t is None:
+        delta_t = 0.1
+        if len(steps) > 1 and 'time' in trajectory.variables():
+            time = trajectory.time
+            delta_t = time[steps[1]]-time[steps[0]]
+    box_size = None
+    if contiguous and 'box_size' in trajectory.variables():
+        box_size = trajectory.box_size
+    writer = _DCDWriter(dcd_file_name, len(atom_order), len(steps), delta_t)
+    chunk_size = _chunkSize(natoms)
+    try:
+        for i in range(0, len(steps), chunk_size):
+            block = _readSteps(trajectory, variable, steps[i:i+chunk_size])
+            if contiguous:
+                for j in range(len(block)):
+                    box = None
+                    if box_size is not None:
+                        box = box_size[steps[i+j]]
+                    conf = ParticleProperties.Configuration(universe,
+                                                            block[j], box)
+                    block[j] = universe.contiguousObjectConfiguration(
+                                                     None, conf).array
+            writer.writeFrames(block, factor, atom_order)
+    finally:
+        writer.close()
+
+def writeTrajectoryDCDPDB(trajectory, dcd_file_name, pdb_file_name,
+                          first=0, last=None, skip=1,
+                          variable='configuration', delta_t=None):
+    """
+    Write the configurations or velocities stored in a trajectory
+    to a DCD file and generate a compatible PDB file. This does the
+    same as :func:`~MMTK.DCD.writeDCDPDB` and
+    :func:`~MMTK.DCD.writeVelocityDCDPDB`, but reads the trajectory
+    in blocks of steps instead of requiring a list of configurations.
+    The parameters are those of :func:`~MMTK.DCD.writeTrajectoryDCD`.
+    """
+    universe = trajectory.universe
+    if variable == 'configuration':
+        configuration = trajectory.configuration[first]
+    else:
+        configuration = universe.configuration()
+    sequence = writePDB(universe, configuration, pdb_file_name)
+    indices = map(lambda a: a.index, sequence)
+    writeTrajectoryDCD(trajectory, dcd_file_name, indices, first, last, skip,
+                       variable, delta_t)
+
+# Size of the data blocks used for DCD output
+_block_size = 8*1024*1024
+
+def _chunkSize(natoms):
+    return max(1, _block_size/(24*max(1, natoms)))
+
+def _readSteps(trajectory, name, steps):
+    # Read the data for the given steps as one array. Contiguous
+    # step ranges of single-block netCDF trajectories that store
+    # all atoms are read with a single access to the file.
+    steps = N.array(steps)
+    if isinstance(trajectory, Trajectory.Trajectory) \
+           and trajectory.block_size == 1 and trajectory.subset is None \
+           and len(steps) > 0:
+        stride = 1
+        if len(steps) > 1:
+            stride = steps[1]-steps[0]
+        if stride > 0 and \
+               N.logical_and.reduce(steps == steps[0]+stride*N.arange(len(steps))):
+            var = trajectory.trajectory.file.variables[name]
+            return N.array(var[steps[0]:steps[-1]+1:stride]).astype(N.Float)
+    variable = getattr(trajectory, name)
+    return N.array([variable[int(i)].array for i in steps])
+
+class _DCDWriter(object):
+
+    # DCD output with the same file layout as write_dcdheader/write_dcdstep
+    # in Src/ReadDCD.c, using native byte order.
+
+    def __init__(self, filename, natoms, nframes, delta_t):
+        self.natoms = natoms
+        self.file = open(filename, 'wb', _block_size)
+        header = 'CORD' + struct.pack('9if10i', nframes, 0, 1,
+                                      0, 0, 0, 0, 0, 0,
+                                      delta_t/Units.akma_time,
+                                      *(10*[0]))
+        titles = ['REMARKS FILENAME=%s CREATED BY VMD' % filename,
+                  'REMARKS DATE: %s CREATED BY MMTK.'
+                  % time.strftime('%m/%d/%y')]
+        titles = struct.pack('i', len(titles)) \
+                 + ''.join([t[:80].ljust(80) for t in titles])
+        for record in [header, titles, struct.pack('i', natoms)]:
+            self._writeRecord(record)
+
+    def _writeRecord(self, data):
+        marker = struct.pack('i', len(data))
+        self.file.write(marker + data + marker)
+
+    def writeFrames(self, block, factor, atom_order):
+        import numpy
+        block = numpy.take(numpy.asarray(block), atom_order, 1)
+        coordinates = numpy.transpose(factor*block, (0, 2, 1)) \
+                      .astype(numpy.float32)
+        records = numpy.empty(coordinates.shape[:2] + (self.natoms+2,),
+                              numpy.int32)
+        records[:, :, 0] = 4*self.natoms
+        records[:, :, -1] = 4*self.natoms
+        records[:, :, 1:-1] = coordinates.view(numpy.int32)
+        self.file.write(records.tostring())
 
-    i_start = 0       # always start at frame 0
-    n_savc  = 1       # save every frame
-    fd = MMTK_DCD.writeOpenDCD(dcd_file_name, natoms, len(vector_list),
-                               i_start, n_savc, delta_t)
-    for vector in vector_list:
-        if conf_flag:
-            vector = universe.contiguousObjectConfiguration(None, vector)
-        array = factor*vector.array
-        x = N.take(array[:, 0], atom_order).astype(N.Float16)
-        y = N.take(array[:, 1], atom_order).astype(N.Float16)
-        z = N.take(array[:, 2], atom_order).astype(N.Float16)
-        MMTK_DCD.writeDCDStep(fd, x, y, z)
-    MMTK_DCD.writeCloseDCD(fd)
+    def close(self):
+        self.file.close()
 
 def writePDB(universe, configuration, pdb_file_name):
     offset = None
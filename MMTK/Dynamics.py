@@ -9,7 +9,8 @@ Molecular Dynamics integrators
 
 __docformat__ = 'restructuredtext'
 
-from MMTK import Environment, Features, Trajectory, Units
+from MMTK import Environment, Features, ParticleProperties, Random, \
+                 Trajectory, Units
 import MMTK_dynamics
 from Scientific import N
 
@@ -23,7 +24,10 @@ class Integrator(Trajectory.TrajectoryGenerator):
 
     default_options = {'first_step': 0, 'steps': 100, 'delta_t': 1.*Units.fs,
                        'background': False, 'threads': None,
-                       'mpi_communicator': None, 'actions': []}
+                       'processes': None, 'mpi_communicator': None,
+                       'domain_decomposition': None,
+                       'constraint_solver': 'shake', 'lincs_order': 4,
+                       'actions': []}
 
     available_data = ['configuration', 'velocities', 'gradients',
                       'energy', 'thermodynamic', 'time', 'auxiliary']
@@ -34,6 +38,36 @@ class Integrator(Trajectory.TrajectoryGenerator):
     def __call__(self, options):
         raise AttributeError
 
+    def _constraintSolver(self):
+        return _constraintSolver(self.getOption('constraint_solver'),
+                                 self.getOption('lincs_order'))
+
+    _timing = None
+
+    def _performance(self):
+        if self._timing is None or self._timing[1] <= 0.:
+            return None
+        steps, seconds = self._timing[:2]
+        performance = {'steps': int(steps), 'wall_time': seconds,
+                       'steps_per_second': steps/seconds,
+                       'ns_per_day': 86.4*self.getOption('delta_t')
+                                     *steps/seconds}
+        for name, t in zip(_timing_phases, self._timing[2:]):
+            performance[name] = 100.*t/seconds
+        return performance
+
+    performance = property(_performance, None, None,
+                           """The performance of the last run: a dictionary
+                           with the number of steps, the wall clock time in
+                           seconds, steps per second, ns/day, and the
+                           percentage of the wall clock time spent in each
+                           phase ('forces', 'constraints', 'thermostat',
+                           'output', 'integration'), or None if the
+                           integrator does not provide this information.""")
+
+_timing_phases = ['forces', 'constraints', 'thermostat', 'output',
+                  'integration']
+
 #
 # Velocity-Verlet integrator
 #
@@ -46,6 +80,13 @@ class VelocityVerletIntegrator(Integrator):
     a thermostat, and a barostat, as well as any combination.
     It is fully thread-safe.
 
+    Distance constraints are enforced by SHAKE or by LINCS, which
+    replaces the iterative solution by a series expansion of fixed
+    order. With either method, the constraints of different molecules
+    are handled in parallel when several threads are used. Molecules
+    made rigid by three constraints between three atoms, such as
+    water, are handled by the analytical SETTLE method.
+
     The integration is started by calling the integrator object.
     All the keyword options (see documnentation of __init__) can be
     specified either when creating the integrator or when calling it.
@@ -72,8 +113,17 @@ class VelocityVerletIntegrator(Integrator):
      - category "auxiliary": extended-system coordinates if a thermostat
        and/or barostat are used
 
+     - category "performance": ns/day, steps per second, and the
+       percentage of the wall clock time spent in force evaluation,
+       constraints, thermostat and barostat, output and trajectory
+       actions, and the remaining integration steps, averaged since
+       the start of the run. After the run, the same information is
+       available in the attribute performance.
+
     """
 
+    available_data = Integrator.available_data + ['performance']
+
     def __init__(self, universe, **options):
         """
         :param universe: the universe on which the integrator acts
@@ -82,18 +132,41 @@ class VelocityVerletIntegrator(Integrator):
         :type steps: int
         :keyword delta_t: the time step (default is 1 fs)
         :type delta_t: float
+        :keyword constraint_solver: the method for enforcing distance
+                                    constraints, "shake" (default) or
+                                    "lincs"
+        :type constraint_solver: str
+        :keyword lincs_order: the expansion order of LINCS (default: 4)
+        :type lincs_order: int
         :keyword actions: a list of actions to be executed periodically
                           (default is none)
         :type actions: list
         :keyword threads: the number of threads to use in energy evaluation
                           (default set by MMTK_ENERGY_THREADS)
         :type threads: int
+        :keyword processes: the number of processes to use in energy
+                            evaluation (default set by
+                            MMTK_ENERGY_PROCESSES)
+        :type processes: int
         :keyword background: if True, the integration is executed as a
                              separate thread (default: False)
         :type background: bool
         :keyword mpi_communicator: an MPI communicator object, or None,
                                    meaning no parallelization (default: None)
         :type mpi_communicator: Scientific.MPI.MPICommunicator
+        :keyword domain_decomposition: if not None, the MPI processes
+                                       divide space into slabs and each
+                                       one integrates only the atoms in
+                                       its slab. The value is the skin
+                                       that is added to the nonbonded
+                                       cutoff to define the region whose
+                                       coordinates are exchanged with
+                                       the neighbouring slabs. This
+                                       requires an mpi_communicator and
+                                       cannot be used with constraints,
+                                       a thermostat, a barostat, or an
+                                       Ewald sum (default: None)
+        :type domain_decomposition: float
         """
         Integrator.__init__(self, universe, options)
         self.features = [Features.FixedParticleFeature,
@@ -115,37 +188,20 @@ class VelocityVerletIntegrator(Integrator):
         masses = self.universe.masses()
         fixed = self.universe.getAtomBooleanArray('fixed')
         nt = self.getOption('threads')
+        np = self.getOption('processes')
         comm = self.getOption('mpi_communicator')
+        dd = self.getOption('domain_decomposition')
         evaluator = self.universe.energyEvaluator(threads=nt,
-                                                  mpi_communicator=comm)
+                                                  mpi_communicator=comm,
+                                                  processes=np,
+                                                  domain_decomposition=dd)
         evaluator = evaluator.CEvaluator()
         constraints, const_distances_sq, c_blocks = \
                      _constraintArrays(self.universe)
-                                                  
-        type = 'NVE'
-        if Features.NoseThermostatFeature in used_features:
-            type = 'NVT'
-            thermostat = self.universe.environmentObjectList(
-                                          Environment.NoseThermostat)[0]
-            t_parameters = thermostat.parameters
-            t_coordinates = thermostat.coordinates
-        else:
-            t_parameters = N.zeros((0,), N.Float)
-            t_coordinates = N.zeros((2,), N.Float)
-        if Features.AndersenBarostatFeature in used_features:
-            if self.universe.cellVolume() is None:
-                raise ValueError("Barostat requires finite volume universe")
-            if type == 'NVE':
-                type = 'NPH'
-            else:
-                type = 'NPT'
-            barostat = self.universe.environmentObjectList(
-                                          Environment.AndersenBarostat)[0]
-            b_parameters = barostat.parameters
-            b_coordinates = barostat.coordinates
-        else:
-            b_parameters = N.zeros((0,), N.Float)
-            b_coordinates = N.zeros((1,), N.Float)
+        method, lincs_order = self._constraintSolver()
+        type, t_parameters, t_coordinates, b_parameters, b_coordinates = \
+                     _extendedSystemArrays(self.universe, used_features)
+        self._timing = N.zeros((2+len(_timing_phases),), N.Float)
 
         args = (self.universe,
                 configuration.array, velocities.array,
@@ -156,9 +212,279 @@ class VelocityVerletIntegrator(Integrator):
                 self.getOption('delta_t'), self.getOption('first_step'),
                 self.getOption('steps'), self.getActions(),
                 type + ' dynamics trajectory with ' +
-                self.optionString(['delta_t', 'steps']))
+                self.optionString(['delta_t', 'steps']),
+                method, lincs_order, self._timing)
         return self.run(MMTK_dynamics.integrateVV, args)
 
+#
+# Multiple-time-step integrator
+#
+class RESPAIntegrator(Integrator):
+
+    """
+    Multiple-time-step (r-RESPA) molecular dynamics integrator
+
+    The energy terms are divided into fast and slow ones. The slow
+    terms are evaluated once per time step, the fast ones inner_steps
+    times with a correspondingly shorter time step, using the
+    Velocity-Verlet scheme in both loops. The thermostat and barostat
+    variables are propagated at the outer time step.
+
+    The integrator can handle fixed atoms, distance constraints,
+    a thermostat, and a barostat, but not distance constraints
+    combined with a barostat. Pressure is not available for systems
+    with distance constraints.
+
+    The integration is started by calling the integrator object.
+    All the keyword options (see documnentation of __init__) can be
+    specified either when creating the integrator or when calling it.
+
+    The data categories and variables available for output are the
+    same as for the :class:`VelocityVerletIntegrator`. Output and
+    trajectory actions happen at the end of the outer steps.
+    """
+
+    default_options = Integrator.default_options.copy()
+    default_options.update({'inner_steps': 4, 'slow_terms': None})
+
+    def __init__(self, universe, **options):
+        """
+        :param universe: the universe on which the integrator acts
+        :type universe: :class:`~MMTK.Universe.Universe`
+        :keyword slow_terms: the energy terms that are evaluated only
+                             once per time step. Each item is the name
+                             of an energy term (e.g.
+                             "electrostatic ewald" or
+                             "nonbonded list summation"), one of the
+                             energy term names it produces, or a
+                             component of the universe's force field.
+        :type slow_terms: list
+        :keyword inner_steps: the number of evaluations of the fast
+                              energy terms per time step (default: 4)
+        :type inner_steps: int
+        :keyword steps: the number of integration steps (default is 100)
+        :type steps: int
+        :keyword delta_t: the time step for the slow energy terms
+                          (default is 1 fs)
+        :type delta_t: float
+        :keyword constraint_solver: the method for enforcing distance
+                                    constraints, "shake" (default) or
+                                    "lincs"
+        :type constraint_solver: str
+        :keyword lincs_order: the expansion order of LINCS (default: 4)
+        :type lincs_order: int
+        :keyword actions: a list of actions to be executed periodically
+                          (default is none)
+        :type actions: list
+        :keyword threads: the number of threads to use in energy evaluation
+                          (default set by MMTK_ENERGY_THREADS)
+        :type threads: int
+        :keyword processes: the number of processes to use in energy
+                            evaluation (default set by
+                            MMTK_ENERGY_PROCESSES)
+        :type processes: int
+        :keyword background: if True, the integration is executed as a
+                             separate thread (default: False)
+        :type background: bool
+        :keyword mpi_communicator: an MPI communicator object, or None,
+                                   meaning no parallelization (default: None)
+        :type mpi_communicator: Scientific.MPI.MPICommunicator
+        """
+        Integrator.__init__(self, universe, options)
+        self.features = [Features.FixedParticleFeature,
+                         Features.NoseThermostatFeature,
+                         Features.AndersenBarostatFeature,
+                         Features.DistanceConstraintsFeature]
+
+    def __call__(self, **options):
+        """
+        Run the integrator. The keyword options are the same as described
+        under __init__.
+        """
+        self.setCallOptions(options)
+        used_features = Features.checkFeatures(self, self.universe)
+        configuration = self.universe.configuration()
+        velocities = self.universe.velocities()
+        if velocities is None:
+            raise ValueError("no velocities")
+        slow_terms = self.getOption('slow_terms')
+        if not slow_terms:
+            raise ValueError("no slow energy terms")
+        if self.getOption('domain_decomposition') is not None:
+            raise ValueError("domain decomposition cannot be used with RESPA")
+        masses = self.universe.masses()
+        fixed = self.universe.getAtomBooleanArray('fixed')
+        nt = self.getOption('threads')
+        np = self.getOption('processes')
+        comm = self.getOption('mpi_communicator')
+        evaluator = self.universe.energyEvaluator(threads=nt,
+                                                  mpi_communicator=comm,
+                                                  processes=np)
+        fast, slow = evaluator.splitCEvaluator(slow_terms)
+        constraints, const_distances_sq, c_blocks = \
+                     _constraintArrays(self.universe)
+        method, lincs_order = self._constraintSolver()
+        type, t_parameters, t_coordinates, b_parameters, b_coordinates = \
+                     _extendedSystemArrays(self.universe, used_features)
+
+        args = (self.universe,
+                configuration.array, velocities.array,
+                masses.array, fixed.array, fast, slow,
+                constraints, const_distances_sq, c_blocks,
+                t_parameters, t_coordinates,
+                b_parameters, b_coordinates,
+                self.getOption('delta_t'), self.getOption('inner_steps'),
+                self.getOption('first_step'),
+                self.getOption('steps'), self.getActions(),
+                type + ' RESPA dynamics trajectory with ' +
+                self.optionString(['delta_t', 'inner_steps', 'steps']),
+                method, lincs_order)
+        return self.run(MMTK_dynamics.integrateRESPA, args)
+
+#
+# Langevin integrator
+#
+class LangevinIntegrator(Integrator):
+
+    """
+    Langevin dynamics integrator
+
+    The integrator uses the BAOAB splitting of Leimkuhler and Matthews:
+    half a step of the forces, half a step of free motion, the exact
+    solution for friction and random forces over a full step, another
+    half step of free motion, and the second half step of the forces.
+    The random numbers are a function of the seed, the step number,
+    and the atom index, so the noise is the same for any number of
+    threads.
+
+    The integrator can handle fixed atoms and distance constraints.
+    Pressure is not available for systems with distance constraints.
+
+    The integration is started by calling the integrator object.
+    All the keyword options (see documnentation of __init__) can be
+    specified either when creating the integrator or when calling it.
+
+    The data categories and variables available for output are the
+    same as for the :class:`VelocityVerletIntegrator`, except for the
+    thermostat and barostat variables.
+    """
+
+    default_options = Integrator.default_options.copy()
+    default_options.update({'temperature': 300.*Units.K,
+                            'friction': None,
+                            'collision_frequency': 1./Units.ps,
+                            'seed': None})
+
+    def __init__(self, universe, **options):
+        """
+        :param universe: the universe on which the integrator acts
+        :type universe: :class:`~MMTK.Universe.Universe`
+        :keyword temperature: the temperature of the heat bath
+                              (default: 300 K)
+        :type temperature: float
+        :keyword friction: the friction coefficients (in units of
+                           mass/time), either one number for all atoms
+                           or a ParticleScalar. The default is the
+                           atom attribute "friction" for atoms that
+                           define it, and the mass times the collision
+                           frequency for all others.
+        :type friction: float or
+                        :class:`~MMTK.ParticleProperties.ParticleScalar`
+        :keyword collision_frequency: the collision frequency (in units
+                                      of 1/time) that defines the default
+                                      friction (default: 1/ps)
+        :type collision_frequency: float
+        :keyword seed: the seed for the random forces (default: a
+                       value taken from :mod:`MMTK.Random`)
+        :type seed: int
+        :keyword steps: the number of integration steps (default is 100)
+        :type steps: int
+        :keyword delta_t: the time step (default is 1 fs)
+        :type delta_t: float
+        :keyword constraint_solver: the method for enforcing distance
+                                    constraints, "shake" (default) or
+                                    "lincs"
+        :type constraint_solver: str
+        :keyword lincs_order: the expansion order of LINCS (default: 4)
+        :type lincs_order: int
+        :keyword actions: a list of actions to be executed periodically
+                          (default is none)
+        :type actions: list
+        :keyword threads: the number of threads to use in energy evaluation
+                          and in the generation of random forces
+                          (default set by MMTK_ENERGY_THREADS)
+        :type threads: int
+        :keyword processes: the number of processes to use in energy
+                            evaluation (default set by
+                            MMTK_ENERGY_PROCESSES)
+        :type processes: int
+        :keyword background: if True, the integration is executed as a
+                             separate thread (default: False)
+        :type background: bool
+        :keyword mpi_communicator: an MPI communicator object, or None,
+                                   meaning no parallelization (default: None)
+        :type mpi_communicator: Scientific.MPI.MPICommunicator
+        """
+        Integrator.__init__(self, universe, options)
+        self.features = [Features.FixedParticleFeature,
+                         Features.DistanceConstraintsFeature]
+
+    def __call__(self, **options):
+        """
+        Run the integrator. The keyword options are the same as described
+        under __init__.
+        """
+        self.setCallOptions(options)
+        Features.checkFeatures(self, self.universe)
+        configuration = self.universe.configuration()
+        velocities = self.universe.velocities()
+        if velocities is None:
+            raise ValueError("no velocities")
+        if self.getOption('domain_decomposition') is not None:
+            raise ValueError("domain decomposition cannot be used with "
+                             "Langevin dynamics")
+        masses = self.universe.masses()
+        fixed = self.universe.getAtomBooleanArray('fixed')
+        friction = self.getOption('friction')
+        if friction is None:
+            gamma = self.getOption('collision_frequency')
+            friction = ParticleProperties.ParticleScalar(self.universe)
+            for a in self.universe.atomList():
+                friction[a] = getattr(a, 'friction', gamma*masses[a])
+        elif not ParticleProperties.isParticleProperty(friction):
+            value = friction
+            friction = ParticleProperties.ParticleScalar(self.universe)
+            friction.array[:] = value
+        seed = self.getOption('seed')
+        if seed is None:
+            seed = int(Random.uniform(0., 2.**31-1.))
+        nt = self.getOption('threads')
+        np = self.getOption('processes')
+        comm = self.getOption('mpi_communicator')
+        evaluator = self.universe.energyEvaluator(threads=nt,
+                                                  mpi_communicator=comm,
+                                                  processes=np)
+        if nt is None:
+            import MMTK.ForceFields
+            nt = MMTK.ForceFields.default_energy_threads
+        evaluator = evaluator.CEvaluator()
+        constraints, const_distances_sq, c_blocks = \
+                     _constraintArrays(self.universe)
+        method, lincs_order = self._constraintSolver()
+
+        args = (self.universe,
+                configuration.array, velocities.array,
+                masses.array, fixed.array, friction.array, evaluator,
+                constraints, const_distances_sq, c_blocks,
+                self.getOption('temperature'), self.getOption('delta_t'),
+                seed, nt,
+                self.getOption('first_step'), self.getOption('steps'),
+                self.getActions(),
+                'Langevin dynamics trajectory with ' +
+                self.optionString(['delta_t', 'temperature', 'steps']),
+                method, lincs_order)
+        return self.run(MMTK_dynamics.integrateLangevin, args)
+
 #
 # Velocity scaling, removal of global translation/rotation
 #
@@ -315,6 +641,33 @@ class RotationRemover(Trajectory.TrajectoryAction):
 #
 # Construct constraint arrays
 #
+def _extendedSystemArrays(universe, used_features):
+    type = 'NVE'
+    if Features.NoseThermostatFeature in used_features:
+        type = 'NVT'
+        thermostat = universe.environmentObjectList(
+                                      Environment.NoseThermostat)[0]
+        t_parameters = thermostat.parameters
+        t_coordinates = thermostat.coordinates
+    else:
+        t_parameters = N.zeros((0,), N.Float)
+        t_coordinates = N.zeros((2,), N.Float)
+    if Features.AndersenBarostatFeature in used_features:
+        if universe.cellVolume() is None:
+            raise ValueError("Barostat requires finite volume universe")
+        if type == 'NVE':
+            type = 'NPH'
+        else:
+            type = 'NPT'
+        barostat = universe.environmentObjectList(
+                                      Environment.AndersenBarostat)[0]
+        b_parameters = barostat.parameters
+        b_coordinates = barostat.coordinates
+    else:
+        b_parameters = N.zeros((0,), N.Float)
+        b_coordinates = N.zeros((1,), N.Float)
+    return type, t_parameters, t_coordinates, b_parameters, b_coordinates
+
 def _constraintArrays(universe):
     nc = universe.numberOfDistanceConstraints()
     constraints = N.zeros((nc, 2), N.Int)
@@ -334,18 +687,30 @@ def _constraintArrays(universe):
         c_blocks = N.zeros((1,), N.Int)
     return constraints, const_distances_sq, c_blocks
 
+_constraint_solvers = {'shake': 0, 'lincs': 1}
+
+def _constraintSolver(solver, lincs_order):
+    try:
+        method = _constraint_solvers[solver]
+    except KeyError:
+        raise ValueError("unknown constraint solver " + repr(solver))
+    return (method, lincs_order)
+
 #
 # Enforce distance constraints for current configuration
 #
-def enforceConstraints(universe, configuration=None):
+def enforceConstraints(universe, configuration=None, solver='shake',
+                       lincs_order=4, threads=1):
     constraints, const_distances_sq, c_blocks = _constraintArrays(universe)
     if len(constraints) == 0:
         return
     if configuration is None:
         configuration = universe.configuration()
+    method, lincs_order = _constraintSolver(solver, lincs_order)
     MMTK_dynamics.enforceConstraints(universe._spec, configuration.array,
                                      universe.masses().array,
-                                     constraints, const_distances_sq, c_blocks)
+                                     constraints, const_distances_sq, c_blocks,
+                                     method, lincs_order, threads)
 
 #
 # Project velocity vector onto the constraint surface
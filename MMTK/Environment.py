@@ -13,6 +13,7 @@ fields, etc.
 
 __docformat__ = 'restructuredtext'
 
+from MMTK import Units
 from Scientific import N
 
 #
@@ -29,6 +30,15 @@ class EnvironmentObject(object):
         return "o('Environment." + self.__class__.__name__ + \
                `tuple(self.parameters)` + "')"
 
+    def _description(self, index_map):
+        return self.description()
+
+    def _addedToUniverse(self, universe):
+        pass
+
+    def _removedFromUniverse(self, universe):
+        pass
+
 # Type check
 
 def isEnvironmentObject(object):
@@ -102,3 +112,103 @@ class AndersenBarostat(EnvironmentObject):
         if other.__class__ is AndersenBarostat:
             raise ValueError("the universe already has a barostat")
 
+#
+# Hydrogen mass repartitioning
+#
+class HydrogenMassRepartitioning(EnvironmentObject):
+
+    """
+    Hydrogen mass repartitioning
+
+    When added to a universe, this object sets the mass of each
+    hydrogen atom bonded to exactly one heavy atom to a given value
+    and subtracts the added mass from the heavy atom, leaving the
+    mass of each molecule unchanged. The slowest-moving hydrogens
+    limit the time step less, such that bond constraints and a
+    4 fs time step become practical. Removing the object from the
+    universe restores the original masses.
+
+    The repartitioning applies to the atoms in the universe at the
+    time the object is added. As an environment object, it is part
+    of the universe description stored in trajectories. The description
+    lists the modified hydrogen atoms, so atoms added later keep their
+    masses when the universe is rebuilt from a trajectory.
+    """
+
+    def __init__(self, hydrogen_mass=3.024*Units.amu, hydrogens=None):
+        """
+        :param hydrogen_mass: the mass of the hydrogen atoms
+        :type hydrogen_mass: float
+        :param hydrogens: the indices of the hydrogen atoms whose
+                          masses are changed. The default is all
+                          hydrogen atoms in the universe.
+        :type hydrogens: sequence of int
+        """
+        self.parameters = N.array([hydrogen_mass])
+        self.hydrogen_indices = hydrogens
+        self.hydrogens = None
+        self.original_masses = None
+
+    def checkCompatibilityWith(self, other):
+        if other.__class__ is HydrogenMassRepartitioning:
+            raise ValueError("the universe already has "
+                             "repartitioned hydrogen masses")
+
+    def description(self):
+        return self._description(None)
+
+    def _description(self, index_map):
+        if self.hydrogens is None:
+            indices = self.hydrogen_indices
+        elif index_map is None:
+            indices = [h.index for h in self.hydrogens]
+        else:
+            indices = [index_map[h.index] for h in self.hydrogens
+                       if index_map[h.index] is not None]
+        if indices is None:
+            return EnvironmentObject.description(self)
+        return "o('Environment.HydrogenMassRepartitioning(%s, %s)')" \
+               % (`float(self.parameters[0])`, `sorted(indices)`)
+
+    def _addedToUniverse(self, universe):
+        hydrogen_mass = self.parameters[0]
+        if self.hydrogen_indices is not None:
+            # Make sure that the atom indices are defined
+            universe.configuration()
+            selected = set(self.hydrogen_indices)
+        delta = {}
+        hydrogens = []
+        for o in universe:
+            for bu in o.bondedUnits():
+                if not hasattr(bu, 'bonds'): continue
+                heavy = {}
+                for bond in bu.bonds:
+                    for h, a in [(bond.a1, bond.a2), (bond.a2, bond.a1)]:
+                        if h.symbol == 'H' and a.symbol != 'H':
+                            heavy.setdefault(h, []).append(a)
+                for h, partners in heavy.items():
+                    if self.hydrogen_indices is not None \
+                       and h.index not in selected:
+                        continue
+                    if len(partners) == 1:
+                        hydrogens.append(h)
+                        dm = hydrogen_mass - h._mass
+                        delta[h] = delta.get(h, 0.) + dm
+                        delta[partners[0]] = delta.get(partners[0], 0.) - dm
+        for atom, dm in delta.items():
+            if atom._mass + dm <= 0.:
+                raise ValueError("hydrogen mass too large for " +
+                                 atom.fullName())
+        self.hydrogens = hydrogens
+        self.original_masses = [(atom, atom._mass) for atom in delta]
+        for atom, dm in delta.items():
+            atom._mass += dm
+        universe._masses = None
+
+    def _removedFromUniverse(self, universe):
+        if self.original_masses is not None:
+            for atom, mass in self.original_masses:
+                atom._mass = mass
+            self.original_masses = None
+        self.hydrogens = None
+        universe._masses = None
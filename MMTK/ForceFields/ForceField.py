@@ -31,6 +31,12 @@ class ForceField(object):
         # must be defined by derived classes
         raise NotImplementedError
 
+    def evaluatorTermGroups(self, universe, subset1, subset2, global_data):
+        # like evaluatorTerms, but returns a list of
+        # (component force field, terms) pairs
+        return [(self, self.evaluatorTerms(universe, subset1, subset2,
+                                           global_data))]
+
     def __add__(self, other):
         return CompoundForceField(self, other)
 
@@ -145,7 +151,7 @@ class CompoundForceField(ForceField):
 
     def evaluatorParameters(self, system, subset1, subset2, global_data):
         parameters = {}
-        def add_item(params):
+        def add_item(params, ff):
             if not isinstance(params, dict):
                 raise ValueError("evaluator parameters are not a dict")
             for key, value in params.items():
@@ -157,13 +163,20 @@ class CompoundForceField(ForceField):
 
     def evaluatorTerms(self, system, subset1, subset2, global_data):
         eval_objects = []
-        def add_item(terms):
+        for ff, terms in self.evaluatorTermGroups(system, subset1, subset2,
+                                                  global_data):
+            eval_objects.extend(terms)
+        return eval_objects
+
+    def evaluatorTermGroups(self, system, subset1, subset2, global_data):
+        groups = []
+        def add_item(terms, ff):
             if not isinstance(terms, list):
                 raise ValueError("evaluator term list not a list")
-            eval_objects.extend(terms)
+            groups.append((ff, terms))
         self._compoundEvaluator(system, subset1, subset2, global_data,
                                 'evaluatorTerms', add_item)
-        return eval_objects
+        return groups
 
     def _compoundEvaluator(self, system, subset1, subset2, global_data,
                            method, add_item):
@@ -175,7 +188,7 @@ class CompoundForceField(ForceField):
                 if ff.ready(global_data):
                     item = getattr(ff, method)(system, subset1, subset2,
                                                global_data)
-                    add_item(item)
+                    add_item(item, ff)
                     done.append(ff)
             if not done:
                 raise TypeError("Cyclic force field dependence")
@@ -259,27 +272,51 @@ def addToForceConstants(total_fc, indices, small_fc):
 class EnergyEvaluator(object):
 
     def __init__(self, universe, force_field, subset1=None, subset2=None,
-                 threads=None, mpi_communicator=None):
+                 threads=None, mpi_communicator=None, processes=None,
+                 domain_decomposition=None):
         if not Universe.isUniverse(universe):
             raise TypeError("energy evaluator defined only for universes")
         self.universe = universe
         self.universe_version = self.universe._version
         self.ff = force_field
         self.configuration = self.universe.configuration()
-        self.global_data = ForceFieldData()
         if subset1 is not None and subset2 is None:
             subset2 = subset1
-        terms = self.ff.evaluatorTerms(self.universe,
-                                       subset1, subset2,
-                                       self.global_data)
-        if not isinstance(terms, list):
-            raise ValueError("evaluator term list not a list")
+        self.subsets = (subset1, subset2)
+        self.global_data = ForceFieldData()
+        terms, self.term_components = self._evaluatorTerms(self.global_data)
+        self.terms = terms
         from MMTK_forcefield import Evaluator
+        import MMTK.ForceFields
+        if processes is None:
+            processes = MMTK.ForceFields.default_energy_processes
         if threads is None:
-            import MMTK.ForceFields
-            threads = MMTK.ForceFields.default_energy_threads;
-        self.evaluator = Evaluator(N.array(terms), threads,
-                                   mpi_communicator)
+            if processes > 1 or domain_decomposition is not None:
+                threads = 1
+            else:
+                threads = MMTK.ForceFields.default_energy_threads;
+        if domain_decomposition is None:
+            domain_decomposition = 0.
+        elif domain_decomposition <= 0.:
+            raise ValueError("domain decomposition skin must be positive")
+        self.evaluator_arguments = (threads, mpi_communicator, processes,
+                                    self.universe.numberOfAtoms(),
+                                    domain_decomposition)
+        self.evaluator = Evaluator(N.array(terms), *self.evaluator_arguments)
+        self.split_evaluators = {}
+
+    def _evaluatorTerms(self, global_data):
+        groups = self.ff.evaluatorTermGroups(self.universe,
+                                             self.subsets[0], self.subsets[1],
+                                             global_data)
+        terms = []
+        components = []
+        for ff, ff_terms in groups:
+            if not isinstance(ff_terms, list):
+                raise ValueError("evaluator term list not a list")
+            terms.extend(ff_terms)
+            components.extend(len(ff_terms)*[ff])
+        return terms, components
 
     def checkUniverseVersion(self):
         if self.universe_version != self.universe._version:
@@ -288,6 +325,75 @@ class EnergyEvaluator(object):
     def CEvaluator(self):
         return self.evaluator
 
+    def splitCEvaluator(self, selection):
+        """
+        Divide the energy terms into two groups and return a low-level
+        evaluator for each of them.
+
+        :param selection: the energy terms for the second group. Each
+                          item is the name of an energy term, one of
+                          the names in its energy term list, or a
+                          component of the force field. The nonbonded
+                          pair sums (Lennard-Jones, electrostatic pair
+                          and Ewald direct sums) are a single term
+                          named "nonbonded list summation".
+        :type selection: sequence
+        :returns: the evaluators for the unselected and for the
+                  selected terms
+        :rtype: tuple
+        """
+        key = tuple(selection)
+        try:
+            return self.split_evaluators[key]
+        except KeyError:
+            pass
+        components = {}
+        for item in selection:
+            if isForceField(item):
+                if isCompoundForceField(item):
+                    for ff in item.flatFFList():
+                        components[id(ff)] = item
+                else:
+                    components[id(item)] = item
+        used = set()
+        selected = []
+        for term, ff in zip(self.terms, self.term_components):
+            names = [term.name] + list(term.term_names)
+            matches = [item for item in selection
+                       if (not isForceField(item) and item in names)]
+            if id(ff) in components:
+                matches.append(components[id(ff)])
+            used.update(id(item) for item in matches)
+            selected.append(len(matches) > 0)
+        for item in selection:
+            if id(item) not in used:
+                raise ValueError("no energy term matches %s" % str(item))
+        if not (False in selected and True in selected):
+            raise ValueError("one of the energy term groups is empty")
+        # An evaluator stores the positions of its terms' results
+        # in the term objects, so each group needs its own copies.
+        fresh_terms = self._evaluatorTerms(ForceFieldData())[0]
+        if len(fresh_terms) != len(self.terms):
+            raise ValueError("energy terms changed since evaluator creation")
+        groups = ([], [])
+        for term, flag in zip(fresh_terms, selected):
+            groups[flag].append(term)
+        from MMTK_forcefield import Evaluator
+        evaluators = tuple(Evaluator(N.array(terms), *self.evaluator_arguments)
+                           for terms in groups)
+        self.split_evaluators[key] = evaluators
+        return evaluators
+
+    def loadStatistics(self):
+        """
+        :returns: for each thread, the number of atom pairs it handled
+                  in the nonbonded pair loop of the last evaluation and
+                  the wall clock time it spent on them (in seconds),
+                  or None if there is no nonbonded list term
+        :rtype: list of tuple
+        """
+        return self.evaluator.loadStatistics()
+
     def __call__(self, gradients = None, force_constants = None,
                  small_change=False):
         self.checkUniverseVersion()
@@ -40,6 +40,12 @@ try:
 except KeyError:
     default_energy_threads = 1
 
+try:
+    default_energy_processes = \
+                 string.atoi(os.environ['MMTK_ENERGY_PROCESSES'])
+except KeyError:
+    default_energy_processes = 1
+
 del os
 del string
 del sys
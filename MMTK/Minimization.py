@@ -9,8 +9,9 @@ Energy minimizers
 
 __docformat__ = 'restructuredtext'
 
-from MMTK import Features, Trajectory, Units
-from MMTK_minimization import conjugateGradient, steepestDescent
+from MMTK import Dynamics, Features, Trajectory, Units
+from MMTK_minimization import conjugateGradient, steepestDescent, lbfgs
+from MMTK_dynamics import minimizeFIRE
 
 #
 # Minimizer base class
@@ -23,7 +24,8 @@ class Minimizer(Trajectory.TrajectoryGenerator):
     default_options = {'steps': 100, 'step_size': 0.02*Units.Ang,
 		       'convergence': 0.01*Units.kJ/(Units.mol*Units.nm),
                        'background': False, 'threads': None,
-                       'mpi_communicator': None, 'actions': []}
+                       'processes': None, 'mpi_communicator': None,
+                       'actions': []}
 
     available_data = ['energy', 'configuration', 'gradients']
 
@@ -77,6 +79,10 @@ class SteepestDescentMinimizer(Minimizer):
         :keyword threads: the number of threads to use in energy evaluation
                           (default set by MMTK_ENERGY_THREADS)
         :type threads: int
+        :keyword processes: the number of processes to use in energy
+                            evaluation (default set by
+                            MMTK_ENERGY_PROCESSES)
+        :type processes: int
         :keyword background: if True, the integration is executed as a
                              separate thread (default: False)
         :type background: bool
@@ -99,9 +105,11 @@ class SteepestDescentMinimizer(Minimizer):
 	configuration = self.universe.configuration()
 	fixed = self.universe.getAtomBooleanArray('fixed')
         nt = self.getOption('threads')
+        np = self.getOption('processes')
         comm = self.getOption('mpi_communicator')
 	evaluator = self.universe.energyEvaluator(threads=nt,
-                                                  mpi_communicator=comm)
+                                                  mpi_communicator=comm,
+                                                  processes=np)
         evaluator = evaluator.CEvaluator()
 	args = (self.universe,
                 configuration.array, fixed.array, evaluator,
@@ -156,6 +164,10 @@ class ConjugateGradientMinimizer(Minimizer):
         :keyword threads: the number of threads to use in energy evaluation
                           (default set by MMTK_ENERGY_THREADS)
         :type threads: int
+        :keyword processes: the number of processes to use in energy
+                            evaluation (default set by
+                            MMTK_ENERGY_PROCESSES)
+        :type processes: int
         :keyword background: if True, the integration is executed as a
                              separate thread (default: False)
         :type background: bool
@@ -174,7 +186,9 @@ class ConjugateGradientMinimizer(Minimizer):
 	configuration = self.universe.configuration()
 	fixed = self.universe.getAtomBooleanArray('fixed')
         nt = self.getOption('threads')
-	evaluator = self.universe.energyEvaluator(threads=nt).CEvaluator()
+        np = self.getOption('processes')
+	evaluator = self.universe.energyEvaluator(threads=nt,
+                                                  processes=np).CEvaluator()
 	args =(self.universe,
                configuration.array, fixed.array, evaluator,
                self.getOption('steps'), self.getOption('step_size'),
@@ -182,3 +196,223 @@ class ConjugateGradientMinimizer(Minimizer):
                'Conjugate gradient minimization with ' +
                self.optionString(['convergence', 'step_size', 'steps']))
         return self.run(conjugateGradient, args)
+
+#
+# Limited-memory BFGS minimizer
+#
+class LBFGSMinimizer(Minimizer):
+
+    """
+    Limited-memory BFGS minimizer
+
+    The minimizer builds an approximation to the inverse Hessian from
+    the position and gradient changes of the last few steps, and
+    chooses the step length by a line search satisfying the strong
+    Wolfe conditions. It usually needs far fewer energy evaluations
+    than the conjugate gradient minimizer.
+
+    The minimizer can handle fixed atoms, but no distance constraints.
+    It is fully thread-safe.
+
+    The minimization is started by calling the minimizer object.
+    All the keyword options can be specified either when
+    creating the minimizer or when calling it.
+
+    The following data categories and variables are available for
+    output:
+
+     - category "configuration": configuration and box size (for
+       periodic universes)
+
+     - category "gradients": energy gradients for each atom
+
+     - category "energy": potential energy and
+                          norm of the potential energy gradient
+    """
+
+    default_options = Minimizer.default_options.copy()
+    default_options['history'] = 10
+
+    def __init__(self, universe, **options):
+        """
+        :param universe: the universe on which the integrator acts
+        :type universe: :class:`~MMTK.Universe.Universe`
+        :keyword steps: the number of minimization steps (default is 100)
+        :type steps: int
+        :keyword step_size: the length of the first minimization step,
+                            and of any step after a reset of the history
+                            (default is 0.002 nm)
+        :type step_size: float
+        :keyword convergence: the root-mean-square gradient length at which
+                              minimization stops (default is 0.01 kJ/mol/nm)
+        :type convergence: float
+        :keyword history: the number of previous steps used in the
+                          approximation of the inverse Hessian
+                          (default is 10)
+        :type history: int
+        :keyword actions: a list of actions to be executed periodically
+                          (default is none)
+        :type actions: list
+        :keyword threads: the number of threads to use in energy evaluation
+                          (default set by MMTK_ENERGY_THREADS)
+        :type threads: int
+        :keyword processes: the number of processes to use in energy
+                            evaluation (default set by
+                            MMTK_ENERGY_PROCESSES)
+        :type processes: int
+        :keyword background: if True, the integration is executed as a
+                             separate thread (default: False)
+        :type background: bool
+        :keyword mpi_communicator: an MPI communicator object, or None,
+                                   meaning no parallelization (default: None)
+        :type mpi_communicator: Scientific.MPI.MPICommunicator
+        """
+        Minimizer.__init__(self, universe, options)
+        self.features = [Features.FixedParticleFeature,
+                         Features.NoseThermostatFeature]
+
+    def __call__(self, **options):
+        """
+        Run the minimizer. The keyword options are the same as described
+        under __init__.
+        """
+        self.setCallOptions(options)
+        Features.checkFeatures(self, self.universe)
+        configuration = self.universe.configuration()
+        fixed = self.universe.getAtomBooleanArray('fixed')
+        nt = self.getOption('threads')
+        np = self.getOption('processes')
+        comm = self.getOption('mpi_communicator')
+        evaluator = self.universe.energyEvaluator(threads=nt,
+                                                  mpi_communicator=comm,
+                                                  processes=np)
+        evaluator = evaluator.CEvaluator()
+        args = (self.universe,
+                configuration.array, fixed.array, evaluator,
+                self.getOption('steps'), self.getOption('step_size'),
+                self.getOption('convergence'), self.getActions(),
+                'L-BFGS minimization with ' +
+                self.optionString(['convergence', 'step_size', 'steps',
+                                   'history']),
+                self.getOption('history'))
+        return self.run(lbfgs, args)
+
+#
+# FIRE minimizer
+#
+class FIREMinimizer(Minimizer):
+
+    """
+    FIRE (Fast Inertial Relaxation Engine) minimizer
+
+    The minimizer follows damped velocity-Verlet dynamics in which the
+    velocities are turned towards the direction of the forces, and set
+    to zero whenever the system starts moving uphill. The time step
+    grows while the energy keeps decreasing and shrinks after each
+    stop. No atom moves by more than step_size in one step, which makes
+    the minimizer robust for relaxing very bad contacts, e.g. in newly
+    built or solvated systems.
+
+    The minimizer can handle fixed atoms and distance constraints.
+    It is fully thread-safe.
+
+    The minimization is started by calling the minimizer object.
+    All the keyword options can be specified either when
+    creating the minimizer or when calling it.
+
+    The following data categories and variables are available for
+    output:
+
+     - category "configuration": configuration and box size (for
+       periodic universes)
+
+     - category "gradients": energy gradients for each atom
+
+     - category "energy": potential energy and
+                          norm of the potential energy gradient
+    """
+
+    default_options = Minimizer.default_options.copy()
+    default_options.update({'step_size': 0.1*Units.Ang,
+                            'delta_t': 1.*Units.fs,
+                            'max_delta_t': 10.*Units.fs,
+                            'constraint_solver': 'shake',
+                            'lincs_order': 4})
+
+    def __init__(self, universe, **options):
+        """
+        :param universe: the universe on which the integrator acts
+        :type universe: :class:`~MMTK.Universe.Universe`
+        :keyword steps: the number of minimization steps (default is 100)
+        :type steps: int
+        :keyword step_size: the maximal displacement of an atom in
+                            one step (default is 0.01 nm)
+        :type step_size: float
+        :keyword delta_t: the initial time step (default is 1 fs)
+        :type delta_t: float
+        :keyword max_delta_t: the largest time step (default is 10 fs)
+        :type max_delta_t: float
+        :keyword convergence: the root-mean-square gradient length at which
+                              minimization stops (default is 0.01 kJ/mol/nm)
+        :type convergence: float
+        :keyword constraint_solver: the method for the distance
+                                    constraints, "shake" (the default)
+                                    or "lincs"
+        :type constraint_solver: str
+        :keyword lincs_order: the expansion order of LINCS (default is 4)
+        :type lincs_order: int
+        :keyword actions: a list of actions to be executed periodically
+                          (default is none)
+        :type actions: list
+        :keyword threads: the number of threads to use in energy evaluation
+                          (default set by MMTK_ENERGY_THREADS)
+        :type threads: int
+        :keyword processes: the number of processes to use in energy
+                            evaluation (default set by
+                            MMTK_ENERGY_PROCESSES)
+        :type processes: int
+        :keyword background: if True, the integration is executed as a
+                             separate thread (default: False)
+        :type background: bool
+        :keyword mpi_communicator: an MPI communicator object, or None,
+                                   meaning no parallelization (default: None)
+        :type mpi_communicator: Scientific.MPI.MPICommunicator
+        """
+        Minimizer.__init__(self, universe, options)
+        self.features = [Features.FixedParticleFeature,
+                         Features.DistanceConstraintsFeature,
+                         Features.NoseThermostatFeature]
+
+    def __call__(self, **options):
+        """
+        Run the minimizer. The keyword options are the same as described
+        under __init__.
+        """
+        self.setCallOptions(options)
+        Features.checkFeatures(self, self.universe)
+        configuration = self.universe.configuration()
+        masses = self.universe.masses()
+        fixed = self.universe.getAtomBooleanArray('fixed')
+        nt = self.getOption('threads')
+        np = self.getOption('processes')
+        comm = self.getOption('mpi_communicator')
+        evaluator = self.universe.energyEvaluator(threads=nt,
+                                                  mpi_communicator=comm,
+                                                  processes=np)
+        evaluator = evaluator.CEvaluator()
+        constraints, const_distances_sq, c_blocks = \
+                     Dynamics._constraintArrays(self.universe)
+        method, lincs_order = \
+                Dynamics._constraintSolver(self.getOption('constraint_solver'),
+                                           self.getOption('lincs_order'))
+        args = (self.universe,
+                configuration.array, masses.array, fixed.array, evaluator,
+                constraints, const_distances_sq, c_blocks,
+                self.getOption('steps'), self.getOption('delta_t'),
+                self.getOption('max_delta_t'), self.getOption('step_size'),
+                self.getOption('convergence'), self.getActions(),
+                'FIRE minimization with ' +
+                self.optionString(['convergence', 'step_size', 'delta_t',
+                                   'max_delta_t', 'steps']),
+                method, lincs_order)
+        return self.run(minimizeFIRE, args)
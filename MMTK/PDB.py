@@ -15,11 +15,12 @@ that module are also available.
 
 __docformat__ = 'restructuredtext'
 
-from MMTK import ChemicalObjects, Collections, Database, Units, \
-                 Universe, Utility
+from MMTK import ChemicalObjects, Collections, Database, \
+                 ParticleProperties, Units, Universe, Utility
 from Scientific.Geometry import Vector
+from Scientific import N
 import Scientific.IO.PDB
-import copy, string
+import copy, cStringIO, hashlib, os, string
 
 #
 # The chain classes from Scientific.IO.PDB are extended by methods
@@ -210,15 +211,57 @@ class PDBConfiguration(Scientific.IO.PDB.Structure):
         :param alternate_code: the alternate code to be used for atoms that
                                have multiple positions
         :type alternate_code: str
+
+        The file is read into a :class:`~MMTK.PDB.PDBArrays` object,
+        available as the attribute arrays. The residue, chain, and
+        molecule objects are built from these arrays when one of them
+        is first accessed.
         """
 
         if isinstance(file_or_filename, basestring):
             file_or_filename = Database.PDBPath(file_or_filename)
-        Scientific.IO.PDB.Structure.__init__(self, file_or_filename,
-                                             model, alternate_code)
+            self.filename = file_or_filename
+        else:
+            self.filename = ''
+        self.model = model
+        self.alternate = alternate_code
+        self.arrays = PDBArrays(file_or_filename, alternate_code)
+        self._build_structure = True
+
+    # Attributes that are defined when the object hierarchy is built
+    _structure_attributes = ['pdb_code', 'residues', 'objects',
+                             'peptide_chains', 'nucleotide_chains',
+                             'molecules', 'to_fractional', 'from_fractional',
+                             'ncs_transformations', 'cs_transformations',
+                             'a', 'b', 'c', 'alpha', 'beta', 'gamma',
+                             'space_group', 'basis', 'reciprocal_basis']
+
+    def __getattr__(self, name):
+        if name in self._structure_attributes \
+               and self.__dict__.get('_build_structure', False):
+            self._buildStructure()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def _buildStructure(self):
+        self._build_structure = False
+        filename = self.filename
+        Scientific.IO.PDB.Structure.__init__(self, cStringIO.StringIO(''),
+                                             self.model, self.alternate)
+        self.filename = filename
+        self.parseFile(self.arrays._recordReader(self.model))
+        self.findSpaceGroupTransformations()
         self._numberAtoms()
         self._convertUnits()
 
+    def modelPositions(self):
+        """
+        :returns: the positions of the atoms in all models of the
+                  file, in the order of the atom records
+        :rtype: N.array of shape (M, N, 3)
+        """
+        return self.arrays.positions
+
     peptide_chain_constructor = PDBPeptideChain
     nucleotide_chain_constructor = PDBNucleotideChain
     molecule_constructor = PDBMolecule
@@ -231,14 +274,9 @@ class PDBConfiguration(Scientific.IO.PDB.Structure):
                 n += 1
 
     def _convertUnits(self):
+        # Positions and temperature factors are converted by PDBArrays.
         for residue in self.residues:
             for atom in residue:
-                atom.position = atom.position*Units.Ang
-                try:
-                    b = atom.properties['temperature_factor']
-                    atom.properties['temperature_factor'] = b*Units.Ang**2
-                except KeyError:
-                    pass
                 try:
                     u = atom.properties['u']
                     atom.properties['u'] = u*Units.Ang**2
@@ -319,8 +357,9 @@ class PDBConfiguration(Scientific.IO.PDB.Structure):
                   has the same meaning as for the PeptideChain constructor.
         :rtype: list
         """
-        return [chain.createPeptideChain(model)
-                for chain in self.peptide_chains]
+        return self._cached(('peptide_chains', model),
+                            lambda: [chain.createPeptideChain(model)
+                                     for chain in self.peptide_chains])
 
     def createNucleotideChains(self, model='all'):
         """
@@ -329,8 +368,9 @@ class PDBConfiguration(Scientific.IO.PDB.Structure):
                   has the same meaning as for the NucleotideChain constructor.
         :rtype: list
         """
-        return [chain.createNucleotideChain(model)
-                for chain in self.nucleotide_chains]
+        return self._cached(('nucleotide_chains', model),
+                            lambda: [chain.createNucleotideChain(model)
+                                     for chain in self.nucleotide_chains])
 
     def createMolecules(self, names = None, permit_undefined=True):
         """
@@ -423,6 +463,11 @@ class PDBConfiguration(Scientific.IO.PDB.Structure):
                   :func:`~MMTK.PDB.PDBConfiguration.createMolecules`.
         :rtype: :class:`~MMTK.Collectionc.Collection`
         """
+        return self._cached(('all', molecule_names, permit_undefined),
+                            lambda: self._createAll(molecule_names,
+                                                    permit_undefined))
+
+    def _createAll(self, molecule_names, permit_undefined):
         collection = Collections.Collection()
         peptide_chains = self.createPeptideChains()
         if peptide_chains:
@@ -434,6 +479,21 @@ class PDBConfiguration(Scientific.IO.PDB.Structure):
         collection.addObject(molecules)
         return collection
 
+    def _cached(self, options, function):
+        # Objects are taken from the object cache only if the
+        # object hierarchy has not been built yet, because after
+        # that it may have been modified and no longer correspond
+        # to the file contents.
+        cache = object_cache
+        if cache is None or not self.__dict__.get('_build_structure', False):
+            return function()
+        key = (self.model, self.alternate) + options
+        object = cache.retrieve(self.arrays.content_hash, key)
+        if object is None:
+            object = function()
+            cache.store(self.arrays.content_hash, key, object)
+        return object
+
     def asuToUnitCell(self, asu_contents, compact=True):
         """
         :param asu_contents: the molecules in the asymmetric unit, usually
@@ -485,6 +545,222 @@ PDBFile = PDBConfiguration
 #
 # Set atom coordinates from PDB configuration.
 #
+class PDBArrays(object):
+
+    """
+    Column-oriented contents of the atom records in a PDB file
+
+    The ATOM and HETATM records of a PDB file are converted into
+    arrays with one entry per atom, in the order of the records.
+    Atoms with alternate positions other than the selected one are
+    left out. The per-atom arrays refer to the first model of a
+    multiple-model file. Positions and temperature factors are
+    converted to MMTK units.
+
+    Attributes:
+
+     * record_type, name, alternate, residue_name, chain_id,
+       insertion_code, segment_id, element, charge: string arrays
+     * serial_number, residue_number: integer arrays
+     * occupancy, temperature_factor: float arrays
+     * positions: an array of shape (M, N, 3) with the positions of the
+       N atoms in each of the M models, or None if the models differ
+       in their number of atoms
+     * model_numbers: the serial numbers of the models, which is [0]
+       for a file without MODEL records
+    """
+
+    # The fixed columns of ATOM/HETATM records (0-based, exclusive end)
+    _columns = [('record_type', 0, 6), ('serial_number', 6, 11),
+                ('name', 12, 16), ('alternate', 16, 17),
+                ('residue_name', 17, 21), ('chain_id', 21, 22),
+                ('residue_number', 22, 26), ('insertion_code', 26, 27),
+                ('x', 30, 38), ('y', 38, 46), ('z', 46, 54),
+                ('occupancy', 54, 60), ('temperature_factor', 60, 66),
+                ('segment_id', 72, 76), ('element', 76, 78),
+                ('charge', 78, 80)]
+
+    def __init__(self, file_or_filename, alternate_code = 'A'):
+        """
+        :param file_or_filename: the name of a PDB file, or a file object
+        :param alternate_code: the alternate code to be used for atoms that
+                               have multiple positions
+        :type alternate_code: str
+        """
+        import numpy
+        from Scientific.IO.TextFile import TextFile
+        if isinstance(file_or_filename, basestring):
+            file = TextFile(file_or_filename)
+            text = file.read()
+            file.close()
+        else:
+            text = file_or_filename.read()
+        self.content_hash = hashlib.sha1(text).hexdigest()
+        # One pass over the lines separates atom records from the rest.
+        # The sequence of other records and blocks of atom records is
+        # kept for building the object hierarchy.
+        atom_lines = []
+        self._sequence = []
+        self._other_lines = []
+        model_starts = []
+        for line in text.splitlines():
+            line = line.rstrip()
+            if not line:
+                continue
+            line = line.ljust(80)
+            type = line[:6].strip()
+            if type == 'ATOM' or type == 'HETATM':
+                atom_lines.append(line[:80])
+                if self._sequence and isinstance(self._sequence[-1], int):
+                    self._sequence[-1] += 1
+                else:
+                    self._sequence.append(1)
+            else:
+                if type == 'MODEL':
+                    model_starts.append((int(line[10:14].strip() or 0),
+                                         len(atom_lines)))
+                self._other_lines.append(line)
+                self._sequence.append(line)
+        record_type = numpy.dtype({'names': [c[0] for c in self._columns],
+                                   'formats': ['S%d' % (c[2]-c[1])
+                                               for c in self._columns],
+                                   'offsets': [c[1] for c in self._columns],
+                                   'itemsize': 80})
+        records = numpy.fromstring(''.join(atom_lines), record_type)
+        alternate = numpy.char.strip(records['alternate'])
+        self._keep = numpy.logical_or(alternate == '',
+                                      alternate == alternate_code)
+        self._records = records
+        data = {}
+        for name in ['record_type', 'name', 'alternate', 'residue_name',
+                     'chain_id', 'insertion_code', 'segment_id', 'element',
+                     'charge']:
+            column = records[name]
+            if name != 'name':
+                column = numpy.char.strip(column)
+            data[name] = column
+        for name in ['serial_number', 'residue_number']:
+            data[name] = _numberColumn(records[name], int)
+        for name in ['occupancy', 'temperature_factor']:
+            data[name] = _numberColumn(records[name], float)
+        data['temperature_factor'] *= Units.Ang**2
+        positions = numpy.transpose([_numberColumn(records[name], float)
+                                     for name in 'xyz'])*Units.Ang
+        data['positions'] = positions
+        self._data = data
+        # Model boundaries in terms of the atom records that are kept
+        kept = numpy.concatenate([[0], numpy.add.accumulate(self._keep)])
+        if model_starts:
+            self.model_numbers = [m[0] for m in model_starts]
+            starts = [m[1] for m in model_starts]
+        else:
+            self.model_numbers = [0]
+            starts = [0]
+        self._model_ranges = zip(starts, starts[1:] + [len(records)])
+        ranges = [(kept[start], kept[end])
+                  for start, end in self._model_ranges]
+        first, last = ranges[0]
+        for name, column in data.items():
+            if name != 'positions':
+                setattr(self, name, column[self._keep][first:last])
+        positions = positions[self._keep]
+        sizes = [end-start for start, end in ranges]
+        if min(sizes) == max(sizes):
+            self.positions = numpy.array([positions[start:end]
+                                          for start, end in ranges])
+        else:
+            self.positions = None
+
+    def __len__(self):
+        return len(self.name)
+
+    def _recordReader(self, model):
+        if model == 0 or self.model_numbers == [0]:
+            start, end = 0, self._model_ranges[0][1]
+        else:
+            try:
+                start, end = self._model_ranges[
+                                 self.model_numbers.index(model)]
+            except ValueError:
+                start = end = 0
+        return _PDBArrayRecordReader(self, start, end)
+
+
+def _numberColumn(column, type):
+    import numpy
+    column = numpy.char.strip(column)
+    column[column == ''] = '0'
+    try:
+        return column.astype(type)
+    except ValueError:
+        # Overflowing fields, e.g. serial numbers in very large files
+        values = []
+        for value in column:
+            try:
+                values.append(type(value))
+            except ValueError:
+                values.append(type(0))
+        return numpy.array(values, type)
+
+
+class _PDBArrayRecordReader(object):
+
+    # Provides the readLine method of Scientific.IO.PDB.PDBFile, which
+    # is all that Structure.parseFile uses. Atom records are generated
+    # from the arrays of a PDBArrays object, the other records are
+    # parsed by PDBFile. Only the atoms records numbered from start to
+    # end are returned; the others are skipped.
+
+    def __init__(self, arrays, start, end):
+        self.arrays = arrays
+        self.other = Scientific.IO.PDB.PDBFile(cStringIO.StringIO(
+                           '\n'.join(arrays._other_lines) + '\n'))
+        data = arrays._data
+        self.columns = {}
+        for name in data.keys():
+            self.columns[name] = data[name].tolist()
+        self.keep = arrays._keep.tolist()
+        self.start = start
+        self.end = end
+        self.records = self._records()
+
+    def _records(self):
+        # The sequence consists of non-atom lines and the lengths of
+        # blocks of consecutive atom records.
+        first = 0
+        for item in self.arrays._sequence:
+            if isinstance(item, int):
+                for i in range(max(first, self.start),
+                               min(first+item, self.end)):
+                    if self.keep[i]:
+                        yield self._atomRecord(i)
+                first += item
+            else:
+                yield self.other.readLine()
+
+    def readLine(self):
+        try:
+            return self.records.next()
+        except StopIteration:
+            return ('END', '')
+
+    def _atomRecord(self, i):
+        c = self.columns
+        data = {'serial_number': c['serial_number'][i],
+                'name': c['name'][i],
+                'alternate': c['alternate'][i],
+                'residue_name': c['residue_name'][i],
+                'chain_id': c['chain_id'][i],
+                'residue_number': c['residue_number'][i],
+                'insertion_code': c['insertion_code'][i],
+                'position': Vector(c['positions'][i]),
+                'occupancy': c['occupancy'][i],
+                'temperature_factor': c['temperature_factor'][i],
+                'segment_id': c['segment_id'][i],
+                'element': c['element'][i],
+                'charge': c['charge'][i]}
+        return c['record_type'][i], data
+
 def setResidueConfiguration(object, pdb_residue, pdbmap, altmap,
                             atom_map = None):
     defined = 0
@@ -577,6 +853,142 @@ def defineMolecule(code, name):
         raise ValueError("PDB code " + code + " already used")
     molecule_names[code] = name
 
+#
+# An on-disk cache for objects constructed from PDB files
+#
+class PDBObjectCache(object):
+
+    """
+    On-disk cache of objects constructed from PDB files
+
+    The cache is used by the methods createPeptideChains,
+    createNucleotideChains, and createAll of
+    :class:`~MMTK.PDB.PDBConfiguration`, and thus also by the
+    construction of a :class:`~MMTK.Proteins.Protein` from a PDB
+    file, once it has been activated by :func:`~MMTK.PDB.setCacheDirectory`
+    or by the environment variable MMTKPDBCACHE. Objects are stored
+    in the pickle format used by :func:`~MMTK.save`, with one file per
+    combination of file contents (a SHA-1 hash) and construction
+    options (model, alternate code, and the method parameters).
+    Protonation states are derived from the file contents and are
+    therefore covered by the hash. The key also contains the MMTK
+    version and the names and modification times of the database
+    files that define atoms, groups, and molecules, such that
+    changes to these definitions are never hidden by old entries.
+    Each retrieval returns a new copy of the object.
+    """
+
+    # The database directories whose definitions enter the objects
+    _database_directories = ['Atoms', 'Groups', 'Molecules', 'Crystals',
+                             'Complexes']
+
+    def __init__(self, directory):
+        """
+        :param directory: the directory in which the objects are stored.
+                          It is created if necessary.
+        :type directory: str
+        """
+        self.directory = os.path.expanduser(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def filename(self, content_hash, options):
+        """
+        :param content_hash: the SHA-1 hash of the PDB file contents
+        :type content_hash: str
+        :param options: the construction options
+        :type options: tuple
+        :returns: the name of the file storing the object
+        :rtype: str
+        """
+        from MMTK import __version__
+        key = hashlib.sha1(repr((content_hash, options, __version__,
+                                 self.databaseVersion())))
+        return os.path.join(self.directory, key.hexdigest() + '.pickle')
+
+    def databaseVersion(self):
+        """
+        :returns: a hash of the names and modification times of the
+                  files in the database directories
+        :rtype: str
+        """
+        entries = []
+        for directory in Database.path:
+            if Utility.isURL(directory):
+                entries.append(directory)
+                continue
+            for subdirectory in self._database_directories:
+                subdirectory = os.path.join(directory, subdirectory)
+                try:
+                    names = os.listdir(subdirectory)
+                except OSError:
+                    continue
+                names.sort()
+                for name in names:
+                    filename = os.path.join(subdirectory, name)
+                    entries.append((filename, os.path.getmtime(filename)))
+        return hashlib.sha1(repr(entries)).hexdigest()
+
+    def retrieve(self, content_hash, options):
+        """
+        :returns: the cached object, or None if there is none
+        """
+        try:
+            file = open(self.filename(content_hash, options), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return Utility.Unpickler(file).load()
+            except Exception:
+                # Incomplete or outdated files are treated as absent
+                return None
+        finally:
+            file.close()
+
+    def store(self, content_hash, options, object):
+        """
+        Adds an object to the cache. The file is written under a
+        temporary name and then renamed, such that several processes
+        can share a cache directory.
+        """
+        filename = self.filename(content_hash, options)
+        temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        file = open(temp_filename, 'wb')
+        try:
+            Utility.Pickler(file, 2).dump(object)
+        finally:
+            file.close()
+        os.rename(temp_filename, filename)
+
+    def clear(self):
+        """
+        Removes all objects from the cache.
+        """
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.pickle'):
+                os.remove(os.path.join(self.directory, filename))
+
+object_cache = None
+
+def setCacheDirectory(directory):
+    """
+    Activates the on-disk cache for objects constructed from PDB files
+    (see :class:`~MMTK.PDB.PDBObjectCache`).
+
+    :param directory: the cache directory, or None to deactivate
+                      the cache
+    :type directory: str
+    """
+    global object_cache
+    if directory is None:
+        object_cache = None
+    else:
+        object_cache = PDBObjectCache(directory)
+
+if os.environ.has_key('MMTKPDBCACHE'):
+    setCacheDirectory(os.environ['MMTKPDBCACHE'])
+
 #
 # This object represents a PDB file for output.
 #
@@ -597,6 +1009,7 @@ class PDBOutputFile(object):
         :type subformat: str
         """
         self.file = Scientific.IO.PDB.PDBFile(filename, 'w', subformat)
+        self.subformat = subformat
         self.warning = False
         self.atom_sequence = []
         self.model_number = None
@@ -670,6 +1083,30 @@ class PDBOutputFile(object):
                         self.write(a, configuration, tag)
                     delattr(a, tag)
 
+    def writeModels(self, object, configurations):
+        """
+        Write an object once for each configuration in a sequence, each
+        time as a new model. The records for the object are generated
+        only once; for each model, the coordinates are inserted into
+        this template by a single formatting operation.
+
+        :param object: the object to be written
+        :type object: :class:`~MMTK.Collections.GroupOfAtoms`
+        :param configurations: a sequence of configurations, e.g. the
+                               variable "configuration" of a trajectory
+        """
+        template = None
+        for configuration in configurations:
+            if template is None:
+                template = _PDBModelTemplate(object, self.subformat,
+                                             configuration)
+            self.nextModel()
+            if template.write(self.file.file, configuration):
+                self.atom_sequence.extend(template.atom_sequence)
+                self.warning = self.warning or template.warning
+            else:
+                self.write(object, configuration)
+
     def close(self):
         """
         Closes the file. Must be called in order to prevent data loss.
@@ -681,3 +1118,53 @@ class PDBOutputFile(object):
             Utility.warning('Some atoms are missing in the output file ' + \
                             'because their positions are undefined.')
             self.warning = False
+
+
+class _PDBModelTemplate(object):
+
+    # The PDB records for one model, with format specifiers in place
+    # of the coordinates. The records are produced by PDBOutputFile.write
+    # for a configuration in which all positions are defined, such that
+    # every atom of the object is included. Configurations with undefined
+    # positions are written atom by atom instead.
+
+    def __init__(self, object, subformat, configuration):
+        complete = ParticleProperties.Configuration(
+                       configuration.universe, None,
+                       configuration.cell_parameters)
+        output = cStringIO.StringIO()
+        pdb = PDBOutputFile(output, subformat)
+        pdb.write(object, complete)
+        text = output.getvalue()
+        self.atom_sequence = pdb.atom_sequence
+        self.warning = pdb.warning
+        pdb.close()
+        self.indices = N.array([a.index for a in self.atom_sequence])
+        self.format = None
+        lines = []
+        natoms = 0
+        for line in text.splitlines():
+            if line[:6] in ['ATOM  ', 'HETATM']:
+                natoms += 1
+                lines.append(line[:30].replace('%', '%%')
+                             + '%8.3f%8.3f%8.3f'
+                             + line[54:].replace('%', '%%'))
+            else:
+                lines.append(line.replace('%', '%%'))
+        if natoms == len(self.indices):
+            self.format = ''.join([line + '\n' for line in lines])
+
+    def write(self, file, configuration):
+        # Returns False if the template can't be used for the
+        # configuration, which must then be written atom by atom.
+        if self.format is None:
+            return False
+        if len(self.indices) == 0:
+            file.write(self.format)
+            return True
+        coordinates = N.take(configuration.array, self.indices)
+        if N.maximum.reduce(N.ravel(coordinates)) > Utility.undefined_limit:
+            return False
+        coordinates = N.ravel(coordinates/Units.Ang)
+        file.write(self.format % tuple(coordinates.tolist()))
+        return True
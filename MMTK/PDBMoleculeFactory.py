@@ -69,6 +69,7 @@ class PDBMoleculeFactory(MoleculeFactory):
         self.peptide_chains = []
         self.nucleotide_chains = []
         self.molecules = {}
+        self.findBonds()
         self.makeAll()
 
     def retrieveMolecules(self):
@@ -238,24 +239,17 @@ class PDBMoleculeFactory(MoleculeFactory):
         self.setAttribute(chain_id, 'sequence', local_resnames)
         for i in range(1, len(chain)):
             if chain[i-1].number == chain[i].number-1:
-                for atom1 in chain[i-1]:
-                    for atom2 in chain[i]:
-                        if self.assumeBond(atom1.properties['element'],
-                                           atom1.position,
-                                           atom2.properties['element'],
-                                           atom2.position):
-                            self.addBond(chain_id,
-                                         local_resnames[i-1]+'.'+atom1.name,
-                                         local_resnames[i]+'.'+atom2.name)
-                       
+                for atom1, atom2 in self.bondedPairs(list(chain[i-1]),
+                                                     list(chain[i])):
+                    self.addBond(chain_id,
+                                 local_resnames[i-1]+'.'+atom1.name,
+                                 local_resnames[i]+'.'+atom2.name)
+
     def makeResidue(self, residue, group_name):
         self.createGroup(group_name)
         self.setAttribute(group_name, 'residue_name', residue.name)
         self.setAttribute(group_name, 'residue_number', residue.number)
-        atoms = []
         for atom in residue:
-            atoms.append((atom.name, atom.properties['element'],
-                          atom.position))
             self.addAtom(group_name, atom.name, atom.properties['element'])
             self.setPosition(group_name, atom.name, atom.position)
             self.setAttribute(group_name, atom.name+'.temperature_factor',
@@ -267,12 +261,71 @@ class PDBMoleculeFactory(MoleculeFactory):
             if atom.properties.has_key('u'):
                 self.setAttribute(group_name, atom.name+'.u',
                                   atom.properties['u'])
-        for i in range(len(atoms)):
-            atom_i, element_i, pos_i = atoms[i]
-            for j in range(i+1, len(atoms)):
-                atom_j, element_j, pos_j = atoms[j]
-                if self.assumeBond(element_i, pos_i, element_j, pos_j):
-                    self.addBond(group_name, atom_i, atom_j)
+        for atom1, atom2 in self.bondedPairs(list(residue)):
+            self.addBond(group_name, atom1.name, atom2.name)
+
+    def findBonds(self):
+        """
+        Identifies all bonded atom pairs in the PDBConfiguration in a
+        single grid-based neighbor search. The results are used by
+        :meth:`bondedPairs` during the construction of the molecules.
+        """
+        atoms = []
+        for residue in self.pdb_conf.residues:
+            atoms.extend(list(residue))
+        self.bond_partners = dict((id(atom), []) for atom in atoms)
+        if not atoms:
+            return
+        elements = [atom.properties['element'] for atom in atoms]
+        positions = N.array([atom.position.array for atom in atoms])
+        for i, j in _bondedPairs(elements, positions, self.bond_lengths):
+            self.bond_partners[id(atoms[i])].append(atoms[j])
+            self.bond_partners[id(atoms[j])].append(atoms[i])
+
+    def bondedPairs(self, atoms1, atoms2=None):
+        """
+        :param atoms1: a list of atoms (as defined in Scientific.IO.PDB)
+        :type atoms1: list
+        :param atoms2: a second list of atoms. If None, pairs within
+                       atoms1 are returned.
+        :type atoms2: list
+        :returns: the pairs of bonded atoms (atom1, atom2), with atom1
+                  taken from atoms1 and atom2 from atoms2, in the order
+                  of the two lists
+        :rtype: list
+        """
+        same_list = atoms2 is None
+        if same_list:
+            atoms2 = atoms1
+        partners = getattr(self, 'bond_partners', {})
+        if type(self).assumeBond.im_func is not \
+               PDBMoleculeFactory.assumeBond.im_func or \
+           not all(partners.has_key(id(atom)) for atom in atoms1):
+            # Atoms outside of the PDBConfiguration, or a subclass
+            # defining its own bond criterion: test all pairs.
+            pairs = []
+            for i in range(len(atoms1)):
+                atom1 = atoms1[i]
+                if same_list:
+                    candidates = atoms2[i+1:]
+                else:
+                    candidates = atoms2
+                for atom2 in candidates:
+                    if self.assumeBond(atom1.properties['element'],
+                                       atom1.position,
+                                       atom2.properties['element'],
+                                       atom2.position):
+                        pairs.append((atom1, atom2))
+            return pairs
+        index2 = dict((id(atom), j) for j, atom in enumerate(atoms2))
+        pairs = []
+        for i, atom1 in enumerate(atoms1):
+            for partner in partners[id(atom1)]:
+                j = index2.get(id(partner), None)
+                if j is not None and (not same_list or j > i):
+                    pairs.append((i, j, atom1, partner))
+        pairs.sort()
+        return [(atom1, atom2) for i, j, atom1, atom2 in pairs]
 
     def assumeBond(self, element1, pos1, element2, pos2):
         if element1 > element2:
@@ -302,3 +355,65 @@ class PDBMoleculeFactory(MoleculeFactory):
                     ('P', 'S'): 0.2,
                     ('S', 'S'): 0.25,
                     }
+
+
+#
+# Grid-based search for bonded atom pairs. The atoms are sorted into
+# cubic cells whose size is the largest bond length cutoff, such that
+# bonded partners of an atom can only be found in its own cell
+# or in one of the 26 neighboring cells. The candidate pairs for each
+# of the 27 cell offsets are generated and tested as arrays.
+#
+def _bondedPairs(elements, positions, bond_lengths):
+    element_names = list(set(elements))
+    element_index = dict((e, i) for i, e in enumerate(element_names))
+    codes = N.array([element_index[e] for e in elements])
+    nelements = len(element_names)
+    cutoff = N.zeros((nelements, nelements), N.Float)
+    for (e1, e2), d in bond_lengths.items():
+        if element_index.has_key(e1) and element_index.has_key(e2):
+            i1 = element_index[e1]
+            i2 = element_index[e2]
+            cutoff[i1, i2] = cutoff[i2, i1] = d
+    cell_size = N.maximum.reduce(N.ravel(cutoff))
+    if cell_size == 0.:
+        return N.zeros((0, 2), N.Int)
+    cells = N.floor((positions-N.minimum.reduce(positions))
+                    / cell_size).astype(N.Int) + 1
+    ncells = N.maximum.reduce(cells) + 2
+    factors = N.array([ncells[1]*ncells[2], ncells[2], 1])
+    keys = N.dot(cells, factors)
+    order = N.argsort(keys)
+    sorted_keys = N.take(keys, order)
+    sorted_positions = N.take(positions, order, axis=0)
+    sorted_codes = N.take(codes, order)
+    natoms = len(keys)
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                neighbor_keys = sorted_keys + N.dot((dx, dy, dz), factors)
+                first = N.searchsorted(sorted_keys, neighbor_keys, 'left')
+                last = N.searchsorted(sorted_keys, neighbor_keys, 'right')
+                counts = last - first
+                total = N.add.reduce(counts)
+                if total == 0:
+                    continue
+                i = N.repeat(N.arange(natoms), counts)
+                offsets = N.cumsum(counts) - counts
+                j = N.repeat(first - offsets, counts) + N.arange(total)
+                mask = i < j
+                i = N.compress(mask, i)
+                j = N.compress(mask, j)
+                d = N.take(sorted_positions, i, axis=0) \
+                    - N.take(sorted_positions, j, axis=0)
+                d = N.sqrt(N.add.reduce(d*d, -1))
+                d_max = cutoff[N.take(sorted_codes, i),
+                               N.take(sorted_codes, j)]
+                mask = d < d_max
+                pairs.append(N.transpose(N.array([N.compress(mask, i),
+                                                  N.compress(mask, j)])))
+    if not pairs:
+        return N.zeros((0, 2), N.Int)
+    pairs = N.take(order, N.concatenate(pairs))
+    return N.sort(pairs, axis=1)
@@ -0,0 +1,307 @@
+# This module implements temperature replica exchange.
+#
+# Written by Konrad Hinsen
+#
+
+"""
+Temperature replica exchange
+
+A replica exchange simulation runs copies (replicas) of a universe at
+different temperatures. After each segment of Molecular Dynamics, the
+configurations of replicas at neighbouring temperatures are exchanged
+with the Metropolis acceptance probability
+min(1, exp((1/kT_i-1/kT_j)(E_i-E_j))), where E is the potential energy.
+The velocities of an exchanged configuration are rescaled to the new
+temperature.
+"""
+
+__docformat__ = 'restructuredtext'
+
+from MMTK import Environment, ParticleProperties, Trajectory, Units, Utility
+from MMTK.Dynamics import VelocityVerletIntegrator
+from Scientific import N
+import copy, os, random
+
+try:
+    import threading
+    if not hasattr(threading, 'Thread'):
+        threading = None
+except ImportError:
+    threading = None
+
+
+class ReplicaExchange(Trajectory.TrajectoryGenerator):
+
+    """
+    Temperature replica exchange driver
+
+    A ReplicaExchange object owns one copy of a universe for each
+    temperature. Each call runs a number of cycles, each of which
+    consists of a Molecular Dynamics segment for every replica followed
+    by exchange attempts between neighbouring temperatures, alternating
+    between the even and the odd pairs. The segments of the replicas
+    are run concurrently in separate threads; the integrators release
+    the global interpreter lock during integration.
+
+    Exchanges move configurations between replicas, so the trajectory
+    of replica i always contains the states at temperature i. The
+    attribute walkers lists, for each temperature, the index of the
+    replica from which its configuration originated at the start.
+
+    The thermostat is a :class:`~MMTK.Environment.NoseThermostat` that
+    is added to each replica (or adjusted if the universe already has
+    one), unless the integrator has a temperature option of its own,
+    such as :class:`~MMTK.Dynamics.LangevinIntegrator`.
+
+    All the keyword options (see documentation of __init__) can be
+    specified either when creating the driver or when calling it.
+    """
+
+    default_options = {'cycles': 10, 'steps': 1000,
+                       'integrator': VelocityVerletIntegrator,
+                       'integrator_options': {},
+                       'trajectory': None, 'data': None, 'skip': 100,
+                       'log': None, 'restart': None,
+                       'seed': None, 'parallel': True}
+
+    def __init__(self, universe, temperatures, **options):
+        """
+        :param universe: the universe of which the replicas are copies.
+                         It is not modified by the replica exchange.
+        :type universe: :class:`~MMTK.Universe.Universe`
+        :param temperatures: the temperatures of the replicas, in
+                             increasing order
+        :type temperatures: sequence of float
+        :keyword cycles: the number of cycles per call (default: 10)
+        :type cycles: int
+        :keyword steps: the number of integration steps per cycle
+                        (default: 1000)
+        :type steps: int
+        :keyword integrator: the integrator class
+                             (default: VelocityVerletIntegrator)
+        :keyword integrator_options: options passed to the integrators,
+                                     e.g. delta_t or threads
+        :type integrator_options: dict
+        :keyword trajectory: the name of the trajectory file for each
+                             replica, containing '%d' for the replica
+                             index (default: no trajectories)
+        :type trajectory: str
+        :keyword data: the data categories written to the trajectories
+                       (default: those of
+                       :class:`~MMTK.Trajectory.TrajectoryOutput`)
+        :type data: list
+        :keyword skip: the number of steps between two trajectory
+                       frames (default: 100)
+        :type skip: int
+        :keyword log: the name of a text file to which the exchange
+                      attempts are written (default: no log)
+        :type log: str
+        :keyword restart: the name of a file to which the state of the
+                          simulation is written after each cycle, for
+                          use with :meth:`readRestart` (default: none)
+        :type restart: str
+        :keyword seed: the seed for the exchange decisions
+        :type seed: int
+        :keyword parallel: if True (the default), the segments of the
+                           replicas run concurrently in separate threads
+        :type parallel: bool
+        """
+        Trajectory.TrajectoryGenerator.__init__(self, universe, options)
+        self.call_options = {}
+        self.temperatures = list(temperatures)
+        if len(self.temperatures) < 2:
+            raise ValueError("replica exchange needs at least two replicas")
+        self.beta = [1./(Units.k_B*t) for t in self.temperatures]
+        self.cycle = 0
+        self.walkers = range(len(self.temperatures))
+        self.random = random.Random(self.getOption('seed'))
+        integrator_class = self.getOption('integrator')
+        own_temperature = 'temperature' in integrator_class.default_options
+        self.replicas = []
+        self.integrators = []
+        for t in self.temperatures:
+            replica = copy.copy(universe)
+            if replica.velocities() is None:
+                replica.initializeVelocitiesToTemperature(t)
+            if not own_temperature:
+                thermostats = replica.environmentObjectList(
+                                               Environment.NoseThermostat)
+                if thermostats:
+                    thermostats[0].setTemperature(t)
+                else:
+                    replica.thermostat = Environment.NoseThermostat(t)
+            self.replicas.append(replica)
+            integrator_options = copy.copy(self.getOption('integrator_options'))
+            if own_temperature:
+                integrator_options['temperature'] = t
+            self.integrators.append(integrator_class(replica,
+                                                     **integrator_options))
+
+    def __call__(self, **options):
+        """
+        Run the replica exchange simulation. The keyword options are
+        the same as described under __init__.
+        """
+        self.setCallOptions(options)
+        cycles = self.getOption('cycles')
+        steps = self.getOption('steps')
+        skip = self.getOption('skip')
+        trajectories = self._openTrajectories()
+        log = self.getOption('log')
+        if log is not None:
+            log = open(log, 'a')
+        try:
+            for cycle in range(self.cycle, self.cycle+cycles):
+                first_output = cycle*steps
+                if cycle > 0:
+                    first_output = first_output + skip
+                actions = []
+                for t in trajectories:
+                    if t is None:
+                        actions.append([])
+                    else:
+                        actions.append([Trajectory.TrajectoryOutput(
+                                                t, self.getOption('data'),
+                                                first_output, None, skip)])
+                self._runSegments(cycle*steps, (cycle+1)*steps, actions)
+                self._exchange(cycle, (cycle+1)*steps, log)
+                self.cycle = cycle+1
+                restart = self.getOption('restart')
+                if restart is not None:
+                    self.writeRestart(restart)
+        finally:
+            for t in trajectories:
+                if t is not None:
+                    t.close()
+            if log is not None:
+                log.close()
+
+    def _openTrajectories(self):
+        filename = self.getOption('trajectory')
+        if filename is None:
+            return len(self.replicas)*[None]
+        trajectories = []
+        for i in range(len(self.replicas)):
+            if self.cycle > 0:
+                t = Trajectory.Trajectory(self.replicas[i], filename % i, 'a')
+            else:
+                t = Trajectory.Trajectory(self.replicas[i], filename % i, 'w',
+                                        'Replica exchange trajectory at T=%g K'
+                                        % (self.temperatures[i]/Units.K))
+            trajectories.append(t)
+        return trajectories
+
+    def _runSegments(self, first_step, last_step, actions):
+        def run(i, errors):
+            try:
+                self.integrators[i](first_step=first_step, steps=last_step,
+                                    actions=actions[i])
+            except Exception, e:
+                errors.append(e)
+        errors = []
+        if self.getOption('parallel') and threading is not None:
+            threads = [threading.Thread(target=run, args=(i, errors))
+                       for i in range(len(self.replicas))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        else:
+            for i in range(len(self.replicas)):
+                run(i, errors)
+        if errors:
+            raise errors[0]
+
+    def _exchange(self, cycle, step, log):
+        energies = [replica.energy() for replica in self.replicas]
+        for i in range(cycle % 2, len(self.replicas)-1, 2):
+            j = i+1
+            delta = (self.beta[i]-self.beta[j])*(energies[i]-energies[j])
+            if delta >= 0.:
+                probability = 1.
+            else:
+                probability = N.exp(delta)
+            accepted = self.random.random() < probability
+            if accepted:
+                self._swap(i, j)
+                energies[i], energies[j] = energies[j], energies[i]
+                self.walkers[i], self.walkers[j] = \
+                                 self.walkers[j], self.walkers[i]
+            if log is not None:
+                log.write('%d %d %d %d %.8g %.8g %.6f %d\n'
+                          % (cycle, step, i, j, energies[i], energies[j],
+                             probability, accepted))
+        if log is not None:
+            log.write('# walkers %s\n' % ' '.join(map(str, self.walkers)))
+            log.flush()
+
+    def _swap(self, i, j):
+        ri = self.replicas[i]
+        rj = self.replicas[j]
+        conf_i = ri.copyConfiguration()
+        conf_j = rj.copyConfiguration()
+        vel_i = N.array(ri.velocities().array)
+        vel_j = N.array(rj.velocities().array)
+        ri.setConfiguration(ParticleProperties.Configuration(
+                                ri, conf_j.array, conf_j.cell_parameters))
+        rj.setConfiguration(ParticleProperties.Configuration(
+                                rj, conf_i.array, conf_i.cell_parameters))
+        scale = N.sqrt(self.temperatures[i]/self.temperatures[j])
+        ri.setVelocities(ParticleProperties.ParticleVector(ri, scale*vel_j))
+        rj.setVelocities(ParticleProperties.ParticleVector(rj, vel_i/scale))
+
+    def writeRestart(self, filename):
+        """
+        Write the state of the simulation (configurations, velocities,
+        thermostat coordinates, exchange bookkeeping) to a file.
+
+        :param filename: the name of the restart file
+        :type filename: str
+        """
+        state = {'temperatures': self.temperatures,
+                 'cycle': self.cycle,
+                 'walkers': self.walkers,
+                 'random': self.random.getstate(),
+                 'configurations': [], 'cells': [], 'velocities': [],
+                 'thermostats': []}
+        for replica in self.replicas:
+            conf = replica.copyConfiguration()
+            state['configurations'].append(conf.array)
+            state['cells'].append(conf.cell_parameters)
+            state['velocities'].append(N.array(replica.velocities().array))
+            state['thermostats'].append(
+                [N.array(o.coordinates) for o in replica.environmentObjectList()
+                 if hasattr(o, 'coordinates')])
+        temp_filename = filename + '.tmp'
+        Utility.save(state, temp_filename)
+        os.rename(temp_filename, filename)
+
+    def readRestart(self, filename):
+        """
+        Restore the state of a simulation from a file written by
+        :meth:`writeRestart`. The next call continues with the cycle
+        following the last one that was completed, and appends to
+        the trajectories.
+
+        :param filename: the name of the restart file
+        :type filename: str
+        """
+        state = Utility.load(filename)
+        if len(state['temperatures']) != len(self.temperatures) \
+           or N.logical_or.reduce(N.fabs(N.array(state['temperatures'])
+                                         - N.array(self.temperatures))
+                                  > 1.e-10*self.temperatures[-1]):
+            raise ValueError("restart file is for different temperatures")
+        self.cycle = state['cycle']
+        self.walkers = state['walkers']
+        self.random.setstate(state['random'])
+        for i, replica in enumerate(self.replicas):
+            replica.setConfiguration(ParticleProperties.Configuration(
+                                         replica, state['configurations'][i],
+                                         state['cells'][i]))
+            replica.setVelocities(ParticleProperties.ParticleVector(
+                                      replica, state['velocities'][i]))
+            objects = [o for o in replica.environmentObjectList()
+                       if hasattr(o, 'coordinates')]
+            for o, coordinates in zip(objects, state['thermostats'][i]):
+                o.coordinates[:] = coordinates
@@ -13,7 +13,7 @@ from MMTK import Collections, Units, Universe, Utility, \
                  ParticleProperties, Visualization
 from Scientific.Geometry import Vector
 from Scientific import N
-import copy, os, sys
+import bisect, copy, cPickle, itertools, os, sys
 
 # Report error if the netCDF module is not available.
 try:
@@ -59,10 +59,18 @@ class Trajectory(object):
     is "configuration", which stores the positions of all atoms.
     Other common variables are "time", "velocities", "temperature",
     "pressure", and various energy terms whose name end with "_energy".
+
+    A trajectory file can store the data for a subset of the atoms
+    only (see the parameter subset below). Per-atom data read from
+    such a file still refers to the complete universe, with undefined
+    values for the atoms that were not stored. The attribute subset is
+    a :class:`~MMTK.Collections.Collection` of the stored atoms, or
+    None if all atoms are stored.
     """
 
     def __init__(self, object, filename, mode = 'r', comment = None,
-                 double_precision = False, cycle = 0, block_size = 1):
+                 double_precision = False, cycle = 0, block_size = 1,
+                 subset = None):
         """
         :param object: the object whose data is stored in the trajectory file.
                        This can be 'None' when opening a file for reading;
@@ -102,6 +110,18 @@ class Trajectory(object):
                            always used a block size of 1 and cannot handle
                            trajectories with different block sizes.
         :type block_size: int
+        :param subset: the atoms whose data is stored in a new trajectory
+                       file. The file contains the description of the
+                       complete universe and the indices of the stored
+                       atoms. When the trajectory is read, per-atom data
+                       for the complete universe is returned, with
+                       undefined values for the atoms that were not stored.
+                       The default (None) is to store all atoms. A subset
+                       can be specified only when object is a universe.
+                       When the file exists already (mode "a"), the subset
+                       must be identical to the one stored in the file,
+                       but it need not be given again.
+        :type subset: :class:`~MMTK.Collections.GroupOfAtoms`
         """
         filename = os.path.expanduser(filename)
         self.filename = filename
@@ -113,6 +133,7 @@ class Trajectory(object):
                 self.block_size = file.dimensions['minor_step_number']
             except KeyError:
                 self.block_size = 1
+            subset_file = 'atom_index' in file.variables
             conf = None
             cell = None
             if self.block_size == 1:
@@ -135,7 +156,12 @@ class Trajectory(object):
             import Skeleton
             local = {}
             skeleton = eval(description, vars(Skeleton), local)
-            universe = skeleton.make({}, conf)
+            if subset_file:
+                # The stored configuration covers only some atoms; the
+                # complete configuration is set from the trajectory below.
+                universe = skeleton.make({})
+            else:
+                universe = skeleton.make({}, conf)
             universe.setCellParameters(cell)
             object = universe
             initialize = 1
@@ -160,6 +186,12 @@ class Trajectory(object):
             for o in Collections.Collection(object):
                 toplevel.add(o.topLevelChemicalObject())
             object = Collections.Collection(list(toplevel))
+        if subset is not None:
+            if mode == 'r':
+                raise ValueError("can't select a subset for reading")
+            if object is not universe:
+                raise ValueError("a subset can be stored only for a universe")
+            index_map = N.array(sorted([a.index for a in subset.atomList()]))
         if description is None:
             description = universe.description(object, inverse_map)
         import MMTK_trajectory
@@ -170,6 +202,9 @@ class Trajectory(object):
                                                      block_size)
         self.universe = universe
         self.index_map = index_map
+        if subset is not None:
+            self._storeAtomIndex(index_map)
+        self._setupSubset()
         try:
             self.block_size = \
                        self.trajectory.file.dimensions['minor_step_number']
@@ -181,8 +216,43 @@ class Trajectory(object):
             self.trajectory.file.comment = comment
         if initialize and conf is not None:
             self.universe.setFromTrajectory(self)
+        self.atom_major = None
+        if mode == 'r':
+            self.atom_major = AtomMajorTrajectory.openCompanion(self)
         self.particle_trajectory_reader = ParticleTrajectoryReader(self)
 
+    def _storeAtomIndex(self, index_map):
+        file = self.trajectory.file
+        try:
+            atom_index = file.variables['atom_index'][:]
+        except KeyError:
+            if len(self) > 0:
+                self.trajectory.close()
+                raise ValueError("trajectory file stores all atoms")
+            var = file.createVariable('atom_index', 'l', ('atom_number',))
+            var[:] = index_map.astype(N.Int32)
+            return
+        if len(atom_index) != len(index_map) \
+               or N.logical_or.reduce(atom_index != index_map):
+            self.trajectory.close()
+            raise ValueError("subset differs from the one in the "
+                             "trajectory file")
+
+    def _setupSubset(self):
+        self.subset = None
+        self.atom_rows = None
+        try:
+            atom_index = self.trajectory.file.variables['atom_index'][:]
+        except KeyError:
+            return
+        atoms = self.universe.numberOfAtoms()*[None]
+        for a in self.universe.atomList():
+            atoms[a.index] = a
+        self.subset = Collections.Collection([atoms[i] for i in atom_index])
+        self.atom_rows = {}
+        for i in range(len(atom_index)):
+            self.atom_rows[int(atom_index[i])] = i
+
     def __getstate__(self):
         if self.mode != 'r':
             raise ValueError("Cannot copy or pickle write-mode trajectories")
@@ -204,6 +274,9 @@ class Trajectory(object):
         ensure that all buffered data is written to the file. No data
         access is possible after closing a file.
         """
+        if self.atom_major is not None:
+            self.atom_major.close()
+            self.atom_major = None
         self.trajectory.close()
 
     def __len__(self):
@@ -255,6 +328,8 @@ class Trajectory(object):
         except KeyError:
             raise AttributeError("no variable named " + name)
         if 'atom_number' in var.dimensions:
+            if 'step_number' not in var.dimensions:
+                return var[:]
             return TrajectoryVariable(self.universe, self, name)
         elif 'box_size_length' in var.dimensions:
             if 'minor_step_number' in var.dimensions:
@@ -301,9 +376,52 @@ class Trajectory(object):
         :type variable: str
         :returns: the trajectory for a single atom
         :rtype: :class:`~MMTK.Trajectory.ParticleTrajectory`
+
+        If an up-to-date atom-major companion file (see
+        :func:`~MMTK.Trajectory.transposeTrajectory`) exists for the
+        trajectory, the data is read from it.
         """
         return ParticleTrajectory(self, atom, first, last, skip, variable)
 
+    def map(self, function, reducer=None, chunk_size=100, processes=None,
+            progress=None):
+        """
+        Apply a function to every step of the trajectory, distributing
+        the work over several processes. Each process opens the trajectory
+        file independently and thus works on its own copy of the universe.
+        The configuration of that universe is set to the configuration
+        of each step before the function is called.
+
+        Since the function and the reducer are sent to the worker
+        processes, they must be picklable, i.e. defined at the top level
+        of a module.
+
+        :param function: a function that is called with the data for one
+                         step (the dictionary returned by indexing the
+                         trajectory) and returns the result for that step
+        :type function: callable
+        :param reducer: None, or a function of two arguments that combines
+                        two results into one (e.g. operator.add). The
+                        results of each chunk are combined in the worker
+                        processes, the partial results in the calling
+                        process, always in the order of the steps.
+        :type reducer: callable
+        :param chunk_size: the number of steps handed to a worker
+                           process at a time
+        :type chunk_size: int
+        :param processes: the number of worker processes. The default
+                          (None) is the number of processors. With a
+                          value of 1, the work is done in the calling
+                          process.
+        :type processes: int
+        :param progress: a :class:`~MMTK.ProgressOutput.ProgressOutput`
+                         object that is updated after each chunk
+        :returns: the list of the results for all steps if no reducer
+                  is given, or else the combined result
+        """
+        return _mapTrajectory(self, function, reducer, chunk_size,
+                              processes, progress)
+
     def readRigidBodyTrajectory(self, object, first=0, last=None, skip=1,
                                 reference = None):
         """
@@ -336,9 +454,10 @@ class Trajectory(object):
         """
         vars = copy.copy(self.trajectory.file.variables.keys())
         vars.remove('step')
-        try:
-            vars.remove('description')
-        except ValueError: pass
+        for name in ['description', 'atom_index']:
+            try:
+                vars.remove(name)
+            except ValueError: pass
         return vars
 
     def view(self, first=0, last=None, skip=1, object = None):
@@ -364,7 +483,8 @@ class Trajectory(object):
     def _boxTransformation(self, pt_in, pt_out, to_box=0):
         from MMTK_trajectory import boxTransformation
         try:
-            box_size = self.trajectory.recently_read_box_size
+            box_size = self.particle_trajectory_reader._trajectory \
+                           .recently_read_box_size
         except AttributeError:
             return
         boxTransformation(self.universe._spec,
@@ -386,6 +506,12 @@ class SubTrajectory(object):
         self.indices = indices
         self.universe = trajectory.universe
 
+    def __getstate__(self):
+        return self.trajectory, self.indices
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
     def __len__(self):
         return len(self.indices)
 
@@ -408,8 +534,8 @@ class SubTrajectory(object):
         indices = self.indices[first:last:skip]
         first = indices[0]
         last = indices[-1]+1
-        if len(self.indices) > 1:
-            skip = self.indices[1]-self.indices[0]
+        if len(indices) > 1:
+            skip = indices[1]-indices[0]
         else:
             skip = 1
         return self.trajectory.readParticleTrajectory(atom, first, last,
@@ -422,8 +548,8 @@ class SubTrajectory(object):
         indices = self.indices[first:last:skip]
         first = indices[0]
         last = indices[-1]+1
-        if len(self.indices) > 1:
-            skip = self.indices[1]-self.indices[0]
+        if len(indices) > 1:
+            skip = indices[1]-indices[0]
         else:
             skip = 1
         return RigidBodyTrajectory(self.trajectory, object,
@@ -432,6 +558,11 @@ class SubTrajectory(object):
     def variables(self):
         return self.trajectory.variables()
 
+    def map(self, function, reducer=None, chunk_size=100, processes=None,
+            progress=None):
+        return _mapTrajectory(self, function, reducer, chunk_size,
+                              processes, progress)
+
     def view(self, first=0, last=None, step=1, subset = None):
         Visualization.viewTrajectory(self, first, last, step, subset)
 
@@ -563,9 +694,14 @@ class TrajectorySet(object):
     last one in the preceding trajectory. To avoid counting it twice,
     specify (filename, 1, None, 1) for all but the first trajectory in
     the set.
+
+    For sets of many files, an index file (see the parameter index
+    below) avoids opening all trajectory files each time a set is
+    created. Steps are located by a binary search in the table of
+    step counts, and only the files that are accessed are opened.
     """
 
-    def __init__(self, object, filenames):
+    def __init__(self, object, filenames, index=None, max_open=16):
         """
         :param object: the object whose data is stored in the trajectory files.
                        This can be (and usually is) None;
@@ -576,39 +712,114 @@ class TrajectorySet(object):
         :param filenames: a list of trajectory file names or
                           (filename, first_step, last_step, increment)
                           tuples.
+        :param index: the name of an index file that stores the number
+                      of steps, the first and last step numbers and times,
+                      and the variables of each trajectory file. The index
+                      file is created if necessary, and entries for
+                      trajectory files that were modified since the index
+                      was written are updated. With an index, only the
+                      trajectory files that are actually accessed are
+                      opened. The default (None) is to build the index
+                      in memory without storing it.
+        :type index: str
+        :param max_open: the maximal number of trajectory files that are
+                         kept open at the same time. Files are opened
+                         when needed and the least recently used ones
+                         are closed.
+        :type max_open: int
         """
-        first = filenames[0]
-        if isinstance(first, tuple):
-            first = Trajectory(object, first[0])[first[1]:first[2]:first[3]]
-        else:
-            first = Trajectory(object, first)
-        self.universe = first.universe
-        self.trajectories = [first]
-        self.nsteps = [0, len(first)]
-        self.cell_parameters = []
-        for file in filenames[1:]:
-            if isinstance(file, tuple):
-                t = Trajectory(self.universe, file[0])[file[1]:file[2]:file[3]]
-            else:
-                t = Trajectory(self.universe, file)
-            self.trajectories.append(t)
-            self.nsteps.append(self.nsteps[-1]+len(t))
-            try:
-                self.cell_parameters.append(t[0]['box_size'])
-            except KeyError:
-                pass
+        self.filenames = filenames
+        self.index_filename = index
+        self.max_open = max_open
+        self.index = _trajectorySetIndex(filenames, index)
+        self.nsteps = [0]
+        for entry in self.index:
+            self.nsteps.append(self.nsteps[-1]+entry['selected_steps'])
         vars = {}
-        for t in self.trajectories:
-            for v in t.variables():
+        for entry in self.index:
+            for v in entry['variables']:
                 vars[v] = vars.get(v, 0) + 1
         self.vars = []
         for v, count in vars.items():
-            if count == len(self.trajectories):
+            if count == len(self.index):
                 self.vars.append(v)
+        self._open = {}
+        self._recently_used = []
+        self._pinned = []
+        first = self._openTrajectory(filenames[0], object)
+        self.universe = first.universe
+        self._addOpen(0, first)
+        self.trajectories = _TrajectorySetFiles(self)
+
+    def __getstate__(self):
+        return self.filenames, self.index_filename, self.max_open
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            self.__init__(None, *state)
+        else:
+            self.__init__(None, state)
+
+    def _openTrajectory(self, filename, object):
+        if isinstance(filename, tuple):
+            return Trajectory(object, filename[0])[filename[1]:filename[2]:
+                                                   filename[3]]
+        else:
+            return Trajectory(object, filename)
+
+    def _addOpen(self, i, t):
+        while len(self._open) >= self.max_open:
+            for j in self._recently_used:
+                if j not in self._pinned:
+                    break
+            else:
+                break
+            self._recently_used.remove(j)
+            _closeTrajectory(self._open.pop(j))
+        self._open[i] = t
+        self._recently_used.append(i)
+
+    def _trajectory(self, i):
+        t = self._open.get(i, None)
+        if t is None:
+            t = self._openTrajectory(self.filenames[i], self.universe)
+            self._addOpen(i, t)
+        else:
+            self._recently_used.remove(i)
+            self._recently_used.append(i)
+        return t
+
+    def _cellParameters(self, i):
+        # The box size at the first selected step of file i, or None
+        # if the file doesn't store box sizes. Jumps between files are
+        # corrected only for orthorhombic boxes.
+        if 'box_size' not in self.index[i]['variables']:
+            return None
+        cell = N.array(self._trajectory(i).box_size[0])
+        if len(cell) != 3:
+            return None
+        return cell
+
+    def locate(self, item):
+        """
+        :param item: a step number in the trajectory set
+        :type item: int
+        :returns: the number of the trajectory file in the set and the
+                  step number in that file
+        :rtype: tuple of two int
+        """
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError
+        tindex = bisect.bisect_right(self.nsteps, item)-1
+        return tindex, item-self.nsteps[tindex]
 
     def close(self):
-        for t in self.trajectories:
-            t.close()
+        for t in self._open.values():
+            _closeTrajectory(t)
+        self._open = {}
+        self._recently_used = []
 
     def __len__(self):
         return self.nsteps[-1]
@@ -616,10 +827,8 @@ class TrajectorySet(object):
     def __getitem__(self, item):
         if not isinstance(item, int):
             return SubTrajectory(self, N.arange(len(self)))[item]
-        if item >= len(self):
-            raise IndexError
-        tindex = N.add.reduce(N.greater_equal(item, self.nsteps))-1
-        return self.trajectories[tindex][item-self.nsteps[tindex]]
+        tindex, step = self.locate(item)
+        return self._trajectory(tindex)[step]
 
     def __getslice__(self, first, last):
         return self[(slice(first, last),)]
@@ -627,12 +836,13 @@ class TrajectorySet(object):
     def __getattr__(self, name):
         if name not in self.vars+['step']:
             raise AttributeError("no variable named " + name)
-        var = self.trajectories[0].trajectory.file.variables[name]
+        var = self._trajectory(0).trajectory.file.variables[name]
         if 'atom_number' in var.dimensions:
             return TrajectorySetVariable(self.universe, self, name)
         else:
             data = []
-            for t in self.trajectories:
+            for i in range(len(self.index)):
+                t = self._trajectory(i)
                 var = t.trajectory.file.variables[name]
                 data.append(N.ravel(N.array(var))[:len(t)])
             return N.concatenate(data)
@@ -641,7 +851,9 @@ class TrajectorySet(object):
                                variable = "configuration"):
         total = None
         self.steps_read = []
-        for i in range(len(self.trajectories)):
+        # The files read from must remain open for _boxTransformation.
+        self._pinned = []
+        for i in range(len(self.index)):
             if self.nsteps[i+1] <= first:
                 self.steps_read.append(0)
                 continue
@@ -655,34 +867,32 @@ class TrajectorySet(object):
                 stop = min(stop, last)
             stop = stop-self.nsteps[i]
             if start >= 0 and start < self.nsteps[i+1]-self.nsteps[i]:
-                t = self.trajectories[i]
+                t = self._trajectory(i)
                 pt = t.readParticleTrajectory(atom, start, stop, skip,
                                               variable)
+                self._pinned.append(i)
                 self.steps_read.append((stop-start)/skip)
                 if total is None:
                     total = pt
                 else:
-                    if variable == "configuration" \
-                       and self.cell_parameters[0] is not None:
+                    cell = self._cellParameters(i)
+                    if variable == "configuration" and cell is not None:
                         jump = pt.array[0]-total.array[-1]
-                        mult = -(jump/self.cell_parameters[i-1]).astype('i')
+                        mult = -(jump/cell).astype('i')
                         if len(N.nonzero(mult)) > 0:
                             t._boxTransformation(pt.array, pt.array, 1)
                             N.add(pt.array, mult[N.NewAxis, : ],
                                         pt.array)
                             t._boxTransformation(pt.array, pt.array, 0)
                             jump = pt.array[0] - total.array[-1]
-                        mask = N.less(jump,
-                                            -0.5*self.cell_parameters[i-1])- \
-                               N.greater(jump,
-                                               0.5*self.cell_parameters[i-1])
+                        mask = N.less(jump, -0.5*cell)- \
+                               N.greater(jump, 0.5*cell)
                         if len(N.nonzero(mask)) > 0:
                             t._boxTransformation(pt.array, pt.array, 1)
                             N.add(pt.array, mask[N.NewAxis, :],
                                         pt.array)
                             t._boxTransformation(pt.array, pt.array, 0)
-                    elif variable == "box_coordinates" \
-                       and self.cell_parameters[0] is not None:
+                    elif variable == "box_coordinates" and cell is not None:
                         jump = pt.array[0]-total.array[-1]
                         mult = -jump.astype('i')
                         if len(N.nonzero(mult)) > 0:
@@ -706,9 +916,9 @@ class TrajectorySet(object):
     def _boxTransformation(self, pt_in, pt_out, to_box=0):
         n = 0
         for i in range(len(self.steps_read)):
-            t = self.trajectories[i]
             steps = self.steps_read[i]
             if steps > 0:
+                t = self._trajectory(i)
                 t._boxTransformation(pt_in[n:n+steps], pt_out[n:n+steps],
                                      to_box)
             n = n + steps
@@ -716,6 +926,11 @@ class TrajectorySet(object):
     def variables(self):
         return self.vars
 
+    def map(self, function, reducer=None, chunk_size=100, processes=None,
+            progress=None):
+        return _mapTrajectory(self, function, reducer, chunk_size,
+                              processes, progress)
+
     def view(self, first=0, last=None, step=1, object = None):
         Visualization.viewTrajectory(self, first, last, step, object)
 
@@ -742,14 +957,102 @@ class TrajectorySetVariable(TrajectoryVariable):
     def __getitem__(self, item):
         if not isinstance(item, int):
             return SubVariable(self, N.arange(len(self)))[item]
-        if item >= len(self.trajectory_set):
-            raise IndexError
-        tindex = N.add.reduce(N.greater_equal(item,
-                                              self.trajectory_set.nsteps))-1
-        step = item-self.trajectory_set.nsteps[tindex]
-        t = self.trajectory_set.trajectories[tindex]
+        tindex, step = self.trajectory_set.locate(item)
+        t = self.trajectory_set._trajectory(tindex)
         return getattr(t, self.name)[step]
 
+class _TrajectorySetFiles(object):
+
+    # Sequence view of the trajectories in a TrajectorySet that opens
+    # them on demand.
+
+    def __init__(self, trajectory_set):
+        self.trajectory_set = trajectory_set
+
+    def __len__(self):
+        return len(self.trajectory_set.index)
+
+    def __getitem__(self, item):
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError
+        return self.trajectory_set._trajectory(item)
+
+def _closeTrajectory(trajectory):
+    if isinstance(trajectory, SubTrajectory):
+        trajectory = trajectory.trajectory
+    trajectory.close()
+
+# Fill value used by netCDF for integer variables
+_netcdf_fill_int = -2147483647
+
+def _trajectoryFileInfo(filename):
+    file = NetCDF.NetCDFFile(filename, 'r')
+    try:
+        steps = N.ravel(N.array(file.variables['step'][:]))
+        nsteps = len(steps)
+        while nsteps > 0 and steps[nsteps-1] == _netcdf_fill_int:
+            nsteps -= 1
+        info = {'steps': nsteps,
+                'first_step': None, 'last_step': None,
+                'first_time': None, 'last_time': None}
+        if nsteps > 0:
+            info['first_step'] = int(steps[0])
+            info['last_step'] = int(steps[nsteps-1])
+            if 'time' in file.variables:
+                time = N.ravel(N.array(file.variables['time'][:]))
+                info['first_time'] = float(time[0])
+                info['last_time'] = float(time[nsteps-1])
+        info['variables'] = [name for name in file.variables.keys()
+                             if name not in ['step', 'description',
+                                             'atom_index']]
+    finally:
+        file.close()
+    return info
+
+def _trajectorySetIndex(filenames, index_filename):
+    stored = {}
+    if index_filename is not None:
+        try:
+            index_file = open(index_filename, 'rb')
+        except IOError:
+            pass
+        else:
+            try:
+                stored = cPickle.load(index_file)
+            finally:
+                index_file.close()
+    modified = False
+    index = []
+    for filename in filenames:
+        if isinstance(filename, tuple):
+            filename, first, last, skip = filename
+            selection = slice(first, last, skip)
+        else:
+            selection = slice(None)
+        path = os.path.abspath(os.path.expanduser(filename))
+        mtime = os.path.getmtime(path)
+        entry = stored.get(path, None)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, _trajectoryFileInfo(path))
+            stored[path] = entry
+            modified = True
+        info = entry[1].copy()
+        info['filename'] = path
+        info['selected_steps'] = \
+                 len(xrange(*selection.indices(info['steps'])))
+        index.append(info)
+    if modified and index_filename is not None:
+        temp_filename = index_filename + '.tmp'
+        index_file = open(temp_filename, 'wb')
+        try:
+            cPickle.dump(stored, index_file, 2)
+        finally:
+            index_file.close()
+        os.rename(temp_filename, index_filename)
+    return index
+
 #
 # Cache for atom trajectories
 #
@@ -758,7 +1061,16 @@ class ParticleTrajectoryReader(object):
     def __init__(self, trajectory):
         self.trajectory = trajectory
         self.natoms = self.trajectory.universe.numberOfAtoms()
-        self._trajectory = trajectory.trajectory
+        self.atom_rows = trajectory.atom_rows
+        if self.atom_rows is not None:
+            self.natoms = len(self.atom_rows)
+            self.row_atoms = self.natoms*[None]
+            for index, row in self.atom_rows.items():
+                self.row_atoms[row] = index
+        if trajectory.atom_major is not None:
+            self._trajectory = trajectory.atom_major
+        else:
+            self._trajectory = trajectory.trajectory
         self.cache = {}
         self.cache_lifetime = 2
 
@@ -784,17 +1096,191 @@ class ParticleTrajectoryReader(object):
                 self.cache[k] = (data, count)
         for k in delete:
             del self.cache[k]
+        if self.atom_rows is None:
+            row = index
+        else:
+            try:
+                row = self.atom_rows[index]
+            except KeyError:
+                raise ValueError("atom %d not stored in trajectory" % index)
         cache_size = min(10, max(1, 100000/max(1, len(self.trajectory))))
-        natoms = min(cache_size, self.natoms-index)
-        data = self._trajectory.readParticleTrajectories(index, natoms,
+        natoms = min(cache_size, self.natoms-row)
+        data = self._trajectory.readParticleTrajectories(row, natoms,
                                                          variable,
                                                          first, last, skip,
                                                          correct, box)
         for i in range(natoms):
-            key = (index+i, variable, first, last, skip, correct, box)
+            if self.atom_rows is None:
+                key = (row+i, variable, first, last, skip, correct, box)
+            else:
+                key = (self.row_atoms[row+i], variable,
+                       first, last, skip, correct, box)
             self.cache[key] = (data[i], self.cache_lifetime)
         return data[0]
 
+#
+# Atom-major companion files
+#
+def atomMajorFilename(filename):
+    """
+    :param filename: the name of a trajectory file
+    :type filename: str
+    :returns: the name of the atom-major companion file that
+              :class:`~MMTK.Trajectory.Trajectory` looks for
+    :rtype: str
+    """
+    root, ext = os.path.splitext(os.path.expanduser(filename))
+    return root + '_atoms' + (ext or '.nc')
+
+def transposeTrajectory(filename, atom_major_filename=None,
+                        memory=64*1024*1024):
+    """
+    Write an atom-major copy of all particle vector variables
+    (configuration, velocities, etc.) of a trajectory. In the copy,
+    the data for one atom is stored contiguously for all steps, which
+    makes :func:`~MMTK.Trajectory.Trajectory.readParticleTrajectory`
+    a sequential read instead of one seek per step. The trajectory
+    is read in blocks of steps, so the memory requirement is bounded
+    independently of the trajectory length.
+
+    :param filename: the name of the trajectory file
+    :type filename: str
+    :param atom_major_filename: the name of the atom-major file to be
+                                written. The default is the name returned
+                                by :func:`~MMTK.Trajectory.atomMajorFilename`,
+                                which is used automatically when the
+                                trajectory is opened for reading.
+    :type atom_major_filename: str
+    :param memory: an approximate upper limit for the size of the data
+                   buffer, in bytes
+    :type memory: int
+    """
+    if atom_major_filename is None:
+        atom_major_filename = atomMajorFilename(filename)
+    trajectory = Trajectory(None, filename)
+    if trajectory.atom_major is not None:
+        trajectory.atom_major.close()
+        trajectory.atom_major = None
+    source = trajectory.trajectory.file
+    nsteps = len(trajectory)
+    natoms = source.dimensions['atom_number']
+    chunk = max(1, min(nsteps, memory / (24*natoms)))
+    file = NetCDF.NetCDFFile(atom_major_filename, 'w')
+    file.source = os.path.abspath(trajectory.filename)
+    file.source_steps = nsteps
+    file.createDimension('atom_number', natoms)
+    file.createDimension('step_number', nsteps)
+    file.createDimension('xyz', 3)
+    names = []
+    for name, var in source.variables.items():
+        if 'step_number' in var.dimensions and 'xyz' in var.dimensions:
+            new = file.createVariable(name, var.typecode(),
+                                      ('atom_number', 'step_number', 'xyz'))
+            try:
+                new.units = var.units
+            except AttributeError:
+                pass
+            names.append(name)
+    if 'box_size' in source.variables:
+        box_size = trajectory.box_size
+        file.createDimension('box_size_length', box_size.shape[1])
+        var = file.createVariable('box_size',
+                                  source.variables['box_size'].typecode(),
+                                  ('step_number', 'box_size_length'))
+        var[:] = box_size
+    for first in range(0, nsteps, chunk):
+        last = min(nsteps, first+chunk)
+        for name in names:
+            data = trajectory.trajectory.readParticleTrajectories(0, natoms,
+                                                      name, first, last, 1)
+            file.variables[name][:, first:last, :] = \
+                       data.astype(file.variables[name].typecode())
+        file.sync()
+    file.close()
+    trajectory.close()
+
+class AtomMajorTrajectory(object):
+
+    """
+    Read access to an atom-major companion file
+
+    An AtomMajorTrajectory object is created automatically by
+    :class:`~MMTK.Trajectory.Trajectory` when a companion file
+    written by :func:`~MMTK.Trajectory.transposeTrajectory`
+    is found and is more recent than the trajectory file.
+    It replaces the low-level trajectory object for reading
+    the trajectories of individual atoms.
+    """
+
+    def __init__(self, trajectory, filename):
+        self.trajectory = trajectory
+        self.filename = filename
+        self.file = NetCDF.NetCDFFile(filename, 'r')
+
+    def openCompanion(trajectory):
+        filename = atomMajorFilename(trajectory.filename)
+        try:
+            if os.path.getmtime(filename) < \
+                   os.path.getmtime(trajectory.filename):
+                return None
+        except OSError:
+            return None
+        companion = AtomMajorTrajectory(trajectory, filename)
+        file = companion.file
+        if file.dimensions['atom_number'] != \
+                     trajectory.trajectory.file.dimensions['atom_number'] \
+               or int(file.source_steps[0]) != len(trajectory):
+            companion.close()
+            return None
+        return companion
+    openCompanion = staticmethod(openCompanion)
+
+    def close(self):
+        self.file.close()
+
+    def readParticleTrajectories(self, atom, natoms, variable,
+                                 first, last, skip,
+                                 correct=0, box_coordinates=0):
+        try:
+            var = self.file.variables[variable]
+        except KeyError:
+            raise ValueError("variable not in trajectory")
+        data = N.array(var[atom:atom+natoms, first:last:skip, :]) \
+                 .astype(N.Float)
+        universe = self.trajectory.universe
+        if not universe.is_periodic or not (correct or box_coordinates):
+            return data
+        try:
+            box = N.array(self.file.variables['box_size'][first:last:skip]) \
+                    .astype(N.Float)
+        except KeyError:
+            box = None
+        else:
+            self.recently_read_box_size = box
+        self._boxTransformation(data, box, 1)
+        if correct:
+            jumps = N.floor(data[:, 1:, :]-data[:, :-1, :]+0.5)
+            data[:, 1:, :] -= N.add.accumulate(jumps, 1)
+        if not box_coordinates:
+            self._boxTransformation(data, box, 0)
+        return data
+
+    def _boxTransformation(self, data, box, to_box):
+        universe = self.trajectory.universe
+        if box is None:
+            if to_box:
+                transformation = universe._realToBoxPointArray
+            else:
+                transformation = universe._boxToRealPointArray
+            for i in range(data.shape[0]):
+                data[i] = transformation(data[i])
+        else:
+            from MMTK_trajectory import boxTransformation
+            for i in range(data.shape[0]):
+                points = data[i].copy()
+                boxTransformation(universe._spec, points, points, box, to_box)
+                data[i] = points
+
 #
 # Single-atom trajectory
 #
@@ -955,6 +1441,68 @@ class RigidBodyTrajectory(object):
         from Scientific.Geometry.Quaternion import Quaternion
         return Vector(self.cms[index]), Quaternion(self.quaternions[index])
 
+#
+# Parallel processing of trajectory steps
+#
+# The state of a worker process: the trajectory it has opened,
+# the function applied to each step, and the reducer.
+_map_state = None
+
+def _mapInitialize(trajectory, function, reducer):
+    global _map_state
+    _map_state = (trajectory, function, reducer)
+
+def _mapChunk(chunk):
+    trajectory, function, reducer = _map_state
+    first, last = chunk
+    universe = trajectory.universe
+    results = []
+    for i in range(first, last):
+        data = trajectory[i]
+        conf = data.get('configuration', None)
+        if conf is not None:
+            universe.setConfiguration(conf)
+        results.append(function(data))
+    if reducer is None:
+        return results
+    return reduce(reducer, results)
+
+def _mapTrajectory(trajectory, function, reducer, chunk_size, processes,
+                   progress):
+    nsteps = len(trajectory)
+    chunk_size = max(1, chunk_size)
+    chunks = [(first, min(first+chunk_size, nsteps))
+              for first in range(0, nsteps, chunk_size)]
+    if processes == 1:
+        _mapInitialize(trajectory, function, reducer)
+        pool = None
+        partial_results = itertools.imap(_mapChunk, chunks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes, _mapInitialize,
+                                    (trajectory, function, reducer))
+        partial_results = pool.imap(_mapChunk, chunks)
+    results = []
+    try:
+        for chunk, partial in itertools.izip(chunks, partial_results):
+            if reducer is None:
+                results.extend(partial)
+            else:
+                results.append(partial)
+            if progress is not None:
+                progress.destination.write('Step %d\n' % chunk[1])
+    finally:
+        if pool is None:
+            _mapInitialize(None, None, None)
+        else:
+            pool.close()
+            pool.join()
+    if reducer is None:
+        return results
+    if not results:
+        raise ValueError("empty trajectory")
+    return reduce(reducer, results)
+
 #
 # Type check for trajectory objects
 #
@@ -1086,7 +1634,8 @@ class TrajectoryOutput(TrajectoryAction):
     """
 
     def __init__(self, trajectory, data = None,
-                 first=0, last=None, skip=1):
+                 first=0, last=None, skip=1, buffer_steps=0,
+                 when_full='wait', subset=None):
         """
         :param trajectory: a trajectory object or a string, which is
                            interpreted as the name of a file that is opened
@@ -1106,11 +1655,38 @@ class TrajectoryOutput(TrajectoryAction):
         :type last: int
         :param skip: the number of steps to skip between two action runs
         :type skip: int
+        :param buffer_steps: if non-zero, the data is written asynchronously
+                             by a separate thread. The trajectory generator
+                             copies the data into a buffer that can hold
+                             the given number of steps and continues
+                             immediately. The buffer is emptied completely
+                             before the trajectory generator returns,
+                             and also when the trajectory's flush method
+                             is called.
+        :type buffer_steps: int
+        :param when_full: what to do when asynchronous output is used and
+                          the buffer is full: "wait" (the default) makes
+                          the trajectory generator wait until the writer
+                          thread has made room, "drop" skips the step.
+                          The number of dropped steps is stored in the
+                          attribute dropped_steps of the trajectory file.
+        :type when_full: str
+        :param subset: the atoms whose data is written to the trajectory
+                       (see :class:`~MMTK.Trajectory.Trajectory`). The
+                       default (None) is to write all atoms. Used only if
+                       trajectory is a string; a trajectory object stores
+                       the subset it was created with.
+        :type subset: :class:`~MMTK.Collections.GroupOfAtoms`
         """
         TrajectoryAction.__init__(self, first, last, skip)
         self.destination = trajectory
         self.categories = data
         self.must_be_closed = None
+        if when_full not in ['wait', 'drop']:
+            raise ValueError("when_full must be 'wait' or 'drop'")
+        self.buffer_steps = buffer_steps
+        self.when_full = when_full
+        self.subset = subset
 
     spec_type = 'trajectory'
 
@@ -1130,11 +1706,15 @@ class TrajectoryOutput(TrajectoryAction):
                 for item in categories:
                     if item not in trajectory_generator.available_data:
                         raise ValueError('data item %s is not available' % item)
-        return self._getSpecificationList(trajectory_generator, steps) \
+        spec = self._getSpecificationList(trajectory_generator, steps) \
                + (destination, categories)
+        if self.spec_type == 'trajectory' and self.buffer_steps > 0:
+            spec = spec + ((self.buffer_steps, self.when_full == 'drop'),)
+        return spec
 
     def _setupDestination(self, destination, universe):
-        self.must_be_closed = Trajectory(universe, destination, 'a')
+        self.must_be_closed = Trajectory(universe, destination, 'a',
+                                         subset=self.subset)
         return self.must_be_closed
         
     def cleanup(self):
@@ -1174,6 +1754,7 @@ class RestartTrajectoryOutput(TrajectoryOutput):
         self.destination = trajectory
         self.categories = None
         self.length = length
+        self.buffer_steps = 0
 
     def _setupDestination(self, destination, universe):
         self.must_be_closed = Trajectory(universe, destination, 'a',
@@ -1242,6 +1823,58 @@ class StandardLogOutput(LogOutput):
     def __init__(self, skip=50):
         LogOutput.__init__(self, sys.stdout, None, 0, None, skip)
 
+class BatchedAction(TrajectoryAction):
+
+    """
+    Trajectory action calling a Python function with batches of steps
+
+    A BatchedAction object can be used in the action list of any
+    trajectory-generating operation. At each step at which it is run,
+    the values of the selected variables are copied into arrays
+    without interrupting the trajectory generator for the Python
+    interpreter. Every batch_size of these steps, and once more for
+    the remaining steps at the end, the function is called with two
+    arguments: an array of step numbers, and a dictionary mapping
+    variable names to arrays whose first index corresponds to the
+    steps. The arrays are reused for the next batch, so the function
+    must copy any data that it wants to keep. The function must not
+    access the universe, whose state is locked while the trajectory
+    generator is running; all the data it needs must be requested as
+    variables.
+    """
+
+    def __init__(self, function, variables=None, batch_size=100,
+                 first=0, last=None, skip=1):
+        """
+        :param function: the function called for each batch
+        :type function: callable
+        :param variables: the names of the variables provided by the
+                          trajectory generator that are passed to the
+                          function, e.g. "configuration", "velocities",
+                          "time", or "potential_energy"
+                          (default: ["configuration"])
+        :type variables: list of str
+        :param batch_size: the number of steps per call of the function
+        :type batch_size: int
+        :param first: the number of the first step at which the action
+                      is run
+        :type first: int
+        :param last: the number of the step at which the action is
+                     suspended. A value of None indicates that the
+                     action should be applied indefinitely.
+        :type last: int
+        :param skip: the number of steps to skip between two action runs
+        :type skip: int
+        """
+        TrajectoryAction.__init__(self, first, last, skip)
+        if batch_size < 1:
+            raise ValueError("batch size must be positive")
+        if variables is None:
+            variables = ['configuration']
+        self.parameters = (function, tuple(variables), batch_size)
+        import MMTK_trajectory
+        self.Cfunction = MMTK_trajectory.batchFunction
+
 #
 # Snapshot generator
 #
@@ -1386,7 +2019,10 @@ def trajectoryInfo(filename):
         s += file.comment + '\n'
     except AttributeError:
         pass
-    s += `file.dimensions['atom_number']` + ' atoms\n'
+    s += `file.dimensions['atom_number']` + ' atoms'
+    if 'atom_index' in file.variables:
+        s += ' (subset)'
+    s += '\n'
     s += `nsteps` + ' steps\n'
     s += file.history
     file.close()
@@ -13,7 +13,7 @@ Universes
 __docformat__ = 'restructuredtext'
 
 from MMTK import Bonds, ChemicalObjects, Collections, Environment, \
-                 Random, Utility, ParticleProperties, Visualization
+                 Random, Units, Utility, ParticleProperties, Visualization
 from Scientific.Geometry import Transformation
 from Scientific.Geometry import Vector, isVector
 from Scientific import N
@@ -205,6 +205,7 @@ class Universe(Collections.GroupOfAtoms, Visualization.Viewable):
         elif Environment.isEnvironmentObject(object):
             for o in self._environment:
                 o.checkCompatibilityWith(object)
+            object._addedToUniverse(self)
             self._environment.append(object)
             self._changed(False)
         elif Collections.isCollection(object) \
@@ -238,6 +239,7 @@ class Universe(Collections.GroupOfAtoms, Visualization.Viewable):
                 self.removeObject(o)
         elif Environment.isEnvironmentObject(object):
             self._environment.remove(object)
+            object._removedFromUniverse(self)
             self._changed(False)
         else:
             raise ValueError(`object` + ' is not in this universe.')
@@ -561,6 +563,27 @@ class Universe(Collections.GroupOfAtoms, Visualization.Viewable):
             self._masses = self.getParticleScalar('_mass')
         return self._masses
 
+    def repartitionHydrogenMasses(self, hydrogen_mass=3.024*Units.amu):
+        """
+        Moves mass from the heavy atoms onto the hydrogen atoms bonded
+        to them, keeping the total mass of each molecule unchanged,
+        by adding a :class:`~MMTK.Environment.HydrogenMassRepartitioning`
+        object to the universe.
+
+        :param hydrogen_mass: the new mass of the hydrogen atoms
+        :type hydrogen_mass: float
+        """
+        self.addObject(Environment.HydrogenMassRepartitioning(hydrogen_mass))
+
+    def restoreHydrogenMasses(self):
+        """
+        Restores the masses changed by
+        :meth:`~MMTK.Universe.Universe.repartitionHydrogenMasses`.
+        """
+        for o in self.environmentObjectList(
+                                 Environment.HydrogenMassRepartitioning):
+            self.removeObject(o)
+
     def charges(self):
         """
         Return the atomic charges defined by the universe's
@@ -701,7 +724,8 @@ class Universe(Collections.GroupOfAtoms, Visualization.Viewable):
         """
         self._objects.removeDistanceConstraints(self)
 
-    def enforceConstraints(self, configuration=None, velocities=None):
+    def enforceConstraints(self, configuration=None, velocities=None,
+                           solver='shake', threads=1):
         """
         Enforces the previously defined distance constraints
         by modifying the configuration and velocities.
@@ -714,9 +738,16 @@ class Universe(Collections.GroupOfAtoms, Visualization.Viewable):
                               constraints are enforced
                               (None for current velocities)
         :type velocities: :class:`~MMTK.ParticleProperties.ParticleVector`
+        :param solver: the method for the configuration,
+                       "shake" or "lincs"
+        :type solver: str
+        :param threads: the number of threads over which the
+                        molecules are distributed
+        :type threads: int
         """
         from MMTK import Dynamics
-        Dynamics.enforceConstraints(self, configuration)
+        Dynamics.enforceConstraints(self, configuration, solver,
+                                    threads=threads)
         self.adjustVelocitiesToConstraints(velocities)
 
     def adjustVelocitiesToConstraints(self, velocities=None, block=True):
@@ -775,17 +806,21 @@ class Universe(Collections.GroupOfAtoms, Visualization.Viewable):
                                                     ffdata)
 
     def energyEvaluator(self, subset1 = None, subset2 = None,
-                        threads=None, mpi_communicator=None):
+                        threads=None, mpi_communicator=None,
+                        processes=None, domain_decomposition=None):
         if self._forcefield is None:
             raise ValueError("no force field defined")
+        key = (subset1, subset2, threads, processes, domain_decomposition)
         try:
-            eval = self._evaluator[(subset1, subset2, threads)]
+            eval = self._evaluator[key]
         except KeyError:
             from MMTK.ForceFields import ForceField
             eval = ForceField.EnergyEvaluator(self, self._forcefield,
                                               subset1, subset2,
-                                              threads, mpi_communicator)
-            self._evaluator[(subset1, subset2, threads)] = eval
+                                              threads, mpi_communicator,
+                                              processes,
+                                              domain_decomposition)
+            self._evaluator[key] = eval
         return eval
 
     def energy(self, subset1 = None, subset2 = None, small_change=False):
@@ -1116,7 +1151,10 @@ class Universe(Collections.GroupOfAtoms, Visualization.Viewable):
             attr = attributes.get(o, None)
             if attr is not None:
                 items.append(repr(attr))
-            items.append(o.description())
+            if hasattr(o, '_description'):
+                items.append(o._description(index_map))
+            else:
+                items.append(o.description())
         try:
             classname = self.classname_for_trajectories
         except AttributeError:
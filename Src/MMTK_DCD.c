@@ -183,6 +183,8 @@ readDCD(PyObject *dummy, PyObject *args)
   if( dcdZ != NULL )
     free(dcdZ);
   PyTrajectory_OutputFinish(output, currFrames-1, 0, 1, data_descriptors);
+  if (PyErr_Occurred())
+    return NULL;
   Py_INCREF(Py_None);
   return Py_None;
 
@@ -6,6 +6,9 @@
 #include "MMTK/universe.h"
 #include "MMTK/forcefield.h"
 #include "MMTK/trajectory.h"
+#ifndef MS_WINDOWS
+#include <sys/time.h>
+#endif
 
 #define DEBUG 0
 
@@ -13,6 +16,84 @@
 
 double kB, temperature_factor;
 
+/* Performance counters: the wall clock time of each integration step
+   is attributed to the phase that ends at each call to timing_mark.
+   The derived quantities are updated before each output call. */
+
+enum timing_phases {T_FORCES=0, T_CONSTRAINTS=1, T_THERMOSTAT=2,
+		    T_OUTPUT=3, T_INTEGRATION=4, T_PHASES=5};
+
+typedef struct {
+  double start, last;
+  double seconds[T_PHASES];
+  double percent[T_PHASES];
+  double steps_per_second, ns_per_day;
+} timing_data;
+
+static double
+wall_time(void)
+{
+#ifdef MS_WINDOWS
+  return (double)clock()/CLOCKS_PER_SEC;
+#else
+  struct timeval tv;
+  gettimeofday(&tv, NULL);
+  return tv.tv_sec + 1.e-6*tv.tv_usec;
+#endif
+}
+
+static void
+timing_start(timing_data *t)
+{
+  int k;
+  t->start = t->last = wall_time();
+  for (k = 0; k < T_PHASES; k++)
+    t->seconds[k] = t->percent[k] = 0.;
+  t->steps_per_second = t->ns_per_day = 0.;
+}
+
+static void
+timing_mark(timing_data *t, int phase)
+{
+  double now = wall_time();
+  t->seconds[phase] += now - t->last;
+  t->last = now;
+}
+
+static void
+timing_update(timing_data *t, int steps, double delta_t)
+{
+  double elapsed = t->last - t->start;
+  int k;
+  if (elapsed <= 0.)
+    return;
+  t->steps_per_second = steps/elapsed;
+  /* delta_t is in ps */
+  t->ns_per_day = 86.4*delta_t*t->steps_per_second;
+  for (k = 0; k < T_PHASES; k++)
+    t->percent[k] = 100.*t->seconds[k]/elapsed;
+}
+
+/* Copy the counters to a Python array: steps, total wall clock time,
+   and the time spent in each phase */
+
+static void
+timing_store(timing_data *t, int steps, PyArrayObject *array)
+{
+  double *data;
+  int k, n;
+  if (array == NULL)
+    return;
+  n = array->dimensions[0];
+  data = (double *)array->data;
+  if (n > 0)
+    data[0] = steps;
+  if (n > 1)
+    data[1] = t->last - t->start;
+  for (k = 0; k < T_PHASES && k+2 < n; k++)
+    data[k+2] = t->seconds[k];
+}
+
 /* Allocate and initialize Output variable descriptors */
 
 static PyTrajectoryVariable *
@@ -20,11 +101,11 @@ get_data_descriptors(int n, PyUniverseSpecObject *universe_spec,
 		     PyArrayObject *configuration, PyArrayObject *velocities,
 		     PyArrayObject *gradients, PyArrayObject *masses,
 		     int *ndf,
-		     double *time, double *p_energy, double *k_energy,
-		     double *n_energy, double *a_energy,
+		     double *time, double *p_energy, double *gradient_norm,
+		     double *k_energy, double *n_energy, double *a_energy,
 		     double *temperature, double *xi,
 		     double *pressure, double *volume, double *alpha,
-		     double *box_size)
+		     double *box_size, timing_data *timing)
 {
   PyTrajectoryVariable *vars = (PyTrajectoryVariable *)
                                malloc((n+1)*sizeof(PyTrajectoryVariable));
@@ -49,6 +130,15 @@ get_data_descriptors(int n, PyUniverseSpecObject *universe_spec,
     vars[i].value.dp = p_energy;
     i++;
   }
+  if (gradient_norm != NULL && i < n) {
+    vars[i].name = "gradient_norm";
+    vars[i].text = "Gradient norm: %lf\n";
+    vars[i].unit = energy_gradient_unit_name;
+    vars[i].type = PyTrajectory_Scalar;
+    vars[i].class = PyTrajectory_Energy;
+    vars[i].value.dp = gradient_norm;
+    i++;
+  }
   if (k_energy != NULL && i < n) {
     vars[i].name = "kinetic_energy";
     vars[i].text = "Kinetic energy: %lf\n";
@@ -176,6 +266,34 @@ get_data_descriptors(int n, PyUniverseSpecObject *universe_spec,
     vars[i].value.ip = ndf;
     i++;
   }
+  if (timing != NULL && i+7 <= n) {
+    static char *names[] = {"ns_per_day", "steps_per_second",
+			    "force_time_percent", "constraint_time_percent",
+			    "thermostat_time_percent", "output_time_percent",
+			    "integration_time_percent"};
+    static char *texts[] = {"Performance: %.4g ns/day, ",
+			    "%.4g steps/s\n",
+			    "Wall time: forces %.1lf%%, ",
+			    "constraints %.1lf%%, ",
+			    "thermostat/barostat %.1lf%%, ",
+			    "output %.1lf%%, ",
+			    "integration %.1lf%%\n"};
+    int k;
+    for (k = 0; k < 7; k++) {
+      vars[i].name = names[k];
+      vars[i].text = texts[k];
+      vars[i].unit = "";
+      vars[i].type = PyTrajectory_Scalar;
+      vars[i].class = PyTrajectory_Performance;
+      i++;
+    }
+    vars[i-7].unit = "nanosecond day-1";
+    vars[i-7].value.dp = &timing->ns_per_day;
+    vars[i-6].unit = "second-1";
+    vars[i-6].value.dp = &timing->steps_per_second;
+    for (k = 0; k < 5; k++)
+      vars[i-5+k].value.dp = &timing->percent[k];
+  }
   vars[i].name = NULL;
   return vars;
 }
@@ -385,8 +503,637 @@ mult_by_h_plus_one(vector3 *in, vector3 *out, int natoms, double *mass,
   }
 }
 
+/* Parallel execution of a function over ranges of work items.
+   Block 0 is handled by the calling thread, each of the other
+   blocks by a worker thread that is started when the blocks are
+   created and waits for work until the blocks are freed. */
+
+typedef void work_function(void *data, int first, int last);
+
+typedef struct {
+  work_function *function;
+  void *data;
+  int first, last;
+#ifdef WITH_THREAD
+  PyThread_type_lock start, done;
+  int running, exit;
+#endif
+} work_block;
+
+#ifdef WITH_THREAD
+static void
+work_thread(void *arg)
+{
+  work_block *block = (work_block *)arg;
+  while (1) {
+    PyThread_acquire_lock(block->start, 1);
+    if (block->exit)
+      break;
+    (*block->function)(block->data, block->first, block->last);
+    PyThread_release_lock(block->done);
+  }
+  PyThread_release_lock(block->done);
+}
+#endif
+
+static void
+free_work_blocks(work_block *blocks, int nblocks)
+{
+#ifdef WITH_THREAD
+  int k;
+  if (blocks != NULL)
+    for (k = 1; k < nblocks; k++) {
+      if (blocks[k].running) {
+	blocks[k].exit = 1;
+	PyThread_release_lock(blocks[k].start);
+	PyThread_acquire_lock(blocks[k].done, 1);
+      }
+      if (blocks[k].start != NULL)
+	PyThread_free_lock(blocks[k].start);
+      if (blocks[k].done != NULL)
+	PyThread_free_lock(blocks[k].done);
+    }
+#endif
+  free(blocks);
+}
+
+static work_block *
+new_work_blocks(int nblocks)
+{
+  work_block *blocks = (work_block *)malloc(nblocks*sizeof(work_block));
+  int k;
+  if (blocks == NULL)
+    return (work_block *)PyErr_NoMemory();
+  for (k = 0; k < nblocks; k++) {
+    blocks[k].first = blocks[k].last = 0;
+#ifdef WITH_THREAD
+    blocks[k].start = blocks[k].done = NULL;
+    blocks[k].running = blocks[k].exit = 0;
+#endif
+  }
+#ifdef WITH_THREAD
+  for (k = 1; k < nblocks; k++) {
+    blocks[k].start = PyThread_allocate_lock();
+    blocks[k].done = PyThread_allocate_lock();
+    if (blocks[k].start == NULL || blocks[k].done == NULL) {
+      free_work_blocks(blocks, nblocks);
+      PyErr_SetString(PyExc_OSError, "couldn't allocate lock");
+      return NULL;
+    }
+    PyThread_acquire_lock(blocks[k].start, 1);
+    PyThread_acquire_lock(blocks[k].done, 1);
+    /* Without a worker thread, the block is handled by the caller */
+    blocks[k].running =
+      PyThread_start_new_thread(work_thread, (void *)(blocks+k)) != -1;
+  }
+#endif
+  return blocks;
+}
+
+static void
+run_work_blocks(work_block *blocks, int nblocks)
+{
+  int k;
+#ifdef WITH_THREAD
+  for (k = 1; k < nblocks; k++) {
+    if (blocks[k].first == blocks[k].last)
+      continue;
+    if (blocks[k].running)
+      PyThread_release_lock(blocks[k].start);
+    else
+      (*blocks[k].function)(blocks[k].data, blocks[k].first, blocks[k].last);
+  }
+#endif
+  (*blocks[0].function)(blocks[0].data, blocks[0].first, blocks[0].last);
+#ifdef WITH_THREAD
+  for (k = 1; k < nblocks; k++)
+    if (blocks[k].first != blocks[k].last && blocks[k].running)
+      PyThread_acquire_lock(blocks[k].done, 1);
+#else
+  for (k = 1; k < nblocks; k++)
+    (*blocks[k].function)(blocks[k].data, blocks[k].first, blocks[k].last);
+#endif
+}
+
+/* Distance constraints: SHAKE or LINCS applied to the constraint
+   blocks, which are independent (one per chemical object) and
+   are distributed over threads.
+
+   LINCS (Hess et al., J. Comput. Chem. 18, 1463 (1997)) solves
+   the linearized constraint equations along the reference
+   directions by a truncated series expansion of the inverse of
+   the coupling matrix, followed by corrections for the rotation
+   of the constraints. The corrections are repeated until the
+   deviations are below the SHAKE tolerance, which usually
+   takes one or two passes for a time step.
+
+   Blocks that describe a rigid three-site molecule (water) are
+   solved analytically by SETTLE (Miyamoto and Kollman,
+   J. Comput. Chem. 13, 952 (1992)) with either method. */
+
+enum constraint_methods {SHAKE_SOLVER=0, LINCS_SOLVER=1};
+
+typedef struct {
+  int method, order;
+  int n_const, n_blocks, ntasks;
+  long *pairs, *blocks;
+  double *dist_sq, *m;
+  PyUniverseSpecObject *universe_spec;
+  /* LINCS: couplings between constraints that share an atom */
+  int *c_start, *c_index;
+  double *c_mass, *c_coef;
+  double *s, *length, *rhs, *sol, *tmp;
+  vector3 *dir;
+  /* SETTLE: for each block, the apex atom (-1 if SETTLE does not apply),
+     the two other atoms, and the constraints apex-b, apex-c, b-c */
+  int *settle;
+  work_block *tasks;
+  /* Arguments of the current call */
+  vector3 *x, *const_vect;
+} constraint_solver;
+
+static void
+free_constraint_solver(constraint_solver *solver)
+{
+  free(solver->c_start);
+  free(solver->c_index);
+  free(solver->c_mass);
+  free(solver->s);
+  free(solver->dir);
+  free(solver->settle);
+  if (solver->tasks != NULL)
+    free_work_blocks(solver->tasks, solver->ntasks);
+  solver->c_start = solver->c_index = solver->settle = NULL;
+  solver->c_mass = solver->s = NULL;
+  solver->dir = NULL;
+  solver->tasks = NULL;
+}
+
+static void solve_constraint_blocks(void *data, int first, int last);
+
+/* Test if constraints from..to-1 make three atoms a rigid triangle
+   a-b-c with |ab| = |ac| and equal masses of b and c, and store
+   the atom and constraint indices for SETTLE. */
+static int
+find_settle_triangle(long *pairs, double *dist_sq, double *m,
+		     int from, int to, int *settle)
+{
+  const double tolerance = 1.e-10;
+  int i;
+
+  if (to-from != 3)
+    return 0;
+  for (i = 0; i < 3; i++) {
+    int c_ab = from + (i+1)%3;
+    int c_ac = from + (i+2)%3;
+    int c_bc = from + i;
+    long a, b, c;
+    /* The apex is the atom common to constraints c_ab and c_ac */
+    if (pairs[2*c_ab] == pairs[2*c_ac] || pairs[2*c_ab] == pairs[2*c_ac+1])
+      a = pairs[2*c_ab];
+    else if (pairs[2*c_ab+1] == pairs[2*c_ac]
+	     || pairs[2*c_ab+1] == pairs[2*c_ac+1])
+      a = pairs[2*c_ab+1];
+    else
+      return 0;
+    b = (pairs[2*c_ab] == a) ? pairs[2*c_ab+1] : pairs[2*c_ab];
+    c = (pairs[2*c_ac] == a) ? pairs[2*c_ac+1] : pairs[2*c_ac];
+    if (b == c || b == a || c == a
+	|| !((pairs[2*c_bc] == b && pairs[2*c_bc+1] == c)
+	     || (pairs[2*c_bc] == c && pairs[2*c_bc+1] == b)))
+      return 0;
+    if (fabs(dist_sq[c_ab]-dist_sq[c_ac]) > tolerance*dist_sq[c_ab]
+	|| fabs(m[b]-m[c]) > tolerance*m[b])
+      continue;
+    /* Exclude linear and degenerate geometries */
+    if (4.*dist_sq[c_ab] <= (1.+1.e-6)*dist_sq[c_bc])
+      continue;
+    settle[0] = a;
+    settle[1] = b;
+    settle[2] = c;
+    settle[3] = c_ab;
+    settle[4] = c_ac;
+    settle[5] = c_bc;
+    return 1;
+  }
+  return 0;
+}
+
+/* Returns 0 on success and -1 with a Python exception set on failure.
+   Must be called with the global interpreter lock held. */
+static int
+init_constraint_solver(constraint_solver *solver, int method, int order,
+		       int nthreads, int atoms, int n_const, long *pairs,
+		       double *dist_sq, int n_blocks, long *blocks,
+		       double *m, PyUniverseSpecObject *universe_spec)
+{
+  const int min_constraints_per_thread = 64;
+  int *a_start = NULL, *a_index = NULL;
+  int i, j, k, n;
+
+  solver->method = method;
+  solver->order = order;
+  solver->n_const = n_const;
+  solver->n_blocks = n_blocks;
+  solver->pairs = pairs;
+  solver->blocks = blocks;
+  solver->dist_sq = dist_sq;
+  solver->m = m;
+  solver->universe_spec = universe_spec;
+  solver->c_start = solver->c_index = NULL;
+  solver->c_mass = solver->c_coef = NULL;
+  solver->s = solver->length = solver->rhs = NULL;
+  solver->sol = solver->tmp = NULL;
+  solver->dir = NULL;
+  solver->settle = NULL;
+  solver->tasks = NULL;
+  solver->ntasks = 1;
+  if (method != SHAKE_SOLVER && method != LINCS_SOLVER) {
+    PyErr_SetString(PyExc_ValueError, "unknown constraint solver");
+    return -1;
+  }
+  if (method == LINCS_SOLVER && order < 1) {
+    PyErr_SetString(PyExc_ValueError, "LINCS order must be positive");
+    return -1;
+  }
+  if (n_const == 0)
+    return 0;
+
+  if (method == LINCS_SOLVER) {
+    /* The constraints in which each atom is involved */
+    a_start = (int *)malloc((atoms+1)*sizeof(int));
+    a_index = (int *)malloc(2*n_const*sizeof(int));
+    solver->c_start = (int *)malloc((n_const+1)*sizeof(int));
+    solver->s = (double *)malloc(5*n_const*sizeof(double));
+    solver->dir = (vector3 *)malloc(n_const*sizeof(vector3));
+    if (a_start == NULL || a_index == NULL || solver->c_start == NULL
+	|| solver->s == NULL || solver->dir == NULL)
+      goto memory_error;
+    solver->length = solver->s + n_const;
+    solver->rhs = solver->length + n_const;
+    solver->sol = solver->rhs + n_const;
+    solver->tmp = solver->sol + n_const;
+    for (j = 0; j <= atoms; j++)
+      a_start[j] = 0;
+    for (i = 0; i < 2*n_const; i++)
+      a_start[pairs[i]+1]++;
+    for (j = 0; j < atoms; j++)
+      a_start[j+1] += a_start[j];
+    for (i = 0; i < 2*n_const; i++)
+      a_index[a_start[pairs[i]]++] = i/2;
+    for (j = atoms; j > 0; j--)
+      a_start[j] = a_start[j-1];
+    a_start[0] = 0;
+    /* The couplings between constraints */
+    solver->c_start[0] = 0;
+    for (i = 0; i < n_const; i++) {
+      long a1 = pairs[2*i];
+      long a2 = pairs[2*i+1];
+      solver->c_start[i+1] = solver->c_start[i]
+	+ (a_start[a1+1]-a_start[a1]-1) + (a_start[a2+1]-a_start[a2]-1);
+      solver->s[i] = 1./sqrt(1./m[a1] + 1./m[a2]);
+      solver->length[i] = sqrt(dist_sq[i]);
+    }
+    n = solver->c_start[n_const];
+    solver->c_index = (int *)malloc((n > 0 ? n : 1)*sizeof(int));
+    solver->c_mass = (double *)malloc(2*(n > 0 ? n : 1)*sizeof(double));
+    if (solver->c_index == NULL || solver->c_mass == NULL)
+      goto memory_error;
+    solver->c_coef = solver->c_mass + n;
+    for (i = 0; i < n_const; i++) {
+      n = solver->c_start[i];
+      for (k = 0; k < 2; k++) {
+	long atom = pairs[2*i+k];
+	double sign_i = k == 0 ? -1. : 1.;
+	int l;
+	for (l = a_start[atom]; l < a_start[atom+1]; l++) {
+	  int c = a_index[l];
+	  double sign_c = (pairs[2*c] == atom) ? -1. : 1.;
+	  if (c == i)
+	    continue;
+	  solver->c_index[n] = c;
+	  solver->c_mass[n] = sign_i*sign_c/m[atom];
+	  n++;
+	}
+      }
+    }
+    free(a_start);
+    free(a_index);
+    a_start = a_index = NULL;
+  }
+
+  /* Rigid three-site molecules */
+  solver->settle = (int *)malloc(6*n_blocks*sizeof(int));
+  if (solver->settle == NULL)
+    goto memory_error;
+  for (j = 0; j < n_blocks; j++)
+    if (!find_settle_triangle(pairs, dist_sq, m, blocks[j], blocks[j+1],
+			      solver->settle+6*j))
+      solver->settle[6*j] = -1;
+
+  /* Distribution of the blocks over threads, balancing the number
+     of constraints */
+  if (nthreads > n_blocks)
+    nthreads = n_blocks;
+  if (nthreads > n_const/min_constraints_per_thread)
+    nthreads = n_const/min_constraints_per_thread;
+  if (nthreads > 1) {
+    solver->tasks = new_work_blocks(nthreads);
+    if (solver->tasks == NULL) {
+      free_constraint_solver(solver);
+      return -1;
+    }
+    solver->ntasks = nthreads;
+    j = 0;
+    for (k = 0; k < nthreads; k++) {
+      long limit = ((long)(k+1)*(long)n_const)/nthreads;
+      solver->tasks[k].function = solve_constraint_blocks;
+      solver->tasks[k].data = (void *)solver;
+      solver->tasks[k].first = j;
+      while (j < n_blocks && (blocks[j+1] <= limit || k == nthreads-1))
+	j++;
+      solver->tasks[k].last = j;
+    }
+  }
+  return 0;
+
+memory_error:
+  free(a_start);
+  free(a_index);
+  free_constraint_solver(solver);
+  PyErr_NoMemory();
+  return -1;
+}
+
+static void
+lincs_expand(constraint_solver *solver, int from, int to)
+{
+  double *rhs = solver->rhs;
+  double *sol = solver->sol;
+  double *tmp = solver->tmp;
+  int i, k, r;
+
+  for (i = from; i < to; i++)
+    sol[i] = rhs[i];
+  for (r = 0; r < solver->order; r++) {
+    for (i = from; i < to; i++) {
+      double sum = 0.;
+      for (k = solver->c_start[i]; k < solver->c_start[i+1]; k++)
+	sum += solver->c_coef[k]*rhs[solver->c_index[k]];
+      tmp[i] = sum;
+    }
+    for (i = from; i < to; i++) {
+      rhs[i] = tmp[i];
+      sol[i] += tmp[i];
+    }
+  }
+}
+
+static void
+lincs_apply(constraint_solver *solver, int from, int to)
+{
+  vector3 *x = solver->x;
+  double *m = solver->m;
+  int i;
+
+  for (i = from; i < to; i++) {
+    long a1 = solver->pairs[2*i];
+    long a2 = solver->pairs[2*i+1];
+    double f = solver->s[i]*solver->sol[i];
+    x[a1][0] += f*solver->dir[i][0]/m[a1];
+    x[a1][1] += f*solver->dir[i][1]/m[a1];
+    x[a1][2] += f*solver->dir[i][2]/m[a1];
+    x[a2][0] -= f*solver->dir[i][0]/m[a2];
+    x[a2][1] -= f*solver->dir[i][1]/m[a2];
+    x[a2][2] -= f*solver->dir[i][2]/m[a2];
+  }
+}
+
+static void
+lincs(constraint_solver *solver, int from, int to)
+{
+  const int max_iter = 500;
+  const double tolerance = 1.e-8;
+  distance_fn *d_fn = solver->universe_spec->distance_function;
+  double *d_data = solver->universe_spec->geometry_data;
+  vector3 *x = solver->x;
+  long *pairs = solver->pairs;
+  int i, j, k;
+
+  /* Reference directions and coupling coefficients */
+  for (i = from; i < to; i++) {
+    double l = vector_length(solver->const_vect[i]);
+    solver->dir[i][0] = solver->const_vect[i][0]/l;
+    solver->dir[i][1] = solver->const_vect[i][1]/l;
+    solver->dir[i][2] = solver->const_vect[i][2]/l;
+  }
+  for (i = from; i < to; i++)
+    for (k = solver->c_start[i]; k < solver->c_start[i+1]; k++) {
+      j = solver->c_index[k];
+      solver->c_coef[k] = -solver->s[i]*solver->s[j]*solver->c_mass[k]
+	                    * dot(solver->dir[i], solver->dir[j]);
+    }
+
+  /* Projection onto the constraint lengths along the reference
+     directions */
+  for (i = from; i < to; i++) {
+    vector3 d;
+    (*d_fn)(d, x[pairs[2*i]], x[pairs[2*i+1]], d_data);
+    solver->rhs[i] = solver->s[i]*(dot(solver->dir[i], d)
+				   - solver->length[i]);
+  }
+  lincs_expand(solver, from, to);
+  lincs_apply(solver, from, to);
+
+  /* Corrections for rotational lengthening */
+  for (k = 0; k < max_iter; k++) {
+    double max_dev = 0.;
+    for (i = from; i < to; i++) {
+      vector3 d;
+      double l_sq, p_sq, dev;
+      (*d_fn)(d, x[pairs[2*i]], x[pairs[2*i+1]], d_data);
+      l_sq = vector_length_sq(d);
+      dev = 0.5*fabs(l_sq-solver->dist_sq[i])/solver->dist_sq[i];
+      if (dev > max_dev) max_dev = dev;
+      p_sq = 2.*solver->dist_sq[i] - l_sq;
+      solver->rhs[i] = solver->s[i]*(solver->length[i]
+				     - (p_sq > 0. ? sqrt(p_sq) : 0.));
+    }
+    if (max_dev < tolerance)
+      break;
+    lincs_expand(solver, from, to);
+    lincs_apply(solver, from, to);
+  }
+}
+
+/* SETTLE for one rigid three-site molecule. The reference geometry
+   is given by the constraint vectors. Returns 0 without changing
+   the positions if the displacements are too large for the
+   analytical solution. */
+static int
+settle(constraint_solver *solver, int *w)
+{
+  distance_fn *d_fn = solver->universe_spec->distance_function;
+  double *d_data = solver->universe_spec->geometry_data;
+  vector3 *x = solver->x;
+  double *m = solver->m;
+  int a = w[0], b = w[1], c = w[2];
+  vector3 b0, c0, rb, rc, com, a1, b1, c1, ax, ay, az;
+  vector3 b0d, c0d, b1d, c1d, a3d, b3d, c3d;
+  double total_mass, d_ab, d_bc, h, ra, rh, l;
+  double sinphi, cosphi, sinpsi, cospsi, ya2d, xb2d, yb2d, yc2d;
+  double alpha, beta, gamma, al2be2, sintheta, costheta;
+  int k;
+
+  /* Reference positions relative to atom a */
+  for (k = 0; k < 3; k++) {
+    b0[k] = (solver->pairs[2*w[3]] == a) ? solver->const_vect[w[3]][k]
+                                         : -solver->const_vect[w[3]][k];
+    c0[k] = (solver->pairs[2*w[4]] == a) ? solver->const_vect[w[4]][k]
+                                         : -solver->const_vect[w[4]][k];
+  }
+
+  /* Unconstrained positions relative to atom a and to the center
+     of mass */
+  (*d_fn)(rb, x[a], x[b], d_data);
+  (*d_fn)(rc, x[a], x[c], d_data);
+  total_mass = m[a]+m[b]+m[c];
+  for (k = 0; k < 3; k++) {
+    com[k] = (m[b]*rb[k] + m[c]*rc[k])/total_mass;
+    a1[k] = -com[k];
+    b1[k] = rb[k]-com[k];
+    c1[k] = rc[k]-com[k];
+  }
+
+  /* Axes: z normal to the reference plane, x normal to z and a1 */
+  cross(az, b0, c0);
+  cross(ax, a1, az);
+  cross(ay, az, ax);
+  l = vector_length(ax);
+  if (l == 0.)
+    return 0;
+  l = 1./l;
+  vector_scale(ax, l);
+  l = 1./vector_length(ay);
+  vector_scale(ay, l);
+  l = 1./vector_length(az);
+  vector_scale(az, l);
+  b0d[0] = dot(ax, b0); b0d[1] = dot(ay, b0);
+  c0d[0] = dot(ax, c0); c0d[1] = dot(ay, c0);
+  b1d[0] = dot(ax, b1); b1d[1] = dot(ay, b1); b1d[2] = dot(az, b1);
+  c1d[0] = dot(ax, c1); c1d[1] = dot(ay, c1); c1d[2] = dot(az, c1);
+
+  /* Canonical geometry: a at distance ra from the center of mass,
+     b and c at distance rh from the base line, half base h */
+  d_ab = sqrt(solver->dist_sq[w[3]]);
+  d_bc = sqrt(solver->dist_sq[w[5]]);
+  h = 0.5*d_bc;
+  rh = sqrt(d_ab*d_ab-h*h);
+  ra = rh*(m[b]+m[c])/total_mass;
+  rh -= ra;
+
+  /* Rotation of the canonical geometry out of the reference plane */
+  sinphi = dot(az, a1)/ra;
+  if (fabs(sinphi) >= 1.)
+    return 0;
+  cosphi = sqrt(1.-sinphi*sinphi);
+  sinpsi = (b1d[2]-c1d[2])/(2.*h*cosphi);
+  if (fabs(sinpsi) >= 1.)
+    return 0;
+  cospsi = sqrt(1.-sinpsi*sinpsi);
+  ya2d = ra*cosphi;
+  xb2d = -h*cospsi;
+  yb2d = -rh*cosphi - h*sinpsi*sinphi;
+  yc2d = -rh*cosphi + h*sinpsi*sinphi;
+  /* Correction of xb2d that makes the b-c distance exact */
+  l = d_bc*d_bc - (yb2d-yc2d)*(yb2d-yc2d) - (b1d[2]-c1d[2])*(b1d[2]-c1d[2]);
+  if (l < 0.)
+    return 0;
+  xb2d = -0.5*sqrt(l);
+
+  /* Rotation in the plane */
+  alpha = xb2d*(b0d[0]-c0d[0]) + b0d[1]*yb2d + c0d[1]*yc2d;
+  beta = xb2d*(c0d[1]-b0d[1]) + b0d[0]*yb2d + c0d[0]*yc2d;
+  gamma = b0d[0]*b1d[1] - b1d[0]*b0d[1] + c0d[0]*c1d[1] - c1d[0]*c0d[1];
+  al2be2 = alpha*alpha + beta*beta;
+  if (al2be2 <= gamma*gamma)
+    return 0;
+  sintheta = (alpha*gamma - beta*sqrt(al2be2-gamma*gamma))/al2be2;
+  costheta = sqrt(1.-sintheta*sintheta);
+  a3d[0] = -ya2d*sintheta;
+  a3d[1] = ya2d*costheta;
+  a3d[2] = dot(az, a1);
+  b3d[0] = xb2d*costheta - yb2d*sintheta;
+  b3d[1] = xb2d*sintheta + yb2d*costheta;
+  b3d[2] = b1d[2];
+  c3d[0] = -xb2d*costheta - yc2d*sintheta;
+  c3d[1] = -xb2d*sintheta + yc2d*costheta;
+  c3d[2] = c1d[2];
+
+  /* Back to the original frame */
+  for (k = 0; k < 3; k++) {
+    x[a][k] += com[k] + ax[k]*a3d[0] + ay[k]*a3d[1] + az[k]*a3d[2];
+    x[b][k] += com[k] + ax[k]*b3d[0] + ay[k]*b3d[1] + az[k]*b3d[2] - rb[k];
+    x[c][k] += com[k] + ax[k]*c3d[0] + ay[k]*c3d[1] + az[k]*c3d[2] - rc[k];
+  }
+  return 1;
+}
+
+static void
+solve_constraint_blocks(void *data, int first, int last)
+{
+  constraint_solver *solver = (constraint_solver *)data;
+  int j;
+
+  for (j = first; j < last; j++) {
+    int from = solver->blocks[j];
+    int to = solver->blocks[j+1];
+    if (from == to)
+      continue;
+    if (solver->settle[6*j] >= 0 && settle(solver, solver->settle+6*j))
+      continue;
+    if (solver->method == LINCS_SOLVER)
+      lincs(solver, from, to);
+    else
+      shake(solver->pairs, from, to, solver->x, solver->m,
+	    solver->const_vect, solver->dist_sq,
+	    solver->universe_spec->distance_function,
+	    solver->universe_spec->geometry_data);
+  }
+}
+
+/* Move the atoms in x to satisfy the constraints, using the
+   constraint vectors in const_vect as reference directions. */
+static void
+constrain_positions(constraint_solver *solver, vector3 *x,
+		    vector3 *const_vect)
+{
+  solver->x = x;
+  solver->const_vect = const_vect;
+  if (solver->tasks != NULL)
+    run_work_blocks(solver->tasks, solver->ntasks);
+  else
+    solve_constraint_blocks((void *)solver, 0, solver->n_blocks);
+}
+
+/* Test if any output specification is active at a given step.
+   The specification list ends with an entry of type 0. */
+
+static int
+output_due(PyTrajectoryOutputSpec *spec, int step)
+{
+  for (; spec->type != 0; spec++)
+    if (step >= spec->first && step < spec->last
+	&& (step-spec->first) % spec->frequency == 0)
+      return 1;
+  return 0;
+}
+
 /* Velocity-Verlet integrator */
 
+/* With domain decomposition, each process integrates only its atoms */
+#define OWNED(j) (owner == NULL || owner[j] == proc_id)
+
 static PyObject *
 integrateVV(PyObject *dummy, PyObject *args)
 {
@@ -400,10 +1147,14 @@ integrateVV(PyObject *dummy, PyObject *args)
   PyArrayObject *constraints, *constraint_distances_squared, *c_blocks;
   PyArrayObject *t_parameters, *t_coordinates;
   PyArrayObject *b_parameters, *b_coordinates;
+  PyArrayObject *timing_array = NULL;
   PyListObject *spec_list;
   PyFFEvaluatorObject *evaluator;
   PyTrajectoryOutputSpec *output;
   PyTrajectoryVariable *data_descriptors = NULL;
+  domain_info *domain;
+  int *owner = NULL;
+  int proc_id = 0, sync = 0;
   double delta_t, dth;
   int first_step, last_step;
   char *description;
@@ -415,6 +1166,8 @@ integrateVV(PyObject *dummy, PyObject *args)
   vector3 *xp, *xph, *vh, *v1, *v2, *xold;
   double *temp;
   projection_data *pdata;
+  constraint_solver solver;
+  timing_data timing;
   double time;
   energy_data p_energy;
   double k_energy, n_energy, a_energy;
@@ -424,10 +1177,11 @@ integrateVV(PyObject *dummy, PyObject *args)
   double dxi, dalpha, factor1, factor2;
   int atoms, n_const, n_const_blocks, df;
   int pressure_available, thermostat, barostat;
+  int solver_method = SHAKE_SOLVER, lincs_order = 4;
   int i, j;
 
   /* Parse and check arguments */
-  if (!PyArg_ParseTuple(args, "OO!O!O!O!O!O!O!O!O!O!O!O!diiO!s", &universe,
+  if (!PyArg_ParseTuple(args, "OO!O!O!O!O!O!O!O!O!O!O!O!diiO!s|iiO!", &universe,
 			&PyArray_Type, &configuration,
 			&PyArray_Type, &velocities,
 			&PyArray_Type, &masses,
@@ -442,7 +1196,8 @@ integrateVV(PyObject *dummy, PyObject *args)
 			&PyArray_Type, &b_coordinates,
 			&delta_t, &first_step, &last_step,
 			&PyList_Type, &spec_list,
-			&description))
+			&description, &solver_method, &lincs_order,
+			&PyArray_Type, &timing_array))
     return NULL;
   universe_spec = (PyUniverseSpecObject *)
                    PyObject_GetAttrString(universe, "_spec");
@@ -475,6 +1230,14 @@ integrateVV(PyObject *dummy, PyObject *args)
   const_pairs = (long *)constraints->data;
   const_dist = (double *)constraint_distances_squared->data;
   const_blocks = (long *)c_blocks->data;
+  domain = evaluator->domain;
+  if (domain != NULL && (n_const > 0 || thermostat || barostat)) {
+    PyErr_SetString(PyExc_ValueError,
+		    "domain decomposition cannot be used with constraints,"
+		    " thermostats, or barostats");
+    Py_DECREF(gradients);
+    return NULL;
+  }
 
   /* Calculate number of degrees of freedom */
   df = 3*atoms;
@@ -519,6 +1282,15 @@ integrateVV(PyObject *dummy, PyObject *args)
   }
   b_alpha = (double *)b_coordinates->data;
 
+  /* Constraint solver */
+  if (init_constraint_solver(&solver, solver_method, lincs_order,
+			     evaluator->nthreads, atoms, n_const,
+			     const_pairs, const_dist, n_const_blocks,
+			     const_blocks, m, universe_spec) == -1) {
+    Py_DECREF(gradients);
+    return NULL;
+  }
+
   /* Allocate arrays for temporary data */
   pdata = NULL;
   if (n_const > 0) {
@@ -568,10 +1340,7 @@ integrateVV(PyObject *dummy, PyObject *args)
       pdata[j].diag = const_dist[j] *
 	(1./m[const_pairs[2*j]] + 1./m[const_pairs[2*j+1]]);
     }
-    for (j = 0; j < n_const_blocks; j++)
-      shake(const_pairs, const_blocks[j], const_blocks[j+1],
-	    x, m, const_vect, const_dist, universe_spec->distance_function,
-	    universe_spec->geometry_data);
+    constrain_positions(&solver, x, const_vect);
     for (j = 0; j < n_const; j++)
       universe_spec->distance_function(const_vect[j],
 				       x[const_pairs[2*j]],
@@ -617,6 +1386,15 @@ integrateVV(PyObject *dummy, PyObject *args)
   PyUniverseSpec_StateLock(universe_spec, -2);
   Py_END_ALLOW_THREADS;
 
+  /* Distribute the atoms over the processes */
+  if (domain != NULL) {
+    if (PyFFEvaluator_DomainUpdate(evaluator, domain_start,
+				   atoms, x, v, NULL) == -1)
+      goto error2;
+    owner = domain->owner;
+    proc_id = domain->proc_id;
+  }
+
   /* Initial force calculation */
   p_energy.gradients = (PyObject *)gradients;
   p_energy.gradient_fn = NULL;
@@ -649,11 +1427,12 @@ integrateVV(PyObject *dummy, PyObject *args)
      get_data_descriptors(9 + pressure_available
 			  + 2*thermostat
 			  + 3*barostat
-			  + (universe_spec->geometry_data_length > 0),
+			  + (universe_spec->geometry_data_length > 0)
+			  + 7,
 			  universe_spec,
 			  configuration, velocities,
 			  gradients, masses, &df,
-			  &time, &p_energy.energy, &k_energy,
+			  &time, &p_energy.energy, NULL, &k_energy,
 			  thermostat ? &n_energy : NULL,
 			  barostat ? &a_energy : NULL,
 			  &temperature,
@@ -662,7 +1441,8 @@ integrateVV(PyObject *dummy, PyObject *args)
 			  barostat ? &volume : NULL,
 			  barostat ? b_alpha : NULL,
 			  (universe_spec->geometry_data_length > 0) ?
-			              universe_spec->geometry_data : NULL);
+			              universe_spec->geometry_data : NULL,
+			  &timing);
   if (data_descriptors == NULL)
     goto error2;
   output = PyTrajectory_OutputSpecification(universe, spec_list,
@@ -679,14 +1459,26 @@ integrateVV(PyObject *dummy, PyObject *args)
 
   /** Main integration loop **/
   time  = first_step*delta_t;
+  timing_start(&timing);
   for (i = first_step; i < last_step; i++) {
 
     /* Calculation of thermodynamic properties */
     k_energy = 0.;
     for (j = 0; j < atoms; j++)
-      if (!fix[j])
+      if (!fix[j] && OWNED(j))
 	k_energy += m[j]*dot(v[j], v[j]);
     k_energy *= 0.5;
+    if (domain != NULL) {
+      /* The processes may have different output specifications,
+	 but they must all take part in the synchronization. */
+      double sums[2];
+      sums[0] = k_energy;
+      sums[1] = output_due(output, i);
+      if (!PyFFEvaluator_DomainSum(evaluator, sums, 2))
+	goto domain_error;
+      k_energy = sums[0];
+      sync = (sums[1] > 0.);
+    }
     n_energy = 0.5*(*t_xi)*(*t_xi)*t_mass*exp(2*(*t_lns))
                  + t_energy*(*t_lns);
     a_energy = 4.5*b_mass*volume*volume*(*b_alpha)*(*b_alpha) + volume*b_press;
@@ -696,13 +1488,20 @@ integrateVV(PyObject *dummy, PyObject *args)
 		+ (*b_alpha)*const_virial2)/(3.*volume);
     if (barostat && !thermostat)
       b_mass = 0.5*k_energy*b_tau*b_tau/(volume*volume);
+    timing_mark(&timing, T_INTEGRATION);
+    timing_update(&timing, i-first_step, delta_t);
     /* Trajectory and log output */
+    if (domain != NULL && sync
+	&& PyFFEvaluator_DomainUpdate(evaluator, domain_sync,
+				      atoms, x, v, f) == -1)
+      goto domain_error;
     if (PyTrajectory_Output(output, i, data_descriptors,
 			    &evaluator->tstate_save) == -1) {
       PyUniverseSpec_StateLock(universe_spec, -2);
       PyEval_RestoreThread(evaluator->tstate_save);
       goto error;
     }
+    timing_mark(&timing, T_OUTPUT);
 
     /* First part of integration step */
     if (barostat) {
@@ -759,8 +1558,9 @@ integrateVV(PyObject *dummy, PyObject *args)
       factor1 = factor2 = 0.;
       dalpha = 0.; /* unused, initialize just to make gcc happy */
     }
+    timing_mark(&timing, T_THERMOSTAT);
     for (j = 0; j < atoms; j++)
-      if (!fix[j]) {
+      if (!fix[j] && OWNED(j)) {
 	vector3 dv;
 	dv[0] = -dth*(f[j][0]/m[j]+(*t_xi)*v[j][0]);
 	dv[1] = -dth*(f[j][1]/m[j]+(*t_xi)*v[j][1]);
@@ -780,6 +1580,7 @@ integrateVV(PyObject *dummy, PyObject *args)
 	v[j][1] += dv[1]-dth*(*b_alpha)*vh[j][1];
 	v[j][2] += dv[2]-dth*(*b_alpha)*vh[j][2];
       }
+    timing_mark(&timing, T_INTEGRATION);
     if (barostat) {
       volume = universe_spec->volume_function(1.+delta_t*(factor1+factor2),
 					      universe_spec->geometry_data);
@@ -791,14 +1592,12 @@ integrateVV(PyObject *dummy, PyObject *args)
       (*t_xi) += dth*dxi;
       (*t_lns) += delta_t*(*t_xi);
     }
+    timing_mark(&timing, T_THERMOSTAT);
 
-    /* Constraints: SHAKE */
+    /* Constraints: SHAKE or LINCS */
     if (n_const > 0) {
       memcpy(xold, x, atoms*sizeof(vector3));
-      for (j = 0; j < n_const_blocks; j++)
-	shake(const_pairs, const_blocks[j], const_blocks[j+1],
-	      x, m, const_vect, const_dist, universe_spec->distance_function,
-	      universe_spec->geometry_data);
+      constrain_positions(&solver, x, const_vect);
       for (j = 0; j < atoms; j++)
 	if (!fix[j]) {
 	  v[j][0] += (x[j][0]-xold[j][0])/delta_t;
@@ -811,11 +1610,19 @@ integrateVV(PyObject *dummy, PyObject *args)
 					 x[const_pairs[2*j+1]],
 					 universe_spec->geometry_data);
     }
+    timing_mark(&timing, T_CONSTRAINTS);
 
     /* Coordinate correction (for periodic universes etc.) */
     universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
 
+    /* Update the positions of the atoms near the domain boundaries */
+    if (domain != NULL
+	&& PyFFEvaluator_DomainUpdate(evaluator, domain_step,
+				      atoms, x, v, NULL) == -1)
+      goto domain_error;
+
     /* Mid-step energy evaluation */
+    timing_mark(&timing, T_INTEGRATION);
     PyUniverseSpec_StateLock(universe_spec, -2);
     PyUniverseSpec_StateLock(universe_spec, 1);
     (*evaluator->eval_func)(evaluator, &p_energy, configuration, 1);
@@ -825,15 +1632,17 @@ integrateVV(PyObject *dummy, PyObject *args)
       goto error;
     }
     PyUniverseSpec_StateLock(universe_spec, -1);
+    timing_mark(&timing, T_FORCES);
 
     /* Second part of integration step */
     for (j = 0; j < atoms; j++)
-      if (!fix[j]) {
+      if (!fix[j] && OWNED(j)) {
 	double factor = dth/m[j];
 	v[j][0] -= factor*f[j][0];
 	v[j][1] -= factor*f[j][1];
 	v[j][2] -= factor*f[j][2];
       }
+    timing_mark(&timing, T_INTEGRATION);
 
     /* Constraints: constraint forces */
     if (n_const > 0) {
@@ -850,6 +1659,7 @@ integrateVV(PyObject *dummy, PyObject *args)
 	const_virial2 += pdata[j].multiplier[MU2]*const_dist[j];
       }
     }
+    timing_mark(&timing, T_CONSTRAINTS);
 
     /* Iterative determination of xi and alpha */
     if (thermostat || barostat) {
@@ -933,6 +1743,7 @@ integrateVV(PyObject *dummy, PyObject *args)
       if (thermostat) (*t_xi) = xi;
       if (barostat) (*b_alpha) = alpha;
     }
+    timing_mark(&timing, T_THERMOSTAT);
     /* Final velocity calculation */
     for (j = 0; j < atoms; j++)
       if (!fix[j]) {
@@ -953,9 +1764,18 @@ integrateVV(PyObject *dummy, PyObject *args)
 
     /* The End - next time step! */
     time += delta_t;
+    timing_mark(&timing, T_INTEGRATION);
   }
   /** End of main integration loop **/
 
+  /* Collect the atoms of all processes */
+  if (domain != NULL) {
+    if (PyFFEvaluator_DomainUpdate(evaluator, domain_finish,
+				   atoms, x, v, f) == -1)
+      goto domain_error;
+    owner = NULL;
+  }
+
   /* Final thermodynamic property evaluation */
   k_energy = 0.;
   for (j = 0; j < atoms; j++)
@@ -969,6 +1789,8 @@ integrateVV(PyObject *dummy, PyObject *args)
   pressure = (2.*k_energy+p_energy.virial
 	      + ((*t_xi)-1./dth)*const_virial1
 	      + (*b_alpha)*const_virial2)/(3.*volume);
+  timing_mark(&timing, T_INTEGRATION);
+  timing_update(&timing, i-first_step, delta_t);
 
   /* Final trajectory and log output */
   if (PyTrajectory_Output(output, i, data_descriptors,
@@ -977,6 +1799,8 @@ integrateVV(PyObject *dummy, PyObject *args)
     PyEval_RestoreThread(evaluator->tstate_save);
     goto error;
   }
+  timing_mark(&timing, T_OUTPUT);
+  timing_store(&timing, i-first_step, timing_array);
 
   /* Cleanup */
   PyUniverseSpec_StateLock(universe_spec, -2);
@@ -984,76 +1808,1438 @@ integrateVV(PyObject *dummy, PyObject *args)
   PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
   free(scratch);
   free(pdata);
+  free_constraint_solver(&solver);
   free(data_descriptors);
   Py_DECREF(gradients);
+  if (PyErr_Occurred())
+    return NULL;
   Py_INCREF(Py_None);
   return Py_None;
 
   /* Error return */
+domain_error:
+  PyUniverseSpec_StateLock(universe_spec, -2);
+  PyEval_RestoreThread(evaluator->tstate_save);
+  PyErr_SetString(PyExc_EnvironmentError,
+		  "communication error in domain decomposition");
 error:
   PyTrajectory_OutputFinish(output, i, 1, 1, data_descriptors);
 error2:
+  if (domain != NULL)
+    domain->active = 0;
   free(scratch);
   free(pdata);
+  free_constraint_solver(&solver);
   free(data_descriptors);
   Py_DECREF(gradients);
   return NULL;
 }
 
-/* Trajectory functions */
+/* Constraints for the splitting integrators (RESPA, Langevin):
+   SHAKE or LINCS after a position update, with the velocity correction
+   corresponding to the constraint displacement, and projection of
+   the velocities onto the constraint surface. */
 
-static int
-getMassesAndVelocities(PyTrajectoryVariable *dynamic_data,
-		       PyArrayObject **masses, PyArrayObject **velocities)
+static void
+prepare_constraints(vector3 *x, double *m,
+		    int n_const, long *const_pairs, double *const_dist,
+		    vector3 *const_vect, projection_data *pdata,
+		    constraint_solver *solver,
+		    PyUniverseSpecObject *universe_spec)
 {
-  PyTrajectoryVariable *var = dynamic_data;
-  int found = 0;
-  while (var->name != NULL) {
-    if (strcmp(var->name, "masses") == 0) {
-      *masses = var->value.array;
-      found++;
-    }
-    if (strcmp(var->name, "velocities") == 0) {
-      *velocities = var->value.array;
-      found++;
-    }
-    var++;
-  }
-  if (found != 2) {
-    PyErr_SetString(PyExc_ValueError,
-		    "trajectory function needs masses and velocities");
-    return 0;
+  int j;
+  for (j = 0; j < n_const; j++) {
+    universe_spec->distance_function(const_vect[j],
+				     x[const_pairs[2*j]],
+				     x[const_pairs[2*j+1]],
+				     universe_spec->geometry_data);
+    pdata[j].multiplier[MU1] = 0.;
+    pdata[j].diag = const_dist[j] *
+      (1./m[const_pairs[2*j]] + 1./m[const_pairs[2*j+1]]);
   }
-  return 1;
+  constrain_positions(solver, x, const_vect);
+  for (j = 0; j < n_const; j++)
+    universe_spec->distance_function(const_vect[j],
+				     x[const_pairs[2*j]],
+				     x[const_pairs[2*j+1]],
+				     universe_spec->geometry_data);
 }
 
-static int
-getDegreesOfFreedom(PyTrajectoryVariable *dynamic_data)
+static void
+rattle_positions(vector3 *x, vector3 *v, vector3 *xold, long *fix,
+		 int atoms, double dt,
+		 int n_const, long *const_pairs,
+		 vector3 *const_vect, constraint_solver *solver,
+		 PyUniverseSpecObject *universe_spec)
 {
-  int natoms = -1, ndf = -1;
-  PyTrajectoryVariable *var = dynamic_data;
-  while (var->name != NULL) {
-    if (strcmp(var->name, "degrees_of_freedom") == 0)
-      ndf = *var->value.ip;
-    if (strcmp(var->name, "configuration") == 0)
-      natoms = var->value.array->dimensions[0];
-    var++;
-  }
-  if (ndf >= 0)
-    return ndf;
-  else
-    return 3*natoms;
+  int j;
+  memcpy(xold, x, atoms*sizeof(vector3));
+  constrain_positions(solver, x, const_vect);
+  for (j = 0; j < atoms; j++)
+    if (!fix[j]) {
+      v[j][0] += (x[j][0]-xold[j][0])/dt;
+      v[j][1] += (x[j][1]-xold[j][1])/dt;
+      v[j][2] += (x[j][2]-xold[j][2])/dt;
+    }
+  for (j = 0; j < n_const; j++)
+    universe_spec->distance_function(const_vect[j],
+				     x[const_pairs[2*j]],
+				     x[const_pairs[2*j+1]],
+				     universe_spec->geometry_data);
 }
 
-static double *
-getScalar(PyTrajectoryVariable *dynamic_data, char *name)
+static void
+rattle_velocities(vector3 *v, vector3 *v1, long *fix, double *m, int atoms,
+		  int n_const, long *const_pairs, double *const_dist,
+		  vector3 *const_vect, projection_data *pdata)
 {
-  PyTrajectoryVariable *var = dynamic_data;
-  double *variable = NULL;
-  while (var->name != NULL) {
-    if (strcmp(var->name, name) == 0) {
-      variable = var->value.dp;
-    }
+  int j;
+  project(n_const, const_pairs, const_dist, const_vect,
+	  pdata, MU1, m, v, v1, atoms);
+  for (j = 0; j < atoms; j++)
+    if (!fix[j]) {
+      v[j][0] -= v1[j][0];
+      v[j][1] -= v1[j][1];
+      v[j][2] -= v1[j][2];
+    }
+}
+
+/* Multiple-time-step (r-RESPA) integrator */
+
+/* Evaluate one group of energy terms in the middle of the integration,
+   switching from write access to read access for the duration of the
+   evaluation. Returns 0 if an error occurred, in which case the
+   universe is no longer locked. */
+
+static int
+evaluate_group(PyFFEvaluatorObject *evaluator, energy_data *energy,
+	       PyArrayObject *configuration,
+	       PyUniverseSpecObject *universe_spec, PyThreadState **tstate)
+{
+  evaluator->tstate_save = *tstate;
+  PyUniverseSpec_StateLock(universe_spec, -2);
+  PyUniverseSpec_StateLock(universe_spec, 1);
+  (*evaluator->eval_func)(evaluator, energy, configuration, 1);
+  PyUniverseSpec_StateLock(universe_spec, 2);
+  *tstate = evaluator->tstate_save;
+  if (energy->error)
+    return 0;
+  PyUniverseSpec_StateLock(universe_spec, -1);
+  return 1;
+}
+
+/* Half step (of length 0.5*dt) of the thermostat and barostat variables,
+   including the velocity scaling they cause. The equations of motion
+   are the same as in integrateVV; the half step is split symmetrically
+   around the velocity scaling. Returns the new kinetic energy. */
+
+static double
+extended_half_step(vector3 *v, long *fix, int atoms,
+		   double k_energy, double virial, double volume, double dt,
+		   int thermostat, double t_mass, double t_energy,
+		   double *t_xi, double *t_lns,
+		   int barostat, double b_mass, double b_press,
+		   double *b_alpha)
+{
+  double dtq = 0.25*dt;
+  double scale;
+  int j, n;
+
+  for (n = 0; n < 2; n++) {
+    if (n == 1) {
+      scale = exp(-0.5*dt*((*t_xi)+(*b_alpha)));
+      for (j = 0; j < atoms; j++)
+	if (!fix[j]) {
+	  v[j][0] *= scale;
+	  v[j][1] *= scale;
+	  v[j][2] *= scale;
+	}
+      k_energy *= scale*scale;
+      (*t_lns) += 0.5*dt*(*t_xi);
+    }
+    if (barostat)
+      (*b_alpha) += dtq*(((2.*k_energy+virial)/(3.*volume)-b_press)
+			 /(3.*volume*b_mass)
+			 - (*b_alpha)*((*t_xi)+3.*(*b_alpha)));
+    if (thermostat)
+      (*t_xi) += dtq*(2.*k_energy - t_energy
+		      + 9.*b_mass*volume*volume*(*b_alpha)*(*b_alpha))/t_mass;
+  }
+  return k_energy;
+}
+
+static PyObject *
+integrateRESPA(PyObject *dummy, PyObject *args)
+{
+  PyObject *universe;
+  PyUniverseSpecObject *universe_spec;
+  PyArrayObject *configuration;
+  PyArrayObject *velocities;
+  PyArrayObject *masses;
+  PyArrayObject *fixed;
+  PyArrayObject *gradients, *fast_gradients, *slow_gradients;
+  PyArrayObject *constraints, *constraint_distances_squared, *c_blocks;
+  PyArrayObject *t_parameters, *t_coordinates;
+  PyArrayObject *b_parameters, *b_coordinates;
+  PyListObject *spec_list;
+  PyFFEvaluatorObject *fast, *slow;
+  PyTrajectoryOutputSpec *output;
+  PyTrajectoryVariable *data_descriptors = NULL;
+  PyThreadState *tstate;
+  double delta_t, dth, dti, dtih;
+  int inner_steps, first_step, last_step;
+  char *description;
+  vector3 *x, *v, *f, *ff, *fs;
+  double *m, *const_dist;
+  long *fix, *const_pairs, *const_blocks;
+  vector3 *scratch, *xold, *v1, *const_vect;
+  projection_data *pdata;
+  constraint_solver solver;
+  double time;
+  energy_data e_fast, e_slow;
+  double p_energy, virial;
+  double k_energy, n_energy, a_energy;
+  double temperature, volume, pressure;
+  double t_temp, t_tau, t_mass, t_energy, *t_xi, *t_lns;
+  double b_press, b_tau, b_mass, *b_alpha;
+  int atoms, n_const, n_const_blocks, df;
+  int pressure_available, thermostat, barostat;
+  int solver_method = SHAKE_SOLVER, lincs_order = 4;
+  int i, j, k;
+
+  /* Parse and check arguments */
+  if (!PyArg_ParseTuple(args, "OO!O!O!O!O!O!O!O!O!O!O!O!O!diiiO!s|ii",
+			&universe,
+			&PyArray_Type, &configuration,
+			&PyArray_Type, &velocities,
+			&PyArray_Type, &masses,
+			&PyArray_Type, &fixed,
+			&PyFFEvaluator_Type, &fast,
+			&PyFFEvaluator_Type, &slow,
+			&PyArray_Type, &constraints,
+			&PyArray_Type, &constraint_distances_squared,
+			&PyArray_Type, &c_blocks,
+			&PyArray_Type, &t_parameters,
+			&PyArray_Type, &t_coordinates,
+			&PyArray_Type, &b_parameters,
+			&PyArray_Type, &b_coordinates,
+			&delta_t, &inner_steps, &first_step, &last_step,
+			&PyList_Type, &spec_list,
+			&description, &solver_method, &lincs_order))
+    return NULL;
+  if (inner_steps < 1) {
+    PyErr_SetString(PyExc_ValueError, "inner_steps must be positive");
+    return NULL;
+  }
+  if (fast->domain != NULL || slow->domain != NULL) {
+    PyErr_SetString(PyExc_ValueError,
+		    "domain decomposition cannot be used with RESPA");
+    return NULL;
+  }
+  universe_spec = (PyUniverseSpecObject *)
+                   PyObject_GetAttrString(universe, "_spec");
+  if (universe_spec == NULL)
+    return NULL;
+  /* The universe keeps the specification alive during the integration */
+  Py_DECREF(universe_spec);
+
+  /* Set some convenient variables */
+  atoms = configuration->dimensions[0];
+  n_const = constraints->dimensions[0];
+  n_const_blocks = c_blocks->dimensions[0]-1;
+  thermostat = (t_parameters->dimensions[0] > 0);
+  barostat = (b_parameters->dimensions[0] > 0);
+  if (barostat && n_const > 0) {
+    PyErr_SetString(PyExc_ValueError,
+		    "RESPA cannot combine a barostat with constraints");
+    return NULL;
+  }
+  dth = 0.5*delta_t;
+  dti = delta_t/inner_steps;
+  dtih = 0.5*dti;
+  x = (vector3 *)configuration->data;
+  v = (vector3 *)velocities->data;
+  m = (double *)masses->data;
+  fix = (long *)fixed->data;
+  const_pairs = (long *)constraints->data;
+  const_dist = (double *)constraint_distances_squared->data;
+  const_blocks = (long *)c_blocks->data;
+  if (init_constraint_solver(&solver, solver_method, lincs_order,
+			     fast->nthreads, atoms, n_const,
+			     const_pairs, const_dist, n_const_blocks,
+			     const_blocks, m, universe_spec) == -1)
+    return NULL;
+
+  /* Create gradient arrays: total, fast terms, slow terms */
+#if defined(NUMPY)
+  gradients = (PyArrayObject *)PyArray_Copy(configuration);
+  fast_gradients = (PyArrayObject *)PyArray_Copy(configuration);
+  slow_gradients = (PyArrayObject *)PyArray_Copy(configuration);
+#else
+  gradients = (PyArrayObject *)PyArray_FromDims(configuration->nd,
+						configuration->dimensions,
+						PyArray_DOUBLE);
+  fast_gradients = (PyArrayObject *)PyArray_FromDims(configuration->nd,
+						     configuration->dimensions,
+						     PyArray_DOUBLE);
+  slow_gradients = (PyArrayObject *)PyArray_FromDims(configuration->nd,
+						     configuration->dimensions,
+						     PyArray_DOUBLE);
+#endif
+  scratch = NULL;
+  pdata = NULL;
+  if (gradients == NULL || fast_gradients == NULL || slow_gradients == NULL)
+    goto error2;
+  f = (vector3 *)gradients->data;
+  ff = (vector3 *)fast_gradients->data;
+  fs = (vector3 *)slow_gradients->data;
+
+  /* Calculate number of degrees of freedom */
+  df = 3*atoms;
+  for (j = 0; j < atoms; j++) {
+    if (fix[j])
+      df -= 3;
+  }
+  for (j = 0; j < n_const; j++) {
+    if (fix[const_pairs[2*j]] || fix[const_pairs[2*j+1]]) {
+      PyErr_SetString(PyExc_ValueError,
+		      "distance constraint on a fixed atom");
+      goto error2;
+    }
+    df--;
+  }
+
+  /* Thermostat and barostat information, as in integrateVV */
+  if (thermostat) {
+    t_temp = *(double *)t_parameters->data;
+    t_tau = *(((double *)t_parameters->data)+1);
+    t_energy = df*t_temp*kB;
+    t_mass = t_energy*t_tau*t_tau;
+  }
+  else {
+    t_mass = 0.;
+    t_energy = 0.;
+    t_temp = 0.; /* unused, initialize just to make gcc happy */
+  }
+  t_xi = (double *)t_coordinates->data;
+  t_lns = t_xi + 1;
+  if (barostat) {
+    b_press = *(double *)b_parameters->data;
+    b_tau = *(((double *)b_parameters->data)+1);
+  }
+  else {
+    b_press = 0.;
+    b_tau = 0.; /* unused, initialize just to make gcc happy */
+  }
+  b_mass = 0.;
+  b_alpha = (double *)b_coordinates->data;
+
+  /* Allocate arrays for constraint data */
+  if (n_const > 0) {
+    scratch = (vector3 *)malloc((2*atoms+n_const)*sizeof(vector3));
+    pdata = (projection_data *)malloc(n_const*sizeof(projection_data));
+    if (scratch == NULL || pdata == NULL) {
+      PyErr_NoMemory();
+      goto error2;
+    }
+    xold = scratch;
+    v1 = xold + atoms;
+    const_vect = v1 + atoms;
+  }
+  else {
+    xold = v1 = const_vect = NULL;
+  }
+
+  /* Enforce constraints and initialize constraint data */
+  Py_BEGIN_ALLOW_THREADS;
+  PyUniverseSpec_StateLock(universe_spec, -1);
+  universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
+  if (n_const > 0)
+    prepare_constraints(x, m, n_const, const_pairs, const_dist, const_vect,
+			pdata, &solver, universe_spec);
+  PyUniverseSpec_StateLock(universe_spec, -2);
+  Py_END_ALLOW_THREADS;
+
+  /* Initial force calculation */
+  e_fast.gradients = (PyObject *)fast_gradients;
+  e_fast.gradient_fn = NULL;
+  e_fast.force_constants = NULL;
+  e_fast.fc_fn = NULL;
+  e_slow.gradients = (PyObject *)slow_gradients;
+  e_slow.gradient_fn = NULL;
+  e_slow.force_constants = NULL;
+  e_slow.fc_fn = NULL;
+  tstate = PyEval_SaveThread();
+  PyUniverseSpec_StateLock(universe_spec, 1);
+  fast->tstate_save = tstate;
+  (*fast->eval_func)(fast, &e_fast, configuration, 0);
+  tstate = fast->tstate_save;
+  if (!e_fast.error) {
+    slow->tstate_save = tstate;
+    (*slow->eval_func)(slow, &e_slow, configuration, 0);
+    tstate = slow->tstate_save;
+  }
+  PyUniverseSpec_StateLock(universe_spec, 2);
+  PyEval_RestoreThread(tstate);
+  if (e_fast.error || e_slow.error)
+    goto error2;
+  for (j = 0; j < atoms; j++) {
+    f[j][0] = ff[j][0] + fs[j][0];
+    f[j][1] = ff[j][1] + fs[j][1];
+    f[j][2] = ff[j][2] + fs[j][2];
+  }
+  p_energy = e_fast.energy + e_slow.energy;
+  virial = e_fast.virial + e_slow.virial;
+
+  /* Check if pressure can be calculated. The constraint forces
+     are not included in the virial, so there is no pressure
+     for systems with constraints. */
+  Py_BEGIN_ALLOW_THREADS;
+  PyUniverseSpec_StateLock(universe_spec, 1);
+  volume = universe_spec->volume_function(1., universe_spec->geometry_data);
+  PyUniverseSpec_StateLock(universe_spec, 2);
+  Py_END_ALLOW_THREADS;
+  pressure_available = volume > 0. && n_const == 0
+                       && e_fast.virial_available && e_slow.virial_available;
+  if (thermostat && barostat)
+    b_mass = df*t_temp*kB*b_tau*b_tau/(volume*volume);
+
+  /* Initialize output */
+  data_descriptors =
+     get_data_descriptors(9 + pressure_available
+			  + 2*thermostat
+			  + 3*barostat
+			  + (universe_spec->geometry_data_length > 0),
+			  universe_spec,
+			  configuration, velocities,
+			  gradients, masses, &df,
+			  &time, &p_energy, NULL, &k_energy,
+			  thermostat ? &n_energy : NULL,
+			  barostat ? &a_energy : NULL,
+			  &temperature,
+			  thermostat ? t_xi : NULL,
+			  pressure_available ? &pressure:NULL,
+			  barostat ? &volume : NULL,
+			  barostat ? b_alpha : NULL,
+			  (universe_spec->geometry_data_length > 0) ?
+			              universe_spec->geometry_data : NULL,
+			  NULL);
+  if (data_descriptors == NULL)
+    goto error2;
+  output = PyTrajectory_OutputSpecification(universe, spec_list,
+					    description,
+					    data_descriptors);
+  if (output == NULL)
+    goto error2;
+
+  tstate = PyEval_SaveThread();
+
+  /* Get write access for the integration, switching to
+     read access only during energy evaluation */
+  PyUniverseSpec_StateLock(universe_spec, -1);
+
+  /** Main integration loop: one outer step per iteration **/
+  time  = first_step*delta_t;
+  for (i = first_step; i < last_step; i++) {
+
+    /* Calculation of thermodynamic properties */
+    k_energy = 0.;
+    for (j = 0; j < atoms; j++)
+      if (!fix[j])
+	k_energy += m[j]*dot(v[j], v[j]);
+    k_energy *= 0.5;
+    /* Nose-Hoover contribution to the conserved energy */
+    n_energy = 0.5*(*t_xi)*(*t_xi)*t_mass + t_energy*(*t_lns);
+    a_energy = 4.5*b_mass*volume*volume*(*b_alpha)*(*b_alpha) + volume*b_press;
+    temperature = 2.*k_energy*temperature_factor/df;
+    pressure = (2.*k_energy+virial)/(3.*volume);
+    if (barostat && !thermostat)
+      b_mass = 0.5*k_energy*b_tau*b_tau/(volume*volume);
+
+    /* Trajectory and log output */
+    if (PyTrajectory_Output(output, i, data_descriptors, &tstate) == -1) {
+      PyUniverseSpec_StateLock(universe_spec, -2);
+      PyEval_RestoreThread(tstate);
+      goto error;
+    }
+
+    /* Thermostat and barostat */
+    if (thermostat || barostat)
+      k_energy = extended_half_step(v, fix, atoms, k_energy,
+				    virial, volume, delta_t,
+				    thermostat, t_mass, t_energy, t_xi, t_lns,
+				    barostat, b_mass, b_press, b_alpha);
+
+    /* Slow forces: first half step */
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	double factor = dth/m[j];
+	v[j][0] -= factor*fs[j][0];
+	v[j][1] -= factor*fs[j][1];
+	v[j][2] -= factor*fs[j][2];
+      }
+
+    /* Fast forces: Velocity-Verlet with the inner time step */
+    for (k = 0; k < inner_steps; k++) {
+      double xscale = 1., vscale = dti;
+      if (barostat) {
+	/* Exact solution of dx/dt = v + alpha*x for constant v */
+	double a = (*b_alpha);
+	xscale = exp(a*dti);
+	vscale = (fabs(a*dti) > 1.e-8) ? (xscale-1.)/a : dti*(1.+0.5*a*dti);
+      }
+      for (j = 0; j < atoms; j++)
+	if (!fix[j]) {
+	  double factor = dtih/m[j];
+	  v[j][0] -= factor*ff[j][0];
+	  v[j][1] -= factor*ff[j][1];
+	  v[j][2] -= factor*ff[j][2];
+	  x[j][0] = xscale*x[j][0] + vscale*v[j][0];
+	  x[j][1] = xscale*x[j][1] + vscale*v[j][1];
+	  x[j][2] = xscale*x[j][2] + vscale*v[j][2];
+	}
+      if (barostat)
+	volume = universe_spec->volume_function(xscale,
+						universe_spec->geometry_data);
+
+      /* Constraints: SHAKE or LINCS */
+      if (n_const > 0)
+	rattle_positions(x, v, xold, fix, atoms, dti,
+			 n_const, const_pairs, const_vect,
+			 &solver, universe_spec);
+
+      /* Coordinate correction (for periodic universes etc.) */
+      universe_spec->correction_function(x, atoms,
+					 universe_spec->geometry_data);
+
+      if (!evaluate_group(fast, &e_fast, configuration,
+			  universe_spec, &tstate)) {
+	PyEval_RestoreThread(tstate);
+	goto error;
+      }
+      for (j = 0; j < atoms; j++)
+	if (!fix[j]) {
+	  double factor = dtih/m[j];
+	  v[j][0] -= factor*ff[j][0];
+	  v[j][1] -= factor*ff[j][1];
+	  v[j][2] -= factor*ff[j][2];
+	}
+
+      /* Constraints: velocity projection */
+      if (n_const > 0)
+	rattle_velocities(v, v1, fix, m, atoms, n_const, const_pairs,
+			  const_dist, const_vect, pdata);
+    }
+
+    /* Slow forces: second half step */
+    if (!evaluate_group(slow, &e_slow, configuration,
+			universe_spec, &tstate)) {
+      PyEval_RestoreThread(tstate);
+      goto error;
+    }
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	double factor = dth/m[j];
+	v[j][0] -= factor*fs[j][0];
+	v[j][1] -= factor*fs[j][1];
+	v[j][2] -= factor*fs[j][2];
+      }
+    if (n_const > 0)
+      rattle_velocities(v, v1, fix, m, atoms, n_const, const_pairs,
+			const_dist, const_vect, pdata);
+    for (j = 0; j < atoms; j++) {
+      f[j][0] = ff[j][0] + fs[j][0];
+      f[j][1] = ff[j][1] + fs[j][1];
+      f[j][2] = ff[j][2] + fs[j][2];
+    }
+    p_energy = e_fast.energy + e_slow.energy;
+    virial = e_fast.virial + e_slow.virial;
+
+    /* Thermostat and barostat */
+    if (thermostat || barostat) {
+      k_energy = 0.;
+      for (j = 0; j < atoms; j++)
+	if (!fix[j])
+	  k_energy += m[j]*dot(v[j], v[j]);
+      k_energy *= 0.5;
+      extended_half_step(v, fix, atoms, k_energy,
+			 virial, volume, delta_t,
+			 thermostat, t_mass, t_energy, t_xi, t_lns,
+			 barostat, b_mass, b_press, b_alpha);
+    }
+
+    /* The End - next time step! */
+    time += delta_t;
+  }
+  /** End of main integration loop **/
+
+  /* Final thermodynamic property evaluation */
+  k_energy = 0.;
+  for (j = 0; j < atoms; j++)
+    if (!fix[j])
+      k_energy += m[j]*dot(v[j], v[j]);
+  k_energy *= 0.5;
+  n_energy = 0.5*(*t_xi)*(*t_xi)*t_mass + t_energy*(*t_lns);
+  a_energy = 4.5*b_mass*volume*volume*(*b_alpha)*(*b_alpha) + volume*b_press;
+  temperature = 2.*k_energy*temperature_factor/df;
+  pressure = (2.*k_energy+virial)/(3.*volume);
+
+  /* Final trajectory and log output */
+  if (PyTrajectory_Output(output, i, data_descriptors, &tstate) == -1) {
+    PyUniverseSpec_StateLock(universe_spec, -2);
+    PyEval_RestoreThread(tstate);
+    goto error;
+  }
+
+  /* Cleanup */
+  PyUniverseSpec_StateLock(universe_spec, -2);
+  PyEval_RestoreThread(tstate);
+  PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
+  free(scratch);
+  free(pdata);
+  free_constraint_solver(&solver);
+  free(data_descriptors);
+  Py_DECREF(gradients);
+  Py_DECREF(fast_gradients);
+  Py_DECREF(slow_gradients);
+  if (PyErr_Occurred())
+    return NULL;
+  Py_INCREF(Py_None);
+  return Py_None;
+
+  /* Error return */
+error:
+  PyTrajectory_OutputFinish(output, i, 1, 1, data_descriptors);
+error2:
+  free(scratch);
+  free(pdata);
+  free_constraint_solver(&solver);
+  free(data_descriptors);
+  Py_XDECREF(gradients);
+  Py_XDECREF(fast_gradients);
+  Py_XDECREF(slow_gradients);
+  return NULL;
+}
+
+/* Langevin dynamics integrator (BAOAB splitting) */
+
+/* Counter-based random numbers: each number is a hash of the seed,
+   the step number, and the atom index, so the noise does not depend
+   on how the atoms are distributed over threads. */
+
+static PY_UINT64_T
+mix64(PY_UINT64_T z)
+{
+  z += (PY_UINT64_T)0x9e3779b97f4a7c15ULL;
+  z = (z ^ (z >> 30)) * (PY_UINT64_T)0xbf58476d1ce4e5b9ULL;
+  z = (z ^ (z >> 27)) * (PY_UINT64_T)0x94d049bb133111ebULL;
+  return z ^ (z >> 31);
+}
+
+static double
+counter_uniform(PY_UINT64_T key)
+{
+  /* 53 random bits, mapped to the open interval (0, 1) */
+  return ((double)(mix64(key) >> 11) + 0.5) * (1./9007199254740992.);
+}
+
+static void
+counter_gaussian(PY_UINT64_T base, int atom, vector3 g)
+{
+  PY_UINT64_T key = base + 4*(PY_UINT64_T)atom;
+  double r1 = sqrt(-2.*log(counter_uniform(key)));
+  double phi1 = 2.*M_PI*counter_uniform(key+1);
+  double r2 = sqrt(-2.*log(counter_uniform(key+2)));
+  double phi2 = 2.*M_PI*counter_uniform(key+3);
+  g[0] = r1*cos(phi1);
+  g[1] = r1*sin(phi1);
+  g[2] = r2*cos(phi2);
+}
+
+/* The friction and noise step (O) for a block of atoms */
+
+typedef struct {
+  vector3 *v;
+  double *m, *friction;
+  long *fix;
+  double temperature, delta_t;
+  PY_UINT64_T base;
+} langevin_data;
+
+static void
+langevin_noise(void *data, int first, int last)
+{
+  langevin_data *ld = (langevin_data *)data;
+  int j;
+  for (j = first; j < last; j++)
+    if (!ld->fix[j] && ld->friction[j] > 0.) {
+      double c1 = exp(-ld->delta_t*ld->friction[j]/ld->m[j]);
+      double c2 = sqrt((1.-c1*c1)*kB*ld->temperature/ld->m[j]);
+      vector3 g;
+      counter_gaussian(ld->base, j, g);
+      ld->v[j][0] = c1*ld->v[j][0] + c2*g[0];
+      ld->v[j][1] = c1*ld->v[j][1] + c2*g[1];
+      ld->v[j][2] = c1*ld->v[j][2] + c2*g[2];
+    }
+}
+
+static PyObject *
+integrateLangevin(PyObject *dummy, PyObject *args)
+{
+  PyObject *universe;
+  PyUniverseSpecObject *universe_spec;
+  PyArrayObject *configuration;
+  PyArrayObject *velocities;
+  PyArrayObject *masses;
+  PyArrayObject *fixed;
+  PyArrayObject *friction;
+  PyArrayObject *gradients;
+  PyArrayObject *constraints, *constraint_distances_squared, *c_blocks;
+  PyListObject *spec_list;
+  PyFFEvaluatorObject *evaluator;
+  PyTrajectoryOutputSpec *output;
+  PyTrajectoryVariable *data_descriptors = NULL;
+  langevin_data noise;
+  work_block *blocks = NULL;
+  double ext_temp, delta_t, dth;
+  long seed;
+  int nthreads, nblocks = 0, first_step, last_step;
+  char *description;
+  vector3 *x, *v, *g;
+  double *m, *const_dist;
+  long *fix, *const_pairs, *const_blocks;
+  vector3 *scratch = NULL, *xold, *v1, *const_vect;
+  projection_data *pdata = NULL;
+  constraint_solver solver;
+  PY_UINT64_T seed_key;
+  double time;
+  energy_data p_energy;
+  double k_energy, temperature, volume, pressure;
+  int atoms, n_const, n_const_blocks, df;
+  int pressure_available;
+  int solver_method = SHAKE_SOLVER, lincs_order = 4;
+  int i, j, k;
+
+  /* Parse and check arguments */
+  if (!PyArg_ParseTuple(args, "OO!O!O!O!O!O!O!O!O!ddliiiO!s|ii", &universe,
+			&PyArray_Type, &configuration,
+			&PyArray_Type, &velocities,
+			&PyArray_Type, &masses,
+			&PyArray_Type, &fixed,
+			&PyArray_Type, &friction,
+			&PyFFEvaluator_Type, &evaluator,
+			&PyArray_Type, &constraints,
+			&PyArray_Type, &constraint_distances_squared,
+			&PyArray_Type, &c_blocks,
+			&ext_temp, &delta_t, &seed, &nthreads,
+			&first_step, &last_step,
+			&PyList_Type, &spec_list,
+			&description, &solver_method, &lincs_order))
+    return NULL;
+  if (evaluator->domain != NULL) {
+    PyErr_SetString(PyExc_ValueError,
+		    "domain decomposition cannot be used with "
+		    "Langevin dynamics");
+    return NULL;
+  }
+  universe_spec = (PyUniverseSpecObject *)
+                   PyObject_GetAttrString(universe, "_spec");
+  if (universe_spec == NULL)
+    return NULL;
+  /* The universe keeps the specification alive during the integration */
+  Py_DECREF(universe_spec);
+
+  /* Create gradient array */
+#if defined(NUMPY)
+  gradients = (PyArrayObject *)PyArray_Copy(configuration);
+#else
+  gradients = (PyArrayObject *)PyArray_FromDims(configuration->nd,
+						configuration->dimensions,
+						PyArray_DOUBLE);
+#endif
+  if (gradients == NULL)
+    return NULL;
+
+  /* Set some convenient variables */
+  atoms = configuration->dimensions[0];
+  n_const = constraints->dimensions[0];
+  n_const_blocks = c_blocks->dimensions[0]-1;
+  dth = 0.5*delta_t;
+  x = (vector3 *)configuration->data;
+  v = (vector3 *)velocities->data;
+  g = (vector3 *)gradients->data;
+  m = (double *)masses->data;
+  fix = (long *)fixed->data;
+  const_pairs = (long *)constraints->data;
+  const_dist = (double *)constraint_distances_squared->data;
+  const_blocks = (long *)c_blocks->data;
+  seed_key = mix64((PY_UINT64_T)seed);
+  if (init_constraint_solver(&solver, solver_method, lincs_order,
+			     nthreads, atoms, n_const,
+			     const_pairs, const_dist, n_const_blocks,
+			     const_blocks, m, universe_spec) == -1) {
+    Py_DECREF(gradients);
+    return NULL;
+  }
+
+  /* Calculate number of degrees of freedom */
+  df = 3*atoms;
+  for (j = 0; j < atoms; j++) {
+    if (fix[j])
+      df -= 3;
+  }
+  for (j = 0; j < n_const; j++) {
+    if (fix[const_pairs[2*j]] || fix[const_pairs[2*j+1]]) {
+      PyErr_SetString(PyExc_ValueError,
+		      "distance constraint on a fixed atom");
+      goto error2;
+    }
+    df--;
+  }
+
+  /* Divide the atoms into blocks for the noise generation */
+  nblocks = (nthreads < 1) ? 1 : nthreads;
+  if (nblocks > atoms)
+    nblocks = (atoms > 0) ? atoms : 1;
+  blocks = new_work_blocks(nblocks);
+  if (blocks == NULL)
+    goto error2;
+  noise.v = v;
+  noise.m = m;
+  noise.friction = (double *)friction->data;
+  noise.fix = fix;
+  noise.temperature = ext_temp;
+  noise.delta_t = delta_t;
+  for (k = 0; k < nblocks; k++) {
+    blocks[k].function = langevin_noise;
+    blocks[k].data = &noise;
+    blocks[k].first = (k*atoms)/nblocks;
+    blocks[k].last = ((k+1)*atoms)/nblocks;
+  }
+
+  /* Allocate arrays for constraint data */
+  if (n_const > 0) {
+    scratch = (vector3 *)malloc((2*atoms+n_const)*sizeof(vector3));
+    pdata = (projection_data *)malloc(n_const*sizeof(projection_data));
+    if (scratch == NULL || pdata == NULL) {
+      PyErr_NoMemory();
+      goto error2;
+    }
+    xold = scratch;
+    v1 = xold + atoms;
+    const_vect = v1 + atoms;
+  }
+  else {
+    xold = v1 = const_vect = NULL;
+  }
+
+  /* Enforce constraints and initialize constraint data */
+  Py_BEGIN_ALLOW_THREADS;
+  PyUniverseSpec_StateLock(universe_spec, -1);
+  universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
+  if (n_const > 0)
+    prepare_constraints(x, m, n_const, const_pairs, const_dist, const_vect,
+			pdata, &solver, universe_spec);
+  PyUniverseSpec_StateLock(universe_spec, -2);
+  Py_END_ALLOW_THREADS;
+
+  /* Initial force calculation */
+  p_energy.gradients = (PyObject *)gradients;
+  p_energy.gradient_fn = NULL;
+  p_energy.force_constants = NULL;
+  p_energy.fc_fn = NULL;
+  evaluator->tstate_save = PyEval_SaveThread();
+  PyUniverseSpec_StateLock(universe_spec, 1);
+  (*evaluator->eval_func)(evaluator, &p_energy, configuration, 0);
+  PyUniverseSpec_StateLock(universe_spec, 2);
+  PyEval_RestoreThread(evaluator->tstate_save);
+  if (p_energy.error)
+    goto error2;
+
+  /* Check if pressure can be calculated. The constraint forces
+     are not included in the virial, so there is no pressure
+     for systems with constraints. */
+  Py_BEGIN_ALLOW_THREADS;
+  PyUniverseSpec_StateLock(universe_spec, 1);
+  volume = universe_spec->volume_function(1., universe_spec->geometry_data);
+  PyUniverseSpec_StateLock(universe_spec, 2);
+  Py_END_ALLOW_THREADS;
+  pressure_available = volume > 0. && n_const == 0
+                       && p_energy.virial_available;
+
+  /* Initialize output */
+  data_descriptors =
+     get_data_descriptors(9 + pressure_available
+			  + (universe_spec->geometry_data_length > 0),
+			  universe_spec,
+			  configuration, velocities,
+			  gradients, masses, &df,
+			  &time, &p_energy.energy, NULL, &k_energy,
+			  NULL, NULL, &temperature, NULL,
+			  pressure_available ? &pressure:NULL,
+			  NULL, NULL,
+			  (universe_spec->geometry_data_length > 0) ?
+			              universe_spec->geometry_data : NULL,
+			  NULL);
+  if (data_descriptors == NULL)
+    goto error2;
+  output = PyTrajectory_OutputSpecification(universe, spec_list,
+					    description,
+					    data_descriptors);
+  if (output == NULL)
+    goto error2;
+
+  evaluator->tstate_save = PyEval_SaveThread();
+
+  /* Get write access for the integration, switching to
+     read access only during energy evaluation */
+  PyUniverseSpec_StateLock(universe_spec, -1);
+
+  /** Main integration loop **/
+  time  = first_step*delta_t;
+  for (i = first_step; i < last_step; i++) {
+
+    /* Calculation of thermodynamic properties */
+    k_energy = 0.;
+    for (j = 0; j < atoms; j++)
+      if (!fix[j])
+	k_energy += m[j]*dot(v[j], v[j]);
+    k_energy *= 0.5;
+    temperature = 2.*k_energy*temperature_factor/df;
+    pressure = (2.*k_energy+p_energy.virial)/(3.*volume);
+
+    /* Trajectory and log output */
+    if (PyTrajectory_Output(output, i, data_descriptors,
+			    &evaluator->tstate_save) == -1) {
+      PyUniverseSpec_StateLock(universe_spec, -2);
+      PyEval_RestoreThread(evaluator->tstate_save);
+      goto error;
+    }
+
+    /* B: half kick */
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	double factor = dth/m[j];
+	v[j][0] -= factor*g[j][0];
+	v[j][1] -= factor*g[j][1];
+	v[j][2] -= factor*g[j][2];
+      }
+    if (n_const > 0)
+      rattle_velocities(v, v1, fix, m, atoms, n_const, const_pairs,
+			const_dist, const_vect, pdata);
+
+    /* A: half drift */
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	x[j][0] += dth*v[j][0];
+	x[j][1] += dth*v[j][1];
+	x[j][2] += dth*v[j][2];
+      }
+    if (n_const > 0)
+      rattle_positions(x, v, xold, fix, atoms, dth,
+		       n_const, const_pairs, const_vect,
+		       &solver, universe_spec);
+
+    /* O: friction and random forces */
+    noise.base = seed_key + mix64((PY_UINT64_T)i);
+    run_work_blocks(blocks, nblocks);
+    if (n_const > 0)
+      rattle_velocities(v, v1, fix, m, atoms, n_const, const_pairs,
+			const_dist, const_vect, pdata);
+
+    /* A: half drift */
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	x[j][0] += dth*v[j][0];
+	x[j][1] += dth*v[j][1];
+	x[j][2] += dth*v[j][2];
+      }
+    if (n_const > 0)
+      rattle_positions(x, v, xold, fix, atoms, dth,
+		       n_const, const_pairs, const_vect,
+		       &solver, universe_spec);
+
+    /* Coordinate correction (for periodic universes etc.) */
+    universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
+
+    /* Mid-step energy evaluation */
+    PyUniverseSpec_StateLock(universe_spec, -2);
+    PyUniverseSpec_StateLock(universe_spec, 1);
+    (*evaluator->eval_func)(evaluator, &p_energy, configuration, 1);
+    PyUniverseSpec_StateLock(universe_spec, 2);
+    if (p_energy.error) {
+      PyEval_RestoreThread(evaluator->tstate_save);
+      goto error;
+    }
+    PyUniverseSpec_StateLock(universe_spec, -1);
+
+    /* B: half kick */
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	double factor = dth/m[j];
+	v[j][0] -= factor*g[j][0];
+	v[j][1] -= factor*g[j][1];
+	v[j][2] -= factor*g[j][2];
+      }
+    if (n_const > 0)
+      rattle_velocities(v, v1, fix, m, atoms, n_const, const_pairs,
+			const_dist, const_vect, pdata);
+
+    /* The End - next time step! */
+    time += delta_t;
+  }
+  /** End of main integration loop **/
+
+  /* Final thermodynamic property evaluation */
+  k_energy = 0.;
+  for (j = 0; j < atoms; j++)
+    if (!fix[j])
+      k_energy += m[j]*dot(v[j], v[j]);
+  k_energy *= 0.5;
+  temperature = 2.*k_energy*temperature_factor/df;
+  pressure = (2.*k_energy+p_energy.virial)/(3.*volume);
+
+  /* Final trajectory and log output */
+  if (PyTrajectory_Output(output, i, data_descriptors,
+			  &evaluator->tstate_save) == -1) {
+    PyUniverseSpec_StateLock(universe_spec, -2);
+    PyEval_RestoreThread(evaluator->tstate_save);
+    goto error;
+  }
+
+  /* Cleanup */
+  PyUniverseSpec_StateLock(universe_spec, -2);
+  PyEval_RestoreThread(evaluator->tstate_save);
+  PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
+  free_work_blocks(blocks, nblocks);
+  free(scratch);
+  free(pdata);
+  free_constraint_solver(&solver);
+  free(data_descriptors);
+  Py_DECREF(gradients);
+  if (PyErr_Occurred())
+    return NULL;
+  Py_INCREF(Py_None);
+  return Py_None;
+
+  /* Error return */
+error:
+  PyTrajectory_OutputFinish(output, i, 1, 1, data_descriptors);
+error2:
+  free_work_blocks(blocks, nblocks);
+  free(scratch);
+  free(pdata);
+  free_constraint_solver(&solver);
+  free(data_descriptors);
+  Py_DECREF(gradients);
+  return NULL;
+}
+
+/* FIRE minimizer (Bitzek et al., Phys. Rev. Lett. 97, 170201 (2006)):
+   velocity-Verlet dynamics in which the velocities are mixed with the
+   direction of the forces, and stopped whenever the power F.v becomes
+   negative. The time step and the mixing parameter are adapted
+   during the minimization. All norms are mass-weighted, such that
+   constrained velocities and accelerations remain constrained. */
+
+#define FIRE_N_MIN 5
+#define FIRE_F_INC 1.1
+#define FIRE_F_DEC 0.5
+#define FIRE_ALPHA_START 0.1
+#define FIRE_F_ALPHA 0.99
+
+/* Accelerations of the moving atoms, projected onto the constraint
+   surface. Returns the squared norm of the corresponding forces. */
+
+static double
+fire_accelerations(vector3 *g, vector3 *a, vector3 *v1, long *fix,
+		   double *m, int atoms,
+		   int n_const, long *const_pairs, double *const_dist,
+		   vector3 *const_vect, projection_data *pdata)
+{
+  double norm_sq = 0.;
+  int j;
+  for (j = 0; j < atoms; j++)
+    if (fix[j])
+      a[j][0] = a[j][1] = a[j][2] = 0.;
+    else {
+      a[j][0] = -g[j][0]/m[j];
+      a[j][1] = -g[j][1]/m[j];
+      a[j][2] = -g[j][2]/m[j];
+    }
+  if (n_const > 0)
+    rattle_velocities(a, v1, fix, m, atoms, n_const, const_pairs,
+		      const_dist, const_vect, pdata);
+  for (j = 0; j < atoms; j++)
+    if (!fix[j])
+      norm_sq += m[j]*m[j]*dot(a[j], a[j]);
+  return norm_sq;
+}
+
+static PyObject *
+minimizeFIRE(PyObject *dummy, PyObject *args)
+{
+  PyObject *universe;
+  PyUniverseSpecObject *universe_spec;
+  PyArrayObject *configuration;
+  PyArrayObject *masses;
+  PyArrayObject *fixed;
+  PyArrayObject *gradients;
+  PyArrayObject *constraints, *constraint_distances_squared, *c_blocks;
+  PyListObject *spec_list;
+  PyFFEvaluatorObject *evaluator;
+  PyTrajectoryOutputSpec *output;
+  PyTrajectoryVariable *data_descriptors = NULL;
+  double delta_t, max_delta_t, step_size, convergence, dth;
+  int steps;
+  char *description;
+  vector3 *x, *v, *a, *g;
+  double *m, *const_dist;
+  long *fix, *const_pairs, *const_blocks;
+  vector3 *scratch = NULL, *xold, *v1, *const_vect;
+  projection_data *pdata = NULL;
+  constraint_solver solver;
+  energy_data p_energy;
+  double alpha, power, v_norm, a_norm, norm_sq, norm, v_max;
+  int atoms, moving_atoms, n_const, n_const_blocks, n_positive;
+  int solver_method = SHAKE_SOLVER, lincs_order = 4;
+  int i, j;
+
+  /* Parse and check arguments */
+  if (!PyArg_ParseTuple(args, "OO!O!O!O!O!O!O!iddddO!s|ii", &universe,
+			&PyArray_Type, &configuration,
+			&PyArray_Type, &masses,
+			&PyArray_Type, &fixed,
+			&PyFFEvaluator_Type, &evaluator,
+			&PyArray_Type, &constraints,
+			&PyArray_Type, &constraint_distances_squared,
+			&PyArray_Type, &c_blocks,
+			&steps, &delta_t, &max_delta_t, &step_size,
+			&convergence,
+			&PyList_Type, &spec_list,
+			&description, &solver_method, &lincs_order))
+    return NULL;
+  if (evaluator->domain != NULL) {
+    PyErr_SetString(PyExc_ValueError,
+		    "domain decomposition cannot be used with "
+		    "FIRE minimization");
+    return NULL;
+  }
+  universe_spec = (PyUniverseSpecObject *)
+                   PyObject_GetAttrString(universe, "_spec");
+  if (universe_spec == NULL)
+    return NULL;
+
+  /* Create gradient array */
+#if defined(NUMPY)
+  gradients = (PyArrayObject *)PyArray_Copy(configuration);
+#else
+  gradients = (PyArrayObject *)PyArray_FromDims(configuration->nd,
+						configuration->dimensions,
+						PyArray_DOUBLE);
+#endif
+  if (gradients == NULL)
+    return NULL;
+
+  /* Set some convenient variables */
+  atoms = configuration->dimensions[0];
+  n_const = constraints->dimensions[0];
+  n_const_blocks = c_blocks->dimensions[0]-1;
+  x = (vector3 *)configuration->data;
+  g = (vector3 *)gradients->data;
+  m = (double *)masses->data;
+  fix = (long *)fixed->data;
+  const_pairs = (long *)constraints->data;
+  const_dist = (double *)constraint_distances_squared->data;
+  const_blocks = (long *)c_blocks->data;
+  if (init_constraint_solver(&solver, solver_method, lincs_order,
+			     evaluator->nthreads, atoms, n_const,
+			     const_pairs, const_dist, n_const_blocks,
+			     const_blocks, m, universe_spec) == -1) {
+    Py_DECREF(gradients);
+    return NULL;
+  }
+
+  moving_atoms = atoms;
+  for (j = 0; j < atoms; j++)
+    if (fix[j])
+      moving_atoms--;
+  for (j = 0; j < n_const; j++)
+    if (fix[const_pairs[2*j]] || fix[const_pairs[2*j+1]]) {
+      PyErr_SetString(PyExc_ValueError,
+		      "distance constraint on a fixed atom");
+      goto error2;
+    }
+
+  /* Allocate arrays for velocities, accelerations,
+     and constraint data */
+  scratch = (vector3 *)malloc((4*atoms+n_const)*sizeof(vector3));
+  if (n_const > 0)
+    pdata = (projection_data *)malloc(n_const*sizeof(projection_data));
+  if (scratch == NULL || (n_const > 0 && pdata == NULL)) {
+    PyErr_NoMemory();
+    goto error2;
+  }
+  v = scratch;
+  a = v + atoms;
+  xold = a + atoms;
+  v1 = xold + atoms;
+  const_vect = v1 + atoms;
+  for (j = 0; j < atoms; j++)
+    v[j][0] = v[j][1] = v[j][2] = 0.;
+
+  /* Enforce constraints and initialize constraint data */
+  Py_BEGIN_ALLOW_THREADS;
+  PyUniverseSpec_StateLock(universe_spec, -1);
+  universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
+  if (n_const > 0)
+    prepare_constraints(x, m, n_const, const_pairs, const_dist, const_vect,
+			pdata, &solver, universe_spec);
+  PyUniverseSpec_StateLock(universe_spec, -2);
+  Py_END_ALLOW_THREADS;
+
+  /* Initial force calculation */
+  p_energy.gradients = (PyObject *)gradients;
+  p_energy.gradient_fn = NULL;
+  p_energy.force_constants = NULL;
+  p_energy.fc_fn = NULL;
+  evaluator->tstate_save = PyEval_SaveThread();
+  PyUniverseSpec_StateLock(universe_spec, 1);
+  (*evaluator->eval_func)(evaluator, &p_energy, configuration, 0);
+  PyUniverseSpec_StateLock(universe_spec, 2);
+  PyEval_RestoreThread(evaluator->tstate_save);
+  if (p_energy.error)
+    goto error2;
+
+  /* Initialize output */
+  data_descriptors =
+     get_data_descriptors(4 + (universe_spec->geometry_data_length > 0),
+			  universe_spec,
+			  configuration, NULL, gradients, NULL, NULL,
+			  NULL, &p_energy.energy, &norm,
+			  NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+			  (universe_spec->geometry_data_length > 0) ?
+			              universe_spec->geometry_data : NULL,
+			  NULL);
+  if (data_descriptors == NULL)
+    goto error2;
+  output = PyTrajectory_OutputSpecification(universe, spec_list,
+					    description,
+					    data_descriptors);
+  if (output == NULL)
+    goto error2;
+
+  evaluator->tstate_save = PyEval_SaveThread();
+
+  /* Get write access for the minimization, switching to
+     read access only during energy evaluation */
+  PyUniverseSpec_StateLock(universe_spec, -1);
+
+  /** Main minimization loop **/
+  norm_sq = fire_accelerations(g, a, v1, fix, m, atoms, n_const,
+			       const_pairs, const_dist, const_vect, pdata);
+  alpha = FIRE_ALPHA_START;
+  n_positive = 0;
+  for (i = 0; i < steps; i++) {
+
+    /* Convergence test */
+    norm = sqrt(norm_sq/moving_atoms);
+    if (norm < convergence)
+      break;
+
+    /* Trajectory and log output */
+    if (PyTrajectory_Output(output, i, data_descriptors,
+			    &evaluator->tstate_save) == -1) {
+      PyUniverseSpec_StateLock(universe_spec, -2);
+      PyEval_RestoreThread(evaluator->tstate_save);
+      goto error;
+    }
+
+    /* Velocity mixing, or a stop if the system moves uphill */
+    power = v_norm = a_norm = 0.;
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	power += m[j]*dot(a[j], v[j]);
+	v_norm += m[j]*dot(v[j], v[j]);
+	a_norm += m[j]*dot(a[j], a[j]);
+      }
+    if (power > 0.) {
+      double mix = alpha*sqrt(v_norm/a_norm);
+      for (j = 0; j < atoms; j++)
+	if (!fix[j]) {
+	  v[j][0] = (1.-alpha)*v[j][0] + mix*a[j][0];
+	  v[j][1] = (1.-alpha)*v[j][1] + mix*a[j][1];
+	  v[j][2] = (1.-alpha)*v[j][2] + mix*a[j][2];
+	}
+      if (++n_positive > FIRE_N_MIN) {
+	delta_t *= FIRE_F_INC;
+	if (delta_t > max_delta_t)
+	  delta_t = max_delta_t;
+	alpha *= FIRE_F_ALPHA;
+      }
+    }
+    else if (v_norm > 0.) {
+      for (j = 0; j < atoms; j++)
+	v[j][0] = v[j][1] = v[j][2] = 0.;
+      delta_t *= FIRE_F_DEC;
+      alpha = FIRE_ALPHA_START;
+      n_positive = 0;
+    }
+    dth = 0.5*delta_t;
+
+    /* Half kick */
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	v[j][0] += dth*a[j][0];
+	v[j][1] += dth*a[j][1];
+	v[j][2] += dth*a[j][2];
+      }
+
+    /* Limit the displacement of each atom to step_size */
+    v_max = 0.;
+    for (j = 0; j < atoms; j++)
+      if (!fix[j] && dot(v[j], v[j]) > v_max)
+	v_max = dot(v[j], v[j]);
+    v_max = sqrt(v_max);
+    if (v_max*delta_t > step_size) {
+      double scale = step_size/(v_max*delta_t);
+      for (j = 0; j < atoms; j++) {
+	v[j][0] *= scale;
+	v[j][1] *= scale;
+	v[j][2] *= scale;
+      }
+    }
+
+    /* Drift */
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	x[j][0] += delta_t*v[j][0];
+	x[j][1] += delta_t*v[j][1];
+	x[j][2] += delta_t*v[j][2];
+      }
+    if (n_const > 0)
+      rattle_positions(x, v, xold, fix, atoms, delta_t,
+		       n_const, const_pairs, const_vect,
+		       &solver, universe_spec);
+
+    /* Coordinate correction (for periodic universes etc.) */
+    universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
+
+    /* Energy evaluation */
+    PyUniverseSpec_StateLock(universe_spec, -2);
+    PyUniverseSpec_StateLock(universe_spec, 1);
+    (*evaluator->eval_func)(evaluator, &p_energy, configuration, 0);
+    PyUniverseSpec_StateLock(universe_spec, 2);
+    if (p_energy.error) {
+      PyEval_RestoreThread(evaluator->tstate_save);
+      goto error;
+    }
+    PyUniverseSpec_StateLock(universe_spec, -1);
+    norm_sq = fire_accelerations(g, a, v1, fix, m, atoms, n_const,
+				 const_pairs, const_dist, const_vect, pdata);
+
+    /* Half kick */
+    for (j = 0; j < atoms; j++)
+      if (!fix[j]) {
+	v[j][0] += dth*a[j][0];
+	v[j][1] += dth*a[j][1];
+	v[j][2] += dth*a[j][2];
+      }
+    if (n_const > 0)
+      rattle_velocities(v, v1, fix, m, atoms, n_const, const_pairs,
+			const_dist, const_vect, pdata);
+  }
+  /** End of main minimization loop **/
+
+  /* Final trajectory and log output */
+  norm = sqrt(norm_sq/moving_atoms);
+  if (PyTrajectory_Output(output, i, data_descriptors,
+			  &evaluator->tstate_save) == -1) {
+    PyUniverseSpec_StateLock(universe_spec, -2);
+    PyEval_RestoreThread(evaluator->tstate_save);
+    goto error;
+  }
+
+  /* Cleanup */
+  PyUniverseSpec_StateLock(universe_spec, -2);
+  PyEval_RestoreThread(evaluator->tstate_save);
+  PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
+  free(scratch);
+  free(pdata);
+  free_constraint_solver(&solver);
+  free(data_descriptors);
+  Py_DECREF(gradients);
+  if (PyErr_Occurred())
+    return NULL;
+  Py_INCREF(Py_None);
+  return Py_None;
+
+  /* Error return */
+error:
+  PyTrajectory_OutputFinish(output, i, 1, 1, data_descriptors);
+error2:
+  free(scratch);
+  free(pdata);
+  free_constraint_solver(&solver);
+  free(data_descriptors);
+  Py_DECREF(gradients);
+  return NULL;
+}
+
+/* Trajectory functions */
+
+static int
+getMassesAndVelocities(PyTrajectoryVariable *dynamic_data,
+		       PyArrayObject **masses, PyArrayObject **velocities)
+{
+  PyTrajectoryVariable *var = dynamic_data;
+  int found = 0;
+  while (var->name != NULL) {
+    if (strcmp(var->name, "masses") == 0) {
+      *masses = var->value.array;
+      found++;
+    }
+    if (strcmp(var->name, "velocities") == 0) {
+      *velocities = var->value.array;
+      found++;
+    }
+    var++;
+  }
+  if (found != 2) {
+    PyErr_SetString(PyExc_ValueError,
+		    "trajectory function needs masses and velocities");
+    return 0;
+  }
+  return 1;
+}
+
+static int
+getDegreesOfFreedom(PyTrajectoryVariable *dynamic_data)
+{
+  int natoms = -1, ndf = -1;
+  PyTrajectoryVariable *var = dynamic_data;
+  while (var->name != NULL) {
+    if (strcmp(var->name, "degrees_of_freedom") == 0)
+      ndf = *var->value.ip;
+    if (strcmp(var->name, "configuration") == 0)
+      natoms = var->value.array->dimensions[0];
+    var++;
+  }
+  if (ndf >= 0)
+    return ndf;
+  else
+    return 3*natoms;
+}
+
+static double *
+getScalar(PyTrajectoryVariable *dynamic_data, char *name)
+{
+  PyTrajectoryVariable *var = dynamic_data;
+  double *variable = NULL;
+  while (var->name != NULL) {
+    if (strcmp(var->name, name) == 0) {
+      variable = var->value.dp;
+    }
     var++;
   }
   return variable;
@@ -1395,7 +3581,7 @@ removeRotation(PyTrajectoryVariable *dynamic_data, PyObject *parameters,
 }
 
 /*
- * Enforce distance constraints by calling SHAKE
+ * Enforce distance constraints by calling SHAKE or LINCS
  */
 static PyObject *
 enforceConstraints(PyObject *dummy, PyObject *args)
@@ -1411,15 +3597,18 @@ enforceConstraints(PyObject *dummy, PyObject *args)
   long *const_pairs, *const_blocks;
   double *const_dist;
   vector3 *const_vect = NULL;
+  constraint_solver solver;
+  int solver_method = SHAKE_SOLVER, lincs_order = 4, nthreads = 1;
   int i;
 
-  if (!PyArg_ParseTuple(args, "O!O!O!O!O!O!",
+  if (!PyArg_ParseTuple(args, "O!O!O!O!O!O!|iii",
 			&PyUniverseSpec_Type, &universe_spec,
 			&PyArray_Type, &configuration,
 			&PyArray_Type, &masses,
 			&PyArray_Type, &constraints,
 			&PyArray_Type, &constraint_distances_squared,
-			&PyArray_Type, &c_blocks))
+			&PyArray_Type, &c_blocks,
+			&solver_method, &lincs_order, &nthreads))
     return NULL;
 
   n_const = constraints->dimensions[0];
@@ -1430,8 +3619,14 @@ enforceConstraints(PyObject *dummy, PyObject *args)
   const_dist = (double *)constraint_distances_squared->data;
   const_blocks = (long *)c_blocks->data;
 
+  if (init_constraint_solver(&solver, solver_method, lincs_order, nthreads,
+			     configuration->dimensions[0], n_const,
+			     const_pairs, const_dist, n_const_blocks,
+			     const_blocks, m, universe_spec) == -1)
+    return NULL;
   const_vect = (vector3 *)malloc(n_const*sizeof(vector3));
   if (const_vect == NULL) {
+    free_constraint_solver(&solver);
     PyErr_NoMemory();
     return NULL;
   }
@@ -1441,16 +3636,60 @@ enforceConstraints(PyObject *dummy, PyObject *args)
 				     x[const_pairs[2*i]],
 				     x[const_pairs[2*i+1]],
 				     universe_spec->geometry_data);
-  for (i = 0; i < n_const_blocks; i++)
-    shake(const_pairs, const_blocks[i], const_blocks[i+1],
-	  x, m, const_vect, const_dist, universe_spec->distance_function,
-	  universe_spec->geometry_data);
+  Py_BEGIN_ALLOW_THREADS;
+  constrain_positions(&solver, x, const_vect);
+  Py_END_ALLOW_THREADS;
 
   free(const_vect);
+  free_constraint_solver(&solver);
   Py_INCREF(Py_None);
   return Py_None;
 }
 
+/*
+ * Find the constraint blocks that are handled by SETTLE. The result
+ * contains the apex atom of each such block and -1 for all others.
+ */
+static PyObject *
+rigidTriangles(PyObject *dummy, PyObject *args)
+{
+  PyArrayObject *masses;
+  PyArrayObject *constraints, *constraint_distances_squared, *c_blocks;
+  PyObject *result;
+  long *const_blocks;
+  int n_const_blocks;
+  int settle[6];
+  int j;
+
+  if (!PyArg_ParseTuple(args, "O!O!O!O!",
+			&PyArray_Type, &masses,
+			&PyArray_Type, &constraints,
+			&PyArray_Type, &constraint_distances_squared,
+			&PyArray_Type, &c_blocks))
+    return NULL;
+
+  n_const_blocks = c_blocks->dimensions[0]-1;
+  const_blocks = (long *)c_blocks->data;
+  result = PyList_New(n_const_blocks);
+  if (result == NULL)
+    return NULL;
+  for (j = 0; j < n_const_blocks; j++) {
+    PyObject *apex;
+    if (!find_settle_triangle((long *)constraints->data,
+			      (double *)constraint_distances_squared->data,
+			      (double *)masses->data,
+			      const_blocks[j], const_blocks[j+1], settle))
+      settle[0] = -1;
+    apex = PyInt_FromLong(settle[0]);
+    if (apex == NULL) {
+      Py_DECREF(result);
+      return NULL;
+    }
+    PyList_SET_ITEM(result, j, apex);
+  }
+  return result;
+}
+
 /*
  * Project velocities onto constraint surface
  */
@@ -1534,7 +3773,11 @@ projectVelocities(PyObject *dummy, PyObject *args)
 
 static PyMethodDef dynamics_methods[] = {
   {"integrateVV", integrateVV, 1},
+  {"integrateRESPA", integrateRESPA, 1},
+  {"integrateLangevin", integrateLangevin, 1},
+  {"minimizeFIRE", minimizeFIRE, 1},
   {"enforceConstraints", enforceConstraints, 1},
+  {"rigidTriangles", rigidTriangles, 1},
   {"projectVelocities", projectVelocities, 1},
   {NULL, NULL}		/* sentinel */
 };
@@ -1570,7 +3813,14 @@ initMMTK_dynamics(void)
     temperature_factor = 1./kB;
   }
 
-  /* Add addresses of C functions to module dictionary */
+  /* Add addresses of C functions to module dictionary. They do not
+     use the Python API after initialization and are therefore
+     registered for being called without the global interpreter lock. */
+  PyTrajectory_RegisterFunction(scaleVelocities);
+  PyTrajectory_RegisterFunction(heat);
+  PyTrajectory_RegisterFunction(resetBarostat);
+  PyTrajectory_RegisterFunction(removeTranslation);
+  PyTrajectory_RegisterFunction(removeRotation);
   PyDict_SetItemString(dict, "scaleVelocities",
 		       PyCObject_FromVoidPtr((void *)scaleVelocities, NULL));
   PyDict_SetItemString(dict, "heat",
@@ -124,6 +124,973 @@ barrier(barrierinfo *binfo, int thread_id, int nthreads)
 #endif
 #endif
 
+/*
+ * Process pool support
+ *
+ * An evaluator can distribute the parallelized energy terms over
+ * several processes on the same machine, as an alternative to MPI.
+ * The worker processes are created by fork() when the evaluator is
+ * created and therefore inherit copies of all energy term objects.
+ * The coordinates, the universe geometry, and one set of energy terms
+ * and one gradient array per worker are kept in a shared memory
+ * region. Each process evaluates its slice of the parallelized
+ * terms exactly as an MPI process would; the master process then
+ * adds up the contributions of the workers. Pipes are used for
+ * starting the workers and for signalling completion. They also
+ * permit to detect workers that have died.
+ * fork() copies only the calling thread, so a pool started while
+ * other threads are running gets a copy of whatever locks those
+ * threads held at that moment. The workers are therefore restricted
+ * to the C code of the energy terms: they never execute Python code,
+ * never release or acquire the interpreter lock, and use no locks
+ * of the master process. Evaluators using processes cannot use
+ * threads, for the same reason.
+ * Gradients are added up either directly in the master's gradient
+ * array or, for a gradient function, by passing each worker's
+ * gradient on each atom to that function.
+ */
+
+#ifndef MS_WINDOWS
+#define PROCESS_POOL
+
+#include <sys/types.h>
+#include <sys/mman.h>
+#include <sys/wait.h>
+#include <signal.h>
+#include <errno.h>
+#ifdef __linux__
+#include <sys/prctl.h>
+#endif
+#ifndef MAP_ANONYMOUS
+#define MAP_ANONYMOUS MAP_ANON
+#endif
+
+typedef struct {
+  int exit;
+  int small_change;
+  int with_gradients;
+} pool_command;
+
+typedef struct {
+  int virial_available;
+  int error;
+} pool_status;
+
+typedef struct {
+  int nworkers, natoms, nterms, ngeometry;
+  pid_t *pids;
+  int *start_fd, *done_fd;
+  void *shared;
+  size_t shared_size;
+  pool_command *command;
+  pool_status *status;
+  double *energy_terms;
+  double *coordinates;
+  double *geometry;
+  double *gradients;
+  PyArrayObject *coordinate_array;
+  PyArrayObject **gradient_arrays;
+  PyUniverseSpecObject *universe_spec;
+} process_pool;
+
+/* Terms that are evaluated by the worker processes. They must not
+   call the Python interpreter. */
+#define POOL_TERM(term) ((term)->parallelized && (term)->thread_safe)
+
+static void
+pool_worker(PyFFEvaluatorObject *self, process_pool *pool, int worker)
+{
+  energy_spec input;
+  energy_data energy;
+  char c;
+  int i;
+
+  input.coordinates = pool->coordinate_array;
+  input.natoms = pool->natoms;
+  input.thread_id = 0;
+  input.nthreads = 1;
+  input.proc_id = input.slice_id = worker+1;
+  input.nprocs = input.nslices = pool->nworkers+1;
+  input.atom_owner = NULL;
+  energy.gradient_fn = NULL;
+  energy.force_constants = NULL;
+  energy.fc_fn = NULL;
+  energy.energy_terms = pool->energy_terms + worker*(pool->nterms+1);
+  while (read(pool->start_fd[worker], &c, 1) == 1) {
+    double *gradients = pool->gradients + 3*worker*pool->natoms;
+    if (pool->command->exit)
+      break;
+    input.small_change = pool->command->small_change;
+    if (pool->universe_spec != NULL)
+      for (i = 0; i < pool->ngeometry; i++)
+	pool->universe_spec->geometry_data[i] = pool->geometry[i];
+    for (i = 0; i < pool->nterms+1; i++)
+      energy.energy_terms[i] = 0.;
+    energy.virial_available = 1;
+    energy.error = 0;
+    if (pool->command->with_gradients) {
+      energy.gradients = (PyObject *)pool->gradient_arrays[worker];
+      for (i = 0; i < 3*pool->natoms; i++)
+	gradients[i] = 0.;
+    }
+    else
+      energy.gradients = NULL;
+    for (i = 0; i < self->ntermobjects; i++) {
+      PyFFEnergyTermObject *term =
+	((PyFFEnergyTermObject **)self->terms->data)[i];
+      if (POOL_TERM(term))
+	(*term->eval_func)(term, self, &input, &energy);
+    }
+    pool->status[worker].virial_available = energy.virial_available;
+    pool->status[worker].error = energy.error;
+    if (write(pool->done_fd[worker], &c, 1) != 1)
+      break;
+  }
+  _exit(0);
+}
+
+static void
+stop_process_pool(process_pool *pool)
+{
+  int i;
+  char c = 0;
+  if (pool->command != NULL)
+    pool->command->exit = 1;
+  for (i = 0; i < pool->nworkers; i++) {
+    if (pool->pids[i] > 0) {
+      if (pool->start_fd[i] >= 0)
+	write(pool->start_fd[i], &c, 1);
+      waitpid(pool->pids[i], NULL, 0);
+    }
+    if (pool->start_fd[i] >= 0)
+      close(pool->start_fd[i]);
+    if (pool->done_fd[i] >= 0)
+      close(pool->done_fd[i]);
+  }
+  Py_XDECREF(pool->coordinate_array);
+  if (pool->gradient_arrays != NULL) {
+    for (i = 0; i < pool->nworkers; i++)
+      Py_XDECREF(pool->gradient_arrays[i]);
+    free(pool->gradient_arrays);
+  }
+  if (pool->shared != NULL)
+    munmap(pool->shared, pool->shared_size);
+  free(pool->pids);
+  free(pool->start_fd);
+  free(pool->done_fd);
+  free(pool);
+}
+
+static process_pool *
+start_process_pool(PyFFEvaluatorObject *self, int nprocesses, int natoms)
+{
+  process_pool *pool;
+  char *p;
+  npy_intp dims[2];
+  int i, j;
+
+  pool = (process_pool *)malloc(sizeof(process_pool));
+  if (pool == NULL) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+  pool->nworkers = nprocesses-1;
+  pool->natoms = natoms;
+  pool->nterms = self->nterms;
+  pool->shared = NULL;
+  pool->command = NULL;
+  pool->coordinate_array = NULL;
+  pool->universe_spec = NULL;
+  pool->ngeometry = 0;
+  if (self->ntermobjects > 0) {
+    pool->universe_spec =
+      ((PyFFEnergyTermObject **)self->terms->data)[0]->universe_spec;
+    if (pool->universe_spec != NULL)
+      pool->ngeometry = pool->universe_spec->geometry_data_length;
+  }
+  pool->pids = (pid_t *)malloc(pool->nworkers*sizeof(pid_t));
+  pool->start_fd = (int *)malloc(pool->nworkers*sizeof(int));
+  pool->done_fd = (int *)malloc(pool->nworkers*sizeof(int));
+  pool->gradient_arrays = (PyArrayObject **)
+                  malloc(pool->nworkers*sizeof(PyArrayObject *));
+  if (pool->pids == NULL || pool->start_fd == NULL || pool->done_fd == NULL
+      || pool->gradient_arrays == NULL) {
+    PyErr_NoMemory();
+    pool->nworkers = 0;
+    stop_process_pool(pool);
+    return NULL;
+  }
+  for (i = 0; i < pool->nworkers; i++) {
+    pool->pids[i] = 0;
+    pool->start_fd[i] = pool->done_fd[i] = -1;
+    pool->gradient_arrays[i] = NULL;
+  }
+
+  pool->shared_size = sizeof(pool_command)
+                      + pool->nworkers*sizeof(pool_status)
+                      + (pool->nworkers*(pool->nterms+1)
+			 + 3*natoms + pool->ngeometry
+			 + 3*pool->nworkers*natoms)*sizeof(double);
+  pool->shared = mmap(NULL, pool->shared_size, PROT_READ | PROT_WRITE,
+		      MAP_SHARED | MAP_ANONYMOUS, -1, 0);
+  if (pool->shared == MAP_FAILED) {
+    pool->shared = NULL;
+    PyErr_SetFromErrno(PyExc_OSError);
+    stop_process_pool(pool);
+    return NULL;
+  }
+  /* The doubles come first, to guarantee their alignment */
+  p = (char *)pool->shared;
+  pool->energy_terms = (double *)p;
+  p += pool->nworkers*(pool->nterms+1)*sizeof(double);
+  pool->coordinates = (double *)p;
+  p += 3*natoms*sizeof(double);
+  pool->geometry = (double *)p;
+  p += pool->ngeometry*sizeof(double);
+  pool->gradients = (double *)p;
+  p += 3*pool->nworkers*natoms*sizeof(double);
+  pool->status = (pool_status *)p;
+  p += pool->nworkers*sizeof(pool_status);
+  pool->command = (pool_command *)p;
+  pool->command->exit = 0;
+
+  dims[0] = natoms;
+  dims[1] = 3;
+  pool->coordinate_array = (PyArrayObject *)
+    PyArray_SimpleNewFromData(2, dims, PyArray_DOUBLE, pool->coordinates);
+  if (pool->coordinate_array == NULL) {
+    stop_process_pool(pool);
+    return NULL;
+  }
+  for (i = 0; i < pool->nworkers; i++) {
+    pool->gradient_arrays[i] = (PyArrayObject *)
+      PyArray_SimpleNewFromData(2, dims, PyArray_DOUBLE,
+				pool->gradients+3*i*natoms);
+    if (pool->gradient_arrays[i] == NULL) {
+      stop_process_pool(pool);
+      return NULL;
+    }
+  }
+
+  fflush(stdout);
+  fflush(stderr);
+  for (i = 0; i < pool->nworkers; i++) {
+    int start_pipe[2], done_pipe[2];
+    if (pipe(start_pipe) != 0)
+      goto error;
+    if (pipe(done_pipe) != 0) {
+      close(start_pipe[0]);
+      close(start_pipe[1]);
+      goto error;
+    }
+    pool->pids[i] = fork();
+    if (pool->pids[i] == 0) {
+      /* Worker process: keep only its own pipe ends */
+      for (j = 0; j < i; j++) {
+	close(pool->start_fd[j]);
+	close(pool->done_fd[j]);
+      }
+      close(start_pipe[1]);
+      close(done_pipe[0]);
+      pool->start_fd[i] = start_pipe[0];
+      pool->done_fd[i] = done_pipe[1];
+      signal(SIGINT, SIG_IGN);
+#ifdef __linux__
+      prctl(PR_SET_PDEATHSIG, SIGTERM);
+#endif
+      pool_worker(self, pool, i);
+    }
+    close(start_pipe[0]);
+    close(done_pipe[1]);
+    if (pool->pids[i] < 0) {
+      close(start_pipe[1]);
+      close(done_pipe[0]);
+      goto error;
+    }
+    pool->start_fd[i] = start_pipe[1];
+    pool->done_fd[i] = done_pipe[0];
+  }
+  return pool;
+
+ error:
+  PyErr_SetFromErrno(PyExc_OSError);
+  stop_process_pool(pool);
+  return NULL;
+}
+
+/* Called by the master process before it evaluates its own part */
+static int
+pool_dispatch(process_pool *pool, energy_spec *input, int with_gradients)
+{
+  char c = 0;
+  int i;
+  if (input->natoms != pool->natoms)
+    return 0;
+  memcpy(pool->coordinates, input->coordinates->data,
+	 3*pool->natoms*sizeof(double));
+  if (pool->universe_spec != NULL)
+    for (i = 0; i < pool->ngeometry; i++)
+      pool->geometry[i] = pool->universe_spec->geometry_data[i];
+  pool->command->small_change = input->small_change;
+  pool->command->with_gradients = with_gradients;
+  for (i = 0; i < pool->nworkers; i++)
+    if (write(pool->start_fd[i], &c, 1) != 1)
+      return 0;
+  return 1;
+}
+
+/* Called by the master process after it has evaluated its own part */
+static int
+pool_collect(process_pool *pool, energy_data *energy)
+{
+  int ok = 1;
+  int i, j;
+  for (i = 0; i < pool->nworkers; i++) {
+    char c;
+    ssize_t n;
+    do
+      n = read(pool->done_fd[i], &c, 1);
+    while (n < 0 && errno == EINTR);
+    if (n != 1) {
+      ok = 0;
+      continue;
+    }
+    for (j = 0; j < pool->nterms+1; j++)
+      energy->energy_terms[j] += pool->energy_terms[i*(pool->nterms+1)+j];
+    energy->virial_available &= pool->status[i].virial_available;
+    energy->error |= pool->status[i].error;
+    if (energy->gradients != NULL) {
+      double *wdata = pool->gradients + 3*i*pool->natoms;
+      if (energy->gradient_fn != NULL) {
+#ifdef GRADIENTFN
+	for (j = 0; j < pool->natoms; j++)
+	  (*energy->gradient_fn)(energy, j, wdata+3*j);
+#else
+	ok = 0;
+#endif
+      }
+      else {
+	double *data = (double *)((PyArrayObject *)energy->gradients)->data;
+	for (j = 0; j < 3*pool->natoms; j++)
+	  data[j] += wdata[j];
+      }
+    }
+  }
+  return ok;
+}
+
+#endif
+
+/*
+ * Spatial domain decomposition
+ *
+ * With MPI, an evaluator can divide space into slabs along the first
+ * box axis, each slab containing the same number of atoms. Each
+ * process owns the atoms in one slab: it integrates their equations
+ * of motion and evaluates the interactions whose reference atom
+ * (the first atom of a bonded term, the lower index of a nonbonded
+ * pair) it owns. The only coordinates it needs from the other
+ * processes are those of the halo atoms, i.e. the atoms within
+ * the interaction range plus a skin of its slab, and the only
+ * gradients it must send back are those on its halo atoms.
+ * The interaction range is the larger of the nonbonded cutoff and
+ * the extent of the bonded terms along the slab axis, which is
+ * measured at each assignment.
+ * The slabs are rebuilt whenever an atom has moved by more than
+ * half the skin since the last assignment. The integrators call
+ * PyFFEvaluator_DomainUpdate to exchange halo coordinates at every
+ * step and to collect the complete state when they produce output.
+ */
+
+#ifdef WITH_MPI
+
+typedef struct {
+  domain_info info;
+  PyMPICommunicatorObject *communicator;
+  PyUniverseSpecObject *universe_spec;
+  int natoms;
+  double skin, halo, cutoff;
+  PyArrayObject **bonded; /* index arrays of the bonded terms */
+  int nbonded;
+  double length;        /* periodic box length along x, 0 if none */
+  double *bounds;       /* slab limits along x, nprocs+1 values */
+  double *sorted;
+  vector3 *reference;   /* positions at the last slab assignment */
+  int *send_atoms, *recv_atoms;
+  int nsend_alloc, nrecv_alloc;
+  int *send_count, *send_displ, *recv_count, *recv_displ;
+  int *owned_count, *owned_displ;
+  int *mpi_counts;      /* scratch space for MPI calls, 4*nprocs values */
+  double *send_buffer, *recv_buffer;
+  int nbuffer;
+} domain_decomposition;
+
+static void
+free_domain(domain_decomposition *dd)
+{
+  free(dd->info.owner);
+  free(dd->bounds);
+  free(dd->sorted);
+  free(dd->reference);
+  free(dd->send_atoms);
+  free(dd->recv_atoms);
+  free(dd->send_count);
+  free(dd->send_buffer);
+  free(dd->recv_buffer);
+  free(dd->bonded);
+  Py_XDECREF(dd->universe_spec);
+  free(dd);
+}
+
+static domain_decomposition *
+new_domain(PyFFEvaluatorObject *self, double skin)
+{
+  domain_decomposition *dd;
+  PyUniverseSpecObject *universe_spec = NULL;
+  double cutoff = 0.;
+  int nprocs = self->nprocs;
+  int nbonded = 0;
+  int i;
+
+  if (self->communicator == NULL || self->nthreads > 1) {
+    PyErr_SetString(PyExc_ValueError,
+		    "domain decomposition requires MPI and a single thread");
+    return NULL;
+  }
+  for (i = 0; i < self->ntermobjects; i++) {
+    PyFFEnergyTermObject *term = ((PyFFEnergyTermObject **)
+				  self->terms->data)[i];
+    if (!term->domain_safe) {
+      PyErr_Format(PyExc_ValueError,
+		   "energy term %s does not support domain decomposition",
+		   term->evaluator_name);
+      return NULL;
+    }
+    if (term->eval_func == nonbonded_evaluator) {
+      PyNonbondedListObject *nblist = (PyNonbondedListObject *)term->data[0];
+      if (nblist->cutoff <= 0.) {
+	PyErr_SetString(PyExc_ValueError,
+			"domain decomposition requires a finite cutoff");
+	return NULL;
+      }
+      if (nblist->cutoff > cutoff)
+	cutoff = nblist->cutoff;
+      if (universe_spec == NULL)
+	universe_spec = nblist->universe_spec;
+    }
+    else if (term->eval_func == harmonic_bond_evaluator
+	     || term->eval_func == harmonic_angle_evaluator
+	     || term->eval_func == cosine_dihedral_evaluator) {
+      nbonded++;
+      if (universe_spec == NULL)
+	universe_spec = term->universe_spec;
+    }
+    else if (term->eval_func != lennard_jones_evaluator
+	     && term->eval_func != electrostatic_evaluator) {
+      /* The halo could miss interaction partners */
+      PyErr_Format(PyExc_ValueError,
+		   "energy term %s has an unknown interaction range",
+		   term->evaluator_name);
+      return NULL;
+    }
+  }
+  if (universe_spec == NULL) {
+    PyErr_SetString(PyExc_ValueError, "no energy terms");
+    return NULL;
+  }
+  if (universe_spec->is_periodic && !universe_spec->is_orthogonal) {
+    PyErr_SetString(PyExc_ValueError,
+		    "domain decomposition requires an orthorhombic box");
+    return NULL;
+  }
+
+  dd = (domain_decomposition *)malloc(sizeof(domain_decomposition));
+  if (dd == NULL) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+  memset(dd, 0, sizeof(domain_decomposition));
+  dd->info.proc_id = self->proc_id;
+  dd->info.nprocs = nprocs;
+  dd->info.active = 0;
+  dd->communicator = self->communicator;
+  dd->universe_spec = universe_spec;
+  Py_INCREF(universe_spec);
+  dd->skin = skin;
+  dd->cutoff = cutoff;
+  dd->halo = cutoff + skin;
+  dd->bounds = (double *)malloc((nprocs+1)*sizeof(double));
+  dd->send_count = (int *)malloc(10*nprocs*sizeof(int));
+  if (nbonded > 0)
+    dd->bonded = (PyArrayObject **)malloc(nbonded*sizeof(PyArrayObject *));
+  if (dd->bounds == NULL || dd->send_count == NULL
+      || (nbonded > 0 && dd->bonded == NULL)) {
+    free_domain(dd);
+    PyErr_NoMemory();
+    return NULL;
+  }
+  dd->send_displ = dd->send_count + nprocs;
+  dd->recv_count = dd->send_displ + nprocs;
+  dd->recv_displ = dd->recv_count + nprocs;
+  dd->owned_count = dd->recv_displ + nprocs;
+  dd->owned_displ = dd->owned_count + nprocs;
+  dd->mpi_counts = dd->owned_displ + nprocs;
+  for (i = 0; i < self->ntermobjects; i++) {
+    PyFFEnergyTermObject *term = ((PyFFEnergyTermObject **)
+				  self->terms->data)[i];
+    if (term->eval_func == harmonic_bond_evaluator
+	|| term->eval_func == harmonic_angle_evaluator
+	|| term->eval_func == cosine_dihedral_evaluator)
+      dd->bonded[dd->nbonded++] = (PyArrayObject *)term->data[0];
+  }
+  return dd;
+}
+
+/* Largest distance along the slab axis between two atoms
+   of the same bonded term */
+
+static double
+bonded_extent(domain_decomposition *dd, vector3 *x)
+{
+  double extent = 0.;
+  int k, t, i, j;
+  for (k = 0; k < dd->nbonded; k++) {
+    PyArrayObject *indices = dd->bonded[k];
+    long *index = (long *)indices->data;
+    int n = indices->dimensions[0];
+    int width = (indices->nd > 1) ? indices->dimensions[1] : 1;
+    for (t = 0; t < n; t++, index += width)
+      for (i = 0; i < width; i++)
+	for (j = i+1; j < width; j++) {
+	  vector3 d;
+	  dd->universe_spec->distance_function(d, x[index[i]], x[index[j]],
+					       dd->universe_spec->geometry_data);
+	  if (fabs(d[0]) > extent)
+	    extent = fabs(d[0]);
+	}
+  }
+  return extent;
+}
+
+/* Allocate the per-atom arrays when the number of atoms is known */
+
+static int
+domain_allocate(domain_decomposition *dd, int natoms)
+{
+  if (dd->natoms == natoms)
+    return 1;
+  free(dd->info.owner);
+  free(dd->sorted);
+  free(dd->reference);
+  free(dd->send_buffer);
+  free(dd->recv_buffer);
+  dd->natoms = natoms;
+  dd->nbuffer = 9*natoms;
+  dd->info.owner = (int *)malloc(natoms*sizeof(int));
+  dd->sorted = (double *)malloc(natoms*sizeof(double));
+  dd->reference = (vector3 *)malloc(natoms*sizeof(vector3));
+  dd->send_buffer = (double *)malloc(dd->nbuffer*sizeof(double));
+  dd->recv_buffer = (double *)malloc(dd->nbuffer*sizeof(double));
+  if (dd->info.owner == NULL || dd->sorted == NULL || dd->reference == NULL
+      || dd->send_buffer == NULL || dd->recv_buffer == NULL) {
+    dd->natoms = 0;
+    return 0;
+  }
+  return 1;
+}
+
+static int
+compare_doubles(const void *a, const void *b)
+{
+  double da = *(const double *)a;
+  double db = *(const double *)b;
+  return (da > db) - (da < db);
+}
+
+/* Position along the decomposition axis, inside the periodic box */
+
+static double
+domain_coordinate(domain_decomposition *dd, vector3 x)
+{
+  double s = x[0];
+  if (dd->length > 0.)
+    s -= dd->length*floor(s/dd->length+0.5);
+  return s;
+}
+
+/* Distance along the decomposition axis from s to a slab */
+
+static double
+slab_distance(domain_decomposition *dd, double s, int slab)
+{
+  double lo = dd->bounds[slab];
+  double hi = dd->bounds[slab+1];
+  double d1, d2;
+  if (s >= lo && s < hi)
+    return 0.;
+  d1 = fabs(s-lo);
+  d2 = fabs(s-hi);
+  if (dd->length > 0.) {
+    d1 -= dd->length*floor(d1/dd->length+0.5);
+    d2 -= dd->length*floor(d2/dd->length+0.5);
+    d1 = fabs(d1);
+    d2 = fabs(d2);
+  }
+  return (d1 < d2) ? d1 : d2;
+}
+
+/* Make sure the buffers can hold n doubles */
+
+static int
+domain_buffers(domain_decomposition *dd, int n)
+{
+  double *b1, *b2;
+  if (n <= dd->nbuffer)
+    return 1;
+  b1 = (double *)realloc(dd->send_buffer, n*sizeof(double));
+  if (b1 == NULL)
+    return 0;
+  dd->send_buffer = b1;
+  b2 = (double *)realloc(dd->recv_buffer, n*sizeof(double));
+  if (b2 == NULL)
+    return 0;
+  dd->recv_buffer = b2;
+  dd->nbuffer = n;
+  return 1;
+}
+
+/* Assign atoms to slabs and build the halo lists. All processes
+   must have identical coordinates when this is called. */
+
+static int
+domain_assign(domain_decomposition *dd, vector3 *x)
+{
+  int natoms = dd->natoms;
+  int nprocs = dd->info.nprocs;
+  int me = dd->info.proc_id;
+  int *owner = dd->info.owner;
+  int nsend, nrecv;
+  int i, p;
+
+  if (dd->universe_spec->is_periodic)
+    dd->length = dd->universe_spec->geometry_data[0];
+  else
+    dd->length = 0.;
+  dd->halo = bonded_extent(dd, x);
+  if (dd->cutoff > dd->halo)
+    dd->halo = dd->cutoff;
+  dd->halo += dd->skin;
+
+  /* Slab limits such that all slabs contain the same number of atoms */
+  for (i = 0; i < natoms; i++)
+    dd->sorted[i] = domain_coordinate(dd, x[i]);
+  qsort(dd->sorted, natoms, sizeof(double), compare_doubles);
+  dd->bounds[0] = (dd->length > 0.) ? -0.5*dd->length : -HUGE_VAL;
+  dd->bounds[nprocs] = (dd->length > 0.) ? 0.5*dd->length : HUGE_VAL;
+  for (p = 1; p < nprocs; p++)
+    dd->bounds[p] = dd->sorted[((long)p*(long)natoms)/nprocs];
+
+  /* Owners */
+  for (p = 0; p < nprocs; p++)
+    dd->owned_count[p] = 0;
+  for (i = 0; i < natoms; i++) {
+    double s = domain_coordinate(dd, x[i]);
+    int lo = 0, hi = nprocs;
+    while (hi-lo > 1) {
+      int mid = (lo+hi)/2;
+      if (s >= dd->bounds[mid])
+	lo = mid;
+      else
+	hi = mid;
+    }
+    owner[i] = lo;
+    dd->owned_count[lo]++;
+    dd->reference[i][0] = x[i][0];
+    dd->reference[i][1] = x[i][1];
+    dd->reference[i][2] = x[i][2];
+  }
+  dd->owned_displ[0] = 0;
+  for (p = 1; p < nprocs; p++)
+    dd->owned_displ[p] = dd->owned_displ[p-1] + dd->owned_count[p-1];
+
+  /* Halo lists: own atoms near the other slabs are sent,
+     atoms of other processes near this slab are received. */
+  nsend = nrecv = 0;
+  for (p = 0; p < nprocs; p++) {
+    dd->send_count[p] = dd->recv_count[p] = 0;
+    if (p == me)
+      continue;
+    for (i = 0; i < natoms; i++) {
+      if (owner[i] == me
+	  && slab_distance(dd, domain_coordinate(dd, x[i]), p) < dd->halo)
+	dd->send_count[p]++;
+      else if (owner[i] == p
+	       && slab_distance(dd, domain_coordinate(dd, x[i]), me) < dd->halo)
+	dd->recv_count[p]++;
+    }
+    nsend += dd->send_count[p];
+    nrecv += dd->recv_count[p];
+  }
+  if (nsend > dd->nsend_alloc) {
+    free(dd->send_atoms);
+    dd->send_atoms = (int *)malloc(nsend*sizeof(int));
+    dd->nsend_alloc = (dd->send_atoms == NULL) ? 0 : nsend;
+  }
+  if (nrecv > dd->nrecv_alloc) {
+    free(dd->recv_atoms);
+    dd->recv_atoms = (int *)malloc(nrecv*sizeof(int));
+    dd->nrecv_alloc = (dd->recv_atoms == NULL) ? 0 : nrecv;
+  }
+  if ((nsend > 0 && dd->send_atoms == NULL)
+      || (nrecv > 0 && dd->recv_atoms == NULL))
+    return 0;
+  nsend = nrecv = 0;
+  for (p = 0; p < nprocs; p++) {
+    dd->send_displ[p] = nsend;
+    dd->recv_displ[p] = nrecv;
+    if (p == me)
+      continue;
+    for (i = 0; i < natoms; i++) {
+      if (owner[i] == me
+	  && slab_distance(dd, domain_coordinate(dd, x[i]), p) < dd->halo)
+	dd->send_atoms[nsend++] = i;
+      else if (owner[i] == p
+	       && slab_distance(dd, domain_coordinate(dd, x[i]), me) < dd->halo)
+	dd->recv_atoms[nrecv++] = i;
+    }
+  }
+  return domain_buffers(dd, 3*(nsend > nrecv ? nsend : nrecv));
+}
+
+/* Send the positions of this process' atoms in the halos of
+   the other processes */
+
+static int
+domain_exchange(domain_decomposition *dd, vector3 *x)
+{
+  int nprocs = dd->info.nprocs;
+  int *sc = dd->mpi_counts, *sd = sc+nprocs, *rc = sd+nprocs, *rd = rc+nprocs;
+  int nsend = dd->send_displ[nprocs-1] + dd->send_count[nprocs-1];
+  int nrecv = dd->recv_displ[nprocs-1] + dd->recv_count[nprocs-1];
+  int k, p;
+  for (p = 0; p < nprocs; p++) {
+    sc[p] = 3*dd->send_count[p];
+    sd[p] = 3*dd->send_displ[p];
+    rc[p] = 3*dd->recv_count[p];
+    rd[p] = 3*dd->recv_displ[p];
+  }
+  for (k = 0; k < nsend; k++) {
+    int i = dd->send_atoms[k];
+    dd->send_buffer[3*k] = x[i][0];
+    dd->send_buffer[3*k+1] = x[i][1];
+    dd->send_buffer[3*k+2] = x[i][2];
+  }
+  if (MPI_Alltoallv(dd->send_buffer, sc, sd, MPI_DOUBLE,
+		    dd->recv_buffer, rc, rd, MPI_DOUBLE,
+		    dd->communicator->handle) != MPI_SUCCESS)
+    return 0;
+  for (k = 0; k < nrecv; k++) {
+    int i = dd->recv_atoms[k];
+    x[i][0] = dd->recv_buffer[3*k];
+    x[i][1] = dd->recv_buffer[3*k+1];
+    x[i][2] = dd->recv_buffer[3*k+2];
+  }
+  return 1;
+}
+
+/* Send the gradient contributions on halo atoms back to their owners */
+
+static int
+domain_return_gradients(domain_decomposition *dd, vector3 *g)
+{
+  int nprocs = dd->info.nprocs;
+  int *sc = dd->mpi_counts, *sd = sc+nprocs, *rc = sd+nprocs, *rd = rc+nprocs;
+  int nsend = dd->send_displ[nprocs-1] + dd->send_count[nprocs-1];
+  int nrecv = dd->recv_displ[nprocs-1] + dd->recv_count[nprocs-1];
+  int k, p;
+  for (p = 0; p < nprocs; p++) {
+    sc[p] = 3*dd->recv_count[p];
+    sd[p] = 3*dd->recv_displ[p];
+    rc[p] = 3*dd->send_count[p];
+    rd[p] = 3*dd->send_displ[p];
+  }
+  for (k = 0; k < nrecv; k++) {
+    int i = dd->recv_atoms[k];
+    dd->recv_buffer[3*k] = g[i][0];
+    dd->recv_buffer[3*k+1] = g[i][1];
+    dd->recv_buffer[3*k+2] = g[i][2];
+  }
+  if (MPI_Alltoallv(dd->recv_buffer, sc, sd, MPI_DOUBLE,
+		    dd->send_buffer, rc, rd, MPI_DOUBLE,
+		    dd->communicator->handle) != MPI_SUCCESS)
+    return 0;
+  for (k = 0; k < nsend; k++) {
+    int i = dd->send_atoms[k];
+    g[i][0] += dd->send_buffer[3*k];
+    g[i][1] += dd->send_buffer[3*k+1];
+    g[i][2] += dd->send_buffer[3*k+2];
+  }
+  return 1;
+}
+
+/* Copy the data of all atoms from their owners to all processes.
+   Since all processes know the owners, the atoms of each process
+   are sent in index order without their indices. */
+
+static int
+domain_gather(domain_decomposition *dd, vector3 *x, vector3 *v, vector3 *g)
+{
+  int natoms = dd->natoms;
+  int nprocs = dd->info.nprocs;
+  int me = dd->info.proc_id;
+  int *owner = dd->info.owner;
+  vector3 *arrays[3];
+  int *rc = dd->mpi_counts, *rd = rc+nprocs;
+  int narrays = 0;
+  int i, k, n, p;
+  if (x != NULL) arrays[narrays++] = x;
+  if (v != NULL) arrays[narrays++] = v;
+  if (g != NULL) arrays[narrays++] = g;
+  if (!domain_buffers(dd, 3*narrays*natoms))
+    return 0;
+  n = 0;
+  for (i = 0; i < natoms; i++)
+    if (owner[i] == me)
+      for (k = 0; k < narrays; k++) {
+	dd->send_buffer[n++] = arrays[k][i][0];
+	dd->send_buffer[n++] = arrays[k][i][1];
+	dd->send_buffer[n++] = arrays[k][i][2];
+      }
+  for (p = 0; p < nprocs; p++) {
+    rc[p] = 3*narrays*dd->owned_count[p];
+    rd[p] = 3*narrays*dd->owned_displ[p];
+  }
+  if (MPI_Allgatherv(dd->send_buffer, n, MPI_DOUBLE,
+		     dd->recv_buffer, rc, rd, MPI_DOUBLE,
+		     dd->communicator->handle) != MPI_SUCCESS)
+    return 0;
+  for (p = 0; p < nprocs; p++)
+    rc[p] = rd[p];
+  for (i = 0; i < natoms; i++) {
+    double *data = dd->recv_buffer + rc[owner[i]];
+    for (k = 0; k < narrays; k++) {
+      arrays[k][i][0] = *data++;
+      arrays[k][i][1] = *data++;
+      arrays[k][i][2] = *data++;
+    }
+    rc[owner[i]] += 3*narrays;
+  }
+  return 1;
+}
+
+#endif
+
+/* Exchange or synchronize atom data for domain decomposition.
+ * domain_start: copy x and v from process 0 to all others,
+ *               assign the slabs, and activate the decomposition
+ * domain_step: after the positions of the owned atoms have changed,
+ *              update the halo positions, or rebuild the slabs
+ *              if an atom has moved too far
+ * domain_sync: make x, v, and g complete on all processes
+ * domain_finish: domain_sync and deactivate the decomposition
+ * Returns 1 if x (and v, g) are now complete on all processes,
+ * 0 if only the halo positions were updated, and -1 after an
+ * error. Only domain_start sets a Python exception; it must be
+ * called while holding the global interpreter lock.
+ */
+
+int
+PyFFEvaluator_DomainUpdate(PyFFEvaluatorObject *self, int mode, int natoms,
+			   vector3 *x, vector3 *v, vector3 *g)
+{
+#ifdef WITH_MPI
+  domain_decomposition *dd = (domain_decomposition *)self->domain;
+  if (dd == NULL)
+    return 1;
+  switch (mode) {
+  case domain_start:
+    if (!domain_allocate(dd, natoms)) {
+      PyErr_NoMemory();
+      return -1;
+    }
+    if (MPI_Bcast(x, 3*natoms, MPI_DOUBLE, 0,
+		  dd->communicator->handle) != MPI_SUCCESS
+	|| MPI_Bcast(v, 3*natoms, MPI_DOUBLE, 0,
+		     dd->communicator->handle) != MPI_SUCCESS) {
+      PyErr_SetString(PyExc_MPIError, "Error in MPI_Bcast");
+      return -1;
+    }
+    if (!domain_assign(dd, x)) {
+      PyErr_NoMemory();
+      return -1;
+    }
+    dd->info.active = 1;
+    return 1;
+  case domain_step:
+    {
+      double limit = 0.25*dd->skin*dd->skin;
+      double max_sq = 0., global_max_sq;
+      int i;
+      for (i = 0; i < natoms; i++)
+	if (dd->info.owner[i] == dd->info.proc_id) {
+	  vector3 d;
+	  double r_sq;
+	  dd->universe_spec->distance_function(d, dd->reference[i], x[i],
+					 dd->universe_spec->geometry_data);
+	  r_sq = dot(d, d);
+	  if (r_sq > max_sq)
+	    max_sq = r_sq;
+	}
+      if (MPI_Allreduce(&max_sq, &global_max_sq, 1, MPI_DOUBLE, MPI_MAX,
+			dd->communicator->handle) != MPI_SUCCESS)
+	return -1;
+      if (global_max_sq < limit)
+	return domain_exchange(dd, x) ? 0 : -1;
+      if (!domain_gather(dd, x, v, NULL) || !domain_assign(dd, x))
+	return -1;
+      return 1;
+    }
+  case domain_sync:
+  case domain_finish:
+    if (!dd->info.active)
+      return 1;
+    if (!domain_gather(dd, x, v, g))
+      return -1;
+    if (mode == domain_finish)
+      dd->info.active = 0;
+    else if (!domain_assign(dd, x))
+      return -1;
+    return 1;
+  }
+#endif
+  return 1;
+}
+
+/* Sum n values over all processes of a domain decomposition */
+
+int
+PyFFEvaluator_DomainSum(PyFFEvaluatorObject *self, double *data, int n)
+{
+#ifdef WITH_MPI
+  domain_decomposition *dd = (domain_decomposition *)self->domain;
+  double sum[MMTK_MAX_TERMS+1];
+  int i;
+  if (dd == NULL || !dd->info.active)
+    return 1;
+  while (n > 0) {
+    int nsum = (n > MMTK_MAX_TERMS+1) ? MMTK_MAX_TERMS+1 : n;
+    if (MPI_Allreduce(data, sum, nsum, MPI_DOUBLE, MPI_SUM,
+		      dd->communicator->handle) != MPI_SUCCESS)
+      return 0;
+    for (i = 0; i < nsum; i++)
+      data[i] = sum[i];
+    data += nsum;
+    n -= nsum;
+  }
+#endif
+  return 1;
+}
+
 /* String copy with memory allocation */
 
 char *
@@ -164,6 +1131,7 @@ PyFFEnergyTerm_new(PyTypeObject *type, PyObject *args, PyObject *kw)
     self->threaded = 0;
     self->thread_safe = 0;
     self->parallelized = 0;
+    self->domain_safe = 0;
     self->n = self->nterms = 0;
   }
   return (PyObject *)self;
@@ -239,6 +1207,7 @@ PyFFEnergyTerm_New(void)
     self->term_names[i] = NULL;
   self->threaded = 0;
   self->parallelized = 0;
+  self->domain_safe = 0;
   self->n = self->nterms = 0;
   return self;
 }
@@ -475,15 +1444,24 @@ PyFFEvaluator_New(void)
     PyErr_NoMemory();
     return NULL;
   }
+  self->eval_func = NULL;
   self->universe_spec = NULL;
   self->terms = NULL;
+  self->energy_terms_array = NULL;
   self->energy_terms = NULL;
   self->nterms =  self->ntermobjects = 0;
   self->scratch = NULL;
   self->nthreads = 0;
+  self->process_pool = NULL;
+  self->domain = NULL;
 #ifdef WITH_THREAD
   self->global_lock = NULL;
   self->binfo = NULL;
+#endif
+#ifdef WITH_MPI
+  self->communicator = NULL;
+  self->energy_parts = NULL;
+  self->gradient_parts = NULL;
 #endif
   return self;
 }
@@ -492,6 +1470,10 @@ static void
 evaluator_dealloc(PyFFEvaluatorObject *self)
 {
   int i;
+#ifdef PROCESS_POOL
+  if (self->process_pool != NULL)
+    stop_process_pool((process_pool *)self->process_pool);
+#endif
 #ifdef WITH_THREAD
   if (self->eval_func == evaluator) {
     threadinfo *tinfo = (threadinfo *)self->scratch;
@@ -499,8 +1481,13 @@ evaluator_dealloc(PyFFEvaluatorObject *self)
       PyThread_free_lock(self->global_lock);
     if (self->binfo != NULL)
       deallocate_barrier(self->binfo);
-    for (i = 1; i < self->nthreads; i++) {
+    for (i = 1; tinfo != NULL && i < self->nthreads; i++) {
       int j = 50;
+      if (tinfo->lock == NULL) {
+	free(tinfo->energy.energy_terms);
+	tinfo++;
+	continue;
+      }
       tinfo->exit = 1;
 #if THREAD_DEBUG
       printf("Releasing thread %d\n", tinfo->input.thread_id);
@@ -530,6 +1517,8 @@ evaluator_dealloc(PyFFEvaluatorObject *self)
   }
 #endif
 #ifdef WITH_MPI
+  if (self->domain != NULL)
+    free_domain((domain_decomposition *)self->domain);
   if (self->energy_parts)
     free(self->energy_parts);
   if (self->gradient_parts)
@@ -653,8 +1642,11 @@ evaluator_call(PyFFEvaluatorObject *self, PyObject *args)
 #ifdef WITH_THREAD
   PyEval_RestoreThread(self->tstate_save);
 #endif
-  if (energy.error)
+  if (energy.error) {
+    if (!PyErr_Occurred())
+      PyErr_SetString(PyExc_RuntimeError, "energy evaluation failed");
     return NULL;
+  }
   else
     return PyFloat_FromDouble(energy.energy);
 }
@@ -666,8 +1658,12 @@ evaluator(PyFFEvaluatorObject *self,
 {
   int natoms = coordinates->dimensions[0];
   PyFFEnergyTermObject *term;
-  energy_spec input;
+  energy_spec input, full_input;
+  int use_pool = 0;
   int i;
+#ifdef PROCESS_POOL
+  process_pool *pool = (process_pool *)self->process_pool;
+#endif
 
   input.coordinates = coordinates;
   input.natoms = natoms;
@@ -678,6 +1674,11 @@ evaluator(PyFFEvaluatorObject *self,
   input.proc_id = self->proc_id;
   input.thread_id = 0;
   input.slice_id = self->nthreads*self->proc_id;
+  input.atom_owner = NULL;
+#ifdef WITH_MPI
+  if (self->domain != NULL && self->domain->active)
+    input.atom_owner = self->domain->owner;
+#endif
   energy->energy_terms = self->energy_terms;
   for (i = 0; i < self->nterms+1; i++)
     energy->energy_terms[i] = 0.;
@@ -687,6 +1688,9 @@ evaluator(PyFFEvaluatorObject *self,
     input.nthreads = 1;
     input.nprocs = 1;
     input.nslices = 1;
+    input.proc_id = 0;
+    input.slice_id = 0;
+    input.atom_owner = NULL;
     if (energy->fc_fn != NULL)
       (*energy->fc_fn)(energy, -1, -1, NULL, 0.);
     else {
@@ -767,18 +1771,37 @@ evaluator(PyFFEvaluatorObject *self,
     }
   }
 #endif
+#ifdef PROCESS_POOL
+  /* The worker processes evaluate their slices of the parallelized
+     terms; all other terms are evaluated completely by the master. */
+  if (pool != NULL && input.nprocs > 1) {
+    if (!pool_dispatch(pool, &input, energy->gradients != NULL)) {
+      energy->error = 1;
+      return;
+    }
+    use_pool = 1;
+  }
+#endif
+  full_input = input;
+  full_input.nprocs = full_input.nslices = 1;
+  full_input.proc_id = full_input.slice_id = 0;
   for (i = 0; i < self->ntermobjects; i++) {
+    energy_spec *term_input = &input;
     term = ((PyFFEnergyTermObject **)self->terms->data)[i];
+#ifdef PROCESS_POOL
+    if (use_pool && !POOL_TERM(term))
+      term_input = &full_input;
+#endif
 #ifdef WITH_THREAD
     if (term->thread_safe)
-      (*term->eval_func)(term, self, &input, energy);
+      (*term->eval_func)(term, self, term_input, energy);
     else {
       PyEval_RestoreThread(self->tstate_save);
-      (*term->eval_func)(term, self, &input, energy);
+      (*term->eval_func)(term, self, term_input, energy);
       self->tstate_save = PyEval_SaveThread();
     }
 #else
-    (*term->eval_func)(term, self, &input, energy);
+    (*term->eval_func)(term, self, term_input, energy);
 #endif
 #if THREAD_DEBUG
     {
@@ -826,6 +1849,10 @@ evaluator(PyFFEvaluatorObject *self,
     }
   }
 #endif
+#ifdef PROCESS_POOL
+  if (use_pool && !pool_collect(pool, energy))
+    energy->error = 1;
+#endif
 #if MPI_DEBUG
   {
     int j;
@@ -854,7 +1881,12 @@ evaluator(PyFFEvaluatorObject *self,
       for (i = 0; i < self->nprocs; i++)
 	energy->energy_terms[j] += self->energy_parts[i*(self->nterms+1)+j];
     }
-    if (energy->gradients != NULL) {
+    if (energy->gradients != NULL && input.atom_owner != NULL) {
+      vector3 *g = (vector3 *)((PyArrayObject *)energy->gradients)->data;
+      if (!domain_return_gradients((domain_decomposition *)self->domain, g))
+	energy->error = 1;
+    }
+    else if (energy->gradients != NULL) {
       double *gdata = (double *)((PyArrayObject *)energy->gradients)->data;
       if (PyMPI_Share(self->communicator, gdata, self->gradient_parts,
 		      PyArray_DOUBLE, 3*natoms) != MPI_SUCCESS) {
@@ -954,6 +1986,49 @@ C_evaluator(PyObject *self, PyObject *args)
   return self;
 }
 
+/* Load statistics of the threads in the nonbonded pair loop */
+
+static PyObject *
+load_statistics(PyObject *self, PyObject *args)
+{
+  PyFFEvaluatorObject *ev = (PyFFEvaluatorObject *)self;
+  PyObject *result;
+  double *pairs;
+  int i, available = 0;
+  if (!PyArg_ParseTuple(args, ""))
+    return NULL;
+  pairs = (double *)malloc(2*ev->nthreads*sizeof(double));
+  if (pairs == NULL)
+    return PyErr_NoMemory();
+  for (i = 0; i < 2*ev->nthreads; i++)
+    pairs[i] = 0.;
+  for (i = 0; i < ev->ntermobjects; i++) {
+    PyFFEnergyTermObject *term = ((PyFFEnergyTermObject **)
+				  ev->terms->data)[i];
+    if (term->eval_func == nonbonded_evaluator)
+      available |= nonbonded_load(term, ev->nthreads,
+				  pairs, pairs+ev->nthreads);
+  }
+  if (available) {
+    result = PyList_New(ev->nthreads);
+    for (i = 0; result != NULL && i < ev->nthreads; i++) {
+      PyObject *item = Py_BuildValue("(dd)", pairs[i], pairs[ev->nthreads+i]);
+      if (item == NULL) {
+	Py_DECREF(result);
+	result = NULL;
+      }
+      else
+	PyList_SetItem(result, i, item);
+    }
+  }
+  else {
+    Py_INCREF(Py_None);
+    result = Py_None;
+  }
+  free(pairs);
+  return result;
+}
+
 /* Documentation string */
 
 static char PyFFEvaluator_Type__doc__[] = 
@@ -963,6 +2038,7 @@ static char PyFFEvaluator_Type__doc__[] =
 
 static struct PyMethodDef evaluator_methods[] = {
   {"CEvaluator", C_evaluator, 1},
+  {"loadStatistics", load_statistics, 1},
   {NULL, NULL} /* sentinel */
 };
 
@@ -1435,6 +2511,7 @@ ListOfNParticleTerms(PyObject *args, ff_eterm_function f,
   self->thread_safe = 1;
   self->nbarriers = 0;
   self->parallelized = 1;
+  self->domain_safe = 1;
   return (PyObject *)self;
 }
 
@@ -1486,6 +2563,7 @@ LennardJonesTerm(PyObject *dummy, PyObject *args)
   self->evaluator_name = "Lennard-Jones";
   self->nterms = 0;
   self->thread_safe = 1;
+  self->domain_safe = 1;
   return (PyObject *)self;
 }
 
@@ -1511,6 +2589,7 @@ ElectrostaticTerm(PyObject *dummy, PyObject *args)
     return PyErr_NoMemory();
   self->nterms = 1;
   self->thread_safe = 1;
+  self->domain_safe = 1;
   return (PyObject *)self;
 }
 
@@ -1589,6 +2668,7 @@ NonbondedListTerm(PyObject *dummy, PyObject *args)
   self->threaded = 1;
   self->nbarriers = 1;
   self->parallelized = 1;
+  self->domain_safe = 1;
   self->n = 0;
   self->evaluator_name = "nonbonded list summation";
   self->term_names[0] = allocstring("Lennard-Jones");
@@ -1616,15 +2696,27 @@ Evaluator(PyObject *dummy, PyObject *args)
   PyObject *communicator;
 #endif
   int nthreads = 1, nbarriers = 0;
+  int nprocesses = 1, natoms = 0;
+  double domain_skin = 0.;
   int error = 0;
   int i;
   if (self == NULL)
     return NULL;
-  if (!PyArg_ParseTuple(args, "O!|iO",
+  if (!PyArg_ParseTuple(args, "O!|iOiid",
 			&PyArray_Type, &self->terms,
-			&nthreads, &communicator))
+			&nthreads, &communicator,
+			&nprocesses, &natoms, &domain_skin)) {
+    self->terms = NULL;
+    Py_DECREF(self);
     return NULL;
+  }
   Py_INCREF(self->terms);
+  if (nprocesses > 1 && nthreads > 1) {
+    PyErr_SetString(PyExc_ValueError,
+		    "threads and processes cannot be combined");
+    Py_DECREF(self);
+    return NULL;
+  }
   self->eval_func = evaluator;
   self->nthreads = nthreads;
 #ifdef WITH_MPI
@@ -1645,6 +2737,23 @@ Evaluator(PyObject *dummy, PyObject *args)
   self->nprocs = 1;
   self->proc_id = 0;
 #endif
+  if (nprocesses > 1) {
+#ifdef PROCESS_POOL
+#ifdef WITH_MPI
+    if (self->communicator != NULL) {
+      PyErr_SetString(PyExc_ValueError,
+		      "processes and MPI cannot be combined");
+      Py_DECREF(self);
+      return NULL;
+    }
+#endif
+    self->nprocs = nprocesses;
+#else
+    PyErr_SetString(PyExc_OSError, "no process pool support");
+    Py_DECREF(self);
+    return NULL;
+#endif
+  }
   self->nslices = self->nprocs*self->nthreads;
   self->ntermobjects = self->terms->dimensions[0];
   self->nterms = 0;
@@ -1695,22 +2804,28 @@ Evaluator(PyObject *dummy, PyObject *args)
     self->global_lock = PyThread_allocate_lock();
     if (self->global_lock == NULL) {
       PyErr_SetString(PyExc_OSError, "couldn't allocate lock");
+      Py_DECREF(self);
       return NULL;
     }
     if (nbarriers > 0) {
       self->binfo = malloc(nbarriers*sizeof(barrierinfo));
-      if (self->binfo == NULL)
+      if (self->binfo == NULL) {
+	Py_DECREF(self);
 	return PyErr_NoMemory();
+      }
       for (i = 0; i < nbarriers; i++) {
 	if (!allocate_barrier(self->binfo+i)) {
 	  PyErr_SetString(PyExc_OSError, "couldn't allocate barrier");
+	  Py_DECREF(self);
 	  return NULL;
 	}
       }
     }
     self->scratch = malloc((nthreads-1)*sizeof(threadinfo));
-    if (self->scratch == NULL)
+    if (self->scratch == NULL) {
+      Py_DECREF(self);
       return PyErr_NoMemory();
+    }
     tinfo = (threadinfo *)self->scratch;
     for (i = 1; i < nthreads; i++) {
       tinfo->evaluator = self;
@@ -1750,6 +2865,7 @@ Evaluator(PyObject *dummy, PyObject *args)
 	tinfo->input.proc_id = self->proc_id;
 	tinfo->input.nslices = self->nthreads*self->nprocs;
 	tinfo->input.slice_id = self->nthreads*self->proc_id+i;
+	tinfo->input.atom_owner = NULL;
 	if (!PyThread_start_new_thread(evaluator_thread, (void *)tinfo)) {
 	  PyErr_SetString(PyExc_OSError, "couldn't start thread");
 	  error = 1;
@@ -1765,6 +2881,23 @@ Evaluator(PyObject *dummy, PyObject *args)
 #else
     PyErr_SetString(PyExc_OSError, "no thread support");
     error = 1;
+#endif
+  }
+#ifdef PROCESS_POOL
+  if (!error && nprocesses > 1) {
+    self->process_pool = start_process_pool(self, nprocesses, natoms);
+    if (self->process_pool == NULL)
+      error = 1;
+  }
+#endif
+  if (!error && domain_skin > 0.) {
+#ifdef WITH_MPI
+    self->domain = (domain_info *)new_domain(self, domain_skin);
+    if (self->domain == NULL)
+      error = 1;
+#else
+    PyErr_SetString(PyExc_ValueError, "domain decomposition requires MPI");
+    error = 1;
 #endif
   }
   if (error) {
@@ -1895,6 +3028,9 @@ initMMTK_forcefield(void)
   PyFF_API[PyFFEvaluator_New_NUM] = (void *)&PyFFEvaluator_New;
   PyFF_API[PyNonbondedListUpdate_NUM] = (void *)&PyNonbondedListUpdate;
   PyFF_API[PyNonbondedListIterate_NUM] = (void *)&PyNonbondedListIterate;
+  PyFF_API[PyFFEvaluator_DomainUpdate_NUM] =
+    (void *)&PyFFEvaluator_DomainUpdate;
+  PyFF_API[PyFFEvaluator_DomainSum_NUM] = (void *)&PyFFEvaluator_DomainSum;
 
 #ifdef EXTENDED_TYPES
   if (PyType_Ready(&PyFFEnergyTerm_Type) < 0)
@@ -261,6 +261,8 @@ steepestDescent(PyObject *dummy, PyObject *args)
   free(min_configuration);
   free(min_gradients);
   Py_DECREF(gradients);
+  if (PyErr_Occurred())
+    return NULL;
   Py_INCREF(Py_None);
   return Py_None;
 
@@ -534,6 +536,8 @@ conjugateGradient(PyObject *dummy, PyObject *args)
   PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
   Py_DECREF(gradients1);
   Py_DECREF(gradients2);
+  if (PyErr_Occurred())
+    return NULL;
   Py_INCREF(Py_None);
   return Py_None;
 
@@ -547,6 +551,397 @@ error2:
   return NULL;
 }
 
+/* Limited-memory BFGS minimizer */
+
+/* State shared by the energy evaluations of a line search: the
+   configuration is x0 + a*d, the gradient of the moving atoms is
+   stored in g, and the directional derivative along d in *dphi. */
+
+typedef struct {
+  PyFFEvaluatorObject *evaluator;
+  PyUniverseSpecObject *universe_spec;
+  PyArrayObject *configuration;
+  energy_data *p_energy;
+  double *x, *f, *x0, *d, *g;
+  long *fix;
+  int n;
+} line_search_data;
+
+static double
+dot_product(double *a, double *b, int n)
+{
+  double sum = 0.;
+  while (n--)
+    sum += *a++ * *b++;
+  return sum;
+}
+
+static int
+line_evaluate(line_search_data *ls, double a, double *phi, double *dphi)
+{
+  int j;
+  for (j = 0; j < ls->n; j++)
+    ls->x[j] = ls->x0[j] + a*ls->d[j];
+  PyUniverseSpec_StateLock(ls->universe_spec, -2);
+  PyUniverseSpec_StateLock(ls->universe_spec, 1);
+  (*ls->evaluator->eval_func)(ls->evaluator, ls->p_energy,
+			      ls->configuration, 0);
+  PyUniverseSpec_StateLock(ls->universe_spec, 2);
+  if (ls->p_energy->error)
+    return 0;
+  PyUniverseSpec_StateLock(ls->universe_spec, -1);
+  for (j = 0; j < ls->n; j++)
+    ls->g[j] = ls->fix[j/3] ? 0. : ls->f[j];
+  *phi = ls->p_energy->energy;
+  *dphi = dot_product(ls->g, ls->d, ls->n);
+  return 1;
+}
+
+/* Line search for a step length satisfying the strong Wolfe conditions
+   (Nocedal & Wright, algorithms 3.5 and 3.6), with safeguarded cubic
+   interpolation. Returns 1 if the configuration has been moved to an
+   acceptable point, 0 if no decrease in energy was found, and -1 if
+   the energy evaluation failed. */
+
+static int
+line_search(line_search_data *ls, double phi0, double dphi0)
+{
+  const double c1 = 1.e-4, c2 = 0.9;
+  const int max_eval = 20;
+  double a_lo = 0., phi_lo = phi0, dphi_lo = dphi0;
+  double a_hi = 0., phi_hi = 0., dphi_hi = 0.;
+  double a = 1., phi, dphi;
+  int neval = 0, bracketed = 0, finite_hi = 1;
+
+  while (neval < max_eval) {
+    if (bracketed) {
+      /* Cubic interpolation between a_lo and a_hi */
+      double lower = min(a_lo, a_hi), upper = max(a_lo, a_hi);
+      double margin = 0.1*(upper-lower);
+      double d1 = dphi_lo + dphi_hi - 3.*(phi_lo-phi_hi)/(a_lo-a_hi);
+      double d2sq = d1*d1 - dphi_lo*dphi_hi;
+      a = 0.5*(a_lo+a_hi);
+      if (finite_hi && d2sq >= 0.) {
+	double d2 = (a_hi > a_lo) ? sqrt(d2sq) : -sqrt(d2sq);
+	double ac = a_hi - (a_hi-a_lo)*(dphi_hi+d2-d1)
+	                   / (dphi_hi-dphi_lo+2.*d2);
+	if (ac >= lower+margin && ac <= upper-margin)
+	  a = ac;
+      }
+      if (upper-lower <= 1.e-12*upper)
+	break;
+    }
+    if (!line_evaluate(ls, a, &phi, &dphi))
+      return -1;
+    neval++;
+    /* The negated comparisons also reject infinite energies */
+    if (!(phi <= phi0 + c1*a*dphi0) || !(phi < phi_lo)) {
+      a_hi = a; phi_hi = phi; dphi_hi = dphi;
+      bracketed = 1;
+      finite_hi = (phi < 1.e300 && dphi < 1.e300 && dphi > -1.e300);
+    }
+    else {
+      if (fabs(dphi) <= -c2*dphi0)
+	return 1;
+      if (bracketed) {
+	if (dphi*(a_hi-a_lo) >= 0.) {
+	  a_hi = a_lo; phi_hi = phi_lo; dphi_hi = dphi_lo;
+	  finite_hi = 1;
+	}
+      }
+      else if (dphi >= 0.) {
+	a_hi = a_lo; phi_hi = phi_lo; dphi_hi = dphi_lo;
+	bracketed = 1;
+      }
+      a_lo = a; phi_lo = phi; dphi_lo = dphi;
+      if (!bracketed)
+	a = 2.*a;
+    }
+  }
+
+  /* No point satisfying both conditions was found: use the best one,
+     which satisfies the sufficient decrease condition if a_lo > 0. */
+  if (a_lo == 0.)
+    return 0;
+  if (a_lo != a && !line_evaluate(ls, a_lo, &phi, &dphi))
+    return -1;
+  return 1;
+}
+
+static PyObject *
+lbfgs(PyObject *dummy, PyObject *args)
+{
+  PyObject *universe;
+  PyUniverseSpecObject *universe_spec;
+  PyArrayObject *configuration;
+  PyArrayObject *fixed;
+  PyListObject *spec_list;
+  PyFFEvaluatorObject *evaluator;
+  PyTrajectoryOutputSpec *output;
+  long *fix;
+  int atoms, moving_atoms, n;
+  int steps, history;
+  double step_size, gradient_convergence;
+  char *description;
+
+  PyArrayObject *gradients;
+  PyTrajectoryVariable *data_descriptors;
+  energy_data p_energy;
+  line_search_data ls;
+  double *x, *f;
+  double *scratch = NULL;
+  double *x0, *d, *g, *g0, *f0, *sn, *yn, *s, *y, *rho, *alpha;
+  double norm, e0, gd, sy;
+  int first = 0, count = 0;
+  int i, j, k, ret;
+  int stalled = 0;
+
+  /* Parse and check arguments */
+  if (!PyArg_ParseTuple(args, "OO!O!O!iddO!si", &universe,
+			&PyArray_Type, &configuration,
+			&PyArray_Type, &fixed,
+			&PyFFEvaluator_Type, &evaluator,
+			&steps, &step_size, &gradient_convergence,
+			&PyList_Type, &spec_list, &description,
+			&history))
+    return NULL;
+  if (history < 1) {
+    PyErr_SetString(PyExc_ValueError, "history length must be positive");
+    return NULL;
+  }
+  universe_spec = (PyUniverseSpecObject *)
+                   PyObject_GetAttrString(universe, "_spec");
+  if (universe_spec == NULL)
+    return NULL;
+  /* The universe keeps the specification alive during the minimization */
+  Py_DECREF(universe_spec);
+
+  /* Create gradient array */
+#if defined(NUMPY)
+  gradients = (PyArrayObject *)PyArray_Copy(configuration);
+#else
+  gradients = (PyArrayObject *)PyArray_FromDims(configuration->nd,
+						configuration->dimensions,
+						PyArray_DOUBLE);
+#endif
+  if (gradients == NULL)
+    return NULL;
+
+  /* Set some convenient variables */
+  atoms = configuration->dimensions[0];
+  n = 3*atoms;
+  x = (double *)configuration->data;
+  f = (double *)gradients->data;
+  fix = (long *)fixed->data;
+
+  moving_atoms = atoms;
+  for (j = 0; j < atoms; j++)
+    if (fix[j])
+      moving_atoms--;
+
+  /* Allocate the work arrays and the correction pair history */
+  scratch = (double *)malloc(((7+2*history)*n + 2*history)*sizeof(double));
+  if (scratch == NULL) {
+    PyErr_NoMemory();
+    Py_DECREF(gradients);
+    return NULL;
+  }
+  x0 = scratch;
+  d = x0 + n;
+  g = d + n;
+  g0 = g + n;
+  f0 = g0 + n;
+  sn = f0 + n;
+  yn = sn + n;
+  s = yn + n;
+  y = s + history*n;
+  rho = y + history*n;
+  alpha = rho + history;
+
+  /* Prepare output data descriptors */
+  data_descriptors = get_data_descriptors(configuration, gradients,
+					  &p_energy.energy, &norm,
+					  universe_spec->geometry_data,
+					  universe_spec->geometry_data_length);
+
+  /* Initialize output */
+  output = PyTrajectory_OutputSpecification(universe, spec_list,
+					    description,
+					    data_descriptors);
+  if (output == NULL)
+    goto error2;
+
+  ls.evaluator = evaluator;
+  ls.universe_spec = universe_spec;
+  ls.configuration = configuration;
+  ls.p_energy = &p_energy;
+  ls.x = x;
+  ls.f = f;
+  ls.x0 = x0;
+  ls.d = d;
+  ls.g = g;
+  ls.fix = fix;
+  ls.n = n;
+
+  /* Initial energy evaluation */
+#ifdef WITH_THREAD
+  evaluator->tstate_save = PyEval_SaveThread();
+#endif
+  p_energy.gradients = (PyObject *)gradients;
+  p_energy.gradient_fn = NULL;
+  p_energy.force_constants = NULL;
+  p_energy.fc_fn = NULL;
+  PyUniverseSpec_StateLock(universe_spec, 1);
+  (*evaluator->eval_func)(evaluator, &p_energy, configuration, 0);
+  PyUniverseSpec_StateLock(universe_spec, 2);
+  if (p_energy.error) {
+#ifdef WITH_THREAD
+    PyEval_RestoreThread(evaluator->tstate_save);
+#endif
+    i = 0;
+    goto error;
+  }
+
+  /* Get write access for the minimization, switching to
+     read access only during energy evaluation */
+  PyUniverseSpec_StateLock(universe_spec, -1);
+  for (j = 0; j < n; j++)
+    g[j] = fix[j/3] ? 0. : f[j];
+
+  for (i = 0; i < steps; i++) {
+    norm = sqrt(dot_product(g, g, n)/moving_atoms);
+    if (norm < gradient_convergence)
+      break;
+    if (PyTrajectory_Output(output, i, data_descriptors,
+			    &evaluator->tstate_save) == -1) {
+      PyUniverseSpec_StateLock(universe_spec, -2);
+#ifdef WITH_THREAD
+      PyEval_RestoreThread(evaluator->tstate_save);
+#endif
+      goto error;
+    }
+
+    /* Search direction from the two-loop recursion */
+    for (j = 0; j < n; j++)
+      d[j] = -g[j];
+    for (k = count-1; k >= 0; k--) {
+      int l = (first+k) % history;
+      alpha[l] = rho[l]*dot_product(s+l*n, d, n);
+      for (j = 0; j < n; j++)
+	d[j] -= alpha[l]*y[l*n+j];
+    }
+    if (count > 0) {
+      int l = (first+count-1) % history;
+      double gamma = 1./(rho[l]*dot_product(y+l*n, y+l*n, n));
+      for (j = 0; j < n; j++)
+	d[j] *= gamma;
+    }
+    for (k = 0; k < count; k++) {
+      int l = (first+k) % history;
+      double beta = rho[l]*dot_product(y+l*n, d, n);
+      for (j = 0; j < n; j++)
+	d[j] += (alpha[l]-beta)*s[l*n+j];
+    }
+    gd = dot_product(g, d, n);
+    if (count > 0 && !(gd < 0.)) {
+      /* Not a descent direction: restart from steepest descent */
+      count = 0;
+      for (j = 0; j < n; j++)
+	d[j] = -g[j];
+      gd = dot_product(g, d, n);
+    }
+    if (count == 0) {
+      /* Without curvature information, the first trial step
+	 has the length step_size */
+      double scale = step_size/sqrt(-gd);
+      for (j = 0; j < n; j++)
+	d[j] *= scale;
+      gd *= scale;
+    }
+
+    /* Line search */
+    memcpy(x0, x, n*sizeof(double));
+    memcpy(g0, g, n*sizeof(double));
+    memcpy(f0, f, n*sizeof(double));
+    e0 = p_energy.energy;
+    ret = line_search(&ls, e0, gd);
+    if (ret == -1) {
+#ifdef WITH_THREAD
+      PyEval_RestoreThread(evaluator->tstate_save);
+#endif
+      goto error;
+    }
+    if (ret == 0) {
+      /* Return to the starting point. Stop if steepest descent
+	 failed as well, otherwise retry without the history. */
+      memcpy(x, x0, n*sizeof(double));
+      memcpy(g, g0, n*sizeof(double));
+      memcpy(f, f0, n*sizeof(double));
+      p_energy.energy = e0;
+      if (count == 0) {
+	stalled = 1;
+	break;
+      }
+      count = 0;
+      continue;
+    }
+
+    /* Store the new correction pair if the curvature is positive,
+       replacing the oldest one when the history is full. A pair
+       that fails the test leaves the history unchanged. */
+    for (j = 0; j < n; j++) {
+      sn[j] = x[j]-x0[j];
+      yn[j] = g[j]-g0[j];
+    }
+    sy = dot_product(sn, yn, n);
+    if (sy > 1.e-10*sqrt(dot_product(sn, sn, n)*dot_product(yn, yn, n))) {
+      k = (first+count) % history;
+      memcpy(s+k*n, sn, n*sizeof(double));
+      memcpy(y+k*n, yn, n*sizeof(double));
+      rho[k] = 1./sy;
+      if (count == history)
+	first = (first+1) % history;
+      else
+	count++;
+    }
+    universe_spec->correction_function((vector3 *)x, atoms,
+				       universe_spec->geometry_data);
+  }
+
+  /* Final output, unless the minimization stopped at a configuration
+     that has already been written as step i */
+  norm = sqrt(dot_product(g, g, n)/moving_atoms);
+  if (!stalled && PyTrajectory_Output(output, i, data_descriptors,
+				      &evaluator->tstate_save) == -1) {
+    PyUniverseSpec_StateLock(universe_spec, -2);
+#ifdef WITH_THREAD
+    PyEval_RestoreThread(evaluator->tstate_save);
+#endif
+    goto error;
+  }
+
+  /* Clean up and return None */
+  PyUniverseSpec_StateLock(universe_spec, -2);
+#ifdef WITH_THREAD
+  PyEval_RestoreThread(evaluator->tstate_save);
+#endif
+  PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
+  free(scratch);
+  Py_DECREF(gradients);
+  if (PyErr_Occurred())
+    return NULL;
+  Py_INCREF(Py_None);
+  return Py_None;
+
+  /* Clean up and return error */
+error:
+  PyTrajectory_OutputFinish(output, i, 1, 1, data_descriptors);
+error2:
+  free(scratch);
+  Py_DECREF(gradients);
+  return NULL;
+}
+
 /*
  * List of functions defined in the module
  */
@@ -554,6 +949,7 @@ error2:
 static PyMethodDef minimization_methods[] = {
   {"steepestDescent", steepestDescent, 1},
   {"conjugateGradient", conjugateGradient, 1},
+  {"lbfgs", lbfgs, 1},
   {NULL, NULL}		/* sentinel */
 };
 
@@ -10,6 +10,16 @@
 #include <time.h>
 #include <limits.h>
 
+/* Asynchronous trajectory output requires POSIX threads */
+
+#ifdef WITH_THREAD
+#include "pythread.h"
+#ifdef _POSIX_THREADS
+#include <pthread.h>
+#define ASYNC_OUTPUT 1
+#endif
+#endif
+
 /* Names of standard dimensions */
 
 char *step_number = "step_number";
@@ -39,10 +49,13 @@ static PyTrajectory_DataClassName class_names[] = {
   {"temperature", PyTrajectory_Thermodynamic},
   {"time", PyTrajectory_Time},
   {"auxiliary", PyTrajectory_Auxiliary},
+  {"performance", PyTrajectory_Performance},
   {NULL, 0}
 };
 
 
+static int async_drain(void *writer);
+
 /* Destroy trajectory object */
 
 static void
@@ -76,6 +89,11 @@ trajectory_close(PyTrajectoryObject *self, PyObject *args)
 {
   if (!PyArg_ParseTuple(args, ""))
     return NULL;
+  if (self->writer != NULL) {
+    PyErr_SetString(PyExc_ValueError,
+		    "trajectory is in use for asynchronous output");
+    return NULL;
+  }
   if (PyTrajectory_Close(self) == 0) {
     Py_INCREF(Py_None);
     return Py_None;
@@ -97,6 +115,8 @@ trajectory_flush(PyTrajectoryObject *self, PyObject *args)
 {
   if (!PyArg_ParseTuple(args, ""))
     return NULL;
+  if (self->writer != NULL && async_drain(self->writer) == -1)
+    return NULL;
   if (PyTrajectory_Flush(self) == 0) {
     Py_INCREF(Py_None);
     return Py_None;
@@ -196,7 +216,26 @@ PyTrajectory_ReadParticleVector(PyTrajectoryObject *trajectory,
     Py_DECREF(data);
     return NULL;
   }
-  if (data->descr->type_num == PyArray_DOUBLE) {
+  if (trajectory->index_map != NULL) {
+    long *map = (long *)trajectory->index_map->data;
+    double *d = (double *)ret->data;
+    int j;
+    for (i = 0; i < 3*trajectory->natoms; i++)
+      d[i] = undefined;
+    if (data->descr->type_num == PyArray_DOUBLE) {
+      double *s = (double *)data->data;
+      for (i = 0; i < trajectory->trajectory_atoms; i++)
+	for (j = 0; j < 3; j++)
+	  d[3*map[i]+j] = s[3*i+j];
+    }
+    else {
+      float *s = (float *)data->data;
+      for (i = 0; i < trajectory->trajectory_atoms; i++)
+	for (j = 0; j < 3; j++)
+	  d[3*map[i]+j] = (double)s[3*i+j];
+    }
+  }
+  else if (data->descr->type_num == PyArray_DOUBLE) {
     double *s = (double *)data->data;
     double *d = (double *)ret->data;
     for (i = 0; i < 3*trajectory->trajectory_atoms; i++)
@@ -864,6 +903,81 @@ verify_description(char *d1, char *d2)
   return 1;
 }
 
+/* Allocate the buffers for conversion and subset selection during output */
+
+static int
+allocate_write_buffers(PyTrajectoryObject *self)
+{
+#if defined(NUMPY)
+  npy_intp dim[2];
+#else
+  int dim[2];
+#endif
+  Py_XDECREF(self->sbuffer);
+  Py_XDECREF(self->vbuffer);
+  self->sbuffer = NULL;
+  self->vbuffer = NULL;
+  if (self->index_map != NULL)
+    dim[0] = self->index_map->dimensions[0];
+  else
+    dim[0] = self->natoms;
+  dim[1] = 3;
+#if defined(NUMPY)
+  self->vbuffer = (PyArrayObject *)PyArray_SimpleNew(2, dim, self->floattype);
+#else
+  self->vbuffer = (PyArrayObject *)PyArray_FromDims(2, dim, self->floattype);
+#endif
+  if (self->vbuffer == NULL)
+    return -1;
+#if defined(NUMPY)
+  self->sbuffer = (PyArrayObject *)PyArray_SimpleNewFromData(1, dim,
+				       self->floattype, self->vbuffer->data);
+#else
+  self->sbuffer = (PyArrayObject *)PyArray_FromDimsAndData(1, dim,
+				       self->floattype, self->vbuffer->data);
+#endif
+  if (self->sbuffer == NULL)
+    return -1;
+  return 0;
+}
+
+/* Read the atom index map of a trajectory that stores only a subset
+   of the atoms in the universe. */
+
+static int
+read_atom_index(PyTrajectoryObject *self)
+{
+  PyNetCDFVariableObject *index_var;
+  PyNetCDFIndex *indices;
+  PyArrayObject *data;
+  long *map;
+  int i;
+
+  index_var = PyNetCDFFile_GetVariable(self->file, "atom_index");
+  if (index_var == NULL) {
+    PyErr_Clear();
+    return 0;
+  }
+  indices = PyNetCDFVariable_Indices(index_var);
+  if (indices == NULL)
+    return -1;
+  data = PyNetCDFVariable_ReadAsArray(index_var, indices);
+  if (data == NULL)
+    return -1;
+  self->index_map = (PyArrayObject *)PyArray_Cast(data, PyArray_LONG);
+  Py_DECREF(data);
+  if (self->index_map == NULL)
+    return -1;
+  map = (long *)self->index_map->data;
+  for (i = 0; i < self->index_map->dimensions[0]; i++)
+    if (map[i] < 0 || map[i] >= self->natoms) {
+      PyErr_SetString(PyExc_ValueError,
+		      "atom index in trajectory file out of range");
+      return -1;
+    }
+  return 0;
+}
+
 /* Create a trajectory object */
 
 static PyTrajectoryObject *
@@ -906,6 +1020,7 @@ PyTrajectory_Open(PyObject *universe, PyObject *description,
   self->sbuffer = NULL;
   self->vbuffer = NULL;
   self->box_buffer = NULL;
+  self->writer = NULL;
   self->floattype = floattype;
   self->trajectory_atoms = (index_map == NULL) ? self->natoms
                                                : index_map->dimensions[0];
@@ -920,34 +1035,9 @@ PyTrajectory_Open(PyObject *universe, PyObject *description,
   Py_INCREF(self->file);
 
   if ((self->index_map != NULL || floattype != PyArray_DOUBLE)
-       && mode[0] != 'r') {
-#if defined(NUMPY)
-    npy_intp dim[2];
-#else
-    int dim[2];
-#endif
-    if (self->index_map != NULL)
-      dim[0] = self->index_map->dimensions[0];
-    else
-      dim[0] = self->natoms;
-    dim[1] = 3;
-#if defined(NUMPY)
-    self->vbuffer = (PyArrayObject *)PyArray_SimpleNew(2, dim, floattype);
-#else
-    self->vbuffer = (PyArrayObject *)PyArray_FromDims(2, dim, floattype);
-#endif
-    if (self->vbuffer == NULL)
-      goto error;
-#if defined(NUMPY)
-    self->sbuffer = (PyArrayObject *)PyArray_SimpleNewFromData(1, dim,
-					 floattype, self->vbuffer->data);
-#else
-    self->sbuffer = (PyArrayObject *)PyArray_FromDimsAndData(1, dim,
-					 floattype, self->vbuffer->data);
-#endif
-    if (self->sbuffer == NULL)
-      goto error;
-  }
+       && mode[0] != 'r'
+       && allocate_write_buffers(self) == -1)
+    goto error;
 
   self->first_step = 0;
   self->var_step = PyNetCDFFile_GetVariable(self->file, "step");
@@ -1081,6 +1171,13 @@ PyTrajectory_Open(PyObject *universe, PyObject *description,
     if (n_ob == NULL)
       goto error;
     self->trajectory_atoms = PyInt_AsLong(n_ob);
+    if (self->index_map == NULL) {
+      if (read_atom_index(self) == -1)
+	goto error;
+      if (self->index_map != NULL && mode[0] != 'r'
+	  && allocate_write_buffers(self) == -1)
+	goto error;
+    }
     description_var = PyNetCDFFile_GetVariable(self->file, "description");
     if (description_var != NULL) {
       PyStringObject *traj_description =
@@ -1141,6 +1238,736 @@ Trajectory(PyObject *self, PyObject *args)
 enum PySpec_TYPE {PySpec_None, PySpec_Trajectory, PySpec_Print,
 		  PySpec_Function};
 
+/* Write one step to a trajectory file. The caller must hold the
+   global interpreter lock. */
+
+static int
+write_step(PyTrajectoryOutputSpec *spec, int step, PyTrajectoryVariable *data)
+{
+  PyTrajectoryObject *trajectory = (PyTrajectoryObject *)spec->destination;
+  PyTrajectoryVariable *var;
+  PyObject **tvar;
+  clock_t cpu_time;
+  int i;
+
+  if (PyTrajectory_Step(trajectory, step) == -1)
+    return -1;
+  for (var = data, tvar = spec->variables; var->name != NULL; var++, tvar++)
+    if (spec->what & var->class) {
+      PyArrayObject *array;
+      switch (var->type) {
+      case PyTrajectory_Scalar:
+	if (PyTrajectory_WriteFloats(trajectory, *tvar,
+				     var->value.dp, 1) == -1)
+	  return -1;
+	break;
+      case PyTrajectory_ParticleScalar:
+	if (trajectory->index_map != NULL) {
+	  long *indices = (long *)trajectory->index_map->data;
+	  double *source = (double *)var->value.array->data;
+	  if (trajectory->floattype == PyArray_DOUBLE) {
+	    double *dest = (double *)trajectory->sbuffer->data;
+	    for (i = 0; i < trajectory->index_map->dimensions[0]; i++)
+	      dest[i] = source[indices[i]];
+	  }
+	  else {
+	    float *dest = (float *)trajectory->sbuffer->data;
+	    for (i = 0; i < trajectory->index_map->dimensions[0]; i++)
+	      dest[i] = (float)source[indices[i]];
+	  }
+	  array = trajectory->sbuffer;
+	}
+	else {
+	  if (trajectory->floattype == PyArray_DOUBLE)
+	    array = var->value.array;
+	  else {
+	    double *source = (double *)var->value.array->data;
+	    float *dest = (float *)trajectory->sbuffer->data;
+	    int natoms = var->value.array->dimensions[0];
+	    for (i = 0; i < natoms; i++)
+	      dest[i] = (float)source[i];
+	    array = trajectory->sbuffer;
+	  }
+	}
+	if (PyTrajectory_WriteArray(trajectory, *tvar, array) == -1)
+	  return -1;
+	break;
+      case PyTrajectory_ParticleVector:
+	if (trajectory->index_map != NULL) {
+	  long *indices = (long *)trajectory->index_map->data;
+	  vector3 *source = (vector3 *)var->value.array->data;
+	  if (trajectory->floattype == PyArray_DOUBLE) {
+	    vector3 *dest = (vector3 *)trajectory->vbuffer->data;
+	    for (i = 0; i < trajectory->index_map->dimensions[0]; i++){
+	      dest[i][0] = source[indices[i]][0];
+	      dest[i][1] = source[indices[i]][1];
+	      dest[i][2] = source[indices[i]][2];
+	    }
+	  }
+	  else {
+	    float *dest = (float *)trajectory->vbuffer->data;
+	    for (i = 0; i < trajectory->index_map->dimensions[0]; i++){
+	      dest[3*i] = (float)source[indices[i]][0];
+	      dest[3*i+1] = (float)source[indices[i]][1];
+	      dest[3*i+2] = (float)source[indices[i]][2];
+	    }
+	  }
+	  array = trajectory->vbuffer;
+	}
+	else {
+	  if (trajectory->floattype == PyArray_DOUBLE)
+	    array = var->value.array;
+	  else {
+	    vector3 *source = (vector3 *)var->value.array->data;
+	    int natoms = var->value.array->dimensions[0];
+	    float *dest = (float *)trajectory->vbuffer->data;
+	    for (i = 0; i < natoms; i++) {
+	      dest[3*i] = (float)source[i][0];
+	      dest[3*i+1] = (float)source[i][1];
+	      dest[3*i+2] = (float)source[i][2];
+	    }
+	    array = trajectory->vbuffer;
+	  }
+	}
+	if (PyTrajectory_WriteArray(trajectory, *tvar, array) == -1)
+	  return -1;
+	break;
+      case PyTrajectory_BoxSize:
+	if (PyTrajectory_WriteFloats(trajectory, *tvar,
+				     var->value.dp, var->length) == -1)
+	  return -1;
+	break;
+      }
+    }
+  cpu_time = clock();
+  if (trajectory->cycle > 0) {
+    if (PyTrajectory_SetAttribute(trajectory, "last_step",
+				  PyInt_FromLong(trajectory->steps-1)) == -1)
+      return -1;
+    if (PyTrajectory_Flush(trajectory) == -1)
+      return -1;
+  }
+  else if (cpu_time-trajectory->last_flush > 900*CLOCKS_PER_SEC) {
+    if (PyTrajectory_Flush(trajectory) == -1)
+      return -1;
+    trajectory->last_flush = cpu_time;
+  }
+  return 0;
+}
+
+/*
+ * Asynchronous trajectory output. The thread that generates the
+ * trajectory copies the data for each step into a ring buffer,
+ * and a writer thread transfers the data from the buffer to the
+ * trajectory file. When the buffer is full, the generating thread
+ * either waits for the writer or, if requested, drops the step.
+ */
+
+#ifdef ASYNC_OUTPUT
+
+typedef struct {
+  PyTrajectoryOutputSpec *spec;
+  PyTrajectoryVariable **slot_data;  /* variable descriptors for each slot */
+  double *buffer;
+  int *steps;
+  int *offsets, *sizes;  /* position and size of each variable in a slot */
+  int depth, slot_size;
+  int head, tail, count;
+  int drop, dropped;
+  int done, running, error;
+  PyObject *error_type, *error_value, *error_traceback;
+  pthread_mutex_t lock;
+  pthread_cond_t not_empty, not_full;
+} async_writer;
+
+static void
+async_thread(void *arg)
+{
+  async_writer *w = (async_writer *)arg;
+  PyGILState_STATE gstate;
+  int slot;
+
+  while (1) {
+    pthread_mutex_lock(&w->lock);
+    while (w->count == 0 && !w->done)
+      pthread_cond_wait(&w->not_empty, &w->lock);
+    if (w->count == 0) {
+      w->running = 0;
+      pthread_cond_broadcast(&w->not_full);
+      pthread_mutex_unlock(&w->lock);
+      return;
+    }
+    slot = w->tail;
+    pthread_mutex_unlock(&w->lock);
+    if (!w->error) {
+      gstate = PyGILState_Ensure();
+      if (write_step(w->spec, w->steps[slot], w->slot_data[slot]) == -1) {
+	PyErr_Fetch(&w->error_type, &w->error_value, &w->error_traceback);
+	w->error = 1;
+      }
+      PyGILState_Release(gstate);
+    }
+    pthread_mutex_lock(&w->lock);
+    w->tail = (w->tail + 1) % w->depth;
+    w->count--;
+    pthread_cond_broadcast(&w->not_full);
+    pthread_mutex_unlock(&w->lock);
+  }
+}
+
+/* Set the exception raised in the writer thread in the calling thread */
+
+static void
+async_raise(async_writer *w)
+{
+  if (w->error_type != NULL) {
+    PyErr_Restore(w->error_type, w->error_value, w->error_traceback);
+    w->error_type = w->error_value = w->error_traceback = NULL;
+  }
+  else
+    PyErr_SetString(PyExc_IOError, "asynchronous trajectory output failed");
+}
+
+static void
+async_free(async_writer *w)
+{
+  int k;
+  PyTrajectoryVariable *var;
+  if (w->slot_data != NULL) {
+    for (k = 0; k < w->depth; k++)
+      if (w->slot_data[k] != NULL) {
+	for (var = w->slot_data[k]; var->name != NULL; var++)
+	  if (w->offsets[var-w->slot_data[k]] >= 0
+	      && (var->type == PyTrajectory_ParticleScalar
+		  || var->type == PyTrajectory_ParticleVector)) {
+	    Py_XDECREF(var->value.array);
+	  }
+	free(w->slot_data[k]);
+      }
+    free(w->slot_data);
+  }
+  free(w->buffer);
+  free(w->steps);
+  free(w->offsets);
+  free(w->sizes);
+  Py_XDECREF(w->error_type);
+  Py_XDECREF(w->error_value);
+  Py_XDECREF(w->error_traceback);
+  free(w);
+}
+
+static int
+async_create(PyTrajectoryOutputSpec *spec, PyTrajectoryVariable *data,
+	     int nvar, int depth, int drop)
+{
+  PyTrajectoryObject *trajectory = (PyTrajectoryObject *)spec->destination;
+  async_writer *w;
+  int i, k;
+
+  if (depth <= 0)
+    return 0;
+  if (trajectory->writer != NULL) {
+    PyErr_SetString(PyExc_ValueError,
+		    "trajectory is already in use for asynchronous output");
+    return -1;
+  }
+  w = (async_writer *)calloc(1, sizeof(async_writer));
+  if (w == NULL) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  w->spec = spec;
+  w->depth = depth;
+  w->drop = drop;
+  w->offsets = (int *)malloc(nvar*sizeof(int));
+  w->sizes = (int *)malloc(nvar*sizeof(int));
+  w->steps = (int *)malloc(depth*sizeof(int));
+  w->slot_data = (PyTrajectoryVariable **)
+                   calloc(depth, sizeof(PyTrajectoryVariable *));
+  if (w->offsets == NULL || w->sizes == NULL || w->steps == NULL
+      || w->slot_data == NULL)
+    goto memory_error;
+  w->slot_size = 0;
+  for (i = 0; i < nvar; i++) {
+    w->offsets[i] = -1;
+    w->sizes[i] = 0;
+    if (!(spec->what & data[i].class))
+      continue;
+    switch (data[i].type) {
+    case PyTrajectory_Scalar:
+      w->sizes[i] = 1;
+      break;
+    case PyTrajectory_BoxSize:
+      w->sizes[i] = data[i].length;
+      break;
+    case PyTrajectory_ParticleScalar:
+      w->sizes[i] = data[i].value.array->dimensions[0];
+      break;
+    case PyTrajectory_ParticleVector:
+      w->sizes[i] = 3*data[i].value.array->dimensions[0];
+      break;
+    default:
+      continue;
+    }
+    w->offsets[i] = w->slot_size;
+    w->slot_size += w->sizes[i];
+  }
+  w->buffer = (double *)malloc(depth*w->slot_size*sizeof(double));
+  if (w->buffer == NULL)
+    goto memory_error;
+  for (k = 0; k < depth; k++) {
+    double *slot = w->buffer + k*w->slot_size;
+    PyTrajectoryVariable *vars = (PyTrajectoryVariable *)
+                        malloc((nvar+1)*sizeof(PyTrajectoryVariable));
+    if (vars == NULL)
+      goto memory_error;
+    w->slot_data[k] = vars;
+    memcpy(vars, data, (nvar+1)*sizeof(PyTrajectoryVariable));
+    for (i = 0; i < nvar; i++) {
+      if (w->offsets[i] < 0)
+	continue;
+      if (vars[i].type == PyTrajectory_ParticleScalar
+	  || vars[i].type == PyTrajectory_ParticleVector) {
+	PyArrayObject *array = data[i].value.array;
+#if defined(NUMPY)
+	vars[i].value.array = (PyArrayObject *)
+	  PyArray_SimpleNewFromData(array->nd, array->dimensions,
+				    PyArray_DOUBLE, slot + w->offsets[i]);
+#else
+	vars[i].value.array = (PyArrayObject *)
+	  PyArray_FromDimsAndData(array->nd, array->dimensions,
+				  PyArray_DOUBLE,
+				  (char *)(slot + w->offsets[i]));
+#endif
+	if (vars[i].value.array == NULL) {
+	  /* Mark the remaining array variables of this slot as unused
+	     before cleaning up */
+	  for (; i < nvar; i++)
+	    w->offsets[i] = -1;
+	  async_free(w);
+	  return -1;
+	}
+      }
+      else
+	vars[i].value.dp = slot + w->offsets[i];
+    }
+  }
+  if (pthread_mutex_init(&w->lock, NULL) != 0
+      || pthread_cond_init(&w->not_empty, NULL) != 0
+      || pthread_cond_init(&w->not_full, NULL) != 0) {
+    PyErr_SetString(PyExc_OSError, "couldn't initialize output thread");
+    async_free(w);
+    return -1;
+  }
+  PyEval_InitThreads();
+  w->running = 1;
+  if (PyThread_start_new_thread(async_thread, (void *)w) == -1) {
+    PyErr_SetString(PyExc_OSError, "couldn't start output thread");
+    pthread_mutex_destroy(&w->lock);
+    pthread_cond_destroy(&w->not_empty);
+    pthread_cond_destroy(&w->not_full);
+    async_free(w);
+    return -1;
+  }
+  spec->writer = (void *)w;
+  trajectory->writer = (void *)w;
+  return 0;
+
+memory_error:
+  PyErr_NoMemory();
+  async_free(w);
+  return -1;
+}
+
+/* Add a step to the buffer. If thread is NULL, the caller holds the
+   global interpreter lock, which is released while waiting. */
+
+static int
+async_put(void *writer, int step, PyTrajectoryVariable *data,
+	  PyThreadState **thread)
+{
+  async_writer *w = (async_writer *)writer;
+  PyThreadState *save = NULL;
+  PyTrajectoryVariable *var;
+  double *slot;
+  int i, error;
+
+  if (thread == NULL)
+    save = PyEval_SaveThread();
+  pthread_mutex_lock(&w->lock);
+  while (w->count == w->depth && !w->drop && !w->error)
+    pthread_cond_wait(&w->not_full, &w->lock);
+  error = w->error;
+  if (!error && w->count == w->depth) {
+    w->dropped++;
+    pthread_mutex_unlock(&w->lock);
+    if (thread == NULL)
+      PyEval_RestoreThread(save);
+    return 0;
+  }
+  pthread_mutex_unlock(&w->lock);
+  if (!error) {
+    /* The slot at the head is not accessed by the writer thread
+       while the buffer isn't full, so no locking is needed for
+       copying the data. */
+    slot = w->buffer + w->head*w->slot_size;
+    for (var = data, i = 0; var->name != NULL; var++, i++) {
+      double *source;
+      if (w->offsets[i] < 0)
+	continue;
+      if (var->type == PyTrajectory_ParticleScalar
+	  || var->type == PyTrajectory_ParticleVector)
+	source = (double *)var->value.array->data;
+      else
+	source = var->value.dp;
+      memcpy(slot + w->offsets[i], source, w->sizes[i]*sizeof(double));
+    }
+    pthread_mutex_lock(&w->lock);
+    w->steps[w->head] = step;
+    w->head = (w->head + 1) % w->depth;
+    w->count++;
+    pthread_cond_signal(&w->not_empty);
+    pthread_mutex_unlock(&w->lock);
+  }
+  if (thread == NULL)
+    PyEval_RestoreThread(save);
+  if (error) {
+    if (thread != NULL)
+      PyEval_RestoreThread(*thread);
+    async_raise(w);
+    if (thread != NULL)
+      *thread = PyEval_SaveThread();
+    return -1;
+  }
+  return 0;
+}
+
+/* Wait until all buffered steps have been written. The caller must hold
+   the global interpreter lock. */
+
+static int
+async_drain(void *writer)
+{
+  async_writer *w = (async_writer *)writer;
+  int error;
+  Py_BEGIN_ALLOW_THREADS;
+  pthread_mutex_lock(&w->lock);
+  while (w->count > 0 && !w->error)
+    pthread_cond_wait(&w->not_full, &w->lock);
+  error = w->error;
+  pthread_mutex_unlock(&w->lock);
+  Py_END_ALLOW_THREADS;
+  if (error) {
+    async_raise(w);
+    return -1;
+  }
+  return 0;
+}
+
+/* Write all remaining steps, stop the writer thread, and release
+   the buffer. The caller must hold the global interpreter lock. */
+
+static void
+async_finish(PyTrajectoryOutputSpec *spec)
+{
+  async_writer *w = (async_writer *)spec->writer;
+  PyTrajectoryObject *trajectory = (PyTrajectoryObject *)spec->destination;
+  Py_BEGIN_ALLOW_THREADS;
+  pthread_mutex_lock(&w->lock);
+  w->done = 1;
+  pthread_cond_signal(&w->not_empty);
+  while (w->running)
+    pthread_cond_wait(&w->not_full, &w->lock);
+  pthread_mutex_unlock(&w->lock);
+  Py_END_ALLOW_THREADS;
+  /* An error of the writer thread is left set for the caller */
+  if (w->error_type != NULL && !PyErr_Occurred())
+    async_raise(w);
+  if (w->dropped > 0)
+    PyTrajectory_SetAttribute(trajectory, "dropped_steps",
+			      PyInt_FromLong(w->dropped));
+  pthread_mutex_destroy(&w->lock);
+  pthread_cond_destroy(&w->not_empty);
+  pthread_cond_destroy(&w->not_full);
+  async_free(w);
+  spec->writer = NULL;
+  trajectory->writer = NULL;
+}
+
+#else
+
+/* Without thread support, output is always synchronous */
+
+static int
+async_create(PyTrajectoryOutputSpec *spec, PyTrajectoryVariable *data,
+	     int nvar, int depth, int drop)
+{
+  return 0;
+}
+
+static int
+async_put(void *writer, int step, PyTrajectoryVariable *data,
+	  PyThreadState **thread)
+{
+  return 0;
+}
+
+static int
+async_drain(void *writer)
+{
+  return 0;
+}
+
+static void
+async_finish(PyTrajectoryOutputSpec *spec)
+{
+}
+
+#endif
+
+/* Registry of trajectory functions that can be called without the
+   global interpreter lock. Initialization (step -1) and cleanup
+   (step -2) are always done with the lock held. */
+
+#define MAX_NOGIL_FUNCTIONS 64
+
+static trajectory_fn *nogil_functions[MAX_NOGIL_FUNCTIONS];
+static int n_nogil_functions = 0;
+
+static int
+PyTrajectory_RegisterFunction(trajectory_fn *function)
+{
+  int i;
+  for (i = 0; i < n_nogil_functions; i++)
+    if (nogil_functions[i] == function)
+      return 0;
+  if (n_nogil_functions == MAX_NOGIL_FUNCTIONS)
+    return -1;
+  nogil_functions[n_nogil_functions++] = function;
+  return 0;
+}
+
+static int
+is_nogil_function(trajectory_fn *function)
+{
+  int i;
+  for (i = 0; i < n_nogil_functions; i++)
+    if (nogil_functions[i] == function)
+      return 1;
+  return 0;
+}
+
+/* Batched Python actions: at each step, the values of the requested
+   variables are copied into arrays holding batch_size steps, without
+   the global interpreter lock. When the arrays are full, and at the
+   end of the trajectory, the Python function is called with the step
+   numbers and a dictionary of the arrays (or views of their filled
+   part). The parameters are a tuple (function, names, batch_size). */
+
+typedef struct {
+  PyObject *function;
+  PyTrajectoryVariable **variables;
+  PyArrayObject **arrays;
+  PyArrayObject *steps;
+  int nvars;
+  int batch_size;
+  int count;
+} batch_data;
+
+static PyObject *
+batch_view(PyArrayObject *array, int count, int batch_size)
+{
+  if (count == batch_size) {
+    Py_INCREF(array);
+    return (PyObject *)array;
+  }
+  return PySequence_GetSlice((PyObject *)array, 0, count);
+}
+
+static int
+batch_call(batch_data *b)
+{
+  PyObject *data, *steps, *view, *result;
+  int i;
+
+  if (b->count == 0)
+    return 1;
+  data = PyDict_New();
+  if (data == NULL)
+    return 0;
+  for (i = 0; i < b->nvars; i++) {
+    view = batch_view(b->arrays[i], b->count, b->batch_size);
+    if (view == NULL
+	|| PyDict_SetItemString(data, b->variables[i]->name, view) == -1) {
+      Py_XDECREF(view);
+      Py_DECREF(data);
+      return 0;
+    }
+    Py_DECREF(view);
+  }
+  steps = batch_view(b->steps, b->count, b->batch_size);
+  if (steps == NULL) {
+    Py_DECREF(data);
+    return 0;
+  }
+  b->count = 0;
+  result = PyObject_CallFunctionObjArgs(b->function, steps, data, NULL);
+  Py_DECREF(steps);
+  Py_DECREF(data);
+  if (result == NULL)
+    return 0;
+  Py_DECREF(result);
+  return 1;
+}
+
+static void
+batch_free(batch_data *b)
+{
+  int i;
+  if (b == NULL)
+    return;
+  if (b->arrays != NULL)
+    for (i = 0; i < b->nvars; i++)
+      Py_XDECREF(b->arrays[i]);
+  Py_XDECREF(b->steps);
+  Py_XDECREF(b->function);
+  free(b->arrays);
+  free(b->variables);
+  free(b);
+}
+
+static int
+batch_function(PyTrajectoryVariable *dynamic_data, PyObject *parameters,
+	       int step, void **scratch, PyObject *universe)
+{
+  batch_data *b = (batch_data *)*scratch;
+  int i;
+
+  if (step == -1) {  /* Initialization */
+    PyObject *names;
+#if defined(NUMPY)
+    npy_intp dim[3];
+#else
+    int dim[3];
+#endif
+    b = (batch_data *)malloc(sizeof(batch_data));
+    *scratch = (void *)b;
+    if (b == NULL) {
+      PyErr_NoMemory();
+      return 0;
+    }
+    b->function = PyTuple_GetItem(parameters, (Py_ssize_t)0);
+    Py_INCREF(b->function);
+    names = PyTuple_GetItem(parameters, (Py_ssize_t)1);
+    b->batch_size = PyInt_AsLong(PyTuple_GetItem(parameters, (Py_ssize_t)2));
+    b->nvars = PyTuple_Size(names);
+    b->count = 0;
+    b->steps = NULL;
+    b->variables = (PyTrajectoryVariable **)
+                   malloc(b->nvars*sizeof(PyTrajectoryVariable *));
+    b->arrays = (PyArrayObject **)calloc(b->nvars, sizeof(PyArrayObject *));
+    if (b->variables == NULL || b->arrays == NULL) {
+      PyErr_NoMemory();
+      return 0;
+    }
+    dim[0] = b->batch_size;
+#if defined(NUMPY)
+    b->steps = (PyArrayObject *)PyArray_SimpleNew(1, dim, PyArray_LONG);
+#else
+    b->steps = (PyArrayObject *)PyArray_FromDims(1, dim, PyArray_LONG);
+#endif
+    if (b->steps == NULL)
+      return 0;
+    for (i = 0; i < b->nvars; i++) {
+      char *name = PyString_AsString(PyTuple_GetItem(names, (Py_ssize_t)i));
+      PyTrajectoryVariable *var;
+      int nd = 1;
+      if (name == NULL)
+	return 0;
+      for (var = dynamic_data; var->name != NULL; var++)
+	if (strcmp(var->name, name) == 0)
+	  break;
+      if (var->name == NULL) {
+	PyErr_Format(PyExc_ValueError, "variable %s is not available", name);
+	return 0;
+      }
+      b->variables[i] = var;
+      switch (var->type) {
+      case PyTrajectory_ParticleScalar:
+	dim[1] = var->value.array->dimensions[0];
+	nd = 2;
+	break;
+      case PyTrajectory_ParticleVector:
+	dim[1] = var->value.array->dimensions[0];
+	dim[2] = 3;
+	nd = 3;
+	break;
+      case PyTrajectory_BoxSize:
+	dim[1] = var->length;
+	nd = 2;
+	break;
+      }
+#if defined(NUMPY)
+      b->arrays[i] = (PyArrayObject *)PyArray_SimpleNew(nd, dim,
+							PyArray_DOUBLE);
+#else
+      b->arrays[i] = (PyArrayObject *)PyArray_FromDims(nd, dim,
+						       PyArray_DOUBLE);
+#endif
+      if (b->arrays[i] == NULL)
+	return 0;
+    }
+  }
+
+  else if (step == -2) {  /* Last batch and clean up */
+    int ok = 1;
+    if (b != NULL && b->steps != NULL && !PyErr_Occurred())
+      ok = batch_call(b);
+    batch_free(b);
+    *scratch = NULL;
+    return ok;
+  }
+
+  else {  /* Store the current values */
+    ((long *)b->steps->data)[b->count] = step;
+    for (i = 0; i < b->nvars; i++) {
+      PyTrajectoryVariable *var = b->variables[i];
+      double *data = (double *)b->arrays[i]->data;
+      int n;
+      switch (var->type) {
+      case PyTrajectory_Scalar:
+	data[b->count] = *var->value.dp;
+	break;
+      case PyTrajectory_IntScalar:
+	data[b->count] = *var->value.ip;
+	break;
+      case PyTrajectory_BoxSize:
+	memcpy(data + b->count*var->length, var->value.dp,
+	       var->length*sizeof(double));
+	break;
+      default:
+	n = var->value.array->dimensions[0];
+	if (var->type == PyTrajectory_ParticleVector)
+	  n *= 3;
+	memcpy(data + b->count*n, var->value.array->data, n*sizeof(double));
+      }
+    }
+    b->count++;
+    if (b->count == b->batch_size) {
+      int ok;
+#ifdef WITH_THREAD
+      PyGILState_STATE gstate = PyGILState_Ensure();
+#endif
+      ok = batch_call(b);
+#ifdef WITH_THREAD
+      PyGILState_Release(gstate);
+#endif
+      return ok;
+    }
+  }
+  return 1;
+}
+
 /* Preprocess an output specification */
 
 static int
@@ -1161,6 +1988,8 @@ get_spec(PyObject *universe, PyObject *spec,
   output->destination = NULL;
   output->parameters = NULL;
   output->scratch = NULL;
+  output->writer = NULL;
+  output->nogil = 0;
 
   if (type != PySpec_Function) {
 
@@ -1238,6 +2067,16 @@ get_spec(PyObject *universe, PyObject *spec,
 	}
       }
     }
+    if (PyTuple_Size(spec) > 6) {
+      int depth, drop;
+      if (!PyArg_ParseTuple(PyTuple_GetItem(spec, (Py_ssize_t)6), "ii",
+			    &depth, &drop)
+	  || async_create(output, data, nvar, depth, drop) == -1) {
+	Py_DECREF(output->destination);
+	free(output->variables);
+	return -1;
+      }
+    }
 
   }
 
@@ -1268,6 +2107,7 @@ get_spec(PyObject *universe, PyObject *spec,
 							   (Py_ssize_t)4));
     output->parameters = PyTuple_GetItem(spec, (Py_ssize_t)5);
     Py_INCREF(output->parameters);
+    output->nogil = is_nogil_function(output->function);
     if (!output->function(data, output->parameters, -1,
 			  &output->scratch, output->universe))
       return -1;
@@ -1344,6 +2184,8 @@ PyTrajectory_OutputFinish(PyTrajectoryOutputSpec *spec, int step,
   while (spec->type != PySpec_None) {
     if (spec->type == PySpec_Trajectory) {
       char *text;
+      if (spec->writer != NULL)
+	async_finish(spec);
       PyTrajectory_Flush((PyTrajectoryObject *)spec->destination);
       if (error_flag) {
 	if (PyErr_CheckSignals())
@@ -1359,6 +2201,7 @@ PyTrajectory_OutputFinish(PyTrajectoryOutputSpec *spec, int step,
       free(spec->variables);
     }
     if (spec->type == PySpec_Function) {
+      /* A failing function leaves its exception set for the caller */
       spec->function(data, spec->parameters, -2,
 		     &spec->scratch, spec->universe);
     }
@@ -1455,152 +2298,39 @@ PyTrajectory_Output(PyTrajectoryOutputSpec *spec, int step,
       if (spec->type == PySpec_Trajectory) {
 	PyTrajectoryObject *trajectory =
 	  (PyTrajectoryObject *)spec->destination;
-	PyObject **tvar;
-	clock_t cpu_time;
 	if (trajectory->cycle > 0 && step < 0)
 	  step = -step;
-	if (step >= 0) {
+	if (step >= 0 && spec->writer != NULL) {
+	  if (async_put(spec->writer, step, data, thread) == -1)
+	    return -1;
+	}
+	else if (step >= 0) {
 	  if (thread != NULL)
 	    PyEval_RestoreThread(*thread);
-	  if (PyTrajectory_Step(trajectory, step) == -1) {
+	  if (write_step(spec, step, data) == -1) {
             if (thread != NULL)
               *thread = PyEval_SaveThread();
 	    return -1;
           }
-	  for (var = data, tvar = spec->variables; var->name != NULL;
-	       var++, tvar++)
-	    if (spec->what & var->class) {
-	      PyArrayObject *array;
-	      switch (var->type) {
-	      case PyTrajectory_Scalar:
-		if (PyTrajectory_WriteFloats(trajectory, *tvar,
-					     var->value.dp, 1) == -1) {
-                  if (thread != NULL)
-                    *thread = PyEval_SaveThread();
-		  return -1;
-                }
-		break;
-	      case PyTrajectory_ParticleScalar:
-		if (trajectory->index_map != NULL) {
-		  int i;
-		  long *indices = (long *)trajectory->index_map->data;
-		  double *source = (double *)var->value.array->data;
-		  if (trajectory->floattype == PyArray_DOUBLE) {
-		    double *dest = (double *)trajectory->sbuffer->data;
-		    for (i = 0; i < trajectory->index_map->dimensions[0]; i++)
-		      dest[i] = source[indices[i]];
-		  }
-		  else {
-		    float *dest = (float *)trajectory->sbuffer->data;
-		    for (i = 0; i < trajectory->index_map->dimensions[0]; i++)
-		      dest[i] = (float)source[indices[i]];
-		  }
-		  array = trajectory->sbuffer;
-		}
-		else {
-		  if (trajectory->floattype == PyArray_DOUBLE)
-		    array = var->value.array;
-		  else {
-		    double *source = (double *)var->value.array->data;
-		    float *dest = (float *)trajectory->sbuffer->data;
-		    int natoms = var->value.array->dimensions[0];
-		    int i;
-		    for (i = 0; i < natoms; i++)
-		      dest[i] = (float)source[i];
-		    array = trajectory->sbuffer;
-		  }
-		}
-		if (PyTrajectory_WriteArray(trajectory, *tvar, array) == -1) {
-                  if (thread != NULL)
-                    *thread = PyEval_SaveThread();
-		  return -1;
-                }
-		break;
-	      case PyTrajectory_ParticleVector:
-		if (trajectory->index_map != NULL) {
-		  int i;
-		  long *indices = (long *)trajectory->index_map->data;
-		  vector3 *source = (vector3 *)var->value.array->data;
-		  if (trajectory->floattype == PyArray_DOUBLE) {
-		    vector3 *dest = (vector3 *)trajectory->vbuffer->data;
-		    for (i = 0; i < trajectory->index_map->dimensions[0]; i++){
-		      dest[i][0] = source[indices[i]][0];
-		      dest[i][1] = source[indices[i]][1];
-		      dest[i][2] = source[indices[i]][2];
-		    }
-		  }
-		  else {
-		    float *dest = (float *)trajectory->vbuffer->data;
-		    for (i = 0; i < trajectory->index_map->dimensions[0]; i++){
-		      dest[3*i] = (float)source[indices[i]][0];
-		      dest[3*i+1] = (float)source[indices[i]][1];
-		      dest[3*i+2] = (float)source[indices[i]][2];
-		    }
-		  }
-		  array = trajectory->vbuffer;
-		}
-		else {
-		  if (trajectory->floattype == PyArray_DOUBLE)
-		    array = var->value.array;
-		  else {
-		    vector3 *source = (vector3 *)var->value.array->data;
-		    int natoms = var->value.array->dimensions[0];
-		    float *dest = (float *)trajectory->vbuffer->data;
-		    int i;
-		    for (i = 0; i < natoms; i++) {
-		      dest[3*i] = (float)source[i][0];
-		      dest[3*i+1] = (float)source[i][1];
-		      dest[3*i+2] = (float)source[i][2];
-		    }
-		    array = trajectory->vbuffer;
-		  }
-		}
-		if (PyTrajectory_WriteArray(trajectory, *tvar, array) == -1) {
-                  if (thread != NULL)
-                    *thread = PyEval_SaveThread();
-		  return -1;
-                }
-		break;
-	      case PyTrajectory_BoxSize:
-		if (PyTrajectory_WriteFloats(trajectory, *tvar,
-					     var->value.dp, var->length) == -1) {
-                  if (thread != NULL)
-                    *thread = PyEval_SaveThread();
-		  return -1;
-                }
-		break;
-	      }
-	    }
-	  cpu_time = clock();
-	  if (trajectory->cycle > 0) {
-	    if (PyTrajectory_SetAttribute(trajectory, "last_step",
-					  PyInt_FromLong(trajectory->steps-1))
-		== -1) {
-              if (thread != NULL)
-                *thread = PyEval_SaveThread();
-	      return -1;
-            }
-	    if (PyTrajectory_Flush(trajectory) == -1) {
-              if (thread != NULL)
-                *thread = PyEval_SaveThread();
-	      return -1;
-            }
-	  }
-	  else if (cpu_time-trajectory->last_flush > 900*CLOCKS_PER_SEC) {
-	    if (PyTrajectory_Flush(trajectory) == -1) {
-              if (thread != NULL)
-                *thread = PyEval_SaveThread();
-	      return -1;
-            }
-	    trajectory->last_flush = cpu_time;
-	  }
 	  if (PyErr_CheckSignals())
 	    interrupt = -1;
 	  if (thread != NULL)
 	    *thread = PyEval_SaveThread();
 	}
       }
-      if (spec->type == PySpec_Function && step >= 0) {
+      if (spec->type == PySpec_Function && step >= 0 && spec->nogil) {
+	if (!spec->function(data, spec->parameters, step,
+			    &spec->scratch, spec->universe)) {
+	  if (thread != NULL)
+	    PyEval_RestoreThread(*thread);
+	  if (!PyErr_Occurred())
+	    PyErr_SetString(PyExc_RuntimeError, "trajectory function failed");
+	  interrupt = -1;
+	  if (thread != NULL)
+	    *thread = PyEval_SaveThread();
+	}
+      }
+      else if (spec->type == PySpec_Function && step >= 0) {
 	if (thread != NULL)
 	  PyEval_RestoreThread(*thread);
 	if (!spec->function(data, spec->parameters, step,
@@ -1784,6 +2514,8 @@ snapshot(PyObject *dummy, PyObject *args)
     if (v->type == PyTrajectory_Scalar)
       free(v->value.dp);
   free(vars);
+  if (PyErr_Occurred())
+    return NULL;
   Py_INCREF(Py_None);
   return Py_None;
 
@@ -1940,9 +2672,16 @@ initMMTK_trajectory(void)
   PyTrajectory_API[PyTrajectory_OutputFinish_NUM] =
     (void *)&PyTrajectory_OutputFinish;
   PyTrajectory_API[PyTrajectory_Output_NUM] = (void *)&PyTrajectory_Output;
+  PyTrajectory_API[PyTrajectory_RegisterFunction_NUM] =
+    (void *)&PyTrajectory_RegisterFunction;
   PyDict_SetItemString(dict, "_C_API",
 		       PyCObject_FromVoidPtr((void *)PyTrajectory_API, NULL));
 
+  /* Batched Python actions */
+  PyTrajectory_RegisterFunction(batch_function);
+  PyDict_SetItemString(dict, "batchFunction",
+		       PyCObject_FromVoidPtr((void *)batch_function, NULL));
+
   /* Define maxint */
   PyDict_SetItemString(dict, "maxint", PyInt_FromLong(INT_MAX));
 
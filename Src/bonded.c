@@ -28,6 +28,12 @@ harmonic_bond_evaluator(PyFFEnergyTermObject *self,
   int last_term = (input->slice_id+1)*nterms;
   double e = 0., v = 0.;
 
+  if (input->atom_owner != NULL) {
+    /* Domain decomposition: each process evaluates the terms whose
+       first atom it owns */
+    term = 0;
+    last_term = self->n;
+  }
   if (last_term > self->n)
     last_term = self->n;
   index += 2*term;
@@ -35,6 +41,11 @@ harmonic_bond_evaluator(PyFFEnergyTermObject *self,
 
   /* Loop over bond terms */
   while (term++ < last_term) {
+    if (!DOMAIN_OWNS(input, index[0])) {
+      index += 2;
+      param += 2;
+      continue;
+    }
     /*
      * E = k (r-r0)^2
      * r = | R_i-R_j |
@@ -106,6 +117,10 @@ harmonic_angle_evaluator(PyFFEnergyTermObject *self,
   int last_term = (input->slice_id+1)*nterms;
   double e = 0.;
 
+  if (input->atom_owner != NULL) {
+    term = 0;
+    last_term = self->n;
+  }
   if (last_term > self->n)
     last_term = self->n;
   index += 3*term;
@@ -113,6 +128,11 @@ harmonic_angle_evaluator(PyFFEnergyTermObject *self,
 
   /* Loop over bond angle terms */
   while (term++ < last_term) {
+    if (!DOMAIN_OWNS(input, index[0])) {
+      index += 3;
+      param += 2;
+      continue;
+    }
     /*
      * E = k (theta-theta0)^2
      * cos theta = (R_i-R_j)*(R_k-R_j)
@@ -358,6 +378,10 @@ cosine_dihedral_evaluator(PyFFEnergyTermObject *self,
   int last_term = (input->slice_id+1)*nterms;
   double e = 0.;
 
+  if (input->atom_owner != NULL) {
+    term = 0;
+    last_term = self->n;
+  }
   if (last_term > self->n)
     last_term = self->n;
   index += 4*term;
@@ -365,6 +389,11 @@ cosine_dihedral_evaluator(PyFFEnergyTermObject *self,
 
   /* Loop over dihedral angle terms */
   while (term++ < last_term) {
+    if (!DOMAIN_OWNS(input, index[0])) {
+      index += 4;
+      param += 4;
+      continue;
+    }
     /*
      * E = V [1 + cos(n phi-gamma)]
      * phi = angle between plane1 and plane2 using the IUPAC sign convention
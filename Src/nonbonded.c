@@ -9,6 +9,9 @@
 
 #include "MMTK/forcefield.h"
 #include "MMTK/forcefield_private.h"
+#ifndef MS_WINDOWS
+#include <sys/time.h>
+#endif
 
 #define THREAD_DEBUG 0
 
@@ -370,6 +373,155 @@ nblist_iterate(PyNonbondedListObject *nblist, struct nblist_iterator *iterator)
   return 0;
 }
 
+/* Work distribution for the nonbonded pair loop
+ *
+ * The units of work in the pair loop are the pairs of neighbouring
+ * boxes of the nonbonded list. When all slices are threads of one
+ * process, each thread handles a contiguous range of box pairs. The
+ * ranges are chosen such that all threads get the same number of
+ * atom pairs, using the pair counts of the previous evaluation, or
+ * the box occupations for a new box layout. Otherwise the atom pairs
+ * are distributed round-robin over the slices, which gives the same
+ * partition on all processes.
+ */
+
+typedef struct {
+  int nitems, nalloc, nthreads;
+  int box_count[3];
+  double *cost;     /* atom pairs per box pair, -1 if unknown */
+  double *pairs;    /* atom pairs handled by each thread */
+  double *seconds;  /* wall clock time of each thread */
+  int *items;       /* box indices, two per box pair */
+  int *first;       /* first box pair of each thread, nthreads+1 values */
+} nb_work_list;
+
+static double
+wall_time(void)
+{
+#ifdef MS_WINDOWS
+  return (double)clock()/CLOCKS_PER_SEC;
+#else
+  struct timeval tv;
+  gettimeofday(&tv, NULL);
+  return tv.tv_sec + 1.e-6*tv.tv_usec;
+#endif
+}
+
+/* Update the list of box pairs after a nonbonded list update,
+   and divide it among the threads. Called by thread 0 only. */
+
+static nb_work_list *
+nblist_work(PyFFEnergyTermObject *self, PyNonbondedListObject *nblist,
+	    int nthreads, int dynamic)
+{
+  nb_work_list *work = (nb_work_list *)self->scratch;
+  int nalloc = nblist->nboxes*nblist->nneighbors;
+  double total, target, sum;
+  int ibox, k, t;
+
+  if (work == NULL || work->nthreads != nthreads
+      || work->box_count[0] != nblist->box_count[0]
+      || work->box_count[1] != nblist->box_count[1]
+      || work->box_count[2] != nblist->box_count[2]
+      || work->nalloc < nalloc) {
+    if (work == NULL || work->nthreads != nthreads || work->nalloc < nalloc) {
+      free(self->scratch);
+      self->scratch = malloc(sizeof(nb_work_list)
+			     + (nalloc+2*nthreads)*sizeof(double)
+			     + (2*nalloc+nthreads+1)*sizeof(int));
+      work = (nb_work_list *)self->scratch;
+      if (work == NULL)
+	return NULL;
+      work->nalloc = nalloc;
+      work->nthreads = nthreads;
+      work->cost = (double *)(work+1);
+      work->pairs = work->cost + nalloc;
+      work->seconds = work->pairs + nthreads;
+      work->items = (int *)(work->seconds + nthreads);
+      work->first = work->items + 2*nalloc;
+      for (t = 0; t < nthreads; t++)
+	work->pairs[t] = work->seconds[t] = 0.;
+    }
+    work->box_count[0] = nblist->box_count[0];
+    work->box_count[1] = nblist->box_count[1];
+    work->box_count[2] = nblist->box_count[2];
+    work->nitems = 0;
+    for (ibox = 0; ibox < nblist->nboxes; ibox++) {
+      nbbox *box1 = &nblist->boxes[ibox];
+      int ineighbor;
+      for (ineighbor = 0; ineighbor < nblist->nneighbors; ineighbor++) {
+	int ix = nblist->neighbors[ineighbor][0]+box1->ix;
+	int iy = nblist->neighbors[ineighbor][1]+box1->iy;
+	int iz = nblist->neighbors[ineighbor][2]+box1->iz;
+	int jbox;
+	if (nblist->universe_spec->is_periodic) {
+	  if (ix < 0) ix += nblist->box_count[0];
+	  if (iy < 0) iy += nblist->box_count[1];
+	  if (iz < 0) iz += nblist->box_count[2];
+	  if (ix >= nblist->box_count[0]) ix -= nblist->box_count[0];
+	  if (iy >= nblist->box_count[1]) iy -= nblist->box_count[1];
+	  if (iz >= nblist->box_count[2]) iz -= nblist->box_count[2];
+	}
+	else if (ix < 0 || iy < 0 || iz < 0
+		 || ix >= nblist->box_count[0]
+		 || iy >= nblist->box_count[1]
+		 || iz >= nblist->box_count[2])
+	  continue;
+	jbox = ix + nblist->box_count[0]*(iy + nblist->box_count[1]*iz);
+	if (jbox < ibox)
+	  continue;
+	work->items[2*work->nitems] = ibox;
+	work->items[2*work->nitems+1] = jbox;
+	work->cost[work->nitems] = -1.;
+	work->nitems++;
+      }
+    }
+  }
+  if (!dynamic)
+    return work;
+
+  /* Cost-weighted partition */
+  total = 0.;
+  for (k = 0; k < work->nitems; k++) {
+    if (work->cost[k] < 0.) {
+      double n1 = nblist->boxes[work->items[2*k]].n;
+      double n2 = nblist->boxes[work->items[2*k+1]].n;
+      work->cost[k] = (work->items[2*k] == work->items[2*k+1]) ?
+	               0.5*n1*(n1-1.) : n1*n2;
+    }
+    total += work->cost[k];
+  }
+  target = total/nthreads;
+  sum = 0.;
+  t = 1;
+  work->first[0] = 0;
+  for (k = 0; k < work->nitems && t < nthreads; k++) {
+    sum += work->cost[k];
+    while (t < nthreads && sum >= t*target)
+      work->first[t++] = k+1;
+  }
+  while (t <= nthreads)
+    work->first[t++] = work->nitems;
+  return work;
+}
+
+/* Load statistics of the threads in the last evaluation */
+
+int
+nonbonded_load(PyFFEnergyTermObject *self, int nthreads,
+	       double *pairs, double *seconds)
+{
+  nb_work_list *work = (nb_work_list *)self->scratch;
+  int t;
+  if (work == NULL || work->nthreads != nthreads)
+    return 0;
+  for (t = 0; t < nthreads; t++) {
+    pairs[t] += work->pairs[t];
+    seconds[t] += work->seconds[t];
+  }
+  return 1;
+}
+
 /* Evaluator for all non-bonded interactions */
 
 #ifdef GRADIENTFN
@@ -565,7 +717,9 @@ nonbonded_evaluator(PyFFEnergyTermObject *self,
   double lj_energy1, lj_energy2, lj_virial1, lj_virial2;
   double es_energy, ewald_energy;
   int lj_flag, es_flag, ewald_flag;
-  int ibox, jbox, slicecounter, k;
+  nb_work_list *work;
+  double start_time, npairs;
+  int slicecounter, k, kfirst, kstep, first_item, last_item, dynamic;
 #if THREAD_DEBUG
   int paircount = 0;
 #endif
@@ -620,75 +774,67 @@ nonbonded_evaluator(PyFFEnergyTermObject *self,
     ewald_one_four = ewald_ev->param[1]-1.;
   }
 
-  if (input->thread_id == 0)
+  /* Threads of a single process share the box pairs according to
+     their cost, otherwise the partition must not depend on data
+     that differs between processes. */
+  dynamic = (input->nprocs == 1 && input->atom_owner == NULL);
+  if (input->thread_id == 0) {
     nblist_update(nblist, input->natoms, (double *)x, distance_data);
+    if (nblist_work(self, nblist, input->nthreads, dynamic) == NULL)
+      energy->error = 1;
+  }
 #ifdef WITH_THREAD
   barrier(eval->binfo+self->barrier_index, input->thread_id, input->nthreads);
 #endif
+  work = (nb_work_list *)self->scratch;
 
   if (!(lj_flag || es_flag || ewald_flag))
     return;
 
+  if (work == NULL)
+    return;
+  if (dynamic) {
+    first_item = work->first[input->thread_id];
+    last_item = work->first[input->thread_id+1];
+  }
+  else {
+    first_item = 0;
+    last_item = work->nitems;
+  }
+  start_time = wall_time();
+  npairs = 0.;
   slicecounter = input->nslices-input->slice_id;
-  for (ibox = 0; ibox < nblist->nboxes; ibox++) {
-    nbbox *box1 = &nblist->boxes[ibox];
-    int ineighbor;
-    
-    for (ineighbor = 0; ineighbor < nblist->nneighbors; ineighbor++) {
-      int ix = nblist->neighbors[ineighbor][0]+box1->ix;
-      int iy = nblist->neighbors[ineighbor][1]+box1->iy;
-      int iz = nblist->neighbors[ineighbor][2]+box1->iz;
-      nbbox *box2;
-      int i, j;
-      if (nblist->universe_spec->is_periodic) {
-	if (ix < 0) ix += nblist->box_count[0];
-	if (iy < 0) iy += nblist->box_count[1];
-	if (iz < 0) iz += nblist->box_count[2];
-	if (ix >= nblist->box_count[0]) ix -= nblist->box_count[0];
-	if (iy >= nblist->box_count[1]) iy -= nblist->box_count[1];
-	if (iz >= nblist->box_count[2]) iz -= nblist->box_count[2];
-      }
-      else if (ix < 0 || iy < 0 || iz < 0
-	       || ix >= nblist->box_count[0]
-	       || iy >= nblist->box_count[1]
-	       || iz >= nblist->box_count[2])
-	continue;
-      jbox = ix + nblist->box_count[0]*(iy + nblist->box_count[1]*iz);
-      if (jbox < ibox)
-	continue;
-      box2 = &nblist->boxes[jbox];
-      if (ibox == jbox) {
-	for (i = 0; i < box1->n; i++) {
-	  int a1 = box1->atoms[i];
-	  for (j = i+1; j < box2->n; j++) {
-	    int a2 = box2->atoms[j];
-	    if (--slicecounter == 0) {
-	      slicecounter = input->nslices;
-	      pair_term(1., 1., 1.);
-#if THREAD_DEBUG
-	      paircount++;
-#endif
-	    }
-	  }
+  for (k = first_item; k < last_item; k++) {
+    nbbox *box1 = &nblist->boxes[work->items[2*k]];
+    nbbox *box2 = &nblist->boxes[work->items[2*k+1]];
+    int item_pairs = 0;
+    int i, j;
+    for (i = 0; i < box1->n; i++) {
+      int a1 = box1->atoms[i];
+      for (j = (box1 == box2) ? i+1 : 0; j < box2->n; j++) {
+	int a2 = box2->atoms[j];
+	if (input->atom_owner != NULL) {
+	  if (!DOMAIN_OWNS_PAIR(input, a1, a2))
+	    continue;
 	}
-      }
-      else {
-	for (i = 0; i < box1->n; i++) {
-	  int a1 = box1->atoms[i];
-	  for (j = 0; j < box2->n; j++) {
-	    int a2 = box2->atoms[j];
-	    if (--slicecounter == 0) {
-	      slicecounter = input->nslices;
-	      pair_term(1., 1., 1.);
-#if THREAD_DEBUG
-	      paircount++;
-#endif
-	    }
-	  }
+	else if (!dynamic) {
+	  if (--slicecounter != 0)
+	    continue;
+	  slicecounter = input->nslices;
 	}
+	pair_term(1., 1., 1.);
+	item_pairs++;
       }
     }
+    if (dynamic)
+      work->cost[k] = item_pairs;
+    npairs += item_pairs;
   }
+  work->pairs[input->thread_id] = npairs;
+  work->seconds[input->thread_id] = wall_time()-start_time;
+#if THREAD_DEBUG
+  paircount = (int)npairs;
+#endif
 #if THREAD_DEBUG
     printf("Slice %d: %d nonbonded pairs\n", input->slice_id, paircount);
 #endif
@@ -697,15 +843,25 @@ nonbonded_evaluator(PyFFEnergyTermObject *self,
   ewald_inv_cutoff = 0.;
   erfc_cutoff = 0.;
   beta = 0.;
-  for (k = 2*input->slice_id; k < n_ex; k += 2*input->nslices) {
+  if (input->atom_owner != NULL) {
+    kfirst = 0;
+    kstep = 2;
+  }
+  else {
+    kfirst = 2*input->slice_id;
+    kstep = 2*input->nslices;
+  }
+  for (k = kfirst; k < n_ex; k += kstep) {
     int a1 = excluded[k];
     int a2 = excluded[k+1];
-    pair_term(-1., -1., -1.);
+    if (DOMAIN_OWNS_PAIR(input, a1, a2))
+      pair_term(-1., -1., -1.);
   }
-  for (k = 2*input->slice_id; k < n_14; k += 2*input->nslices) {
+  for (k = kfirst; k < n_14; k += kstep) {
     int a1 = one_four[k];
     int a2 = one_four[k+1];
-    pair_term(lj_one_four, es_one_four, ewald_one_four);
+    if (DOMAIN_OWNS_PAIR(input, a1, a2))
+      pair_term(lj_one_four, es_one_four, ewald_one_four);
   }
 
   energy->energy_terms[self->index] = lj_energy1 + lj_energy2;
@@ -750,7 +906,8 @@ electrostatic_evaluator(PyFFEnergyTermObject *self,
     double sum = 0.;
     for (k = 0; k < n; k++) {
       int i = (n_sub == 0) ? k : subset[k];
-      sum += sqr(charge[i]);
+      if (DOMAIN_OWNS(input, i))
+	sum += sqr(charge[i]);
     }
     e -= 0.5*inv_cutoff*sum*electrostatic_energy_factor;
     v -= 0.5*inv_cutoff*sum*electrostatic_energy_factor;
@@ -15,6 +15,10 @@ import normal_mode_tests
 import subspace_tests
 import enm_tests
 import internal_coordinate_tests
+import dynamics_tests
+import minimization_tests
+import pdb_tests
+import dcd_tests
 
 def suite():
     test_suite = unittest.TestSuite()
@@ -28,6 +32,10 @@ def suite():
     test_suite.addTests(trajectory_tests.suite())
     test_suite.addTests(enm_tests.suite())
     test_suite.addTests(internal_coordinate_tests.suite())
+    test_suite.addTests(dynamics_tests.suite())
+    test_suite.addTests(minimization_tests.suite())
+    test_suite.addTests(pdb_tests.suite())
+    test_suite.addTests(dcd_tests.suite())
     return test_suite
 
 if __name__ == '__main__':
@@ -46,11 +46,37 @@ class SuperpositionTest(unittest.TestCase):
             self.assert_(abs(abs(N.cos(axis.angle(MMTK.Vector(0., 1., 1.))))-1)
                          < 1.e-5)
 
+
+class HydrogenPositionTest(unittest.TestCase):
+
+    """
+    Compare the batch placement of missing hydrogens with the
+    atom-by-atom construction
+    """
+
+    def test_protein(self):
+        from MMTK import ChemicalObjects
+        protein = Protein('insulin.pdb')
+        batch_methods = ChemicalObjects._h_batch_methods
+        ChemicalObjects._h_batch_methods = {}
+        try:
+            reference = Protein('insulin.pdb')
+        finally:
+            ChemicalObjects._h_batch_methods = batch_methods
+        hydrogens = 0
+        for a1, a2 in zip(protein.atomList(), reference.atomList()):
+            self.assertEqual(a1.fullName(), a2.fullName())
+            if a1.symbol == 'H':
+                hydrogens += 1
+            self.assert_((a1.position()-a2.position()).length() < 1.e-10)
+        self.assert_(hydrogens > 0)
+
 def suite():
     loader = unittest.TestLoader()
     s = unittest.TestSuite()
     s.addTest(loader.loadTestsFromTestCase(GroupOfAtomTest))
     s.addTest(loader.loadTestsFromTestCase(SuperpositionTest))
+    s.addTest(loader.loadTestsFromTestCase(HydrogenPositionTest))
     return s
 
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+# DCD tests
+#
+# Written by Konrad Hinsen
+#
+
+import unittest
+from MMTK import *
+from MMTK.DCD import DCDTrajectory, writeDCD, writeDCDPDB, writePDB, \
+                     writeTrajectoryDCD
+from MMTK.Proteins import Protein
+from MMTK.Trajectory import Trajectory, SnapshotGenerator, TrajectoryOutput
+import MMTK_DCD
+from Scientific import N
+import os, struct
+
+def writeCharmmDCD(filename, frames, cells=None, fixed=0):
+    # Write a CHARMM-style DCD file, which can contain unit cell data
+    # and fixed atoms, neither of which MMTK writes itself.
+    def record(data):
+        marker = struct.pack('i', len(data))
+        return marker + data + marker
+    control = [len(frames), 0, 1, 0, 0, 0, 0, 0, fixed, 0.1/Units.akma_time,
+               int(cells is not None), 0, 0, 0, 0, 0, 0, 0, 0, 24]
+    natoms = frames.shape[1]
+    file = open(filename, 'wb')
+    file.write(record('CORD' + struct.pack('9if10i', *control)))
+    file.write(record(struct.pack('i', 1) + 80*' '))
+    file.write(record(struct.pack('i', natoms)))
+    for i in range(len(frames)):
+        if cells is not None:
+            a, b, c = cells[i]
+            file.write(record(struct.pack('6d', a, 90., b, 90., 90., c)))
+        for j in range(3):
+            data = N.array(frames[i, :, j]).astype(N.Float32)
+            file.write(record(data.tostring()))
+    file.close()
+
+
+class DCDTrajectoryTest(unittest.TestCase):
+
+    """
+    Test reading DCD files through DCDTrajectory
+    """
+
+    def setUp(self):
+        self.universe = InfiniteUniverse()
+        self.universe.addObject(Protein('bala1'))
+        self.configurations = []
+        for i in range(5):
+            self.configurations.append(self.universe.copyConfiguration())
+            self.universe.translateBy(Vector(0.1, -0.05, 0.2))
+            self.universe.rotateAroundOrigin(Vector(0., 0., 1.), 0.3)
+
+    def tearDown(self):
+        for filename in ['test.dcd', 'test.pdb']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def assertSameConfiguration(self, conf1, conf2):
+        d = N.ravel(conf1.array-conf2.array)
+        self.assert_(N.maximum.reduce(N.fabs(d)) < 1.e-5)
+
+    def test_round_trip(self):
+        writeDCD(self.configurations, 'test.dcd', 1./Units.Ang)
+        trajectory = DCDTrajectory(self.universe, 'test.dcd')
+        self.assertEqual(len(trajectory), len(self.configurations))
+        self.assertEqual(list(trajectory.step), range(5))
+        self.assertEqual(trajectory.variables(),
+                         ['configuration', 'time', 'step'])
+        for i in range(len(trajectory)):
+            data = trajectory[i]
+            self.assertEqual(data['step'], i)
+            self.assertSameConfiguration(data['configuration'],
+                                         self.configurations[i])
+            self.assertSameConfiguration(trajectory.configuration[i],
+                                         self.configurations[i])
+        self.assertSameConfiguration(trajectory[-1]['configuration'],
+                                     self.configurations[-1])
+        self.assertRaises(IndexError, lambda: trajectory[5])
+        atom = self.universe.atomList()[3]
+        pt = trajectory.readParticleTrajectory(atom)
+        for i in range(len(trajectory)):
+            self.assert_((pt[i]-self.configurations[i][atom]).length()
+                         < 1.e-5)
+        trajectory.close()
+
+    def test_atom_order(self):
+        # writeDCDPDB stores the atoms in the order of the PDB file
+        writeDCDPDB(self.configurations, 'test.dcd', 'test.pdb')
+        sequence = writePDB(self.universe, self.configurations[0],
+                            'test.pdb')
+        order = [atom.index for atom in sequence]
+        trajectory = DCDTrajectory(self.universe, 'test.dcd', order)
+        for i in range(len(trajectory)):
+            self.assertSameConfiguration(trajectory.configuration[i],
+                                         self.configurations[i])
+        atom = self.universe.atomList()[0]
+        pt = trajectory.readParticleTrajectory(atom)
+        self.assert_((pt[2]-self.configurations[2][atom]).length() < 1.e-5)
+        self.assertRaises(ValueError, DCDTrajectory,
+                          self.universe, 'test.dcd', order[:-1])
+
+    def test_slicing(self):
+        writeDCD(self.configurations, 'test.dcd', 1./Units.Ang)
+        trajectory = DCDTrajectory(self.universe, 'test.dcd')
+        for indices in [slice(1, 4), slice(0, 5, 2)]:
+            steps = range(5)[indices]
+            sub = trajectory[indices]
+            self.assertEqual(len(sub), len(steps))
+            for i, step in enumerate(steps):
+                self.assertSameConfiguration(sub[i]['configuration'],
+                                             self.configurations[step])
+                self.assertSameConfiguration(sub.configuration[i],
+                                             self.configurations[step])
+            configurations = trajectory.configuration[indices]
+            self.assertEqual(len(configurations), len(steps))
+            for i, step in enumerate(steps):
+                self.assertSameConfiguration(configurations[i],
+                                             self.configurations[step])
+        sub = trajectory[1:5][::2]
+        self.assertEqual(len(sub), 2)
+        self.assertSameConfiguration(sub[1]['configuration'],
+                                     self.configurations[3])
+
+    def test_unit_cell(self):
+        universe = OrthorhombicPeriodicUniverse((2., 3., 4.))
+        for i in range(4):
+            universe.addObject(Atom('Ar', position=Vector(0.3*i, 0.2, 0.1)))
+        frames = N.array([universe.configuration().array/Units.Ang
+                          + 0.1*i for i in range(3)])
+        cells = [(20.+i, 30.+i, 40.+i) for i in range(3)]
+        writeCharmmDCD('test.dcd', frames, cells)
+        trajectory = DCDTrajectory(universe, 'test.dcd')
+        self.assert_('box_size' in trajectory.variables())
+        box_size = trajectory.box_size
+        self.assertEqual(box_size.shape, (3, 3))
+        for i in range(3):
+            expected = N.array(cells[i])*Units.Ang
+            self.assert_(N.maximum.reduce(N.fabs(box_size[i]-expected))
+                         < 1.e-10)
+            data = trajectory[i]
+            self.assert_(N.maximum.reduce(N.fabs(data['box_size']-expected))
+                         < 1.e-10)
+            conf = data['configuration']
+            self.assert_(N.maximum.reduce(N.fabs(conf.cell_parameters
+                                                 - expected)) < 1.e-10)
+            d = N.ravel(conf.array - frames[i]*Units.Ang)
+            self.assert_(N.maximum.reduce(N.fabs(d)) < 1.e-5)
+        trajectory.close()
+        # Files without unit cell data have no variable box_size
+        writeCharmmDCD('test.dcd', frames)
+        trajectory = DCDTrajectory(universe, 'test.dcd')
+        self.assert_('box_size' not in trajectory.variables())
+        trajectory.close()
+
+    def test_fixed_atoms(self):
+        frames = N.array([self.configurations[0].array/Units.Ang])
+        writeCharmmDCD('test.dcd', frames, fixed=2)
+        self.assertRaises(ValueError, DCDTrajectory,
+                          self.universe, 'test.dcd')
+
+
+class DCDOutputTest(unittest.TestCase):
+
+    """
+    Compare the DCD output with the writer in Src/ReadDCD.c
+    """
+
+    def setUp(self):
+        self.universe = InfiniteUniverse()
+        self.universe.addObject(Protein('bala1'))
+        self.configurations = []
+        for i in range(5):
+            self.configurations.append(self.universe.copyConfiguration())
+            self.universe.translateBy(Vector(0.1, -0.05, 0.2))
+            self.universe.rotateAroundOrigin(Vector(0., 0., 1.), 0.3)
+
+    def tearDown(self):
+        for filename in ['test.dcd', 'test.nc']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def referenceFile(self, atom_order):
+        natoms = len(atom_order)
+        fd = MMTK_DCD.writeOpenDCD('test.dcd', natoms,
+                                   len(self.configurations), 0, 1, 0.1)
+        for conf in self.configurations:
+            array = (1./Units.Ang)*conf.array
+            x, y, z = [N.take(array[:, i], atom_order).astype(N.Float32)
+                       for i in range(3)]
+            MMTK_DCD.writeDCDStep(fd, x, y, z)
+        MMTK_DCD.writeCloseDCD(fd)
+        return open('test.dcd', 'rb').read()
+
+    def test_identical_files(self):
+        natoms = self.universe.numberOfAtoms()
+        for atom_order in [range(natoms), range(natoms)[::-2]]:
+            reference = self.referenceFile(atom_order)
+            writeDCD(self.configurations, 'test.dcd', 1./Units.Ang,
+                     atom_order)
+            data = open('test.dcd', 'rb').read()
+            self.assertEqual(len(data), len(reference))
+            # The second title record contains the date, which changes
+            # at midnight. It occupies bytes 180 to 260.
+            self.assertEqual(data[:180], reference[:180])
+            self.assertEqual(data[260:], reference[260:])
+
+    def test_trajectory(self):
+        trajectory = Trajectory(self.universe, 'test.nc', 'w')
+        snapshot = SnapshotGenerator(self.universe,
+                                     actions=[TrajectoryOutput(trajectory,
+                                              ['configuration', 'time'],
+                                              0, None, 1)])
+        for i, conf in enumerate(self.configurations):
+            self.universe.setConfiguration(conf)
+            snapshot(data={'time': 0.5*i})
+        trajectory.close()
+        trajectory = Trajectory(self.universe, 'test.nc')
+        writeTrajectoryDCD(trajectory, 'test.dcd', first=1, skip=2)
+        dcd = DCDTrajectory(self.universe, 'test.dcd')
+        self.assertEqual(len(dcd), 2)
+        self.assertAlmostEqual(dcd.time[1]-dcd.time[0], 1., 5)
+        for i, step in enumerate([1, 3]):
+            d = N.ravel(dcd.configuration[i].array
+                        - self.configurations[step].array)
+            self.assert_(N.maximum.reduce(N.fabs(d)) < 1.e-5)
+        dcd.close()
+        trajectory.close()
+
+
+def suite():
+    loader = unittest.TestLoader()
+    s = unittest.TestSuite()
+    s.addTest(loader.loadTestsFromTestCase(DCDTrajectoryTest))
+    s.addTest(loader.loadTestsFromTestCase(DCDOutputTest))
+    return s
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,401 @@
+# Molecular dynamics tests
+#
+# Written by Konrad Hinsen
+#
+
+import unittest
+from MMTK import *
+from MMTK.ForceFields import Amber99ForceField
+from MMTK.Dynamics import VelocityVerletIntegrator, RESPAIntegrator, \
+                          LangevinIntegrator, TranslationRemover
+from MMTK.ReplicaExchange import ReplicaExchange
+from MMTK.Trajectory import Trajectory, TrajectoryOutput, LogOutput, \
+                            BatchedAction
+from MMTK import Dynamics, Environment
+from Scientific import N
+from cStringIO import StringIO
+import MMTK_dynamics
+import os
+
+class RESPATest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse(Amber99ForceField())
+        self.universe.water1 = Molecule('water', position=Vector(0.15, 0., 0.))
+        self.universe.water2 = Molecule('water', position=Vector(-0.15, 0., 0.))
+        self.universe.initializeVelocitiesToTemperature(300.*Units.K)
+
+    def tearDown(self):
+        if os.path.exists('test.nc'):
+            os.remove('test.nc')
+
+    def test_split_evaluator(self):
+        terms = self.universe.energyTerms()
+        evaluator = self.universe.energyEvaluator()
+        fast, slow = evaluator.splitCEvaluator(['nonbonded list summation'])
+        x = self.universe.configuration().array
+        g1 = ParticleVector(self.universe)
+        g2 = ParticleVector(self.universe)
+        e1 = fast(x, g1.array, None, False)
+        e2 = slow(x, g2.array, None, False)
+        e, g = self.universe.energyAndGradients()
+        self.assertAlmostEqual(e1+e2, e, 10)
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         g1.array+g2.array-g.array))) < 1.e-10)
+        self.assertRaises(ValueError, evaluator.splitCEvaluator,
+                          ['no such term'])
+        # The full evaluator is not affected by the split
+        for name, value in self.universe.energyTerms().items():
+            self.assertAlmostEqual(value, terms[name], 10)
+
+    def test_single_inner_step(self):
+        # With one inner step, RESPA is the Velocity-Verlet integrator
+        conf = copy(self.universe.configuration())
+        vel = copy(self.universe.velocities())
+        VelocityVerletIntegrator(self.universe, delta_t=0.5*Units.fs)(steps=20)
+        x1 = copy(self.universe.configuration())
+        v1 = copy(self.universe.velocities())
+        self.universe.setConfiguration(conf)
+        self.universe.setVelocities(vel)
+        RESPAIntegrator(self.universe, delta_t=0.5*Units.fs, inner_steps=1,
+                        slow_terms=['nonbonded list summation'])(steps=20)
+        x2 = self.universe.configuration()
+        v2 = self.universe.velocities()
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         x1.array-x2.array))) < 1.e-10)
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         v1.array-v2.array))) < 1.e-8)
+
+    def test_energy_conservation(self):
+        integrator = RESPAIntegrator(self.universe, delta_t=1.*Units.fs,
+                                     inner_steps=4,
+                                     slow_terms=['nonbonded list summation'])
+        integrator(steps=100)
+        e0 = self.universe.energy() + self.universe.kineticEnergy()
+        integrator(steps=100)
+        e1 = self.universe.energy() + self.universe.kineticEnergy()
+        self.assert_(abs(e1-e0) < 0.05*abs(self.universe.kineticEnergy()))
+
+    def test_single_inner_step_thermostat(self):
+        # With one inner step, RESPA with a thermostat is the
+        # Velocity-Verlet integrator with the same thermostat
+        self.universe.thermostat = Environment.NoseThermostat(300.*Units.K)
+        conf = copy(self.universe.configuration())
+        vel = copy(self.universe.velocities())
+        t_coordinates = copy(self.universe.thermostat.coordinates)
+        VelocityVerletIntegrator(self.universe, delta_t=0.5*Units.fs)(steps=20)
+        x1 = copy(self.universe.configuration())
+        v1 = copy(self.universe.velocities())
+        t1 = copy(self.universe.thermostat.coordinates)
+        self.universe.setConfiguration(conf)
+        self.universe.setVelocities(vel)
+        self.universe.thermostat.coordinates[:] = t_coordinates
+        RESPAIntegrator(self.universe, delta_t=0.5*Units.fs, inner_steps=1,
+                        slow_terms=['nonbonded list summation'])(steps=20)
+        x2 = self.universe.configuration()
+        v2 = self.universe.velocities()
+        t2 = self.universe.thermostat.coordinates
+        self.assert_(N.maximum.reduce(N.fabs(t1-t_coordinates)) > 0.)
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         x1.array-x2.array))) < 1.e-10)
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         v1.array-v2.array))) < 1.e-8)
+        self.assert_(N.maximum.reduce(N.fabs(t1-t2)) < 1.e-8)
+
+    def _conservedEnergy(self, universe, steps):
+        # Run RESPA and return the conserved energy, the kinetic energy,
+        # and the thermostat/barostat energy at each step
+        trajectory = Trajectory(universe, 'test.nc', 'w')
+        RESPAIntegrator(universe, delta_t=1.*Units.fs, inner_steps=4,
+                        slow_terms=['nonbonded list summation'])(
+            steps=steps,
+            actions=[TrajectoryOutput(trajectory, ['energy'], 0, None, 1)])
+        trajectory.close()
+        trajectory = Trajectory(None, 'test.nc')
+        kinetic = trajectory.kinetic_energy
+        extended = N.zeros((len(trajectory),), N.Float)
+        for name in ['nose_energy', 'andersen_energy']:
+            if name in trajectory.variables():
+                extended = extended + getattr(trajectory, name)
+        total = trajectory.potential_energy + kinetic + extended
+        trajectory.close()
+        return total, kinetic, extended
+
+    def _checkConservation(self, universe):
+        universe.initializeVelocitiesToTemperature(300.*Units.K)
+        total, kinetic, extended = self._conservedEnergy(universe, 200)
+        # The thermostat or barostat must be active
+        self.assert_(N.maximum.reduce(N.fabs(extended-extended[0]))
+                     > 1.e-3*N.add.reduce(kinetic)/len(kinetic))
+        self.assert_(N.maximum.reduce(total)-N.minimum.reduce(total)
+                     < 0.05*N.add.reduce(kinetic)/len(kinetic))
+
+    def test_thermostat(self):
+        self.universe.thermostat = Environment.NoseThermostat(350.*Units.K,
+                                                              0.05*Units.ps)
+        self._checkConservation(self.universe)
+
+    def test_barostat(self):
+        universe = OrthorhombicPeriodicUniverse((1.2, 1.2, 1.2),
+                                                Amber99ForceField(0.5, 0.5))
+        for i in range(2):
+            for j in range(2):
+                for k in range(2):
+                    universe.addObject(Molecule('water',
+                                       position=Vector(0.6*i, 0.6*j, 0.6*k)))
+        universe.barostat = Environment.AndersenBarostat(100.*Units.atm,
+                                                         0.1*Units.ps)
+        volume = universe.cellVolume()
+        self._checkConservation(universe)
+        self.assert_(abs(universe.cellVolume()-volume) > 0.)
+
+class LangevinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse(Amber99ForceField())
+        self.universe.water1 = Molecule('water', position=Vector(0.15, 0., 0.))
+        self.universe.water2 = Molecule('water', position=Vector(-0.15, 0., 0.))
+        self.universe.initializeVelocitiesToTemperature(300.*Units.K)
+        self.friction = self.universe.masses()*(10./Units.ps)
+
+    def _run(self, **options):
+        conf = copy(self.universe.configuration())
+        vel = copy(self.universe.velocities())
+        options.setdefault('friction', self.friction)
+        LangevinIntegrator(self.universe, seed=42, **options)(steps=10)
+        result = copy(self.universe.configuration())
+        self.universe.setConfiguration(conf)
+        self.universe.setVelocities(vel)
+        return result
+
+    def test_threads(self):
+        # The random forces do not depend on the number of threads
+        x1 = self._run(threads=1)
+        x2 = self._run(threads=3)
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         x1.array-x2.array))) < 1.e-8)
+
+    def test_default_friction(self):
+        # Atoms without a friction attribute get the mass times
+        # the collision frequency
+        x1 = self._run(friction=None, collision_frequency=5./Units.ps)
+        x2 = self._run(friction=self.universe.masses()*(5./Units.ps))
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         x1.array-x2.array))) < 1.e-12)
+        self.universe.water1.O.friction = 0.
+        x3 = self._run(friction=None, collision_frequency=5./Units.ps)
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         x1.array-x3.array))) > 0.)
+        del self.universe.water1.O.friction
+
+    def test_zero_friction(self):
+        # Without friction, the integrator is equivalent to Velocity-Verlet
+        conf = copy(self.universe.configuration())
+        vel = copy(self.universe.velocities())
+        LangevinIntegrator(self.universe, friction=0., seed=42)(steps=10)
+        x1 = copy(self.universe.configuration())
+        self.universe.setConfiguration(conf)
+        self.universe.setVelocities(vel)
+        VelocityVerletIntegrator(self.universe)(steps=10)
+        x2 = self.universe.configuration()
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         x1.array-x2.array))) < 1.e-8)
+
+    def test_constraints(self):
+        self.universe.setBondConstraints()
+        self.universe.initializeVelocitiesToTemperature(300.*Units.K)
+        LangevinIntegrator(self.universe, friction=self.friction,
+                           seed=1)(steps=20)
+        for a1, a2, d in self.universe.distanceConstraintList():
+            self.assertAlmostEqual(self.universe.distance(a1, a2), d, 6)
+
+class ConstraintSolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse(Amber99ForceField())
+        for i in range(4):
+            self.universe.addObject(Molecule('water',
+                                             position=Vector(0.3*i, 0., 0.)))
+        self.universe.setBondConstraints()
+        self.universe.initializeVelocitiesToTemperature(300.*Units.K)
+
+    def _checkConstraints(self):
+        for a1, a2, d in self.universe.distanceConstraintList():
+            self.assertAlmostEqual(self.universe.distance(a1, a2), d, 6)
+
+    def test_enforce(self):
+        conf = copy(self.universe.configuration())
+        for solver in ['shake', 'lincs']:
+            self.universe.setConfiguration(conf)
+            x = self.universe.configuration()
+            x.array[:] += 0.005*N.sin(N.arange(3*len(x.array))
+                                      ).reshape(x.array.shape)
+            self.universe.enforceConstraints(solver=solver, threads=2)
+            self._checkConstraints()
+        self.assertRaises(ValueError, self.universe.enforceConstraints,
+                          solver='no such solver')
+
+    def test_dynamics(self):
+        conf = copy(self.universe.configuration())
+        vel = copy(self.universe.velocities())
+        VelocityVerletIntegrator(self.universe, threads=2,
+                                 constraint_solver='lincs')(steps=20)
+        self._checkConstraints()
+        x1 = copy(self.universe.configuration())
+        self.universe.setConfiguration(conf)
+        self.universe.setVelocities(vel)
+        VelocityVerletIntegrator(self.universe,
+                                 constraint_solver='shake')(steps=20)
+        x2 = self.universe.configuration()
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                         x1.array-x2.array))) < 1.e-6)
+
+    def test_performance(self):
+        log = StringIO()
+        integrator = VelocityVerletIntegrator(self.universe)
+        integrator(steps=20, actions=[LogOutput(log, ['performance'],
+                                                0, None, 10)])
+        self.assertEqual(log.getvalue().count('ns/day'), 3)
+        performance = integrator.performance
+        self.assertEqual(performance['steps'], 20)
+        self.assert_(performance['ns_per_day'] > 0.)
+        total = sum([performance[phase]
+                     for phase in ['forces', 'constraints', 'thermostat',
+                                   'output', 'integration']])
+        self.assertAlmostEqual(total, 100., 6)
+
+    def test_settle(self):
+        universe = InfiniteUniverse(Amber99ForceField())
+        for i in range(4):
+            universe.addObject(Molecule('water',
+                                        position=Vector(0.3*i, 0., 0.)))
+        for o in universe.objectList():
+            o.setRigidBodyConstraints(universe)
+        # All water molecules are handled by SETTLE, with the oxygen
+        # at the apex
+        constraints, const_distances_sq, c_blocks = \
+                     Dynamics._constraintArrays(universe)
+        masses = universe.masses().array
+        apex = MMTK_dynamics.rigidTriangles(masses, constraints,
+                                            const_distances_sq, c_blocks)
+        self.assertEqual(apex, [o.O.index for o in universe.objectList()])
+        # Different hydrogen masses rule out SETTLE
+        masses = N.array(masses)
+        masses[universe.objectList()[1].H1.index] *= 2.
+        apex = MMTK_dynamics.rigidTriangles(masses, constraints,
+                                            const_distances_sq, c_blocks)
+        self.assertEqual(apex[1], -1)
+        self.assertEqual(apex[2], universe.objectList()[2].O.index)
+        universe.initializeVelocitiesToTemperature(300.*Units.K)
+        integrator = VelocityVerletIntegrator(universe, delta_t=1.*Units.fs)
+        integrator(steps=20)
+        e0 = universe.energy() + universe.kineticEnergy()
+        integrator(steps=100)
+        e1 = universe.energy() + universe.kineticEnergy()
+        for a1, a2, d in universe.distanceConstraintList():
+            self.assertAlmostEqual(universe.distance(a1, a2), d, 8)
+        self.assert_(abs(e1-e0) < 0.05*abs(universe.kineticEnergy()))
+
+class TrajectoryActionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse(Amber99ForceField())
+        self.universe.water1 = Molecule('water', position=Vector(0.15, 0., 0.))
+        self.universe.water2 = Molecule('water', position=Vector(-0.15, 0., 0.))
+        self.universe.initializeVelocitiesToTemperature(300.*Units.K)
+
+    def test_translation_remover(self):
+        integrator = VelocityVerletIntegrator(self.universe)
+        integrator(steps=10, actions=[TranslationRemover(0, None, 5)])
+        p = self.universe.momentum()
+        self.assert_(p.length() < 1.e-10)
+
+    def test_batched_action(self):
+        batches = []
+        def collect(steps, data):
+            batches.append((N.array(steps),
+                            N.array(data['configuration']),
+                            N.array(data['time'])))
+        integrator = VelocityVerletIntegrator(self.universe)
+        integrator(steps=20,
+                   actions=[BatchedAction(collect,
+                                          ['configuration', 'time'],
+                                          4, 0, None, 2)])
+        self.assertEqual([len(b[0]) for b in batches], [4, 4, 3])
+        steps = N.concatenate([b[0] for b in batches])
+        self.assertEqual(list(steps), range(0, 21, 2))
+        self.assertEqual(batches[-1][1].shape,
+                         (3, self.universe.numberOfAtoms(), 3))
+        x = self.universe.configuration().array
+        self.assert_(N.maximum.reduce(N.ravel(N.fabs(
+                         batches[-1][1][-1]-x))) < 1.e-12)
+        self.assertAlmostEqual(batches[-1][2][-1], 20.*Units.fs, 10)
+
+
+class ReplicaExchangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse(Amber99ForceField())
+        self.universe.water1 = Molecule('water', position=Vector(0.15, 0., 0.))
+        self.universe.water2 = Molecule('water', position=Vector(-0.15, 0., 0.))
+        self.temperatures = [300.*Units.K, 320.*Units.K, 340.*Units.K]
+
+    def tearDown(self):
+        for filename in ['rex_0.nc', 'rex_1.nc', 'rex_2.nc',
+                         'rex.log', 'rex.restart']:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_exchange(self):
+        rex = ReplicaExchange(self.universe, self.temperatures,
+                              steps=20, skip=10, seed=1,
+                              trajectory='rex_%d.nc', log='rex.log',
+                              restart='rex.restart')
+        rex(cycles=4)
+        self.assertEqual(sorted(rex.walkers), range(3))
+        lines = [l for l in open('rex.log') if not l.startswith('#')]
+        self.assertEqual(len(lines), 4)
+        for replica in rex.replicas:
+            self.assert_(replica.environmentObjectList(
+                                     Environment.NoseThermostat))
+        self.assert_(self.universe.velocities() is None)
+        trajectory = Trajectory(None, 'rex_0.nc')
+        self.assertEqual(len(trajectory), 9)
+        trajectory.close()
+
+    def test_restart(self):
+        rex = ReplicaExchange(self.universe, self.temperatures,
+                              steps=20, skip=10, seed=1, parallel=False,
+                              trajectory='rex_%d.nc', restart='rex.restart')
+        rex(cycles=2)
+        walkers = rex.walkers
+        x = copy(rex.replicas[1].configuration())
+        restarted = ReplicaExchange(self.universe, self.temperatures,
+                                    steps=20, skip=10,
+                                    trajectory='rex_%d.nc')
+        restarted.readRestart('rex.restart')
+        self.assertEqual(restarted.cycle, 2)
+        self.assertEqual(restarted.walkers, walkers)
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                        restarted.replicas[1].configuration().array
+                        - x.array))) < 1.e-12)
+        restarted(cycles=1)
+        trajectory = Trajectory(None, 'rex_1.nc')
+        self.assertEqual(len(trajectory), 7)
+        trajectory.close()
+        self.assertRaises(ValueError, ReplicaExchange(self.universe,
+                                  self.temperatures[:2]).readRestart,
+                          'rex.restart')
+
+def suite():
+    loader = unittest.TestLoader()
+    s = unittest.TestSuite()
+    s.addTest(loader.loadTestsFromTestCase(RESPATest))
+    s.addTest(loader.loadTestsFromTestCase(LangevinTest))
+    s.addTest(loader.loadTestsFromTestCase(ConstraintSolverTest))
+    s.addTest(loader.loadTestsFromTestCase(TrajectoryActionTest))
+    s.addTest(loader.loadTestsFromTestCase(ReplicaExchangeTest))
+    return s
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,8 @@ from MMTK.Utility import pairs
 from Scientific.Geometry import ex, ey, ez
 from Scientific import N
 from cStringIO import StringIO
-import itertools
+from distutils.spawn import find_executable
+import itertools, os, subprocess
 
 factory = MoleculeFactory()
 factory.createGroup('dihedral_test')
@@ -223,6 +224,108 @@ class LennardJonesSubsetTest(unittest.TestCase,
         self.subset1 = Collection(self.universe.atomList()[:10])
         self.subset2 = Collection(self.universe.atomList()[20:30])
 
+
+class ProcessPoolTest(unittest.TestCase):
+
+    """
+    Compare energy evaluation by several processes with a serial one
+    """
+
+    def setUp(self):
+        self.universe = OrthorhombicPeriodicUniverse((2., 2., 2.),
+                                                     LennardJonesForceField())
+        for point in SCLattice(0.5, 4):
+            p = point + randomPointInBox(0.1)
+            self.universe.addObject(Atom('Ar', position=p))
+
+    def test_processes(self):
+        serial = self.universe.energyEvaluator(threads=1, processes=1)
+        e1, g1 = serial(gradients=True)
+        for np in [2, 3]:
+            parallel = self.universe.energyEvaluator(threads=1, processes=np)
+            for i in range(2):
+                e2, g2 = parallel(gradients=True)
+                self.assertAlmostEqual(e1, e2, 10)
+                self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                                 g1.array-g2.array))) < 1.e-10)
+            self.universe.translateBy(Vector(0.01, 0., 0.))
+            e1, g1 = serial(gradients=True)
+            e2 = parallel()
+            self.assertAlmostEqual(e1, e2, 10)
+
+    def test_invalid_combination(self):
+        self.assertRaises(ValueError, self.universe.energyEvaluator,
+                          threads=2, processes=2)
+
+
+class ThreadLoadTest(unittest.TestCase):
+
+    """
+    Check the distribution of nonbonded pairs over threads for an
+    inhomogeneous system
+    """
+
+    def setUp(self):
+        self.universe = OrthorhombicPeriodicUniverse((4., 4., 4.),
+                                                     LennardJonesForceField(0.8))
+        for point in SCLattice(0.35, 5):
+            self.universe.addObject(Atom('Ar', position=point))
+        for point in SCLattice(1., 4):
+            self.universe.addObject(Atom('Ar', position=point
+                                                 + Vector(2.1, 0.1, 0.1)))
+
+    def test_threads(self):
+        serial = self.universe.energyEvaluator(threads=1)
+        e1, g1 = serial(gradients=True)
+        total = serial.loadStatistics()[0][0]
+        parallel = self.universe.energyEvaluator(threads=3)
+        for i in range(2):
+            e2, g2 = parallel(gradients=True)
+            self.assertAlmostEqual(e1, e2, 10)
+            self.assert_(N.maximum.reduce(N.fabs(N.ravel(
+                             g1.array-g2.array))) < 1.e-10)
+            load = parallel.loadStatistics()
+            self.assertEqual(len(load), 3)
+            pairs = [p for p, t in load]
+            self.assertEqual(sum(pairs), total)
+            self.assert_(max(pairs) < 0.5*total)
+
+
+class DomainDecompositionTest(unittest.TestCase):
+
+    """
+    Check the argument validation for domain decomposition, and
+    compare with replicated data if MPI is available
+    """
+
+    def test_requires_mpi(self):
+        universe = OrthorhombicPeriodicUniverse((2., 2., 2.),
+                                                LennardJonesForceField(0.8))
+        for point in SCLattice(0.5, 4):
+            universe.addObject(Atom('Ar', position=point))
+        self.assertRaises(ValueError, universe.energyEvaluator,
+                          threads=1, domain_decomposition=0.1)
+        self.assertRaises(ValueError, universe.energyEvaluator,
+                          threads=1, domain_decomposition=-0.1)
+
+    def test_replicated_data(self):
+        mpirun = find_executable('mpirun')
+        mpipython = find_executable('mpipython')
+        if mpirun is None or mpipython is None:
+            self.skipTest("mpirun or mpipython not available")
+        try:
+            import Scientific.MPI
+        except ImportError:
+            self.skipTest("Scientific.MPI not available")
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'mpi_domains.py')
+        process = subprocess.Popen([mpirun, '-np', '2', mpipython, script],
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        for difference in output.split()[-2:]:
+            self.assert_(float(difference) < 1.e-8)
+
             
 def suite():
     loader = unittest.TestLoader()
@@ -232,6 +335,9 @@ def suite():
     s.addTest(loader.loadTestsFromTestCase(OrthorhombicUniverseNonbondedListTest))
     s.addTest(loader.loadTestsFromTestCase(ParallelepipedicUniverseNonbondedListTest))
     s.addTest(loader.loadTestsFromTestCase(LennardJonesSubsetTest))
+    s.addTest(loader.loadTestsFromTestCase(ProcessPoolTest))
+    s.addTest(loader.loadTestsFromTestCase(ThreadLoadTest))
+    s.addTest(loader.loadTestsFromTestCase(DomainDecompositionTest))
     return s
 
 
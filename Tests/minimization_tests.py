@@ -0,0 +1,115 @@
+# Energy minimization tests
+#
+# Written by Konrad Hinsen
+#
+
+import unittest
+from MMTK import *
+from MMTK.ForceFields import Amber99ForceField
+from MMTK.Minimization import ConjugateGradientMinimizer, LBFGSMinimizer, \
+                             FIREMinimizer
+from MMTK.Trajectory import Trajectory, TrajectoryOutput, LogOutput
+from Scientific import N
+from cStringIO import StringIO
+import os
+
+class LBFGSTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse(Amber99ForceField())
+        self.universe.water1 = Molecule('water', position=Vector(0.15, 0., 0.))
+        self.universe.water2 = Molecule('water', position=Vector(-0.15, 0., 0.))
+
+    def tearDown(self):
+        if os.path.exists('test.nc'):
+            os.remove('test.nc')
+
+    def _gradientNorm(self):
+        e, g = self.universe.energyAndGradients()
+        return N.sqrt(N.add.reduce(N.ravel(g.array*g.array))
+                      /self.universe.numberOfAtoms())
+
+    def test_convergence(self):
+        conf = copy(self.universe.configuration())
+        convergence = 1.e-3*Units.kJ/(Units.mol*Units.nm)
+        ConjugateGradientMinimizer(self.universe,
+                                   convergence=convergence)(steps=1000)
+        e_cg = self.universe.energy()
+        self.universe.setConfiguration(conf)
+        log = StringIO()
+        LBFGSMinimizer(self.universe, convergence=convergence,
+                       history=5)(steps=1000,
+                                  actions=[LogOutput(log, ['energy'])])
+        self.assert_(self._gradientNorm() < convergence)
+        self.assertAlmostEqual(self.universe.energy(), e_cg, 4)
+        self.assert_('L-BFGS' in log.getvalue())
+
+    def test_short_history(self):
+        # With a history shorter than the minimization, every step
+        # must still go downhill
+        trajectory = Trajectory(self.universe, 'test.nc', 'w')
+        LBFGSMinimizer(self.universe, history=2)(
+            steps=50,
+            actions=[TrajectoryOutput(trajectory,
+                                      ['configuration', 'gradients',
+                                       'energy'], 0, None, 1)])
+        trajectory.close()
+        trajectory = Trajectory(self.universe, 'test.nc')
+        self.assert_(len(trajectory) > 5)
+        energy = trajectory.potential_energy
+        for i in range(len(trajectory)-1):
+            step = N.ravel(trajectory.configuration[i+1].array
+                           - trajectory.configuration[i].array)
+            if N.maximum.reduce(N.fabs(step)) == 0.:
+                continue
+            g = N.ravel(trajectory.gradients[i].array)
+            self.assert_(N.dot(g, step) < 0.)
+            self.assert_(energy[i+1] < energy[i])
+        trajectory.close()
+
+    def test_fixed_atoms(self):
+        atom = self.universe.water1.O
+        atom.fixed = True
+        position = atom.position()
+        LBFGSMinimizer(self.universe)(steps=50)
+        self.assert_((atom.position()-position).length() < 1.e-12)
+        self.assertRaises(ValueError, LBFGSMinimizer(self.universe),
+                          history=0)
+
+class FIRETest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse(Amber99ForceField())
+        self.universe.water1 = Molecule('water', position=Vector(0.1, 0., 0.))
+        self.universe.water2 = Molecule('water', position=Vector(-0.1, 0., 0.))
+
+    def test_bad_contact(self):
+        e0 = self.universe.energy()
+        x0 = copy(self.universe.configuration())
+        step_size = 0.05*Units.Ang
+        minimizer = FIREMinimizer(self.universe, step_size=step_size)
+        minimizer(steps=1)
+        dx = self.universe.configuration().array-x0.array
+        self.assert_(N.maximum.reduce(N.sqrt(N.add.reduce(dx*dx, 1)))
+                     <= 1.000001*step_size)
+        minimizer(steps=500)
+        self.assert_(self.universe.energy() < e0)
+
+    def test_constraints(self):
+        self.universe.setBondConstraints()
+        self.universe.water1.O.fixed = True
+        self.assertRaises(ValueError, FIREMinimizer(self.universe), steps=10)
+        self.universe.water1.O.fixed = False
+        FIREMinimizer(self.universe, constraint_solver='lincs')(steps=200)
+        for a1, a2, d in self.universe.distanceConstraintList():
+            self.assertAlmostEqual(self.universe.distance(a1, a2), d, 6)
+
+def suite():
+    loader = unittest.TestLoader()
+    s = unittest.TestSuite()
+    s.addTest(loader.loadTestsFromTestCase(LBFGSTest))
+    s.addTest(loader.loadTestsFromTestCase(FIRETest))
+    return s
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# Comparison of domain decomposition with replicated data, run by
+# energy_tests.DomainDecompositionTest as
+#     mpirun -np 2 mpipython mpi_domains.py
+#
+# Written by Konrad Hinsen
+#
+
+from MMTK import *
+from MMTK.ForceFields import LennardJonesForceField
+from MMTK.ForceFields.Amber.AmberForceField import AmberBondedForceField
+from MMTK.Dynamics import VelocityVerletIntegrator
+from MMTK.Geometry import SCLattice
+from Scientific.MPI import world
+from Scientific import N
+
+def compare(universe, skin):
+    universe.initializeVelocitiesToTemperature(100.*Units.K)
+    world.broadcast(universe.velocities().array, 0)
+    initial = universe.copyConfiguration()
+    initial_velocities = universe.velocities().copy()
+    VelocityVerletIntegrator(universe, delta_t=1.*Units.fs,
+                             mpi_communicator=world,
+                             domain_decomposition=skin)(steps=50)
+    x_dd = N.array(universe.configuration().array)
+    universe.setConfiguration(initial)
+    universe.setVelocities(initial_velocities)
+    VelocityVerletIntegrator(universe, delta_t=1.*Units.fs,
+                             mpi_communicator=world)(steps=50)
+    x_rd = universe.configuration().array
+    return N.maximum.reduce(N.fabs(N.ravel(x_dd-x_rd)))
+
+# Argon: the halo is defined by the cutoff
+argon = OrthorhombicPeriodicUniverse((3., 3., 3.),
+                                     LennardJonesForceField(0.8))
+for point in SCLattice(0.4, 7):
+    argon.addObject(Atom('Ar', position=point-Vector(1.4, 1.4, 1.4)))
+
+# Water without nonbonded interactions: the halo is defined by
+# the bonded terms, which extend further than the skin
+water = OrthorhombicPeriodicUniverse((3., 3., 3.), AmberBondedForceField())
+for point in SCLattice(0.5, 6):
+    water.addObject(Molecule('water', position=point-Vector(1.25, 1.25, 1.25)))
+
+differences = [compare(argon, 0.1), compare(water, 0.01)]
+if world.rank == 0:
+    print ' '.join(['%g' % d for d in differences])
@@ -0,0 +1,328 @@
+# PDB tests
+#
+# Written by Konrad Hinsen
+#
+
+import unittest
+from MMTK import *
+from MMTK import Database, PDB, Utility
+from MMTK.PDB import PDBConfiguration, PDBArrays, PDBOutputFile
+from MMTK.PDBMoleculeFactory import PDBMoleculeFactory, _bondedPairs
+from MMTK.Proteins import Protein
+from Scientific import N
+from cStringIO import StringIO
+import Scientific.IO.PDB
+import copy, os, shutil
+
+def atomRecord(serial, name, residue_name, residue_number, position,
+               alternate=' ', insertion_code=' ', chain_id='A'):
+    x, y, z = position
+    return 'ATOM  %5d %4s%1s%-3s %1s%4d%1s   %8.3f%8.3f%8.3f%6.2f%6.2f' \
+           '          %2s' % (serial, name, alternate, residue_name,
+                              chain_id, residue_number, insertion_code,
+                              x, y, z, 1., 10., name.strip()[0])
+
+glycine = [(' N  ', (0., 0., 0.)), (' CA ', (1.45, 0., 0.)),
+           (' C  ', (2.0, 1.4, 0.)), (' O  ', (1.3, 2.4, 0.))]
+
+def glycines(residues, shift=0., serial=1):
+    # residues is a list of (number, insertion code) pairs
+    lines = []
+    for i, (number, insertion_code) in enumerate(residues):
+        for name, (x, y, z) in glycine:
+            lines.append(atomRecord(serial, name, 'GLY', number,
+                                    (x+3.8*i+shift, y, z),
+                                    insertion_code=insertion_code))
+            serial += 1
+    return lines
+
+multi_model_file = '\n'.join(['MODEL        1']
+                             + glycines([(1, ' '), (2, ' ')])
+                             + ['ENDMDL', 'MODEL        2']
+                             + glycines([(1, ' '), (2, ' ')], shift=1.)
+                             + ['ENDMDL', 'END']) + '\n'
+
+insertion_code_file = '\n'.join(glycines([(9, ' '), (10, ' '), (10, 'A'),
+                                          (11, ' ')])
+                                + ['END']) + '\n'
+
+alternate_file = '\n'.join(
+    glycines([(1, ' ')])
+    + [atomRecord(5, ' N  ', 'GLY', 2, (3.8, 0., 0.), alternate='A'),
+       atomRecord(6, ' N  ', 'GLY', 2, (3.9, 0.1, 0.), alternate='B'),
+       atomRecord(7, ' CA ', 'GLY', 2, (5.25, 0., 0.)),
+       atomRecord(8, ' C  ', 'GLY', 2, (5.8, 1.4, 0.), alternate='A'),
+       atomRecord(9, ' C  ', 'GLY', 2, (5.9, 1.5, 0.), alternate='B'),
+       atomRecord(10, ' O  ', 'GLY', 2, (5.1, 2.4, 0.)),
+       'END']) + '\n'
+
+
+class PDBArraysTest(unittest.TestCase):
+
+    """
+    Test the column-wise reading of atom records
+    """
+
+    def test_multiple_models(self):
+        arrays = PDBArrays(StringIO(multi_model_file))
+        self.assertEqual(arrays.model_numbers, [1, 2])
+        self.assertEqual(len(arrays), 8)
+        self.assertEqual(arrays.positions.shape, (2, 8, 3))
+        shift = arrays.positions[1]-arrays.positions[0]
+        self.assert_(N.maximum.reduce(N.fabs(shift[:, 0]-0.1)) < 1.e-10)
+        self.assert_(N.maximum.reduce(N.fabs(N.ravel(shift[:, 1:]))) < 1.e-10)
+
+    def test_alternate_positions(self):
+        for code, x in [('A', 0.38), ('B', 0.39)]:
+            arrays = PDBArrays(StringIO(alternate_file), code)
+            self.assertEqual(len(arrays), 8)
+            self.assertEqual(list(arrays.alternate), 4*[''] + [code, '',
+                                                               code, ''])
+            self.assertAlmostEqual(arrays.positions[0, 4, 0], x, 10)
+
+    def test_insertion_codes(self):
+        arrays = PDBArrays(StringIO(insertion_code_file))
+        self.assertEqual(list(arrays.residue_number),
+                         4*[9] + 8*[10] + 4*[11])
+        self.assertEqual(list(arrays.insertion_code),
+                         8*[''] + 4*['A'] + 4*[''])
+
+
+class PDBConfigurationTest(unittest.TestCase):
+
+    """
+    Compare the object hierarchy built from PDBArrays with the one
+    built by Scientific.IO.PDB.Structure
+    """
+
+    def compare(self, source, model=0, alternate='A'):
+        conf = PDBConfiguration(source(), model, alternate)
+        reference = Scientific.IO.PDB.Structure(source(), model, alternate)
+        self.assertEqual(len(conf.residues), len(reference.residues))
+        for r1, r2 in zip(conf.residues, reference.residues):
+            self.assertEqual(r1.name, r2.name)
+            self.assertEqual(r1.number, r2.number)
+            self.assertEqual(len(r1), len(r2))
+            for a1, a2 in zip(r1, r2):
+                self.assertEqual(a1.name, a2.name)
+                d = a1.position - a2.position*Units.Ang
+                self.assert_(d.length() < 1.e-10)
+        self.assertEqual(len(conf.peptide_chains),
+                         len(reference.peptide_chains))
+        for c1, c2 in zip(conf.peptide_chains, reference.peptide_chains):
+            self.assertEqual(c1.chain_id, c2.chain_id)
+            self.assertEqual(len(c1), len(c2))
+        self.assertEqual(len(conf.nucleotide_chains),
+                         len(reference.nucleotide_chains))
+        self.assertEqual(sorted(conf.molecules.keys()),
+                         sorted(reference.molecules.keys()))
+        for name in conf.molecules.keys():
+            self.assertEqual(len(conf.molecules[name]),
+                             len(reference.molecules[name]))
+        return conf
+
+    def test_reference_files(self):
+        for filename in ['insulin.pdb', '2YCC.pdb']:
+            path = Database.PDBPath(filename)
+            self.compare(lambda: path)
+
+    def test_multiple_models(self):
+        for model in [0, 1, 2]:
+            conf = self.compare(lambda: StringIO(multi_model_file), model)
+            x = conf.residues[0][0].position[0]
+            if model == 2:
+                self.assertAlmostEqual(x, 0.1, 10)
+            else:
+                self.assertAlmostEqual(x, 0., 10)
+        conf = PDBConfiguration(StringIO(multi_model_file))
+        self.assertEqual(conf.modelPositions().shape, (2, 8, 3))
+
+    def test_alternate_positions(self):
+        for code in ['A', 'B']:
+            self.compare(lambda: StringIO(alternate_file), 0, code)
+
+    def test_insertion_codes(self):
+        self.compare(lambda: StringIO(insertion_code_file))
+
+
+class PDBOutputTest(unittest.TestCase):
+
+    """
+    Write several models and read them back
+    """
+
+    def setUp(self):
+        self.universe = InfiniteUniverse()
+        self.universe.addObject(Protein('bala1'))
+        self.universe.addObject(Molecule('water', position=Vector(1., 0., 0.)))
+        self.configurations = []
+        for i in range(3):
+            self.configurations.append(self.universe.copyConfiguration())
+            self.universe.translateBy(Vector(0.1, -0.05, 0.2))
+            self.universe.rotateAroundOrigin(Vector(0., 0., 1.), 0.3)
+
+    def tearDown(self):
+        if os.path.exists('models.pdb'):
+            os.remove('models.pdb')
+
+    def writeModels(self):
+        pdb = PDBOutputFile('models.pdb')
+        pdb.writeModels(self.universe, self.configurations)
+        natoms = len(pdb.atom_sequence)/len(self.configurations)
+        indices = [a.index for a in pdb.atom_sequence[:natoms]]
+        pdb.close()
+        return indices
+
+    def test_round_trip(self):
+        indices = self.writeModels()
+        self.assertEqual(len(indices), self.universe.numberOfAtoms())
+        positions = PDBConfiguration('models.pdb').modelPositions()
+        self.assertEqual(positions.shape[0], len(self.configurations))
+        for model, conf in zip(positions, self.configurations):
+            d = model - N.take(conf.array, indices)
+            self.assert_(N.maximum.reduce(N.fabs(N.ravel(d))) < 1.e-4)
+
+    def test_undefined_positions(self):
+        # Atoms undefined in the first model must appear in the others
+        first = copy.copy(self.configurations[0])
+        first.array[0] = Utility.undefined
+        self.configurations[0] = first
+        self.writeModels()
+        natoms = self.universe.numberOfAtoms()
+        for model, n in [(1, natoms-1), (2, natoms), (3, natoms)]:
+            conf = PDBConfiguration('models.pdb', model)
+            self.assertEqual(sum([len(r) for r in conf.residues]), n)
+
+
+class PDBObjectCacheTest(unittest.TestCase):
+
+    """
+    Test the on-disk cache for objects constructed from PDB files
+    """
+
+    def setUp(self):
+        self.saved_cache = PDB.object_cache
+        PDB.setCacheDirectory('pdb_cache')
+        PDB.object_cache.clear()
+        self.saved_path = Database.path[:]
+
+    def tearDown(self):
+        PDB.object_cache = self.saved_cache
+        Database.path[:] = self.saved_path
+        for directory in ['pdb_cache', 'test_database']:
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+
+    def entries(self):
+        return [name for name in os.listdir('pdb_cache')
+                if name.endswith('.pickle')]
+
+    def test_retrieve(self):
+        chains = PDBConfiguration('insulin.pdb').createPeptideChains()
+        self.assertEqual(len(self.entries()), 1)
+        cached = PDBConfiguration('insulin.pdb').createPeptideChains()
+        self.assertEqual(len(self.entries()), 1)
+        self.assertEqual(len(cached), len(chains))
+        for chain1, chain2 in zip(chains, cached):
+            self.assert_(chain1 is not chain2)
+            atoms1 = chain1.atomList()
+            atoms2 = chain2.atomList()
+            self.assertEqual(len(atoms1), len(atoms2))
+            for a1, a2 in zip(atoms1, atoms2):
+                self.assertEqual(a1.fullName(), a2.fullName())
+                self.assert_((a1.position()-a2.position()).length()
+                             < 1.e-10)
+        # Different options give different entries
+        PDBConfiguration('insulin.pdb').createPeptideChains('no_hydrogens')
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_modified_hierarchy(self):
+        # Once the residues have been accessed, they may have been
+        # modified, so the cache is bypassed.
+        conf = PDBConfiguration('insulin.pdb')
+        del conf.residues[-1]
+        conf.createPeptideChains()
+        self.assertEqual(self.entries(), [])
+
+    def test_database_change(self):
+        cache = PDB.object_cache
+        filename = cache.filename('0', ('peptide_chains', 'all'))
+        self.assertEqual(cache.filename('0', ('peptide_chains', 'all')),
+                         filename)
+        os.makedirs(os.path.join('test_database', 'Groups'))
+        open(os.path.join('test_database', 'Groups', 'test'), 'w').close()
+        Database.path.insert(0, os.path.abspath('test_database'))
+        self.assertNotEqual(cache.filename('0', ('peptide_chains', 'all')),
+                            filename)
+
+    def test_inactive(self):
+        PDB.setCacheDirectory(None)
+        PDBConfiguration('insulin.pdb').createPeptideChains()
+        self.assertEqual(self.entries(), [])
+
+
+class PairwiseBondFactory(PDBMoleculeFactory):
+
+    # Redefining assumeBond makes bondedPairs test all atom pairs
+    def assumeBond(self, element1, pos1, element2, pos2):
+        return PDBMoleculeFactory.assumeBond(self, element1, pos1,
+                                             element2, pos2)
+
+
+class PDBMoleculeFactoryTest(unittest.TestCase):
+
+    """
+    Compare the grid-based bond search with the pairwise test
+    """
+
+    def setUp(self):
+        text = open(Database.PDBPath('insulin.pdb')).read()
+        lines = [line for line in text.split('\n')
+                 if not line.startswith('CONECT')]
+        self.text = '\n'.join(lines)
+
+    def test_all_pairs(self):
+        conf = PDBConfiguration(StringIO(self.text))
+        factory = PDBMoleculeFactory(conf)
+        atoms = []
+        for residue in conf.residues:
+            atoms.extend(list(residue))
+        elements = [atom.properties['element'] for atom in atoms]
+        positions = N.array([atom.position.array for atom in atoms])
+        grid = [tuple(pair) for pair in
+                _bondedPairs(elements, positions, factory.bond_lengths)]
+        grid.sort()
+        pairwise = []
+        for i in range(len(atoms)):
+            for j in range(i+1, len(atoms)):
+                if factory.assumeBond(elements[i], atoms[i].position,
+                                      elements[j], atoms[j].position):
+                    pairwise.append((i, j))
+        self.assert_(len(pairwise) > 0)
+        self.assertEqual(grid, pairwise)
+
+    def test_molecules(self):
+        grid = PDBMoleculeFactory(PDBConfiguration(StringIO(self.text)))
+        pairwise = PairwiseBondFactory(PDBConfiguration(StringIO(self.text)))
+        molecules1 = grid.retrieveMolecules()
+        molecules2 = pairwise.retrieveMolecules()
+        self.assertEqual(len(molecules1), len(molecules2))
+        for m1, m2 in zip(molecules1, molecules2):
+            bonds1 = [(b.a1.fullName(), b.a2.fullName()) for b in m1.bonds]
+            bonds2 = [(b.a1.fullName(), b.a2.fullName()) for b in m2.bonds]
+            self.assertEqual(bonds1, bonds2)
+
+
+def suite():
+    loader = unittest.TestLoader()
+    s = unittest.TestSuite()
+    s.addTest(loader.loadTestsFromTestCase(PDBArraysTest))
+    s.addTest(loader.loadTestsFromTestCase(PDBConfigurationTest))
+    s.addTest(loader.loadTestsFromTestCase(PDBOutputTest))
+    s.addTest(loader.loadTestsFromTestCase(PDBObjectCacheTest))
+    s.addTest(loader.loadTestsFromTestCase(PDBMoleculeFactoryTest))
+    return s
+
+
+if __name__ == '__main__':
+    unittest.main()
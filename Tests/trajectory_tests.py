@@ -6,9 +6,17 @@
 
 import unittest
 from MMTK import *
-from MMTK.Trajectory import Trajectory, SnapshotGenerator, TrajectoryOutput
+from MMTK import Utility
+from MMTK.Dynamics import VelocityVerletIntegrator
+from MMTK.ForceFields import Amber99ForceField
+from MMTK.Trajectory import Trajectory, SnapshotGenerator, TrajectoryOutput, \
+                            TrajectorySet, transposeTrajectory
 from Scientific import N
-import os
+import operator, os
+
+
+def _positionSum(data):
+    return N.add.reduce(N.ravel(data['configuration'].array))
 
 class InfiniteUniverseTest:
 
@@ -56,10 +64,53 @@ class DoublePrecisionTest:
 class TrajectoryTest:
 
     def tearDown(self):
-        try:
-            os.remove('test.nc')
-        except OSError:
-            pass
+        for filename in ['test.nc', 'test_atoms.nc', 'test.index']:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def _writeTrajectory(self, steps, subset=None, **output_options):
+        transformation = Translation(Vector(0.,0.,0.01)) \
+                         * Rotation(Vector(0.,0.,1.), 1.*Units.deg)
+        trajectory = Trajectory(self.universe, "test.nc", "w",
+                                "trajectory test",
+                                double_precision = self.double_precision,
+                                subset = subset)
+        snapshot = SnapshotGenerator(self.universe,
+                                     actions = [TrajectoryOutput(trajectory,
+                                                                 ["all"],
+                                                                 0, None, 1,
+                                                            **output_options)])
+        snapshot()
+        for i in range(steps):
+            self.universe.setConfiguration(
+                self.universe.contiguousObjectConfiguration())
+            self.universe.applyTransformation(transformation)
+            self.universe.foldCoordinatesIntoBox()
+            snapshot()
+        trajectory.close()
+
+    def test_atom_major(self):
+        self._writeTrajectory(50)
+        trajectory = Trajectory(None, "test.nc")
+        self.assert_(trajectory.atom_major is None)
+        reference = [[trajectory.readParticleTrajectory(a, 3, None, 2,
+                                                        variable).array
+                      for variable in ["configuration", "box_coordinates"]]
+                     for a in trajectory.universe.atomList()]
+        trajectory.close()
+        transposeTrajectory("test.nc")
+        trajectory = Trajectory(None, "test.nc")
+        self.assert_(trajectory.atom_major is not None)
+        for a, data in zip(trajectory.universe.atomList(), reference):
+            for variable, ref in zip(["configuration", "box_coordinates"],
+                                     data):
+                pt = trajectory.readParticleTrajectory(a, 3, None, 2,
+                                                       variable)
+                max_diff = N.maximum.reduce(N.ravel(N.fabs(pt.array-ref)))
+                self.assert_(max_diff < 1.e-5)
+        trajectory.close()
 
     def test_snapshot(self):
 
@@ -103,6 +154,103 @@ class TrajectoryTest:
             self.universe.foldCoordinatesIntoBox()
         trajectory.close()
 
+    def test_async_output(self):
+        initial = self.universe.copyConfiguration()
+        self._writeTrajectory(20)
+        trajectory = Trajectory(None, "test.nc")
+        reference = [trajectory[i]['configuration'].array
+                     for i in range(len(trajectory))]
+        trajectory.close()
+        os.remove("test.nc")
+        self.universe.setConfiguration(initial)
+        self._writeTrajectory(20, buffer_steps=3)
+        trajectory = Trajectory(None, "test.nc")
+        self.assertEqual(len(trajectory), len(reference))
+        for i in range(len(trajectory)):
+            max_diff = N.maximum.reduce(N.ravel(N.fabs(
+                trajectory[i]['configuration'].array - reference[i])))
+            self.assert_(max_diff < self.tolerance)
+        trajectory.close()
+
+    def test_subset_output(self):
+        initial = self.universe.copyConfiguration()
+        self._writeTrajectory(20)
+        trajectory = Trajectory(None, "test.nc")
+        reference = [trajectory[i]['configuration'].array
+                     for i in range(len(trajectory))]
+        reference_pt = [trajectory.readParticleTrajectory(a).array
+                        for a in trajectory.universe.atomList()]
+        trajectory.close()
+        os.remove("test.nc")
+        self.universe.setConfiguration(initial)
+        subset = self.universe.objectList()[1]
+        self._writeTrajectory(20, subset)
+        trajectory = Trajectory(None, "test.nc")
+        self.assertEqual(trajectory.universe.numberOfAtoms(),
+                         self.universe.numberOfAtoms())
+        stored = [a.index for a in subset.atomList()]
+        self.assertEqual(len(trajectory.subset), len(stored))
+        for i in range(len(trajectory)):
+            conf = trajectory[i]['configuration'].array
+            for index in range(len(conf)):
+                if index in stored:
+                    max_diff = N.maximum.reduce(N.fabs(conf[index]
+                                                       - reference[i][index]))
+                    self.assert_(max_diff < self.tolerance)
+                else:
+                    self.assert_(N.minimum.reduce(conf[index])
+                                 > Utility.undefined_limit)
+        for a in trajectory.universe.atomList():
+            if a.index in stored:
+                pt = trajectory.readParticleTrajectory(a)
+                max_diff = N.maximum.reduce(N.ravel(N.fabs(
+                    pt.array - reference_pt[a.index])))
+                self.assert_(max_diff < 1.e-5)
+            else:
+                self.assertRaises(ValueError,
+                                  trajectory.readParticleTrajectory, a)
+        trajectory.close()
+
+    def test_trajectory_set(self):
+        self._writeTrajectory(20)
+        trajectory = Trajectory(None, "test.nc")
+        reference = [trajectory[i]['configuration'].array
+                     for i in range(len(trajectory))]
+        reference = reference + reference[1::2]
+        trajectory.close()
+        filenames = ["test.nc", ("test.nc", 1, None, 2)]
+        for attempt in range(2):
+            trajectory_set = TrajectorySet(None, filenames, "test.index", 1)
+            self.assertEqual(len(trajectory_set), len(reference))
+            self.assertEqual(trajectory_set.locate(22), (1, 1))
+            for i in range(len(trajectory_set)-1, -1, -3):
+                max_diff = N.maximum.reduce(N.ravel(N.fabs(
+                    trajectory_set[i]['configuration'].array - reference[i])))
+                self.assert_(max_diff < self.tolerance)
+            self.assert_(len(trajectory_set._open) <= 1)
+            for atom in trajectory_set.universe.atomList()[:2]:
+                pt = trajectory_set.readParticleTrajectory(atom)
+                self.assertEqual(len(pt.array), len(reference))
+                pt = trajectory_set.readParticleTrajectory(atom, 15, None, 3)
+                self.assertEqual(len(pt.array), len(range(15, len(reference),
+                                                         3)))
+            trajectory_set.close()
+            self.assert_(os.path.exists("test.index"))
+
+    def test_map(self):
+        self._writeTrajectory(30)
+        trajectory = Trajectory(None, "test.nc")
+        reference = [_positionSum(trajectory[i])
+                     for i in range(len(trajectory))]
+        for processes in [1, 2]:
+            results = trajectory.map(_positionSum, chunk_size=7,
+                                     processes=processes)
+            self.assertEqual(results, reference)
+            total = trajectory[5:20].map(_positionSum, operator.add,
+                                         chunk_size=4, processes=processes)
+            self.assert_(abs(total-sum(reference[5:20])) < 1.e-10)
+        trajectory.close()
+
 
 class InfiniteUniverseTestSP(unittest.TestCase,
                              InfiniteUniverseTest,
@@ -146,6 +294,85 @@ class ParallelepipedicUniverseTestDP(unittest.TestCase,
     tearDown = TrajectoryTest.tearDown
 
 
+class AsyncOutputTest(unittest.TestCase):
+
+    """
+    Asynchronous output from an integrator, which produces the steps
+    faster than the writer thread stores them
+    """
+
+    def setUp(self):
+        self.universe = InfiniteUniverse(Amber99ForceField())
+        self.universe.addObject(Molecule('water',
+                                         position = Vector(-0.2, 0., 0.)))
+        self.universe.addObject(Molecule('water',
+                                         position = Vector(0.2, 0., 0.)))
+        self.universe.initializeVelocitiesToTemperature(300.*Units.K)
+        self.configuration = copy(self.universe.configuration())
+        self.velocities = copy(self.universe.velocities())
+
+    def tearDown(self):
+        if os.path.exists("test.nc"):
+            os.remove("test.nc")
+
+    def _run(self, steps, **output_options):
+        self.universe.setConfiguration(self.configuration)
+        self.universe.setVelocities(self.velocities)
+        trajectory = Trajectory(self.universe, "test.nc", "w")
+        output = TrajectoryOutput(trajectory, ["configuration", "time"],
+                                  0, None, 1, **output_options)
+        VelocityVerletIntegrator(self.universe,
+                                 delta_t = 1.*Units.fs)(steps = steps,
+                                                        actions = [output])
+        trajectory.close()
+        trajectory = Trajectory(None, "test.nc")
+        steps = list(trajectory.step)
+        configurations = [trajectory.configuration[i].array
+                          for i in range(len(trajectory))]
+        try:
+            dropped = int(trajectory.trajectory.file.dropped_steps[0])
+        except AttributeError:
+            dropped = 0
+        trajectory.close()
+        os.remove("test.nc")
+        return steps, configurations, dropped
+
+    def _reference(self, steps):
+        reference_steps, reference, dropped = self._run(steps)
+        self.assertEqual(dropped, 0)
+        self.assertEqual(reference_steps, range(len(reference_steps)))
+        return reference_steps, reference
+
+    def _compare(self, configuration, reference):
+        max_diff = N.maximum.reduce(N.ravel(N.fabs(configuration
+                                                   - reference)))
+        self.assert_(max_diff < 1.e-12)
+
+    def test_wait(self):
+        # The buffer wraps around many times, and the integrator waits
+        # whenever it is full. All steps are written in order.
+        reference_steps, reference = self._reference(100)
+        steps, configurations, dropped = self._run(100, buffer_steps = 3)
+        self.assertEqual(dropped, 0)
+        self.assertEqual(steps, reference_steps)
+        for conf, ref in zip(configurations, reference):
+            self._compare(conf, ref)
+
+    def test_drop(self):
+        # Steps that find the buffer full are dropped and counted,
+        # the others are written in order
+        reference_steps, reference = self._reference(200)
+        steps, configurations, dropped = self._run(200, buffer_steps = 1,
+                                                   when_full = 'drop')
+        self.assertEqual(len(steps) + dropped, len(reference_steps))
+        for i in range(len(steps)-1):
+            self.assert_(steps[i+1] > steps[i])
+        for step, conf in zip(steps, configurations):
+            self._compare(conf, reference[step])
+        self.assertRaises(ValueError, TrajectoryOutput, None, ["all"],
+                          when_full = 'block')
+
+
 def suite():
     loader = unittest.TestLoader()
     s = unittest.TestSuite()
@@ -155,6 +382,7 @@ def suite():
     s.addTest(loader.loadTestsFromTestCase(OrthorhombicUniverseTestDP))
     s.addTest(loader.loadTestsFromTestCase(ParallelepipedicUniverseTestSP))
     s.addTest(loader.loadTestsFromTestCase(ParallelepipedicUniverseTestDP))
+    s.addTest(loader.loadTestsFromTestCase(AsyncOutputTest))
     return s
 
 
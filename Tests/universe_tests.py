@@ -5,6 +5,7 @@
 
 import unittest
 from MMTK import *
+from MMTK import Skeleton
 from MMTK.Random import randomPointInBox
 from Scientific import N
 
@@ -100,11 +101,51 @@ class OrthorhombicPeriodicUniverseTest(unittest.TestCase,
         self.universe.addObject(Molecule('water'))
 
 
+class HydrogenMassTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse()
+        self.universe.addObject(Molecule('water'))
+        self.universe.addObject(Molecule('water',
+                                         position=Vector(0.3, 0., 0.)))
+
+    def test_repartitioning(self):
+        m0 = copy(self.universe.masses())
+        self.universe.repartitionHydrogenMasses(3.*Units.amu)
+        m1 = self.universe.masses()
+        self.assertAlmostEqual(N.add.reduce(m1.array),
+                               N.add.reduce(m0.array), 10)
+        for atom in self.universe.atomList():
+            if atom.symbol == 'H':
+                self.assertAlmostEqual(m1[atom], 3., 10)
+        self.assert_('HydrogenMassRepartitioning'
+                     in self.universe.description())
+        self.assertRaises(ValueError,
+                          self.universe.repartitionHydrogenMasses)
+        self.universe.restoreHydrogenMasses()
+        m2 = self.universe.masses()
+        self.assert_(N.maximum.reduce(N.fabs(m2.array-m0.array)) < 1.e-12)
+
+    def test_description(self):
+        # Atoms added after the repartitioning keep their masses
+        # in a universe rebuilt from the description
+        self.universe.repartitionHydrogenMasses(3.*Units.amu)
+        water = Molecule('water', position=Vector(0., 0.3, 0.))
+        self.universe.addObject(water)
+        m1 = self.universe.masses()
+        self.assertAlmostEqual(m1[water.H1], Atom('H').mass(), 10)
+        conf = self.universe.configuration()
+        skeleton = eval(self.universe.description(), vars(Skeleton), {})
+        universe = skeleton.make({}, conf.array)
+        m2 = universe.masses()
+        self.assert_(N.maximum.reduce(N.fabs(m2.array-m1.array)) < 1.e-12)
+
 def suite():
     loader = unittest.TestLoader()
     s = unittest.TestSuite()
     s.addTest(loader.loadTestsFromTestCase(ParallelepipedicPeriodicUniverseTest))
     s.addTest(loader.loadTestsFromTestCase(OrthorhombicPeriodicUniverseTest))
+    s.addTest(loader.loadTestsFromTestCase(HydrogenMassTest))
     return s
 
 
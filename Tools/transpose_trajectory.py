@@ -0,0 +1,17 @@
+# Write the atom-major companion file for one or more trajectories.
+#
+# Usage: python transpose_trajectory.py trajectory.nc [trajectory2.nc ...]
+#
+# The companion file is used automatically by MMTK.Trajectory.Trajectory
+# for reading the trajectories of individual atoms.
+#
+
+from MMTK.Trajectory import transposeTrajectory, atomMajorFilename
+import sys
+
+if len(sys.argv) < 2:
+    sys.stderr.write('No trajectory specified\n')
+    sys.exit(1)
+for filename in sys.argv[1:]:
+    transposeTrajectory(filename)
+    sys.stdout.write('%s -> %s\n' % (filename, atomMajorFilename(filename)))